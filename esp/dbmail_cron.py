@@ -33,7 +33,9 @@
 
 logger.info('dbmail_cron: starting!')
 
-# lock to ensure only one cron instance runs at a time
+# lock to ensure only one cron instance runs at a time.  (This is just to
+# avoid piling up cron runs; for more throughput, run several
+# `manage.py dbmail_worker` processes, which can safely run side by side.)
 lock_file_path = os.path.join(tempfile.gettempdir(), 'espweb.dbmailcron.lock')
 lock_file_handle = open(lock_file_path, 'w')
 try:
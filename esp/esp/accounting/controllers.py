@@ -194,17 +194,23 @@ def donation_lineitemtype(self):
                 return LineItemType.objects.get_or_create(program=self.program, text=other_module.get_setting('donation_text'))[0]
         return None
 
+    def donation_texts(self):
+        # The Stripe module (or, if used, donation module) currently takes care of the donation
+        # optional line item, so ignore it in the optional costs module.
+        texts = []
+        for module_name in ['CreditCardModule_Stripe', 'DonationModule']:
+            other_module = self.program.getModule(module_name)
+            if other_module and other_module.get_setting('offer_donation', default=True):
+                texts.append(other_module.get_setting('donation_text'))
+        return texts
+
     def get_lineitemtypes_Q(self, include_donations=True, required_only=False, optional_only=False, payment_only=False, lineitemtype_id=None):
         if lineitemtype_id:
             return Q(id=lineitemtype_id)
         q_object = Q(program=self.program) & ~Q(text__in=self.finaid_items) # exclude finaid grants and sibling discounts
         if not include_donations:
-            # The Stripe module (or, if used, donation module) currently takes care of the donation
-            # optional line item, so ignore it in the optional costs module.
-            for module_name in ['CreditCardModule_Stripe', 'DonationModule']:
-                other_module = self.program.getModule(module_name)
-                if other_module and other_module.get_setting('offer_donation', default=True):
-                    q_object &= ~Q(text=other_module.get_setting('donation_text'))
+            for text in self.donation_texts():
+                q_object &= ~Q(text=text)
         if required_only:
             q_object &= Q(required=True, for_payments=False)
         elif optional_only:
@@ -268,7 +274,7 @@ def classify_transfer(self, transfer):
             return 'Financial aid'
         elif line_item == self.default_siblingdiscount_lineitemtype():
             return 'Sibling discount'
-        elif transfer.destination == self.default_program_account():
+        elif transfer.destination_id == getattr(self.default_program_account(), 'id', None):
             req_desc = "required" if line_item.required else "optional"
             return "Cost ({})".format(req_desc)
         else:
@@ -669,3 +675,227 @@ def updatePaid(program, user, paid=True, in_full=False):
 
     def __str__(self):
         return 'Accounting for %s at %s' % (self.user.name(), self.program.niceName())
+
+class BatchAccountingController(ProgramAccountingController):
+    """ Accounting for many users of one program at once.
+
+        Answers the same questions as IndividualAccountingController (amount
+        due, financial aid, itemized transfers...) but loads the line item
+        types, transfers, grants and sibling discounts for all of the users
+        up front, in a fixed number of queries.  Use it instead of creating
+        an IndividualAccountingController per user inside a loop, e.g. when
+        printing schedules or receipts for a whole program.
+
+        The per-user methods take the user (or user ID) as their first
+        argument and return lists rather than querysets.
+    """
+
+    def __init__(self, program, users, ensure_required=True, *args, **kwargs):
+        super().__init__(program, *args, **kwargs)
+        self.users = list(users)
+        self.user_ids = [getattr(user, 'id', user) for user in self.users]
+
+        self._lineitemtypes = list(LineItemType.objects.filter(program=program).order_by('id'))
+        self._program_account = Account.objects.filter(program=program).order_by('id').first()
+
+        transfers = Transfer.objects.filter(user__in=self.user_ids).filter(
+            Q(line_item__program=program) | Q(destination=self._program_account)
+        ).select_related('line_item', 'option').order_by('id')
+        self._transfers = {user_id: [] for user_id in self.user_ids}
+        for transfer in transfers:
+            self._transfers[transfer.user_id].append(transfer)
+
+        self._grants = {}
+        for grant in FinancialAidGrant.objects.filter(request__program=program, request__user__in=self.user_ids).select_related('request').order_by('id'):
+            self._grants[grant.request.user_id] = grant
+
+        self._sibling_discounts = set()
+        if program.sibling_discount:
+            seen = set()
+            for info in SplashInfo.objects.filter(program=program, student__in=self.user_ids).order_by('id'):
+                if info.student_id not in seen:
+                    seen.add(info.student_id)
+                    if info.siblingdiscount:
+                        self._sibling_discounts.add(info.student_id)
+
+        if ensure_required:
+            self.ensure_required_transfers()
+
+    ##  Line item types, from memory
+
+    def _latest_lineitemtype(self, predicate):
+        matches = [lit for lit in self._lineitemtypes if predicate(lit)]
+        if matches:
+            return matches[-1]
+        return None
+
+    def default_program_account(self):
+        return self._program_account
+
+    def default_payments_lineitemtype(self):
+        return self._latest_lineitemtype(lambda lit: lit.for_payments)
+
+    def default_finaid_lineitemtype(self):
+        return self._latest_lineitemtype(lambda lit: lit.text == 'Financial aid grant')
+
+    def default_siblingdiscount_lineitemtype(self):
+        return self._latest_lineitemtype(lambda lit: lit.text == 'Sibling discount')
+
+    def default_admission_lineitemtype(self):
+        return self._latest_lineitemtype(lambda lit: lit.text == 'Program admission')
+
+    def lineitemtypes(self, include_donations=True, required_only=False, optional_only=False, payment_only=False, lineitemtype_id=None):
+        """ In-memory equivalent of get_lineitemtypes(): keeps only the
+            newest line item type with each name. """
+        if lineitemtype_id:
+            return [lit for lit in self._lineitemtypes if lit.id == int(lineitemtype_id)]
+        excluded = set(self.finaid_items)
+        if not include_donations:
+            excluded.update(self.donation_texts())
+        newest = {}
+        for lit in self._lineitemtypes:
+            if lit.text in excluded:
+                continue
+            if required_only and not (lit.required and not lit.for_payments):
+                continue
+            elif optional_only and not (not lit.required and not lit.for_payments):
+                continue
+            elif payment_only and not (not lit.required and lit.for_payments):
+                continue
+            newest[lit.text] = lit
+        return sorted(newest.values(), key=lambda lit: lit.text)
+
+    ##  Bulk updates
+
+    @transaction.atomic
+    def ensure_required_transfers(self, save=True):
+        """ Same as IndividualAccountingController.ensure_required_transfers(),
+            for all of the users at once.
+
+            With save=False, the missing or outdated transfers are only made
+            in memory, so that the amounts come out as if they had been
+            saved but nothing is written, e.g. when printing.  The
+            controller should then only be read from. """
+        required_line_items = self.lineitemtypes(required_only=True)
+        if not required_line_items:
+            return
+        program_account = self.default_program_account()
+        source_account = self.default_source_account()
+
+        new_transfers = []
+        for user_id in self.user_ids:
+            existing_transfers_by_li = {t.line_item_id: t for t in self._transfers[user_id]}
+            for item in required_line_items:
+                transfer = existing_transfers_by_li.get(item.id)
+                if transfer is None:
+                    new_transfers.append(Transfer(source=source_account,
+                                                  destination=program_account,
+                                                  user_id=user_id,
+                                                  line_item=item,
+                                                  amount_dec=item.amount_dec))
+                elif not transfer.paid_in_id and transfer.amount_dec != item.amount_dec:
+                    transfer.amount_dec = item.amount_dec
+                    if save:
+                        transfer.save()
+
+        if new_transfers and not save:
+            for transfer in new_transfers:
+                self._transfers[transfer.user_id].append(transfer)
+        elif new_transfers:
+            new_transfers = Transfer.objects.bulk_create(new_transfers)
+            for transfer in new_transfers:
+                self._transfers[transfer.user_id].append(transfer)
+
+    ##  Per-user queries
+
+    def get_id(self, user):
+        return '%d/%d' % (self.program.id, getattr(user, 'id', user))
+
+    def get_identifier(self, user):
+        purchases_str = ';'.join(['%d,%.2f' % (t.line_item_id, t.amount) for t in self.get_transfers(user)])
+        return '%s:%s' % (self.get_id(user), purchases_str)
+
+    def transfers_to_program_exist(self, user):
+        return bool(self.requested_transfers(user))
+
+    def get_transfers(self, user, line_items=None, **kwargs):
+        if line_items is None:
+            line_items = self.lineitemtypes(**kwargs)
+        line_item_ids = set(getattr(lit, 'id', lit) for lit in line_items if lit is not None)
+        return [t for t in self._transfers[getattr(user, 'id', user)] if t.line_item_id in line_item_ids]
+
+    def requested_transfers(self, user, for_finaid_only=False):
+        program_account = self.default_program_account()
+        if program_account is None:
+            return []
+        transfers = [t for t in self._transfers[getattr(user, 'id', user)] if t.destination_id == program_account.id]
+        if for_finaid_only:
+            transfers = [t for t in transfers if t.line_item.for_finaid]
+        return transfers
+
+    def amount_requested(self, user, for_finaid_only=False):
+        return sum((t.amount_dec for t in self.requested_transfers(user, for_finaid_only)), Decimal('0'))
+
+    def latest_finaid_grant(self, user):
+        return self._grants.get(getattr(user, 'id', user))
+
+    def amount_siblingdiscount(self, user):
+        if getattr(user, 'id', user) in self._sibling_discounts:
+            return self.program.sibling_discount
+        else:
+            return Decimal('0')
+
+    def amount_finaid(self, user, amount_siblingdiscount=None):
+        amount_requested = self.amount_requested(user, for_finaid_only=True)
+        if amount_siblingdiscount is None:
+            amount_siblingdiscount = self.amount_siblingdiscount(user)
+
+        aid_amount = Decimal('0')
+        latest_grant = self.latest_finaid_grant(user)
+        if latest_grant is not None:
+            if latest_grant.amount_max_dec is not None:
+                if amount_requested - amount_siblingdiscount > latest_grant.amount_max_dec:
+                    aid_amount = latest_grant.amount_max_dec
+                else:
+                    aid_amount = amount_requested - amount_siblingdiscount
+
+            if latest_grant.percent is not None:
+                discount_aid_amount = (Decimal('0.01') * latest_grant.percent) * (amount_requested - amount_siblingdiscount - aid_amount)
+                aid_amount += discount_aid_amount
+
+        return aid_amount
+
+    def amount_paid(self, user):
+        payments_lit = self.default_payments_lineitemtype()
+        if payments_lit is None:
+            return Decimal('0')
+        return sum((t.amount_dec for t in self._transfers[getattr(user, 'id', user)]
+                    if t.line_item_id == payments_lit.id and t.source_id is None), Decimal('0'))
+
+    def amount_due(self, user):
+        amt_request = self.amount_requested(user)
+        amt_sibling = self.amount_siblingdiscount(user)
+        return amt_request - self.amount_finaid(user, amt_sibling) - amt_sibling - self.amount_paid(user)
+
+    def has_paid(self, user, in_full=False):
+        if in_full:
+            return (self.amount_paid(user) > 0) and (self.amount_due(user) <= 0)
+        else:
+            return (self.amount_paid(user) > 0)
+
+    def balance(self, user):
+        """ Return a dict with all of the amounts for the user at once:
+            'requested', 'siblingdiscount', 'finaid', 'paid' and 'due'. """
+        result = {'requested': self.amount_requested(user),
+                  'siblingdiscount': self.amount_siblingdiscount(user),
+                  'paid': self.amount_paid(user)}
+        result['finaid'] = self.amount_finaid(user, result['siblingdiscount'])
+        result['due'] = result['requested'] - result['finaid'] - result['siblingdiscount'] - result['paid']
+        return result
+
+    def balances(self):
+        """ The balance() of each of the users, by user ID. """
+        return {user_id: self.balance(user_id) for user_id in self.user_ids}
+
+    def __str__(self):
+        return 'Accounting for %d users at %s' % (len(self.users), self.program.niceName())
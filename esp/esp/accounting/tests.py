@@ -240,6 +240,7 @@ def test_str(self):
 from django.contrib.auth.models import Group
 
 from esp.accounting.controllers import (
+    BatchAccountingController,
     GlobalAccountingController,
     IndividualAccountingController,
     ProgramAccountingController,
@@ -440,3 +441,90 @@ def test_amount_due_with_partial_finaid(self):
         self.iac.set_finaid_params(20.0, 0)
         due = self.iac.amount_due()
         self.assertEqual(due, Decimal('30.00'))
+
+
+class BatchAccountingControllerTest(TestCase):
+    def setUp(self):
+        super().setUp()
+        _setup_roles()
+        self.program = Program.objects.create(grade_min=7, grade_max=12)
+        self.users = [
+            ESPUser.objects.create_user(username='batchstu%d' % i, password='password')
+            for i in range(4)
+        ]
+        gac = GlobalAccountingController()
+        gac.setup_accounts()
+        self.pac = ProgramAccountingController(self.program)
+        self.pac.setup_accounts()
+        self.pac.setup_lineitemtypes(50.0, optional_items=[('Lunch', 7.5, 2)])
+
+        #   Give the students a variety of states
+        iac = IndividualAccountingController(self.program, self.users[1])
+        iac.set_preference('Lunch', 2)
+        iac.submit_payment(20, link_transfers=False)
+        IndividualAccountingController(self.program, self.users[2]).set_finaid_params(20.0, 50)
+        IndividualAccountingController(self.program, self.users[3]).grant_full_financial_aid()
+
+    def test_creates_required_transfers(self):
+        BatchAccountingController(self.program, self.users)
+        admission = self.pac.default_admission_lineitemtype()
+        for user in self.users:
+            self.assertEqual(Transfer.objects.filter(user=user, line_item=admission).count(), 1)
+        #   Doing it again doesn't duplicate them
+        BatchAccountingController(self.program, self.users)
+        self.assertEqual(Transfer.objects.filter(line_item=admission).count(), len(self.users))
+
+    def test_matches_individual_controller(self):
+        bac = BatchAccountingController(self.program, self.users)
+        for user in self.users:
+            iac = IndividualAccountingController(self.program, user)
+            self.assertEqual(bac.get_id(user), iac.get_id())
+            self.assertEqual(bac.amount_requested(user), iac.amount_requested())
+            self.assertEqual(bac.amount_finaid(user), iac.amount_finaid())
+            self.assertEqual(bac.amount_siblingdiscount(user), iac.amount_siblingdiscount())
+            self.assertEqual(bac.amount_paid(user), iac.amount_paid())
+            self.assertEqual(bac.amount_due(user), iac.amount_due())
+            self.assertEqual(bac.has_paid(user, in_full=True), iac.has_paid(in_full=True))
+            for kwargs in [{}, {'optional_only': True}, {'required_only': True}]:
+                self.assertEqual([t.id for t in bac.get_transfers(user, **kwargs)],
+                                 [t.id for t in iac.get_transfers(**kwargs)])
+
+    def test_query_count_is_constant(self):
+        BatchAccountingController(self.program, self.users)
+        #   Line item types, program account, transfers, grants, and the
+        #   source account for required transfers
+        with self.assertNumQueries(5):
+            bac = BatchAccountingController(self.program, self.users)
+        with self.assertNumQueries(0):
+            for user in self.users:
+                bac.amount_due(user)
+                bac.get_transfers(user, optional_only=True)
+
+    def test_balances_match_individual_controller(self):
+        bac = BatchAccountingController(self.program, self.users)
+        balances = bac.balances()
+        for user in self.users:
+            iac = IndividualAccountingController(self.program, user)
+            self.assertEqual(balances[user.id], {
+                'requested': iac.amount_requested(),
+                'siblingdiscount': iac.amount_siblingdiscount(),
+                'finaid': iac.amount_finaid(),
+                'paid': iac.amount_paid(),
+                'due': iac.amount_due(),
+            })
+            self.assertEqual(bac.get_identifier(user), iac.get_identifier())
+            self.assertEqual(bac.transfers_to_program_exist(user), iac.transfers_to_program_exist())
+            for transfer in bac.get_transfers(user):
+                self.assertEqual(bac.classify_transfer(transfer), iac.classify_transfer(transfer))
+
+    def test_user_accounting(self):
+        from esp.accounting.views import user_accounting
+        BatchAccountingController(self.program, self.users)
+        with self.assertNumQueries(5):
+            [result] = user_accounting(self.users[1], [self.program])
+        iac = IndividualAccountingController(self.program, self.users[1])
+        self.assertTrue(result['transfers_exist'])
+        self.assertEqual(result['due'], iac.amount_due())
+        self.assertEqual(result['identifier'], iac.get_identifier())
+        self.assertEqual(result['transfers'][0]['transfer'].line_item.text, 'Program admission')
+        self.assertEqual(result['transfers'][0]['type'], 'Cost (required)')
@@ -33,7 +33,7 @@
   Email: web-team@learningu.org
 """
 
-from esp.accounting.controllers import IndividualAccountingController
+from esp.accounting.controllers import BatchAccountingController
 from esp.accounting.models import Account, Transfer
 from esp.program.models import Program
 from esp.utils.web import render_to_response
@@ -77,10 +77,14 @@ def user_summary(request):
 def user_accounting(user, progs = []):
     results = []
     for prog in progs:
-        iac = IndividualAccountingController(prog, user)
+        #   Load everything about the user's accounts for this program at once
+        bac = BatchAccountingController(prog, [user], ensure_required=False)
+        transfers_exist = bac.transfers_to_program_exist(user)
+        if transfers_exist:
+            bac.ensure_required_transfers()
         classified_transfers = [
-            { 'transfer': t, 'type': iac.classify_transfer(t) }
-            for t in iac.get_transfers().select_related('line_item')
+            { 'transfer': t, 'type': bac.classify_transfer(t) }
+            for t in bac.get_transfers(user)
         ]
         sort_order = {"Cost (required)": 0, "Cost (optional)": 1, "Sibling discount": 2, "Financial aid": 3, "Payment": 4}
         classified_transfers.sort(key=lambda t: 'Program admission' not in t['transfer'].line_item.text) # put Program admission at the top
@@ -88,16 +92,12 @@ def user_accounting(user, progs = []):
         result = {
             'program': prog,
             'transfers': classified_transfers,
-            'identifier': iac.get_identifier(),
-            'grant': iac.latest_finaid_grant(),
+            'identifier': bac.get_identifier(user),
+            'grant': bac.latest_finaid_grant(user),
         }
-        if iac.transfers_to_program_exist():
+        if transfers_exist:
             result['transfers_exist'] = True
-            result['requested'] = iac.amount_requested(ensure_required=False)
-            result['finaid'] = iac.amount_finaid()
-            result['siblingdiscount'] = iac.amount_siblingdiscount()
-            result['paid'] = iac.amount_paid()
-            result['due'] = iac.amount_due()
+            result.update(bac.balance(user))
         results.append(result)
     return results
 
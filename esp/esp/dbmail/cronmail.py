@@ -35,11 +35,16 @@
 import logging
 logger = logging.getLogger(__name__)
 
-import math
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from esp.dbmail.models import MessageRequest, send_mail, TextOfEmail
 from datetime import datetime, timedelta
+from django.contrib.sites.models import Site
+from django.core.mail import get_connection
+from django.db import transaction
+from django.db.models import Max
 from django.db.models.query import Q
 from django.template.loader import render_to_string
 
@@ -47,42 +52,201 @@
 
 _ONE_WEEK = timedelta(weeks=1)
 
+# Outcomes of sending are recorded once this many have piled up, or once
+# this many seconds have passed since the last time, whichever comes first.
+# If a sender dies, only the emails it sent since then are sent again.
+_RECORD_BATCH_SIZE = 20
+_RECORD_INTERVAL = 2
+
+class TokenBucket(object):
+    """ Rate limiter allowing `rate` operations per second on average, and
+        bursts of up to `burst` operations at once.  A rate of 0 or None
+        means no limit. """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """ Block until an operation is allowed. """
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class DeliveryEngine(object):
+    """ Sends TextOfEmails over a small pool of persistent mail connections.
+
+        Each of the `num_connections` worker threads keeps its own connection
+        open between messages, and reopens it after a failure.  Sending is
+        limited to `rate` messages per second (with bursts of `burst`) across
+        all workers.  The defaults come from the EMAIL_CONNECTIONS,
+        EMAIL_SEND_RATE and EMAIL_SEND_BURST settings; if EMAIL_SEND_RATE is
+        not set, the old EMAILTIMEOUT delay between messages (1.5 seconds by
+        default) is turned into a rate.
+
+        The workers don't touch the database: deliver() and deliver_iter()
+        return the outcomes and the caller records them, e.g. with
+        TextOfEmail.record_delivery().
+        Use it as a context manager, so that the connections get closed.
+    """
+
+    def __init__(self, num_connections=None, rate=None, burst=None, connection_factory=None):
+        if num_connections is None:
+            num_connections = getattr(settings, 'EMAIL_CONNECTIONS', 4)
+        if rate is None:
+            rate = getattr(settings, 'EMAIL_SEND_RATE', None)
+        if rate is None:
+            wait = getattr(settings, 'EMAILTIMEOUT', None)
+            if wait is None:
+                wait = 1.5
+            rate = 1.0 / wait if wait else 0
+        if burst is None:
+            burst = getattr(settings, 'EMAIL_SEND_BURST', num_connections)
+        if connection_factory is None:
+            connection_factory = lambda: get_connection(return_path=settings.DEFAULT_EMAIL_ADDRESSES['bounces'])
+
+        self.bucket = TokenBucket(rate, burst)
+        self.connection_factory = connection_factory
+        self.connections_opened = 0
+        self._headers = {}
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=num_connections, thread_name_prefix='dbmail')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _get_connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self.connection_factory()
+            connection.open()
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+                self.connections_opened += 1
+        return connection
+
+    def _drop_connection(self):
+        connection = getattr(self._local, 'connection', None)
+        self._local.connection = None
+        if connection is not None:
+            with self._lock:
+                self._connections.remove(connection)
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    def _send(self, mailtxt, extra_headers):
+        try:
+            connection = self._get_connection()
+        except Exception as e:
+            return e
+        self.bucket.take()
+        exception = mailtxt.deliver(connection=connection, extra_headers=extra_headers)
+        if exception is not None:
+            # The connection may be what broke; start over with a new one.
+            self._drop_connection()
+        return exception
+
+    def _submit(self, mailtxts):
+        mailtxts = list(mailtxts)
+        # Do everything that needs the database here, in the caller's thread
+        # (and transaction), before handing the messages to the workers.
+        # With users selected along with the emails, this costs at most one
+        # query per batch, for the headers of requests we haven't seen yet.
+        Site.objects.get_current()
+        for mailtxt in mailtxts:
+            mailtxt.user  # needed for the unsubscribe headers
+        extra_headers = TextOfEmail.get_extra_headers_for(mailtxts, self._headers)
+        return [(mailtxt, self._pool.submit(self._send, mailtxt, headers))
+                for (mailtxt, headers) in zip(mailtxts, extra_headers)]
+
+    def deliver(self, mailtxts):
+        """ Send the given TextOfEmails.  Returns a list of (mailtxt,
+            exception) pairs, in order, where exception is None for messages
+            which were sent successfully. """
+        return [(mailtxt, future.result()) for (mailtxt, future) in self._submit(mailtxts)]
+
+    def deliver_iter(self, mailtxts):
+        """ Like deliver(), but yields each (mailtxt, exception) pair as soon
+            as that message has been handed to the mail server, so that the
+            caller can record it right away. """
+        futures = {future: mailtxt for (mailtxt, future) in self._submit(mailtxts)}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+    def close(self):
+        self._pool.shutdown()
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
 def process_messages():
     """Go through all unprocessed messages and process them.
 
-    Callers (e.g. dbmail_cron.py) should ensure that this function is not
-    called in more than one thread simultaneously."""
+    This may be called from several processes at once (see the dbmail_worker
+    command): each message is locked while it is being processed, and other
+    callers skip over it."""
 
     now = datetime.now()
     one_week_ago = now - _ONE_WEEK
 
-    # Choose a set of messages to process.  Anything which arrives later will
-    # not be processed by this run of the script. Any outstanding requests
-    # which were created over one week ago are assumed to be out-of-date, and
-    # are ignored.
+    # Any outstanding requests which were created over one week ago are
+    # assumed to be out-of-date, and are ignored.
     messages = MessageRequest.objects.filter(Q(processed_by__lte=now) |
                                              Q(processed_by__isnull=True),
                                              created_at__gte=one_week_ago,
                                              processed=False,
     )
-    messages = list(messages)
 
-    #   Process message requests
-    for message in messages:
+    #   Process message requests, one at a time.  The row lock is held until
+    #   processing commits, and is released if this process dies, so there is
+    #   no need for a lease.
+    processed = []
+    while True:
         # If we raise an error here, transaction management will make sure that
         # things with the MessageRequest get backed out properly.  We let the
         # whole script just exit in this case -- this way we get an error
         # message via cron, and the next run of the script can just try again.
-        message.process()
-    return messages
+        with transaction.atomic():
+            message = messages.select_for_update(skip_locked=True).order_by('id').first()
+            if message is None:
+                break
+            message.process()
+        processed.append(message)
+    return processed
 
 # Deliberately uses transaction autocommitting -- we don't need this to be
 # atomic.
 def send_email_requests():
     """Go through all email requests that aren't sent and send them.
 
-    Callers (e.g. dbmail_cron.py) should ensure that this function is not
-    called in more than one thread simultaneously."""
+    This may be called from several processes at once (see the dbmail_worker
+    command): emails are leased in batches with TextOfEmail.claim(), so each
+    one is sent by a single caller.  Note that the rate limit applies to each
+    caller separately.  Returns the number of emails sent."""
 
     now = datetime.now()
     one_week_ago = now - _ONE_WEEK
@@ -103,45 +267,71 @@ def send_email_requests():
                                           created_at__gte=one_week_ago,
                                           sent__isnull=True,
                                           tries__lte=retries)
-
-    wait = getattr(settings, 'EMAILTIMEOUT', None)
-    if wait is None:
-        wait = 1.5
+    max_id = mailtxts.aggregate(Max('id'))['id__max'] or 0
+    mailtxts = mailtxts.filter(id__lte=max_id)
 
     num_sent = 0
     errors = [] # if any messages failed to deliver
+    mailtxt = None
 
     # We make two optimizations here to reduce memory usage.  First, mailtxts
     # is quite large, and by default even for iterating over a queryset django
-    # tries to cache it all in memory, which can get quite large, so we use
-    # .iterator() to prevent that.  Second, even when django doesn't load the
-    # whole query into django objects in memory, psycopg2 still loads it all
-    # internally:
+    # tries to cache it all in memory, which can get quite large.  Second, even
+    # when django doesn't load the whole query into django objects in memory,
+    # psycopg2 still loads it all internally:
     # http://thebuild.com/blog/2010/12/13/very-large-result-sets-in-django-using-postgresql/
-    # So we do our own batching on top of that.
-    batch_size = 1000
-    for i in range(int(math.ceil(float(mailtxts.count()) / batch_size))):
-        # .iterator() re-evaulates the QuerySet each time, moving to the remaining unsent texts
-        for mailtxt in mailtxts[:batch_size].iterator():
-            exception = mailtxt.send()
-            if exception is not None:
-                # In the line below, we don't use str(exception) because if the user-defined exception doesn't define
-                # __str__() then str(exception) will return an empty string. Then we won't know what the exception is.
-                # There are many cases in the logs where the errors show exception as empty string, which indicates that
-                # there was an exception but we have no idea what it was. At least str(type(exception)) will show us
-                # the type (class name) of the exception.
-                exception_type_str = str(type(exception))
-
-                errors.append({'email': mailtxt, 'exception': exception_type_str})
-
-                # Do not use str(mailtxt.send_to) in the line below. If the mailtxt.send_to contains a non-ascii
-                # character, then the str() will cause a UnicodeEncodeError, but directly concatenating with +
-                # works fine.
-                logger.warning("Encountered error while sending to " + mailtxt.send_to + ": " + exception_type_str)
-            else:
-                num_sent += 1
+    # So we do our own batching, claiming the emails in order of id.  Each
+    # batch is handed to the delivery engine, and the outcomes are recorded
+    # with a couple of UPDATEs for every few emails sent (see
+    # _RECORD_BATCH_SIZE), so that if we die partway through a batch, the
+    # emails we did send aren't sent again.  Failed emails are retried on a
+    # later run.
+    #
+    # A batch should be sent well within its lease; otherwise another sender
+    # could claim the rest of it and send some emails twice.
+    lease = timedelta(seconds=getattr(settings, 'EMAIL_LEASE_TIME', 600))
+    last_id = 0
+    with DeliveryEngine() as engine:
+        batch_size = 1000
+        if engine.bucket.rate:
+            batch_size = max(1, min(batch_size, int(engine.bucket.rate * lease.total_seconds() / 2)))
+        while True:
+            ids = TextOfEmail.claim(mailtxts.filter(id__gt=last_id), batch_size, lease)
+            if not ids:
+                break
+            last_id = ids[-1]
+            batch = list(TextOfEmail.objects.filter(id__in=ids).select_related('user').order_by('id'))
 
-            time.sleep(wait)
+            sent_ids = []
+            failed_ids = []
+            last_recorded = time.monotonic()
+            for mailtxt, exception in engine.deliver_iter(batch):
+                if exception is not None:
+                    # In the line below, we don't use str(exception) because if the user-defined exception doesn't define
+                    # __str__() then str(exception) will return an empty string. Then we won't know what the exception is.
+                    # There are many cases in the logs where the errors show exception as empty string, which indicates that
+                    # there was an exception but we have no idea what it was. At least str(type(exception)) will show us
+                    # the type (class name) of the exception.
+                    exception_type_str = str(type(exception))
+
+                    errors.append({'email': mailtxt, 'exception': exception_type_str})
+                    failed_ids.append(mailtxt.id)
+
+                    # Do not use str(mailtxt.send_to) in the line below. If the mailtxt.send_to contains a non-ascii
+                    # character, then the str() will cause a UnicodeEncodeError, but directly concatenating with +
+                    # works fine.
+                    logger.warning("Encountered error while sending to " + mailtxt.send_to + ": " + exception_type_str)
+                else:
+                    sent_ids.append(mailtxt.id)
+                if (len(sent_ids) + len(failed_ids) >= _RECORD_BATCH_SIZE
+                        or time.monotonic() - last_recorded >= _RECORD_INTERVAL):
+                    TextOfEmail.record_delivery(sent_ids, failed_ids)
+                    num_sent += len(sent_ids)
+                    sent_ids = []
+                    failed_ids = []
+                    last_recorded = time.monotonic()
+            TextOfEmail.record_delivery(sent_ids, failed_ids)
+            num_sent += len(sent_ids)
 
     if num_sent > 0:
         logger.info('Sent %d messages', num_sent)
@@ -161,3 +351,5 @@ def send_email_requests():
         send_mail('Mail delivery failure', delivery_failed_string, settings.SERVER_EMAIL, recipients)
     elif num_sent > 0:
         logger.info('No mail delivery failures')
+
+    return num_sent
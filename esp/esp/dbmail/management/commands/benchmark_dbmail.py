@@ -0,0 +1,84 @@
+import time
+
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from esp.dbmail.cronmail import DeliveryEngine
+from esp.dbmail.models import MessageRequest, TextOfEmail
+from esp.users.models import ESPUser, PersistentQueryFilter
+
+class _Rollback(Exception):
+    pass
+
+class Command(BaseCommand):
+    """
+    Measures how fast MessageRequest.process() turns a message into emails,
+    using a set of synthetic recipients.  Everything is created inside a
+    transaction which is rolled back at the end, so nothing is left behind.
+
+    With --smtp-port, the emails are then also delivered to that SMTP server,
+    which should be a local sink such as
+        python -m smtpd -n -c DebuggingServer localhost:1025
+    """
+    help = 'Benchmark dbmail message processing on synthetic recipients'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipients', type=int, default=5000)
+        parser.add_argument('--chunk-size', type=int, default=MessageRequest.PROCESS_CHUNK_SIZE)
+        parser.add_argument('--smtp-host', default='localhost')
+        parser.add_argument('--smtp-port', type=int, default=None,
+                            help='Also deliver the emails to this SMTP server')
+        parser.add_argument('--connections', type=int, default=4)
+        parser.add_argument('--rate', type=float, default=0,
+                            help='Messages per second; 0 for no limit')
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options)
+                raise _Rollback
+        except _Rollback:
+            pass
+
+    def run(self, options):
+        n = options['recipients']
+        start = time.time()
+        users = ESPUser.objects.bulk_create([
+            ESPUser(username='dbmail-benchmark-%d' % i, first_name='Bench', last_name=str(i),
+                    email='dbmail-benchmark-%d@example.com' % i)
+            for i in range(n)])
+        creator = users[0]
+        recipients = PersistentQueryFilter.create_from_Q(
+            ESPUser, Q(username__startswith='dbmail-benchmark-'))
+        request = MessageRequest.createRequest(
+            var_dict={'user': creator},
+            subject='Benchmark for {{ user.first_name }} {{ user.last_name }}',
+            msgtext='<html>Dear {{ user.name }},\n\nThis is a benchmark.\n{{ user.unsubscribe_link }}</html>',
+            recipients=recipients, sender=creator.email, creator=creator)
+        request.save()
+        self.stdout.write('Created %d synthetic recipients in %.1fs' % (n, time.time() - start))
+
+        start = time.time()
+        num_emails = request.process(chunk_size=options['chunk_size'])
+        elapsed = time.time() - start
+        self.stdout.write('Processed %d emails in %.1fs (%.0f emails/s)'
+                          % (num_emails, elapsed, num_emails / elapsed if elapsed else 0))
+        assert TextOfEmail.objects.filter(messagerequest=request).count() == num_emails
+
+        if options['smtp_port'] is None:
+            return
+        connection_factory = lambda: get_connection(
+            'django.core.mail.backends.smtp.EmailBackend',
+            host=options['smtp_host'], port=options['smtp_port'], username='', password='', use_tls=False)
+        texts = TextOfEmail.objects.filter(messagerequest=request).select_related('user').order_by('id')
+        start = time.time()
+        with DeliveryEngine(num_connections=options['connections'], rate=options['rate'],
+                            connection_factory=connection_factory) as engine:
+            results = engine.deliver(texts)
+        elapsed = time.time() - start
+        failed = len([e for (text, e) in results if e is not None])
+        self.stdout.write('Delivered %d emails (%d failed) over %d connections in %.1fs (%.0f emails/s)'
+                          % (len(results) - failed, failed, engine.connections_opened, elapsed,
+                             len(results) / elapsed if elapsed else 0))
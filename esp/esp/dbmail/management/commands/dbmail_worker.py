@@ -0,0 +1,43 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from esp.dbmail.cronmail import process_messages, send_email_requests
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    """
+    Processes and sends dbmail in a loop, as an alternative to dbmail_cron.py.
+
+    Any number of workers, on any number of hosts, may run against the same
+    database: message requests are locked while they are processed, and
+    emails are leased in batches (see TextOfEmail.claim()), so no email is
+    sent twice.  A worker which dies only holds up its batch until the lease
+    (settings.EMAIL_LEASE_TIME, 10 minutes by default) expires.  Each worker
+    applies settings.EMAIL_SEND_RATE on its own, so divide the total rate
+    the mail server accepts by the number of workers.
+    """
+    help = 'Run a dbmail worker which processes and sends emails'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Do one pass and exit, like dbmail_cron.py')
+        parser.add_argument('--poll-interval', type=float, default=10,
+                            help='Seconds to wait when there is nothing to do')
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                processed = process_messages()
+                num_sent = send_email_requests()
+            except Exception as e:
+                if options['once']:
+                    raise
+                logger.exception(e)
+                processed, num_sent = [], 0
+            if options['once']:
+                break
+            if not processed and not num_sent:
+                time.sleep(options['poll_interval'])
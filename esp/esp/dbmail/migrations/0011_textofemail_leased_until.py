@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dbmail', '0010_textofemail_messagerequest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='textofemail',
+            name='leased_until',
+            field=models.DateTimeField(blank=True, db_index=True, default=None, null=True),
+        ),
+    ]
@@ -40,12 +40,13 @@
 import pickle
 import re
 import sys
+import time
 
 from django.db import models, transaction
 from django.db.models import Q
 from argcache import cache_function
 from esp.middleware import ESPError
-from datetime import datetime
+from datetime import datetime, timedelta
 from esp.db.fields import AjaxForeignKey
 
 from esp.users.models import PersistentQueryFilter, ESPUser
@@ -67,7 +68,7 @@
 # https://support.google.com/a/answer/81126?visit_id=638428689824104778-3542874255&rd=1#subscriptions
 def send_mail(subject, message, from_email, recipient_list, fail_silently=False, bcc=None,
               return_path=settings.DEFAULT_EMAIL_ADDRESSES['bounces'], extra_headers={}, user=None,
-              *args, **kwargs):
+              connection=None, *args, **kwargs):
     from_email = from_email.strip()
     # the from_email must match one of our DMARC domains/subdomains
     # or the email may be rejected by email clients
@@ -77,6 +78,9 @@ def send_mail(subject, message, from_email, recipient_list, fail_silently=False,
                        "@learningu.org, or a valid subdomain of learningu.org " +
                        "(i.e., @subdomain.learningu.org).")
 
+    # Copy the headers, since we add to them below and callers may share one
+    # dict between many messages.
+    extra_headers = dict(extra_headers)
     if 'Reply-To' in extra_headers:
         extra_headers['Reply-To'] = extra_headers['Reply-To'].strip()
     if isinstance(recipient_list, str):
@@ -104,9 +108,11 @@ def send_mail(subject, message, from_email, recipient_list, fail_silently=False,
     from django.core.mail import EmailMessage, EmailMultiAlternatives #send_mail as django_send_mail
     logger.info("Sent mail to %s", recipients)
 
-    #   Get whatever type of email connection Django provides.
+    #   Get whatever type of email connection Django provides, unless the
+    #   caller is reusing one (see esp.dbmail.cronmail.DeliveryEngine).
     #   Normally this will be SMTP, but it also has an in-memory backend for testing.
-    connection = get_connection(fail_silently=fail_silently, return_path=return_path)
+    if connection is None:
+        connection = get_connection(fail_silently=fail_silently, return_path=return_path)
 
     #   Detect HTML tags in message and change content-type if they are found
     if '<html>' in message:
@@ -333,6 +339,19 @@ def assert_is_valid_sendto_fn_or_ESPError(cls, sendto_fn_name):
                 'The error message is: "%s".' % \
                 (sendto_fn_name, settings.DEFAULT_EMAIL_ADDRESSES['support'], e))
 
+    def get_send_from(self):
+        """ The sender address for emails generated from this request. """
+        if self.sender is not None and len(self.sender.strip()) > 0:
+            return self.sender
+        elif self.creator is not None:
+            return self.creator.get_email_sendto_address()
+        else:
+            return 'ESP Web Site <esp@mit.edu>'
+
+    # Number of recipients to render and write to the database at a time in
+    # process()
+    PROCESS_CHUNK_SIZE = 500
+
     # Processing a MessageRequest needs to be atomic, so that if the DB falls
     # over halfway through the processing, we don't end up with half of the
     # TextOfEmail objects created and half of them not without a way to repair.
@@ -342,62 +361,77 @@ def assert_is_valid_sendto_fn_or_ESPError(cls, sendto_fn_name):
     # instances of the same function (which should probably be locked out
     # anyway at a higher level).
     @transaction.atomic
-    def process(self):
+    def process(self, chunk_size=None):
         """Process this request, creating TextOfEmail and EmailRequest objects.
 
+        The subject and body templates are compiled and the message variables
+        loaded once for the whole request; recipients are then rendered
+        chunk_size at a time, and each chunk's emails are written with one
+        INSERT per table.
+
         It is the caller's responsibility to call this only on unprocessed
         MessageRequests.
         """
         logger.info("Processing MessageRequest %d: %s", self.id, self.subject)
+        start_time = time.time()
+        if chunk_size is None:
+            chunk_size = self.PROCESS_CHUNK_SIZE
 
         # figure out who we're sending from...
-        if self.sender is not None and len(self.sender.strip()) > 0:
-            send_from = self.sender
-        else:
-            if self.creator is not None:
-                send_from = self.creator.get_email_sendto_address()
-            else:
-                send_from = 'ESP Web Site <esp@mit.edu>'
-
-        users = self.recipients.getList(ESPUser).distinct()
+        send_from = self.get_send_from()
 
         sendto_fn = self.get_sendto_fn_callable(self.sendto_fn_name)
 
-        # go through each user and parse the text...then create the proper
-        # emailrequest and textofemail object
-        for user in users:
-            subject = self.parseSmartText(self.subject, user)
-            msgtext = self.parseSmartText(self.msgtext, user)
-
-            # For each user, create an EmailRequest and a TextOfEmail
-            # for each address given by the output of the sendto function.
-            for address_pair in sendto_fn(user):
-                newemailrequest = {'target': user, 'msgreq': self}
-                send_to = ESPUser.email_sendto_address(*address_pair)
-                newtxt = {
-                    'messagerequest': self,
-                    'user': user,
-                    'send_to': send_to,
-                    'send_from': send_from,
-                    'subject': subject,
-                    'msgtext': msgtext,
-                    'created_at': self.created_at,
-                    'sent': None,
-                }
-
-                # Use get_or_create so that, if this send_to address is
-                # already receiving the exact same email, it doesn't need to
-                # get sent a second time.
-                # This is useful to de-duplicate announcement emails for
-                # people with multiple accounts, or for preventing a user
-                # from receiving a duplicate when a message request needs to
-                # be resent after a bug prevented it from being received by
-                # all recipients the first time.
-                # Disabled in hopes that it will make postgres less sad.
-                # TODO(benkraft): Figure out a more permanent solution.
-                newtxt = TextOfEmail.objects.create(**newtxt)
-                newemailrequest['textofemail'] = newtxt
-                EmailRequest.objects.create(**newemailrequest)
+        users = self.recipients.getList(ESPUser).distinct().order_by('id')
+        users = esp.dbmail.sendto_fns.annotate_addresses(users, sendto_fn)
+
+        subject_template = Template(str(self.subject))
+        msgtext_template = Template(str(self.msgtext))
+        providers = MessageVars.getProviders(self)
+
+        # Walk through the users in chunks, parse the text for each one, and
+        # create the proper emailrequest and textofemail objects.
+        num_users = 0
+        num_emails = 0
+        last_id = 0
+        seen_addresses = set()
+        while True:
+            chunk = list(users.filter(id__gt=last_id)[:chunk_size])
+            if not chunk:
+                break
+            last_id = chunk[-1].id
+            num_users += len(chunk)
+
+            texts = []
+            for user in chunk:
+                context = MessageVars.getContext(self, user, providers)
+                subject = subject_template.render(context)
+                msgtext = msgtext_template.render(context)
+
+                # For each user, create an EmailRequest and a TextOfEmail
+                # for each address given by the output of the sendto function
+                # (read from the annotations).  Addresses which were already
+                # given for an earlier user (e.g. a parent of two students)
+                # are skipped, so each address gets the email only once.
+                # This used to be a get_or_create, but it was replaced in
+                # hopes that it would make postgres less sad.
+                for address_pair in esp.dbmail.sendto_fns.get_addresses(user, sendto_fn, seen_addresses):
+                    texts.append(TextOfEmail(
+                        messagerequest=self,
+                        user=user,
+                        send_to=ESPUser.email_sendto_address(*address_pair),
+                        send_from=send_from,
+                        subject=subject,
+                        msgtext=msgtext,
+                        created_at=self.created_at,
+                        sent=None,
+                    ))
+
+            texts = TextOfEmail.objects.bulk_create(texts)
+            EmailRequest.objects.bulk_create([
+                EmailRequest(target_id=text.user_id, msgreq=self, textofemail=text)
+                for text in texts])
+            num_emails += len(texts)
 
         # Mark ourselves processed.  We don't have to worry about the DB
         # falling over between the above writes and this one, because the whole
@@ -405,7 +439,11 @@ def process(self):
         self.processed = True
         self.save()
 
-        logger.info('Prepared emails to send for message request %d: %s', self.id, self.subject)
+        elapsed = time.time() - start_time
+        logger.info('Prepared %d emails to %d users for message request %d in %.1fs (%.0f emails/s): %s',
+                    num_emails, num_users, self.id, elapsed,
+                    num_emails / elapsed if elapsed else 0, self.subject)
+        return num_emails
 
 @python_2_unicode_compatible
 class TextOfEmail(models.Model):
@@ -428,6 +466,7 @@ class TextOfEmail(models.Model):
     sent = models.DateTimeField(blank=True, null=True)
     sent_by = models.DateTimeField(null=True, default=None, db_index=True) # When it should be sent by.
     tries = models.IntegerField(default=0) # Number of times we attempted to send this message and failed
+    leased_until = models.DateTimeField(null=True, blank=True, default=None, db_index=True) # Claimed by a sender until this time; see claim()
 
     def __str__(self):
         return str(self.subject) + ' <' + (self.send_to) + '>'
@@ -442,16 +481,54 @@ def send(self):
         have not already been sent, and which do not have too many retries.
         """
 
-        parent_request = None
-        if self.emailrequest_set.count() > 0:
-            parent_request = self.emailrequest_set.all()[0].msgreq
+        now = datetime.now()
 
-        if parent_request is not None:
-            extra_headers = parent_request.special_headers_dict
+        e = self.deliver()
+        if e is not None:
+            self.tries += 1
+            TextOfEmail.record_delivery(failed_ids=[self.id], now=now)
+            return e
         else:
-            extra_headers = {}
+            self.sent = now
+            # clear the msgtext to save DB space
+            # we can always repopulate it using self.fill_msgtext()
+            self.msgtext = ""
+            TextOfEmail.record_delivery(sent_ids=[self.id], now=now)
 
-        now = datetime.now()
+    def get_extra_headers(self):
+        """Return the special headers of the request this email came from."""
+        return self.messagerequest.special_headers_dict
+
+    @classmethod
+    def get_extra_headers_for(cls, mailtxts, cache=None):
+        """Return the special headers for each of the given emails, in order.
+
+        The headers of each parent request are looked up once, with one query
+        for all the requests not already in `cache` (a dict from request id
+        to headers, which is updated).  The same dict is returned for emails
+        from the same request, so don't modify it.
+        """
+        if cache is None:
+            cache = {}
+        missing = {mailtxt.messagerequest_id for mailtxt in mailtxts} - set(cache)
+        if missing:
+            for request in MessageRequest.objects.filter(id__in=missing).only('id', 'special_headers'):
+                cache[request.id] = request.special_headers_dict
+        return [cache.get(mailtxt.messagerequest_id, {}) for mailtxt in mailtxts]
+
+    def deliver(self, connection=None, extra_headers=None):
+        """Send this email without recording the outcome in the database.
+
+        Returns an exception, if one was raised by `send_mail`, or None if the
+        message sent successfully; callers are responsible for bookkeeping,
+        e.g. with record_delivery().  `connection` is an open mail connection
+        to reuse; by default a new one is opened for this message.  If
+        `extra_headers` is given, it is used instead of looking up the
+        headers of the parent request.
+        """
+
+        if extra_headers is None:
+            extra_headers = self.get_extra_headers()
 
         try:
             send_mail(self.subject,
@@ -460,17 +537,50 @@ def send(self):
                       self.send_to,
                       False,
                       extra_headers=extra_headers,
-                      user = self.user)
+                      user = self.user,
+                      connection = connection)
         except Exception as e:
-            self.tries += 1
-            self.save()
             return e
-        else:
-            self.sent = now
-            # clear the msgtext to save DB space
-            # we can always repopulate it using self.fill_msgtext()
-            self.msgtext = ""
-            self.save()
+
+    @classmethod
+    def claim(cls, queryset, size, lease, now=None):
+        """Lease up to `size` emails from `queryset` for the next `lease`.
+
+        Several senders may run at once: each one claims the lowest ids which
+        are neither leased nor locked by another sender's claim in progress
+        (using SELECT ... FOR UPDATE SKIP LOCKED), and marks them leased.
+        Other senders leave leased emails alone until the lease expires, so
+        a sender which dies only holds up its emails for `lease`.  Returns
+        the list of claimed ids.
+        """
+        if now is None:
+            now = datetime.now()
+        with transaction.atomic():
+            ids = list(queryset.filter(Q(leased_until__isnull=True) | Q(leased_until__lte=now))
+                               .order_by('id').select_for_update(skip_locked=True)
+                               .values_list('id', flat=True)[:size])
+            if ids:
+                cls.objects.filter(id__in=ids).update(leased_until=now + lease)
+        return ids
+
+    # How long a failed email waits before the next try
+    RETRY_DELAY = timedelta(minutes=1)
+
+    @classmethod
+    def record_delivery(cls, sent_ids=(), failed_ids=(), now=None):
+        """Record the outcome of delivering many emails with two UPDATEs.
+
+        Sent emails get their sent time set and their msgtext cleared (as in
+        send()); failed emails get their number of tries incremented, and are
+        leased for RETRY_DELAY so that no sender retries them right away.
+        """
+        if now is None:
+            now = datetime.now()
+        if sent_ids:
+            cls.objects.filter(id__in=sent_ids).update(sent=now, msgtext='', leased_until=None)
+        if failed_ids:
+            cls.objects.filter(id__in=failed_ids).update(tries=models.F('tries') + 1,
+                                                         leased_until=now + cls.RETRY_DELAY)
 
     def fill_msgtext(self):
         """ Repopulate the msgtext based on the messagerequest """
@@ -536,13 +646,22 @@ def getVar(self, key, user):
             return None
 
     @staticmethod
-    def getContext(msgrequest, user):
+    def getProviders(msgrequest):
+        """ Load the variable providers of a message, as a list of
+            (name, provider) pairs which can be passed to getContext() for
+            every recipient. """
+        return [(msgvar.provider_name, pickle.loads(msgvar.pickled_provider))
+                for msgvar in msgrequest.messagevars_set.all()]
+
+    @staticmethod
+    def getContext(msgrequest, user, providers=None):
         """ Get a context-like dictionary for template rendering. """
         from django.template import Context  ## aseering 8-13-2010 -- Yes, this is supposed to be 'Context', not 'RequestContext'.
+        if providers is None:
+            providers = MessageVars.getProviders(msgrequest)
         context = {}
-        msgvars = msgrequest.messagevars_set.all()
-        for msgvar in msgvars:
-            context.update(msgvar.getDict(user))
+        for name, provider in providers:
+            context[name] = ActionHandler(provider, user)
         context['request'] = ActionHandler(msgrequest, user) # add the request so the public url is accessible
         context['EMAIL_HOST_SENDER'] = settings.EMAIL_HOST_SENDER # add the host address
         return Context(context)
@@ -2,10 +2,18 @@
 This module contains definitions of various sendto functions:
 functions that take a user, and return a list of associated sendto addresses.
 These addresses are (email address, name) pairs.
+
+Each sendto function also lists its `sources` ('self', 'guardian' or
+'emergency', in order), which lets annotate_addresses() and get_addresses()
+compute the same addresses for many users at once, without a profile query
+per user.
 """
 
 import re
 
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Lower, Trim
+
 def send_to_self(user):
     """
     Returns a single address, the user's own address.
@@ -14,6 +22,7 @@ def send_to_self(user):
         return [user.get_email_sendto_address_pair()]
     except:
         return []
+send_to_self.sources = ('self',)
 
 def _send_to_contact(contact):
     """
@@ -37,6 +46,7 @@ def sendto_fn(user):
         return []
     sendto_fn.__doc__ = sendto_fn.__doc__ % contact
     sendto_fn.__name__ = 'send_to_' + contact
+    sendto_fn.sources = (contact,)
     return sendto_fn
 
 send_to_guardian = _send_to_contact('guardian')
@@ -65,6 +75,7 @@ def sendto_fn(user):
             except:
                 pass
         return address_pairs
+    sendto_fn.sources = tuple(source for fn in sendto_fns for source in fn.sources)
 
     # Some docstring formatting
     sendto_fn.__doc__ = re.sub('^[ \t]*', '', sendto_fn.__doc__, flags=re.MULTILINE)
@@ -97,3 +108,83 @@ def sendto_fn(user):
 #send_to_self_and_guardian_and_emergency.__doc__ = \
 #    "Returns three addresses, the user's own address, its guardian, and its emergency contact."
 
+
+# Annotation suffix -> ContactInfo field
+_CONTACT_FIELDS = (('email', 'e_mail'), ('first_name', 'first_name'), ('last_name', 'last_name'))
+
+def annotate_addresses(users, sendto_fn):
+    """
+    Annotates a queryset of users with the contact information of their most
+    recent profile that sendto_fn needs, so that get_addresses() can be
+    called on the results without further queries.
+    """
+    from esp.program.models import RegistrationProfile
+    latest_profile = RegistrationProfile.objects.filter(user=OuterRef('pk')).order_by('-last_ts', '-id')
+    annotations = {}
+    for source in getattr(sendto_fn, 'sources', ()):
+        if source == 'self':
+            continue
+        for name, field in _CONTACT_FIELDS:
+            annotations['sendto_%s_%s' % (source, name)] = Subquery(
+                latest_profile.values('contact_%s__%s' % (source, field))[:1])
+    if annotations:
+        users = users.annotate(**annotations)
+    return users
+
+def _normalize_address(email):
+    """ The form of an email address used to detect duplicates. """
+    return (email or '').strip().lower()
+
+def get_addresses(user, sendto_fn, seen=None):
+    """
+    Returns the same addresses as sendto_fn(user), for a user from a queryset
+    annotated with annotate_addresses().  Duplicate emails are ignored; if
+    `seen` is a set, it is also used (and updated) to skip addresses already
+    given for previous users, so that an address shared between several users
+    (such as a parent's) is only given once.
+    """
+    if seen is None:
+        seen = set()
+    sources = getattr(sendto_fn, 'sources', None)
+    if sources is None:
+        address_pairs = sendto_fn(user)
+    else:
+        address_pairs = []
+        for source in sources:
+            if source == 'self':
+                address_pairs.append(user.get_email_sendto_address_pair())
+                continue
+            email = getattr(user, 'sendto_%s_email' % source)
+            if email:
+                address_pairs.append((email, '%s %s' % (getattr(user, 'sendto_%s_first_name' % source),
+                                                        getattr(user, 'sendto_%s_last_name' % source))))
+    result = []
+    for address_pair in address_pairs:
+        key = _normalize_address(address_pair[0])
+        if key not in seen:
+            seen.add(key)
+            result.append(address_pair)
+    return result
+
+def count_addresses(users, sendto_fn):
+    """
+    Returns the exact number of distinct addresses which sendto_fn gives for
+    a queryset of users, counting an address shared by several users once,
+    as MessageRequest.process() does.  This is a single query, which counts
+    the union of the (normalized) addresses from each source in the database.
+    """
+    sources = getattr(sendto_fn, 'sources', None)
+    if sources is None:
+        seen = set()
+        return sum(len(get_addresses(user, sendto_fn, seen)) for user in users.iterator())
+    users = annotate_addresses(users.order_by(), sendto_fn)
+    parts = []
+    for source in sources:
+        if source == 'self':
+            column = 'email'
+            part = users
+        else:
+            column = 'sendto_%s_email' % source
+            part = users.exclude(**{column + '__isnull': True}).exclude(**{column: ''})
+        parts.append(part.annotate(sendto_address=Lower(Trim(column))).values('sendto_address'))
+    return parts[0].union(*parts[1:]).count()
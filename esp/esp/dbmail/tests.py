@@ -5,18 +5,25 @@
 Tests send_mail functionality, ActionHandler dynamic dispatch,
 and MessageRequest validation methods.
 """
+from datetime import datetime
 from unittest.mock import patch, MagicMock
 
 from django.contrib.auth.models import Group
+from django.contrib.sites.models import Site
 from django.core import mail
+from django.db import connection
+from django.db.models import Q
+from django.test.utils import CaptureQueriesContext
 
 from esp.dbmail.models import (
     ActionHandler,
+    EmailRequest,
     MessageRequest,
+    TextOfEmail,
     send_mail,
 )
 from esp.tests.util import CacheFlushTestCase as TestCase
-from esp.users.models import ESPUser
+from esp.users.models import ESPUser, PersistentQueryFilter
 
 
 def _setup_roles():
@@ -68,6 +75,62 @@ def test_send_mail_with_user_adds_unsubscribe(self):
         self.assertIn('List-Unsubscribe', sent.extra_headers)
 
 
+class SendtoFnsTest(TestCase):
+    def setUp(self):
+        super().setUp()
+        _setup_roles()
+        from esp.program.models import RegistrationProfile
+        from esp.users.models import ContactInfo
+        self.users = []
+        for i in range(4):
+            user = ESPUser.objects.create_user(
+                username='sendto%d' % i, email='sendto%d@example.com' % i,
+                first_name='Sendto', last_name=str(i), password='password')
+            self.users.append(user)
+        #   No profile for users[0]; a guardian for users[1]; a guardian and
+        #   an emergency contact with the same email for users[2]; an older
+        #   profile with contacts and a newer one with none for users[3].
+        #   Also a guardian sharing the user's own address.
+        def contact(user, email):
+            return ContactInfo.objects.create(user=user, first_name='Contact', last_name=user.last_name, e_mail=email)
+        RegistrationProfile.objects.create(user=self.users[1], contact_guardian=contact(self.users[1], 'g1@example.com'))
+        shared = contact(self.users[2], 'g2@example.com')
+        RegistrationProfile.objects.create(user=self.users[2], contact_guardian=shared, contact_emergency=shared)
+        RegistrationProfile.objects.create(user=self.users[3], last_ts=datetime(2020, 1, 1),
+                                           contact_guardian=contact(self.users[3], 'sendto3@example.com'),
+                                           contact_emergency=contact(self.users[3], 'e3@example.com'))
+        RegistrationProfile.objects.create(user=self.users[3], contact_emergency=contact(self.users[3], ''))
+        #   And a user whose guardian is users[1]'s, up to case and spaces.
+        user = ESPUser.objects.create_user(
+            username='sendto4', email='sendto4@example.com',
+            first_name='Sendto', last_name='4', password='password')
+        self.users.append(user)
+        RegistrationProfile.objects.create(user=user, contact_guardian=contact(user, ' G1@Example.com'))
+        self.queryset = ESPUser.objects.filter(id__in=[user.id for user in self.users]).order_by('id')
+
+    def test_addresses_match_sendto_fns(self):
+        import esp.dbmail.sendto_fns
+        for (name, label) in MessageRequest.SENDTO_FN_CHOICES:
+            sendto_fn = MessageRequest.get_sendto_fn_callable(name)
+            users = esp.dbmail.sendto_fns.annotate_addresses(self.queryset, sendto_fn)
+            with CaptureQueriesContext(connection) as queries:
+                users = list(users)
+                addresses = [esp.dbmail.sendto_fns.get_addresses(user, sendto_fn) for user in users]
+            self.assertEqual(len(queries), 1)
+            expected = [sendto_fn(user) for user in self.users]
+            self.assertEqual(addresses, expected, name)
+            #   Across users, each address is only given (and counted) once.
+            seen = set()
+            deduplicated = [esp.dbmail.sendto_fns.get_addresses(user, sendto_fn, seen) for user in users]
+            emails = [email.strip().lower() for pairs in deduplicated for (email, name) in pairs]
+            self.assertEqual(len(emails), len(set(emails)), name)
+            self.assertEqual(set(emails), set(email.strip().lower() for pairs in expected for (email, name) in pairs), name)
+            with CaptureQueriesContext(connection) as queries:
+                count = esp.dbmail.sendto_fns.count_addresses(self.queryset, sendto_fn)
+            self.assertEqual(len(queries), 1)
+            self.assertEqual(count, len(emails), name)
+
+
 class ActionHandlerTest(TestCase):
     def test_getattribute_delegates_to_obj(self):
         class FakeObj:
@@ -89,17 +152,89 @@ def test_is_sendto_fn_name_choice_valid(self):
 
     def test_is_sendto_fn_name_choice_invalid(self):
         self.assertFalse(MessageRequest.is_sendto_fn_name_choice('not_a_real_choice'))
+
+
+class MessageRequestProcessTest(TestCase):
+    def setUp(self):
+        super().setUp()
+        _setup_roles()
+        self.creator = ESPUser.objects.create_user(
+            username='mailcreator', email='creator@example.com', password='password')
+        self.users = [
+            ESPUser.objects.create_user(
+                username='recipient%d' % i, first_name='Recipient%d' % i,
+                email='recipient%d@example.com' % i, password='password')
+            for i in range(12)
+        ]
+
+    def make_request(self, users):
+        recipients = PersistentQueryFilter.create_from_Q(
+            ESPUser, Q(id__in=[user.id for user in users]))
+        request = MessageRequest.createRequest(
+            var_dict={'user': self.creator},
+            subject='Hello {{ user.first_name }}',
+            msgtext='Dear {{ user.first_name }}, see {{ request.public_url }}',
+            recipients=recipients,
+            sender='from@learningu.org',
+            creator=self.creator)
+        request.save()
+        return request
+
+    def test_process(self):
+        request = self.make_request(self.users)
+        self.assertEqual(request.process(chunk_size=5), len(self.users))
+        self.assertTrue(MessageRequest.objects.get(id=request.id).processed)
+
+        texts = TextOfEmail.objects.filter(messagerequest=request)
+        self.assertEqual(texts.count(), len(self.users))
+        for user in self.users:
+            text = texts.get(user=user)
+            self.assertEqual(text.subject, 'Hello %s' % user.first_name)
+            self.assertTrue(text.msgtext.startswith('Dear %s, ' % user.first_name))
+            self.assertIn(user.email, text.send_to)
+            self.assertEqual(EmailRequest.objects.get(textofemail=text).target, user)
+
+    def test_process_deduplicates_addresses(self):
+        #   Users sharing an address (up to case) get a single email, even
+        #   across chunks.
+        ESPUser.objects.filter(id__in=[self.users[1].id, self.users[7].id]).update(email='Shared@example.com')
+        ESPUser.objects.filter(id=self.users[9].id).update(email='shared@example.com ')
+        request = self.make_request(self.users)
+        self.assertEqual(request.process(chunk_size=5), len(self.users) - 2)
+        texts = TextOfEmail.objects.filter(messagerequest=request)
+        self.assertEqual(texts.filter(send_to__icontains='shared@example.com').count(), 1)
+        self.assertEqual(texts.get(send_to__icontains='shared@example.com').user, self.users[1])
+
+    def test_process_queries_scale_with_chunks(self):
+        #   The number of queries should depend on the number of chunks, not
+        #   on the number of recipients.
+        def count_queries(users):
+            request = self.make_request(users)
+            with CaptureQueriesContext(connection) as queries:
+                request.process(chunk_size=4)
+            return len(queries)
+        self.assertEqual(count_queries(self.users[:4]) + 3, count_queries(self.users[:8]))
 """
 Tests for esp.dbmail.cronmail
 Source: esp/esp/dbmail/cronmail.py
 
 Tests the process_messages and send_email_requests functions.
 """
+from datetime import datetime, timedelta
 from unittest.mock import patch, MagicMock
+import time
 
 from django.contrib.auth.models import Group
+from django.core import mail
+from django.db import connection
+from django.db.models import Q
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 
+from esp.dbmail.cronmail import DeliveryEngine, TokenBucket, process_messages, send_email_requests
+from esp.dbmail.models import MessageRequest, TextOfEmail
 from esp.tests.util import CacheFlushTestCase as TestCase
+from esp.users.models import ESPUser, PersistentQueryFilter
 
 
 def _setup_roles():
@@ -117,3 +252,178 @@ def test_import(self):
     def test_process_messages_callable(self):
         from esp.dbmail.cronmail import process_messages
         self.assertTrue(callable(process_messages))
+
+
+class TokenBucketTest(TestCase):
+    def test_unlimited(self):
+        bucket = TokenBucket(0)
+        start = time.monotonic()
+        for i in range(1000):
+            bucket.take()
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_rate(self):
+        #   A burst of 2 goes through at once; the next 2 wait 0.1s each.
+        bucket = TokenBucket(10, burst=2)
+        start = time.monotonic()
+        for i in range(4):
+            bucket.take()
+        elapsed = time.monotonic() - start
+        self.assertGreaterEqual(elapsed, 0.15)
+        self.assertLess(elapsed, 0.5)
+
+
+@override_settings(EMAIL_SEND_RATE=0)
+class SendEmailRequestsTest(TestCase):
+    def setUp(self):
+        super().setUp()
+        _setup_roles()
+        self.creator = ESPUser.objects.create_user(
+            username='cronmailcreator', email='creator@example.com', password='password')
+        self.users = [
+            ESPUser.objects.create_user(
+                username='cronmail%d' % i, email='cronmail%d@example.com' % i, password='password')
+            for i in range(6)
+        ]
+        recipients = PersistentQueryFilter.create_from_Q(
+            ESPUser, Q(id__in=[user.id for user in self.users]))
+        self.request = MessageRequest.createRequest(
+            var_dict={}, subject='Hi', msgtext='Hello there', recipients=recipients,
+            sender='from@learningu.org', creator=self.creator,
+            special_headers_dict={'Reply-To': 'replyto@learningu.org'})
+        self.request.save()
+        self.request.process()
+
+    def test_send_email_requests(self):
+        send_email_requests()
+        self.assertEqual(len(mail.outbox), len(self.users))
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox),
+                         sorted('"%s" <%s>' % (u.name(), u.email) for u in self.users))
+        for message in mail.outbox:
+            self.assertEqual(message.extra_headers['Reply-To'], 'replyto@learningu.org')
+            self.assertIn('List-Unsubscribe', message.extra_headers)
+        texts = TextOfEmail.objects.filter(messagerequest=self.request)
+        self.assertFalse(texts.filter(sent__isnull=True).exists())
+        self.assertFalse(texts.exclude(msgtext='').exists())
+
+        #   Nothing is sent twice
+        send_email_requests()
+        self.assertEqual(len(mail.outbox), len(self.users))
+
+    def test_connections_are_reused(self):
+        texts = TextOfEmail.objects.filter(messagerequest=self.request)
+        with DeliveryEngine(num_connections=2) as engine:
+            results = engine.deliver(texts)
+        self.assertEqual([exception for (text, exception) in results], [None] * len(self.users))
+        self.assertLessEqual(engine.connections_opened, 2)
+
+    def test_failures_are_counted(self):
+        with patch('esp.dbmail.models.send_mail', side_effect=IOError('SMTP is down')), \
+             patch('esp.dbmail.cronmail.send_mail') as error_report:
+            send_email_requests()
+        texts = TextOfEmail.objects.filter(messagerequest=self.request)
+        self.assertEqual(list(texts.values_list('tries', flat=True).distinct()), [1])
+        self.assertFalse(texts.filter(sent__isnull=False).exists())
+        self.assertTrue(error_report.called)
+        #   Failed emails wait a bit before they can be tried again
+        self.assertFalse(texts.filter(leased_until__isnull=True).exists())
+        with patch('esp.dbmail.models.send_mail') as retry:
+            send_email_requests()
+        self.assertFalse(retry.called)
+
+    @override_settings(EMAIL_CONNECTIONS=1)
+    def test_outcomes_recorded_as_sent(self):
+        #   If the sender dies partway through a batch, the emails it already
+        #   sent are recorded, and aren't sent again by the next run.
+        class Crash(BaseException):
+            pass
+        calls = []
+        def send(*args, **kwargs):
+            calls.append(kwargs)
+            if len(calls) == 5:
+                raise Crash()
+        with patch('esp.dbmail.cronmail._RECORD_BATCH_SIZE', 2), \
+             patch('esp.dbmail.models.send_mail', side_effect=send):
+            with self.assertRaises(Crash):
+                send_email_requests()
+        texts = TextOfEmail.objects.filter(messagerequest=self.request)
+        self.assertEqual(texts.filter(sent__isnull=False).count(), 4)
+
+    def test_deliver_queries(self):
+        #   Headers are looked up once per request, not once per email.
+        texts = list(TextOfEmail.objects.filter(messagerequest=self.request).select_related('user'))
+        Site.objects.get_current()
+        with DeliveryEngine() as engine:
+            with CaptureQueriesContext(connection) as queries:
+                engine.deliver(texts[:3])
+            self.assertEqual(len(queries), 1)
+            with CaptureQueriesContext(connection) as queries:
+                engine.deliver(texts[3:])
+            self.assertEqual(len(queries), 0)
+        self.assertEqual(len(mail.outbox), len(self.users))
+        #   Each email gets its own unsubscribe header.
+        self.assertEqual(len({m.extra_headers['List-Unsubscribe'] for m in mail.outbox}), len(self.users))
+
+    def test_send_email_requests_queries(self):
+        #   The number of queries doesn't depend on the number of emails.
+        Site.objects.get_current()
+        with CaptureQueriesContext(connection) as queries:
+            send_email_requests()
+        self.assertEqual(len(mail.outbox), len(self.users))
+        request = MessageRequest.createRequest(
+            var_dict={}, subject='Hi again', msgtext='Hello', recipients=self.request.recipients,
+            sender='from@learningu.org', creator=self.creator)
+        request.save()
+        request.process()
+        TextOfEmail.objects.filter(messagerequest=request).exclude(id=TextOfEmail.objects.filter(
+            messagerequest=request).order_by('id')[0].id).delete()
+        with CaptureQueriesContext(connection) as fewer_queries:
+            send_email_requests()
+        self.assertEqual(len(mail.outbox), len(self.users) + 1)
+        self.assertEqual(len(queries), len(fewer_queries))
+
+    def test_leased_emails_are_skipped(self):
+        texts = TextOfEmail.objects.filter(messagerequest=self.request).order_by('id')
+        leased = texts[0]
+        expired = texts[1]
+        TextOfEmail.objects.filter(id=leased.id).update(leased_until=datetime.now() + timedelta(minutes=5))
+        TextOfEmail.objects.filter(id=expired.id).update(leased_until=datetime.now() - timedelta(minutes=5))
+        send_email_requests()
+        self.assertEqual(len(mail.outbox), len(self.users) - 1)
+        self.assertFalse(TextOfEmail.objects.get(id=leased.id).sent)
+        self.assertTrue(TextOfEmail.objects.get(id=expired.id).sent)
+
+    def test_claim(self):
+        texts = TextOfEmail.objects.filter(messagerequest=self.request)
+        lease = timedelta(minutes=10)
+        first = TextOfEmail.claim(texts, 4, lease)
+        second = TextOfEmail.claim(texts, 4, lease)
+        self.assertEqual(len(first), 4)
+        self.assertEqual(len(second), len(self.users) - 4)
+        self.assertFalse(set(first) & set(second))
+        self.assertEqual(TextOfEmail.claim(texts, 4, lease), [])
+        #   Once the leases expire, the emails can be claimed again.
+        later = datetime.now() + 2 * lease
+        self.assertEqual(len(TextOfEmail.claim(texts, 10, lease, now=later)), len(self.users))
+
+
+class ProcessMessagesTest(TestCase):
+    def setUp(self):
+        super().setUp()
+        _setup_roles()
+        self.creator = ESPUser.objects.create_user(
+            username='processcreator', email='creator@example.com', password='password')
+        recipients = PersistentQueryFilter.create_from_Q(ESPUser, Q(id=self.creator.id))
+        self.requests = []
+        for i in range(2):
+            request = MessageRequest.createRequest(
+                var_dict={}, subject='Hi %d' % i, msgtext='Hello', recipients=recipients,
+                sender='from@learningu.org', creator=self.creator)
+            request.save()
+            self.requests.append(request)
+
+    def test_process_messages(self):
+        processed = process_messages()
+        self.assertEqual([m.id for m in processed], [r.id for r in self.requests])
+        self.assertEqual(TextOfEmail.objects.filter(messagerequest__in=self.requests).count(), 2)
+        self.assertEqual(process_messages(), [])
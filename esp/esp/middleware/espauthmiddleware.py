@@ -42,7 +42,21 @@
 
 from esp.users.models import AnonymousESPUser, ESPUser
 
-__all__ = ('ESPAuthMiddleware',)
+__all__ = ('ESPAuthMiddleware', 'get_user_data')
+
+#   Per-user values handed to the browser, as cookies by ESPAuthMiddleware and
+#   as JSON by esp.users.views.user_data_json.
+#   : see public/media/scripts/content/user_data.js
+USER_DATA_KEYS = ('cur_username', 'cur_userid', 'cur_email',
+                  'cur_first_name', 'cur_last_name',
+                  'cur_other_user', 'cur_retTitle',
+                  'cur_admin', 'cur_roles',
+                  'cur_yog', 'cur_grade',
+                  'cur_qsd_bits')
+
+#   Values that are URL-encoded before being stored in a cookie
+QUOTED_USER_DATA_KEYS = ('cur_email', 'cur_first_name', 'cur_last_name',
+                         'cur_retTitle', 'cur_roles')
 
 def get_user(request):
     """ Code modified from django.contrib.auth.middleware.get_user
@@ -62,6 +76,31 @@ def get_user(request):
             request._cached_user = AnonymousESPUser()
     return request._cached_user
 
+def get_user_data(request, user):
+    """ The values describing a logged-in user that the browser-side scripts
+    use to fill in login boxes, admin toolbars and the like. """
+    ret_title = ''
+    try:
+        ret_title = request.session['user_morph']['retTitle']
+    except KeyError:
+        pass
+
+    has_qsd_bits = user.isAdministrator()
+
+    return {'cur_username': user.username,
+            'cur_userid': user.id,
+            'cur_email': user.email,
+            'cur_first_name': user.first_name,
+            'cur_last_name': user.last_name,
+            'cur_other_user': getattr(user, 'other_user', False) and '1' or '0',
+            'cur_retTitle': ret_title,
+            'cur_admin': user.isAdministrator() and '1' or '0',
+            'cur_qsd_bits': has_qsd_bits and '1' or '0',
+            'cur_yog': user.getYOG(),
+            'cur_grade': user.getGrade(),
+            'cur_roles': ",".join(user.getUserTypes()),
+            }
+
 class ESPAuthMiddleware(AuthenticationMiddleware):
     """ Much like the auth middleware except that this messes with cookie settings and such. """
 
@@ -75,6 +114,10 @@ def process_request(self, request):
     def process_response(self, request, response):
         ## This gets set if we're not supposed to modify the cookie
         if getattr(response, 'no_set_cookies', False):
+            if getattr(response, 'cookie_free', False):
+                ## Keep the session middleware from adding "Vary: Cookie" to a
+                ## page that is the same for everyone (see esp.utils.no_autocookie)
+                request.session.accessed = request.session.modified
             return response
 
         modified_cookies = False
@@ -93,12 +136,6 @@ def process_response(self, request, response):
             else:
                 max_age = settings.SESSION_COOKIE_AGE
                 expires = datetime.datetime.strftime(datetime.datetime.utcnow() + datetime.timedelta(seconds=settings.SESSION_COOKIE_AGE), "%a, %d-%b-%Y %H:%M:%S GMT")
-            ret_title = ''
-            try:
-                ret_title = request.session['user_morph']['retTitle']
-            except KeyError:
-                pass
-
             # URL-encode some data since cookies don't like funny characters. They
             # make the chocolate chips nervous.
             # : see public/media/scripts/content/user_data.js
@@ -107,21 +144,9 @@ def process_response(self, request, response):
             if encoding is None:
                 encoding = settings.DEFAULT_CHARSET
 
-            has_qsd_bits = user.isAdministrator()
-
-            new_values = {'cur_username': user.username,
-                          'cur_userid': user.id,
-                          'cur_email': urllib.parse.quote(user.email.encode(encoding)),
-                          'cur_first_name': urllib.parse.quote(user.first_name.encode(encoding)),
-                          'cur_last_name': urllib.parse.quote(user.last_name.encode(encoding)),
-                          'cur_other_user': getattr(user, 'other_user', False) and '1' or '0',
-                          'cur_retTitle': urllib.parse.quote(ret_title.encode(encoding)),
-                          'cur_admin': user.isAdministrator() and '1' or '0',
-                          'cur_qsd_bits': has_qsd_bits and '1' or '0',
-                          'cur_yog': user.getYOG(),
-                          'cur_grade': user.getGrade(),
-                          'cur_roles': urllib.parse.quote(",".join(user.getUserTypes())),
-                          }
+            new_values = get_user_data(request, user)
+            for key in QUOTED_USER_DATA_KEYS:
+                new_values[key] = urllib.parse.quote(new_values[key].encode(encoding))
 
             for key, value in new_values.items():
                 if request.COOKIES.get(key, "") != str(value if value else ""):
@@ -134,12 +159,7 @@ def process_response(self, request, response):
                     modified_cookies = True
 
         if user and not user.is_authenticated:
-            cookies_to_delete = [x for x in ('cur_username', 'cur_userid', 'cur_email',
-                                         'cur_first_name', 'cur_last_name',
-                                         'cur_other_user', 'cur_retTitle',
-                                         'cur_admin', 'cur_roles',
-                                         'cur_yog', 'cur_grade',
-                                         'cur_qsd_bits') if request.COOKIES.get(x, False)]
+            cookies_to_delete = [x for x in USER_DATA_KEYS if request.COOKIES.get(x, False)]
 
             list(map(response.delete_cookie, cookies_to_delete))
             modified_cookies = (len(cookies_to_delete) > 0)
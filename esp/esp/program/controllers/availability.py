@@ -0,0 +1,241 @@
+
+__author__    = "Individual contributors (see AUTHORS file)"
+__date__      = "$DATE$"
+__rev__       = "$REV$"
+__license__   = "AGPL v.3"
+__copyright__ = """
+This file is part of the ESP Web Site
+Copyright (c) 2026 by the individual contributors
+  (see AUTHORS file)
+
+The ESP Web Site is free software; you can redistribute it and/or
+modify it under the terms of the GNU Affero General Public License
+as published by the Free Software Foundation; either version 3
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public
+License along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+Contact information:
+MIT Educational Studies Program
+  84 Massachusetts Ave W20-467, Cambridge, MA 02139
+  Phone: 617-253-4882
+  Email: esp-webmasters@mit.edu
+Learning Unlimited, Inc.
+  527 Franklin St, Cambridge, MA 02139
+  Phone: 617-379-0178
+  Email: web-team@learningu.org
+"""
+
+
+from collections import defaultdict
+
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+from esp.cal.models import EventType
+from esp.program.class_status import ClassStatus
+from esp.program.models import ClassSection, ClassSubject
+from esp.users.models import UserAvailability
+
+class AvailabilityIndex(object):
+    """ The availability of teachers and moderators for a program, as bitsets.
+
+        Each event gets a bit, with the program's timeslots first in order
+        of start time, so that a set of times is just an int.  Each user's
+        available times, and the times of the sections they teach and
+        moderate, are loaded with a fixed number of queries the first time
+        they are needed; after that, working out when someone is available,
+        when a group of teachers are all available, or whether a teacher's
+        other sections conflict with some times, are set operations which
+        don't touch the database.
+
+        Users can be given as ESPUsers or IDs.  If users is given, only their
+        data is loaded; otherwise the data for
+        everyone teaching, moderating or available in the program is.  The
+        index is a snapshot, so it should be thrown away once the schedule
+        or anyone's availability changes.
+    """
+
+    def __init__(self, program, users=None):
+        self.program = program
+        if users is None:
+            self.user_ids = None
+        else:
+            self.user_ids = sorted({getattr(user, 'id', user) for user in users})
+        self._event_ids = []
+        self._bits = {}
+        for timeslot in self.timeslots:
+            self.bit(timeslot.id)
+        self.all_timeslots = (1 << len(self.timeslots)) - 1
+
+    @cached_property
+    def timeslots(self):
+        return self.program.getTimeSlotList()
+
+    def bit(self, event_id):
+        """ The bit for an event.  Events other than the program's timeslots
+            (which can still be meeting times) get bits as they come up. """
+        if event_id not in self._bits:
+            self._bits[event_id] = 1 << len(self._event_ids)
+            self._event_ids.append(event_id)
+        return self._bits[event_id]
+
+    def mask(self, events):
+        """ The bitset of a list of Events or event IDs. """
+        result = 0
+        for event in events:
+            result |= self.bit(getattr(event, 'id', event))
+        return result
+
+    def event_ids(self, mask):
+        """ The IDs of the events in a bitset, timeslots first in order of
+            start time. """
+        return [event_id for (position, event_id) in enumerate(self._event_ids) if mask >> position & 1]
+
+    def times(self, mask):
+        """ The timeslots in a bitset, in order of start time. """
+        return [timeslot for (position, timeslot) in enumerate(self.timeslots) if mask >> position & 1]
+
+    def _filter_users(self, queryset, field):
+        if self.user_ids is None:
+            return queryset
+        return queryset.filter(**{field + '__in': self.user_ids})
+
+    @cached_property
+    def _availability(self):
+        """ Map user IDs to the bitset of the times they are available, or
+            None if the program doesn't ask for availability. """
+        if not self.program.hasModule('AvailabilityModule'):
+            return None
+        et = EventType.get_from_desc('Class Time Block')
+        availability = defaultdict(int)
+        records = UserAvailability.objects.filter(event__program=self.program, event__event_type=et)
+        for (user_id, event_id) in self._filter_users(records, 'user').values_list('user_id', 'event_id'):
+            availability[user_id] |= self.bit(event_id)
+        return availability
+
+    @cached_property
+    def _taught(self):
+        """ Map user IDs to the IDs of the sections they teach. """
+        taught = defaultdict(set)
+        teachers = ClassSubject.teachers.through.objects.filter(classsubject__parent_program=self.program)
+        for (user_id, class_id) in self._filter_users(teachers, 'espuser').values_list('espuser_id', 'classsubject_id'):
+            taught[user_id].update(self._sections_by_class.get(class_id, ()))
+        return taught
+
+    @cached_property
+    def _moderated(self):
+        moderated = defaultdict(set)
+        moderators = ClassSection.moderators.through.objects.filter(classsection__parent_class__parent_program=self.program)
+        for (user_id, section_id) in self._filter_users(moderators, 'espuser').values_list('espuser_id', 'classsection_id'):
+            moderated[user_id].add(section_id)
+        return moderated
+
+    @cached_property
+    def _sections(self):
+        """ Map the IDs of the program's sections to their class ID and the
+            statuses of the section and its class. """
+        sections = ClassSection.objects.filter(parent_class__parent_program=self.program)
+        if self.user_ids is not None:
+            sections = sections.filter(Q(parent_class__teachers__in=self.user_ids) | Q(moderators__in=self.user_ids))
+        result = {}
+        for (section_id, class_id, status, class_status) in sections.values_list(
+                'id', 'parent_class_id', 'status', 'parent_class__status').distinct():
+            result[section_id] = (class_id, (status, class_status))
+        return result
+
+    @cached_property
+    def _sections_by_class(self):
+        sections_by_class = defaultdict(list)
+        for (section_id, (class_id, statuses)) in self._sections.items():
+            sections_by_class[class_id].append(section_id)
+        return sections_by_class
+
+    @cached_property
+    def _section_times(self):
+        """ Map section IDs to the bitsets of their meeting times. """
+        section_times = defaultdict(int)
+        meeting_times = ClassSection.meeting_times.through.objects.filter(
+            classsection__parent_class__parent_program=self.program).order_by('event__start', 'event_id')
+        if self.user_ids is not None:
+            meeting_times = meeting_times.filter(classsection_id__in=list(self._sections))
+        for (section_id, event_id) in meeting_times.values_list('classsection_id', 'event_id'):
+            section_times[section_id] |= self.bit(event_id)
+        return section_times
+
+    def section_mask(self, section):
+        """ The bitset of the meeting times of one of the loaded sections. """
+        return self._section_times.get(getattr(section, 'id', section), 0)
+
+    def taught_sections(self, user, include_cancelled=True):
+        """ The IDs of the sections the user teaches, in order, like
+            user.getTaughtSections(program). """
+        excluded = {ClassStatus.REJECTED} if include_cancelled else {ClassStatus.REJECTED, ClassStatus.CANCELLED}
+        return sorted(section_id for section_id in self._taught.get(getattr(user, 'id', user), ())
+                      if not excluded.intersection(self._sections[section_id][1]))
+
+    def moderated_sections(self, user):
+        return sorted(self._moderated.get(getattr(user, 'id', user), ()))
+
+    def teaching_mask(self, user, ignore_sections=()):
+        """ The times the user is teaching, leaving out ignore_sections. """
+        ignore_ids = {getattr(section, 'id', section) for section in ignore_sections}
+        result = 0
+        for section_id in self.taught_sections(user):
+            if section_id not in ignore_ids:
+                result |= self.section_mask(section_id)
+        return result
+
+    def moderating_mask(self, user):
+        result = 0
+        for section_id in self.moderated_sections(user):
+            result |= self.section_mask(section_id)
+        return result
+
+    def available_mask(self, user, ignore_classes=False, ignore_moderation=False, ignore_sections=()):
+        """ The times the user is available and free, as in
+            user.getAvailableTimes(program, ...). """
+        if self._availability is None:
+            result = self.all_timeslots
+        else:
+            result = self._availability.get(getattr(user, 'id', user), 0)
+        if not ignore_classes:
+            result &= ~self.teaching_mask(user, ignore_sections)
+        if not ignore_moderation:
+            result &= ~self.moderating_mask(user)
+        return result
+
+    def available_times(self, user, **kwargs):
+        """ The timeslots for available_mask(), in order of start time. """
+        return self.times(self.available_mask(user, **kwargs))
+
+    def common_mask(self, users, **kwargs):
+        """ The times all of the users are available.  This is empty if there
+            are no users. """
+        users = list(users)
+        if not users:
+            return 0
+        result = self.all_timeslots
+        for user in users:
+            result &= self.available_mask(user, **kwargs)
+        return result
+
+    def conflict(self, user, mask, exclude_section=None):
+        """ Return the IDs of the first of the user's other non-cancelled
+            sections which meets at one of the times in mask, and of the first
+            such time, or None if there is no such section. """
+        exclude_id = getattr(exclude_section, 'id', exclude_section)
+        for section_id in self.taught_sections(user, include_cancelled=False):
+            if section_id == exclude_id:
+                continue
+            overlap = self.section_mask(section_id) & mask
+            if overlap:
+                return (section_id, self.event_ids(overlap)[0])
+        return None
@@ -0,0 +1,133 @@
+
+__author__    = "Individual contributors (see AUTHORS file)"
+__date__      = "$DATE$"
+__rev__       = "$REV$"
+__license__   = "AGPL v.3"
+__copyright__ = """
+This file is part of the ESP Web Site
+Copyright (c) 2026 by the individual contributors
+  (see AUTHORS file)
+
+The ESP Web Site is free software; you can redistribute it and/or
+modify it under the terms of the GNU Affero General Public License
+as published by the Free Software Foundation; either version 3
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public
+License along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+Contact information:
+MIT Educational Studies Program
+  84 Massachusetts Ave W20-467, Cambridge, MA 02139
+  Phone: 617-253-4882
+  Email: esp-webmasters@mit.edu
+Learning Unlimited, Inc.
+  527 Franklin St, Cambridge, MA 02139
+  Phone: 617-379-0178
+  Email: web-team@learningu.org
+"""
+
+
+from collections import OrderedDict, defaultdict
+
+from argcache import cache_function
+
+from esp.resources.models import Resource, ResourceAssignment, ResourceType
+
+class ClassroomMatrix(object):
+    """ The classrooms of a program, by timeslot.
+
+        A classroom is a set of Resources with the same name, one for each
+        timeslot it can be used in.  The matrix records which of those exist
+        and are free, along with each one's capacity and furnishings, so that
+        questions like which rooms are free at a time, which rooms could take
+        a section, or which of a section's requests a room satisfies can be
+        answered without going back to the database.
+
+        Building the matrix takes a fixed number of queries.  Use
+        ClassroomMatrix.for_program(), which caches it until the program's
+        resources, resource assignments or timeslots change.  Resources are
+        referred to by ID.
+    """
+
+    def __init__(self, program):
+        self.program_id = program.id
+        classroom_type = ResourceType.get_or_create('Classroom')
+        rooms = Resource.objects.filter(event__program=program, res_type=classroom_type)
+
+        #   Map each room's name to an OrderedDict of the IDs of its Resources
+        #   by event ID, in order of start time.
+        self.rooms = OrderedDict()
+        self.by_event = defaultdict(list)
+        self.names = {}
+        self.capacities = {}
+        self.identical_ids = {}
+        self.event_order = {}
+        groups = {}
+        for (resource_id, name, num_students, event_id, group_id) in rooms.order_by('event__start', 'event_id', 'id').values_list(
+                'id', 'name', 'num_students', 'event_id', 'res_group_id'):
+            self.rooms.setdefault(name, OrderedDict()).setdefault(event_id, resource_id)
+            self.by_event[event_id].append(resource_id)
+            self.event_order.setdefault(event_id, len(self.event_order))
+            self.names[resource_id] = name
+            self.capacities[resource_id] = num_students
+            self.identical_ids[name] = min(resource_id, self.identical_ids.get(name, resource_id))
+            groups[resource_id] = group_id
+
+        self.taken = set(ResourceAssignment.objects.filter(resource__in=rooms).values_list('resource_id', flat=True))
+
+        furnishings_by_group = defaultdict(list)
+        furnishings = Resource.objects.filter(res_group__in=rooms.values('res_group')).exclude(res_type__name='Classroom')
+        for (group_id, res_type_id, value) in furnishings.order_by('id').values_list('res_group_id', 'res_type_id', 'attribute_value'):
+            furnishings_by_group[group_id].append((res_type_id, value))
+        self.furnishings = {resource_id: furnishings_by_group.get(group_id, []) for (resource_id, group_id) in groups.items()}
+
+    @cache_function
+    def for_program(program):
+        return ClassroomMatrix(program)
+    for_program.depend_on_row('resources.Resource', lambda res: {'program': res.event.program})
+    for_program.depend_on_row('resources.ResourceAssignment', lambda ra: {'program': ra.resource.event.program})
+    for_program.depend_on_row('cal.Event', lambda event: {'program': event.program})
+    for_program = staticmethod(for_program)
+
+    def is_free(self, resource_id):
+        return resource_id not in self.taken
+
+    def free_rooms(self, event_id):
+        """ The IDs of the classroom Resources which are free at the event,
+            as in program.getAvailableClassrooms(). """
+        return [resource_id for resource_id in self.by_event.get(event_id, []) if self.is_free(resource_id)]
+
+    def times(self, name):
+        """ The IDs of the events the room can be used at, in order of start
+            time, as in resource.matching_times(program). """
+        return list(self.rooms.get(name, ()))
+
+    def available_times(self, name):
+        """ The IDs of the events at which the room is free, in order of
+            start time, as in resource.available_times(program). """
+        return [event_id for (event_id, resource_id) in self.rooms.get(name, {}).items() if self.is_free(resource_id)]
+
+    def viable_rooms(self, event_ids):
+        """ The IDs of the classroom Resources which are free at the first of
+            the events (in order of start time), for rooms which can be used
+            at all of them. """
+        if not event_ids:
+            return []
+        return [resource_id for resource_id in self.free_rooms(event_ids[0])
+                if all(event_id in self.rooms[self.names[resource_id]] for event_id in event_ids)]
+
+    def furnishing_types(self, resource_id):
+        return {res_type_id for (res_type_id, value) in self.furnishings.get(resource_id, [])}
+
+    def unsatisfied_requests(self, resource_id, requests):
+        """ The ResourceRequests which the room's furnishings don't satisfy,
+            as in resource.satisfies_requests(). """
+        types = self.furnishing_types(resource_id)
+        return [request for request in requests if request.res_type_id not in types]
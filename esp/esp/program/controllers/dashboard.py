@@ -0,0 +1,174 @@
+
+__author__    = "Individual contributors (see AUTHORS file)"
+__date__      = "$DATE$"
+__rev__       = "$REV$"
+__license__   = "AGPL v.3"
+__copyright__ = """
+This file is part of the ESP Web Site
+Copyright (c) 2026 by the individual contributors
+  (see AUTHORS file)
+
+The ESP Web Site is free software; you can redistribute it and/or
+modify it under the terms of the GNU Affero General Public License
+as published by the Free Software Foundation; either version 3
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public
+License along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+Contact information:
+MIT Educational Studies Program
+  84 Massachusetts Ave W20-467, Cambridge, MA 02139
+  Phone: 617-253-4882
+  Email: esp-webmasters@mit.edu
+Learning Unlimited, Inc.
+  527 Franklin St, Cambridge, MA 02139
+  Phone: 617-379-0178
+  Email: web-team@learningu.org
+"""
+
+
+from collections import defaultdict
+
+from django.conf import settings
+from django.db.models import Count, Sum
+from django.db.models.query import Q
+
+from esp.program.models import ClassSection, StudentRegistration
+from esp.users.models import ESPUser
+
+#   The figures which change with every registration or check-in are cached
+#   for this many seconds, rather than recomputed after every such change.
+STATS_TIMEOUT = getattr(settings, 'DASHBOARD_STATS_TIMEOUT', 60)
+
+class DashboardStats(object):
+    """ Computes the figures on the program dashboard (the JSONDataModule
+        stats view) with a fixed number of grouped queries, however many
+        user lists, grades, classes and sections the program has. """
+
+    def __init__(self, program):
+        self.program = program
+
+    @staticmethod
+    def count_lists(queries, names=None, combined=()):
+        """ Count the active users in each of the user lists `names` (by
+            default, all of them), given a dict `queries` of Q objects by list
+            name, in one query.  `combined` is a list of (name, function)
+            pairs for extra counts; each function takes a dict of Q objects
+            selecting the members of each list (by ID, so that they can be
+            negated and combined freely) and returns one for the users to
+            count.  Returns a dict of counts by name. """
+        if names is None:
+            names = list(queries.keys())
+        members = {key: Q(id__in=ESPUser.objects.filter(query).values('id'))
+                   for (key, query) in queries.items()}
+        filters = [members[name] for name in names] + [func(members) for (name, func) in combined]
+        names = list(names) + [name for (name, func) in combined]
+        if not names:
+            return {}
+        aggregates = {'n%d' % i: Count('id', filter=q) for (i, q) in enumerate(filters)}
+        results = ESPUser.objects.filter(is_active=True).aggregate(**aggregates)
+        return {name: results['n%d' % i] for (i, name) in enumerate(names)}
+
+    def grade_counts(self):
+        """ The number of (non-rejected) classes and sections open to, and
+            of enrolled students in, each grade of the program, as a list of
+            dicts in grade order. """
+        prog = self.program
+        students = prog.students()
+        # We can't perfectly trust most_recent_profile, but it's good enough for stats
+        students_grades = students['enrolled'].filter(registrationprofile__most_recent_profile=True)
+        students_grades = students_grades.values_list('registrationprofile__student_info__graduation_year')
+        students_grades = students_grades.annotate(Count('id', distinct=True))
+        grades_dict = {result[0]: result[1] for result in students_grades}
+
+        classes = list(prog.classes().filter(status__gte=0).order_by()
+                       .annotate(num_sections=Count('sections', filter=Q(sections__status__gte=0)))
+                       .values_list('grade_min', 'grade_max', 'num_sections'))
+        grades_results = []
+        for g in range(prog.grade_min, prog.grade_max + 1):
+            year = ESPUser.YOGFromGrade(g, ESPUser.program_schoolyear(prog))
+            grade_classes = [num_sections for (grade_min, grade_max, num_sections) in classes
+                             if grade_min <= g <= grade_max]
+            grades_results.append({'grade': g, 'num_subjects': len(grade_classes),
+                                   'num_sections': sum(grade_classes),
+                                   'num_students': grades_dict.get(year, 0)})
+        return grades_results
+
+    def checked_in_counts(self):
+        """ For each class, the sum over its sections of the number of
+            enrolled students who have ever checked in to the program, by
+            class ID. """
+        prog = self.program
+        regs = StudentRegistration.valid_objects().filter(
+            relationship__name='Enrolled', section__parent_class__parent_program=prog,
+            user__record__event__name='attended', user__record__program=prog)
+        counts = defaultdict(int)
+        for (class_id, num) in regs.values('section', 'section__parent_class').order_by().annotate(
+                num=Count('user', distinct=True)).values_list('section__parent_class', 'num'):
+            counts[class_id] += num
+        return counts
+
+    def section_capacities(self, section_ids):
+        """ The capacities of the given sections, by section ID. """
+        return ClassSection.capacities(section_ids, self.program)
+
+    @staticmethod
+    def calc_hours(classes):
+        hours = {"class-hours": 0, "class-student-hours": 0, "class-registered-hours": 0, "class-checked-in-hours": 0}
+        for cls in classes:
+            if cls['subject_duration']:
+                hours["class-hours"] += float(cls['subject_duration'])
+                hours["class-student-hours"] += float(cls['subject_duration']) * (float(cls['class_size_max']) if cls['class_size_max'] else 0)
+                hours["class-registered-hours"] += float(cls['subject_duration']) * float(cls['subject_students']) / float(cls['num_sections'])
+                hours["class-checked-in-hours"] += float(cls['subject_duration']) * float(cls['subject_checked_in_students']) / float(cls['num_sections'])
+        return hours
+
+    @staticmethod
+    def calc_section_hours(sections, capacities):
+        hours = {"class-hours": 0, "class-student-hours": 0, "class-registered-hours": 0}
+        for sec in sections:
+            if sec['duration']:
+                hours["class-hours"] += float(sec['duration'])
+                hours["class-student-hours"] += float(sec['duration']) * float(capacities[sec['id']])
+                hours["class-registered-hours"] += float(sec['duration']) * float(sec['enrolled_students'])
+        return hours
+
+    def hours(self):
+        """ The class-hour figures, as a list of (label, value) pairs. """
+        prog = self.program
+        checked_in = self.checked_in_counts()
+
+        def class_rows(classes):
+            classes = classes.exclude(category__category='Lunch').annotate(
+                num_sections=Count('sections'), subject_duration=Sum('sections__duration'),
+                subject_students=Sum('sections__enrolled_students'))
+            return [{'num_sections': cls['num_sections'], 'subject_duration': cls['subject_duration'],
+                     'subject_students': cls['subject_students'], 'subject_checked_in_students': checked_in[cls['id']],
+                     'class_size_max': cls['class_size_max']}
+                    for cls in classes.values('id', 'class_size_max', 'num_sections', 'subject_duration', 'subject_students')]
+
+        reg_hours = self.calc_hours(class_rows(prog.classes()))
+        app_hours = self.calc_hours(class_rows(prog.classes().filter(status__gt=0, sections__status__gt=0)))
+        sched_sections = list(prog.sections().filter(status__gt=0, meeting_times__isnull=False).exclude(parent_class__category__category='Lunch').values('duration', 'enrolled_students', 'id'))
+        capacities = self.section_capacities(set(sec['id'] for sec in sched_sections))
+        sched_hours = self.calc_section_hours(sched_sections, capacities)
+
+        hour_num_list = []
+        hour_num_list.append(("Total # of Class-Hours (registered)", round(reg_hours["class-hours"], 2)))
+        hour_num_list.append(("Total # of Class-Hours (approved)", round(app_hours["class-hours"], 2)))
+        hour_num_list.append(("Total # of Class-Hours (scheduled)", round(sched_hours["class-hours"], 2)))
+        hour_num_list.append(("Total # of Class-Student-Hours (registered)", round(reg_hours["class-student-hours"], 2)))
+        hour_num_list.append(("Total # of Class-Student-Hours (approved)", round(app_hours["class-student-hours"], 2)))
+        hour_num_list.append(("Total # of Class-Student-Hours (scheduled)", round(sched_hours["class-student-hours"], 2)))
+        hour_num_list.append(("Total # of Class-Student-Hours (enrolled)", round(reg_hours["class-registered-hours"], 2)))
+        hour_num_list.append(("Total # of Class-Student-Hours (attended program)", round(reg_hours["class-checked-in-hours"], 2)))
+        if sched_hours["class-student-hours"]:
+            hour_num_list.append(("Class-Student-Hours Utilization", str(round(100 * reg_hours["class-registered-hours"] / sched_hours["class-student-hours"], 2)) + "%"))
+        return hour_num_list
@@ -0,0 +1,232 @@
+
+__author__    = "Individual contributors (see AUTHORS file)"
+__date__      = "$DATE$"
+__rev__       = "$REV$"
+__license__   = "AGPL v.3"
+__copyright__ = """
+This file is part of the ESP Web Site
+Copyright (c) 2026 by the individual contributors
+  (see AUTHORS file)
+
+The ESP Web Site is free software; you can redistribute it and/or
+modify it under the terms of the GNU Affero General Public License
+as published by the Free Software Foundation; either version 3
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public
+License along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+Contact information:
+MIT Educational Studies Program
+  84 Massachusetts Ave W20-467, Cambridge, MA 02139
+  Phone: 617-253-4882
+  Email: esp-webmasters@mit.edu
+Learning Unlimited, Inc.
+  527 Franklin St, Cambridge, MA 02139
+  Phone: 617-379-0178
+  Email: web-team@learningu.org
+"""
+
+import datetime
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Min
+
+from esp.program.models import ClassSection, StudentRegistration
+from esp.tagdict.models import Tag
+
+DIRTY_KEY = 'section_status_dirty:%d'
+
+def get_section_marks(section_ids):
+    """ The marks left by mark_sections_dirty() on these sections, as a dict
+        mapping section IDs to tokens; unmarked sections are left out. """
+    marks = cache.get_many([DIRTY_KEY % section_id for section_id in section_ids])
+    return {section_id: marks[DIRTY_KEY % section_id] for section_id in section_ids
+            if DIRTY_KEY % section_id in marks}
+
+def mark_sections_dirty(section_ids):
+    """ Note that the status of these sections may have changed, so that
+        the next poll of a SectionStatusFeed recomputes them.
+
+        This costs no queries, so it can be called whenever a registration
+        or section is saved.  Each section has its own mark, which is
+        replaced rather than updated, so concurrent calls cannot lose each
+        other's marks.  Marks expire after two refresh intervals, since by
+        then the full refresh of the feed has picked up the change. """
+    token = uuid.uuid4().hex
+    cache.set_many({DIRTY_KEY % section_id: token for section_id in section_ids if section_id is not None},
+                   2 * SectionStatusFeed.REFRESH_INTERVAL)
+
+class SectionStatusFeed(object):
+    """ A versioned feed of the status of the sections of a program, for the
+        onsite class changes grid.
+
+        The status of each section (capacity, enrollment and attendance
+        counts, whether it is full, and its registration status) is kept in
+        the cache together with the version at which it last changed.
+        Clients poll changes() with the version they last saw, and get back
+        only the sections which changed since then.  A poll only recomputes
+        the sections marked by mark_sections_dirty(); every REFRESH_INTERVAL
+        seconds all sections are recomputed, to pick up anything not caught
+        by the marks (such as the attendance-based fullness rules, which
+        depend on the time of day).
+
+        Versions are timestamps in milliseconds (or the previous version plus
+        one, if that is larger), so that if the cached state is lost, every
+        client is sent everything again rather than nothing.
+    """
+
+    REFRESH_INTERVAL = getattr(settings, 'SECTION_STATUS_REFRESH', 60)
+    # How long a poll waits for another one to finish updating the state
+    LOCK_TIMEOUT = 10
+
+    def __init__(self, program):
+        self.program = program
+        self.key = 'section_status_feed:%d' % program.id
+        self.lock_key = self.key + ':lock'
+
+    def sections(self, section_ids=None):
+        """ The live sections of the program, or those among section_ids. """
+        sections = ClassSection.objects.filter(status__gt=0, parent_class__status__gt=0,
+                                               parent_class__parent_program=self.program)
+        if section_ids is not None:
+            sections = sections.filter(id__in=section_ids)
+        return sections
+
+    def _tag_value(self, key, parse):
+        value = Tag.getProgramTag(key, program=self.program)
+        if value:
+            try:
+                return parse(value)
+            except ValueError:
+                pass
+        return None
+
+    def compute(self, section_ids=None):
+        """ Return the current status of those of the given sections (or of
+            all sections) which are live, by section ID.
+
+            This follows ClassSection.capacity and ClassSection.isFull(webapp=True),
+            but works them out with a fixed number of queries rather than a
+            few per section. """
+        rows = list(self.sections(section_ids).order_by().values(
+            'id', 'enrolled_students', 'attending_students', 'registration_status'
+        ).annotate(start=Min('meeting_times__start')))
+        ids = [row['id'] for row in rows]
+        capacities = ClassSection.capacities(ids, self.program) if ids else {}
+
+        now = datetime.datetime.now()
+        switch_lag = self._tag_value('switch_lag_class_attendance', int)
+        switch_time = self._tag_value('switch_time_program_attendance',
+                                      lambda value: datetime.datetime.strptime(now.strftime('%Y/%m/%d ') + value, '%Y/%m/%d %H:%M'))
+        checked_in = None
+        if ids and switch_time and now >= switch_time:
+            checked_in_students = self.program.currentlyCheckedInStudents()
+            if checked_in_students.count() >= 5:
+                checked_in = dict(StudentRegistration.valid_objects().filter(
+                    section__in=ids, relationship__name='Enrolled', user__in=checked_in_students
+                ).order_by().values('section').annotate(num=Count('user', distinct=True)).values_list('section', 'num'))
+
+        result = {}
+        for row in rows:
+            capacity = capacities[row['id']]
+            enrolled = row['enrolled_students']
+            attending = row['attending_students']
+            if row['start'] is None:
+                full = True
+            else:
+                if switch_lag and now >= row['start'] + datetime.timedelta(minutes=switch_lag) and attending >= 1:
+                    num_students = attending
+                elif checked_in is not None:
+                    num_students = checked_in.get(row['id'], 0)
+                else:
+                    num_students = enrolled
+                full = not (enrolled == capacity == 0) and num_students >= capacity
+            result[row['id']] = {
+                'capacity': capacity,
+                'enrolled': enrolled,
+                'attending': attending,
+                'full': full,
+                'registration_status': row['registration_status'],
+            }
+        return result
+
+    def _next_version(self, state):
+        return max(state['version'] + 1, int(time.time() * 1000))
+
+    def update(self):
+        """ Bring the cached state up to date, and return it.  The state is a
+            dict with the current 'version', the time of the last full
+            'refreshed', and the 'sections' dict mapping each section ID to a
+            (version, status) pair; removed sections have a status of None. """
+        state = cache.get(self.key)
+        now = time.time()
+        full = state is None or now - state['refreshed'] >= self.REFRESH_INTERVAL
+        #   Only sections the feed already knows about are checked for marks;
+        #   new sections are picked up by the next full refresh.
+        marks = get_section_marks(list(state['sections'])) if state is not None else {}
+        if not full:
+            dirty = [section_id for (section_id, mark) in marks.items() if state.get('marks', {}).get(section_id) != mark]
+            if not dirty:
+                return state
+
+        #   Only one poll at a time does the work; the others use the state
+        #   as it is, which is at most one update out of date.
+        if not cache.add(self.lock_key, True, self.LOCK_TIMEOUT):
+            return state or {'version': 0, 'refreshed': 0, 'sections': {}, 'marks': {}}
+        try:
+            if full:
+                statuses = self.compute()
+                if state is not None:
+                    for section_id in state['sections']:
+                        statuses.setdefault(section_id, None)
+            else:
+                statuses = self.compute(dirty)
+                for section_id in dirty:
+                    statuses.setdefault(section_id, None)
+
+            if state is None:
+                version = int(now * 1000)
+                state = {'version': version, 'refreshed': now, 'marks': marks,
+                         'sections': {section_id: (version, status) for (section_id, status) in statuses.items()}}
+            else:
+                if full:
+                    state['refreshed'] = now
+                #   Remember the marks we dealt with, so that only sections
+                #   marked again after this are recomputed next time.
+                state['marks'] = marks
+                changed = [section_id for (section_id, status) in statuses.items()
+                           if section_id not in state['sections'] or state['sections'][section_id][1] != status]
+                if changed:
+                    version = self._next_version(state)
+                    state['version'] = version
+                    for section_id in changed:
+                        state['sections'][section_id] = (version, statuses[section_id])
+            cache.set(self.key, state, None)
+            return state
+        finally:
+            cache.delete(self.lock_key)
+
+    def changes(self, since=None):
+        """ Return the current version and the status of every section which
+            changed after version `since` (or of all sections, if since is
+            None), by section ID.  Sections which were removed map to None. """
+        state = self.update()
+        if since is None or since > state['version']:
+            since = -1
+        sections = {section_id: status for (section_id, (version, status)) in state['sections'].items()
+                    if version > since and (status is not None or since >= 0)}
+        return state['version'], sections
+
+    def statuses(self):
+        """ The current status of every live section, by section ID. """
+        return self.changes()[1]
@@ -0,0 +1,249 @@
+
+__author__    = "Individual contributors (see AUTHORS file)"
+__date__      = "$DATE$"
+__rev__       = "$REV$"
+__license__   = "AGPL v.3"
+__copyright__ = """
+This file is part of the ESP Web Site
+Copyright (c) 2026 by the individual contributors
+  (see AUTHORS file)
+
+The ESP Web Site is free software; you can redistribute it and/or
+modify it under the terms of the GNU Affero General Public License
+as published by the Free Software Foundation; either version 3
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public
+License along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+Contact information:
+MIT Educational Studies Program
+  84 Massachusetts Ave W20-467, Cambridge, MA 02139
+  Phone: 617-253-4882
+  Email: esp-webmasters@mit.edu
+Learning Unlimited, Inc.
+  527 Franklin St, Cambridge, MA 02139
+  Phone: 617-379-0178
+  Email: web-team@learningu.org
+"""
+
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.query import Q
+
+from esp.program.models import Program
+from esp.users.models import ESPUser
+
+VERSION_KEY = 'program_user_lists_version'
+PROGRAM_VERSION_KEY = 'program_user_lists_version:%d'
+#   The lists are also recomputed after this many seconds, to pick up
+#   changes to data which invalidate_user_lists() isn't called for (such
+#   as custom form responses).
+CACHE_TIMEOUT = getattr(settings, 'USER_LIST_CACHE_TIMEOUT', 300)
+
+def invalidate_user_lists(program_id=None):
+    """ Forget the cached members of a program's user lists, or of every
+        program's if program_id is None.  This costs no queries, so it can be
+        called whenever a registration, record or anything else the lists
+        depend on is saved. """
+    key = VERSION_KEY if program_id is None else PROGRAM_VERSION_KEY % program_id
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, None)
+
+def _version(key):
+    version = cache.get(key)
+    if version is None:
+        version = 0
+        cache.add(key, version, None)
+    return version
+
+class UserSet(object):
+    """ A set of users, stored as a set of user IDs or (if complement is
+        True) as the set of IDs of the users *not* in it, so that lists can
+        be negated and combined without listing every user.
+
+        A UserSet made from program lists also remembers how it was made, as
+        an expression such as ('and', ('list', 'students', 'enrolled'),
+        ('not', ('all',))), so that a stored filter can be evaluated again
+        from the lists themselves; see ProgramUserLists.query(). """
+
+    def __init__(self, ids=(), complement=False, expr=None):
+        self.ids = frozenset(ids)
+        self.complement = complement
+        self.expr = expr
+
+    @classmethod
+    def everyone(cls):
+        return cls(complement=True, expr=('all',))
+
+    @staticmethod
+    def _combine(op, *sets):
+        if any(x.expr is None for x in sets):
+            return None
+        return (op,) + tuple(x.expr for x in sets)
+
+    def __invert__(self):
+        return UserSet(self.ids, not self.complement, self._combine('not', self))
+
+    def __and__(self, other):
+        expr = self._combine('and', self, other)
+        if not self.complement and not other.complement:
+            return UserSet(self.ids & other.ids, expr=expr)
+        elif not self.complement:
+            return UserSet(self.ids - other.ids, expr=expr)
+        elif not other.complement:
+            return UserSet(other.ids - self.ids, expr=expr)
+        else:
+            return UserSet(self.ids | other.ids, True, expr)
+
+    def __or__(self, other):
+        #   De Morgan
+        result = ~(~self & ~other)
+        result.expr = self._combine('or', self, other)
+        return result
+
+    def __eq__(self, other):
+        return isinstance(other, UserSet) and (self.ids, self.complement) == (other.ids, other.complement)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __contains__(self, user_id):
+        return (user_id in self.ids) != self.complement
+
+    def as_Q(self):
+        """ A flat Q object selecting the users in the set. """
+        if not self.complement:
+            return Q(id__in=sorted(self.ids))
+        elif self.ids:
+            return ~Q(id__in=sorted(self.ids))
+        else:
+            return Q()
+
+class UserListQuery(object):
+    """ The users in a combination of a program's lists, for use as the value
+        of an id__in lookup.
+
+        Only the program and the expression describing the combination are
+        pickled, so a PersistentQueryFilter holding one selects the current
+        members of the lists whenever it is used.  Until then, the UserSet
+        it was made from is used, so that counting the users while the list
+        is being chosen can use the cached IDs. """
+
+    def __init__(self, program_id, expr, users=None):
+        self.program_id = program_id
+        self.expr = expr
+        self.users = users
+
+    def __getstate__(self):
+        return {'program_id': self.program_id, 'expr': self.expr, 'users': None}
+
+    def __deepcopy__(self, memo):
+        #   Q objects are copied when they are combined; keep the UserSet.
+        return self
+
+    def __eq__(self, other):
+        return isinstance(other, UserListQuery) and (self.program_id, self.expr) == (other.program_id, other.expr)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.program_id, self.expr))
+
+    def as_Q(self):
+        if self.users is not None:
+            return self.users.as_Q()
+        program = Program.objects.get(id=self.program_id)
+        return ProgramUserLists(program).expression_Q(self.expr)
+
+    def resolve_expression(self, *args, **kwargs):
+        return ESPUser.objects.filter(self.as_Q()).values('id').query.resolve_expression(*args, **kwargs)
+
+class ProgramUserLists(object):
+    """ The users in the lists defined by a program's modules (the ones in
+        program.students(), teachers() and volunteers()), as UserSets.
+
+        Each list is evaluated on its own, with a single flat query, and the
+        IDs are cached until invalidate_user_lists() is next called for the
+        program or CACHE_TIMEOUT passes.  Combinations of lists are then
+        worked out with set operations, rather than by nesting the lists' Q
+        objects into one big query.  Lists whose names start with 'all' stand
+        for everyone; the caller restricts those by user type.
+    """
+
+    def __init__(self, program):
+        self.program = program
+        self._queries = {}
+
+    def queries(self, user_type_func):
+        """ The Q objects of the lists for a user type, e.g. 'students'. """
+        if user_type_func not in self._queries:
+            self._queries[user_type_func] = getattr(self.program, user_type_func)(QObjects=True)
+        return self._queries[user_type_func]
+
+    def user_type_func(self, list_name):
+        """ The name of the Program method defining the list, or None if there
+            is no such list. """
+        for user_type_func in Program.USER_TYPE_LIST_FUNCS:
+            if list_name in self.queries(user_type_func):
+                return user_type_func
+        return None
+
+    def _cache_key(self, user_type_func, list_name):
+        return 'program_user_list:%d:%d:%d:%s:%s' % (self.program.id, _version(VERSION_KEY),
+                                                     _version(PROGRAM_VERSION_KEY % self.program.id),
+                                                     user_type_func, list_name)
+
+    def get(self, list_name, user_type_func=None):
+        """ The UserSet of a list.  Raises KeyError if the list isn't defined
+            (for the given user type, if there is one). """
+        if list_name.startswith('all'):
+            return UserSet.everyone()
+        if user_type_func is None:
+            user_type_func = self.user_type_func(list_name)
+            if user_type_func is None:
+                raise KeyError(list_name)
+        query = self.queries(user_type_func)[list_name]
+
+        key = self._cache_key(user_type_func, list_name)
+        ids = cache.get(key)
+        if ids is None:
+            ids = frozenset(ESPUser.objects.filter(query).values_list('id', flat=True))
+            cache.set(key, ids, CACHE_TIMEOUT)
+        return UserSet(ids, expr=('list', user_type_func, list_name))
+
+    def query(self, users):
+        """ A Q object selecting the users in a UserSet made from this
+            program's lists, which a PersistentQueryFilter can store.  See
+            UserListQuery. """
+        return Q(id__in=UserListQuery(self.program.id, users.expr, users))
+
+    def expression_Q(self, expr):
+        """ A Q object selecting the current members of a combination of lists
+            (see UserSet), with a subquery for each list.  A list which no
+            longer exists selects nobody. """
+        op = expr[0]
+        if op == 'all':
+            return Q(id__isnull=False)
+        elif op == 'list':
+            query = self.queries(expr[1]).get(expr[2])
+            if query is None:
+                return Q(id__in=[])
+            return Q(id__in=ESPUser.objects.filter(query).values('id'))
+        elif op == 'not':
+            return ~self.expression_Q(expr[1])
+        elif op == 'and':
+            return self.expression_Q(expr[1]) & self.expression_Q(expr[2])
+        elif op == 'or':
+            return self.expression_Q(expr[1]) | self.expression_Q(expr[2])
+        raise ValueError('Unknown user list expression %r' % (expr,))
@@ -0,0 +1,118 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count
+
+from esp.program.models import ClassSection, Program, RegistrationType, StudentRegistration
+from esp.users.models import ESPUser
+from esp.utils.expirable_model import ExpirableModel
+from esp.utils.query_utils import nest_Q
+
+class _Rollback(Exception):
+    pass
+
+class Command(BaseCommand):
+    """
+    Measures the enrollment queries for a program against a synthetic
+    multi-year history of student registrations, comparing the valid-row
+    filter which uses the expired flag (and so the partial indexes over the
+    live registrations) with the one which only compares the dates.
+
+    The synthetic students get a few live registrations in the program's
+    sections, and many more expired ones, as if they had registered,
+    entered lotteries and changed classes for several years.  Everything is
+    created inside a transaction which is rolled back at the end, so
+    nothing is left behind.
+    """
+    help = 'Benchmark enrollment queries on a synthetic registration history'
+
+    def add_arguments(self, parser):
+        parser.add_argument('program', type=int, help='ID of a program with some sections')
+        parser.add_argument('--students', type=int, default=2000)
+        parser.add_argument('--years', type=int, default=5)
+        parser.add_argument('--live', type=int, default=4,
+                            help='Live registrations per student')
+        parser.add_argument('--history', type=int, default=40,
+                            help='Expired registrations per student per year')
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options)
+                raise _Rollback
+        except _Rollback:
+            pass
+
+    def run(self, options):
+        try:
+            program = Program.objects.get(id=options['program'])
+        except Program.DoesNotExist:
+            raise CommandError('No program with ID %d' % options['program'])
+        section_ids = list(ClassSection.objects.filter(parent_class__parent_program=program).values_list('id', flat=True))
+        if not section_ids:
+            raise CommandError('%s has no sections' % program)
+        names = ['Enrolled', 'Interested', 'Priority/1']
+        registration_types = RegistrationType.get_map(include=names, category='student')
+        relationships = [registration_types[name] for name in names]
+        enrolled = relationships[0]
+
+        start = time.time()
+        ESPUser.objects.bulk_create([
+            ESPUser(username='registration-benchmark-%d' % i, first_name='Bench', last_name=str(i),
+                    email='registration-benchmark-%d@example.com' % i)
+            for i in range(options['students'])])
+        students = list(ESPUser.objects.filter(username__startswith='registration-benchmark-').values_list('id', flat=True))
+
+        now = datetime.datetime.now()
+        num_rows = 0
+        for (i, student_id) in enumerate(students):
+            rows = []
+            for j in range(options['live']):
+                rows.append(StudentRegistration(
+                    user_id=student_id, section_id=section_ids[(i + j) % len(section_ids)],
+                    relationship=enrolled, start_date=now - datetime.timedelta(days=30)))
+            for year in range(options['years']):
+                for j in range(options['history']):
+                    started = now - datetime.timedelta(days=365 * year + j + 1)
+                    rows.append(StudentRegistration(
+                        user_id=student_id, section_id=section_ids[(i + j + year) % len(section_ids)],
+                        relationship=relationships[j % len(relationships)],
+                        start_date=started, end_date=started + datetime.timedelta(hours=1), expired=True))
+            StudentRegistration.objects.bulk_create(rows)
+            num_rows += len(rows)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE %s' % StudentRegistration._meta.db_table)
+        self.stdout.write('Created %d registrations for %d students over %d years in %.1fs'
+                          % (num_rows, len(students), options['years'], time.time() - start))
+
+        sample = students[::max(1, len(students) // 100)]
+        queries = [
+            ('enrollment counts by section', lambda valid: list(
+                StudentRegistration.objects.filter(valid, section__parent_class__parent_program=program, relationship=enrolled)
+                .values('section').annotate(num=Count('user', distinct=True)).order_by('section'))),
+            ('enrolled students in program', lambda valid: ESPUser.objects.filter(
+                nest_Q(valid, 'studentregistration'), studentregistration__section__parent_class__parent_program=program,
+                studentregistration__relationship=enrolled).distinct().count()),
+            ('enrolled sections of %d students' % len(sample), lambda valid: [list(
+                ClassSection.objects.filter(nest_Q(valid, 'studentregistration'), studentregistration__user=student_id,
+                                            studentregistration__relationship=enrolled).order_by('id').values_list('id', flat=True))
+                for student_id in sample]),
+        ]
+        filters = [
+            ('dates only', lambda: ExpirableModel.is_valid_qobject()),
+            ('expired flag', lambda: StudentRegistration.is_valid_qobject()),
+        ]
+        for (name, query) in queries:
+            results = {}
+            for (filter_name, valid) in filters:
+                times = []
+                for i in range(options['repeat']):
+                    start = time.time()
+                    results[filter_name] = query(valid())
+                    times.append(time.time() - start)
+                self.stdout.write('%s, %s: best %.1fms, mean %.1fms'
+                                  % (name, filter_name, 1000 * min(times), 1000 * sum(times) / len(times)))
+            assert len(set(repr(result) for result in results.values())) == 1, 'Results differ for %s' % name
@@ -0,0 +1,119 @@
+import threading
+import time
+
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+
+from esp.program.models import ClassSection, Program
+from esp.program.modules.module_ext import AJAXChangeLog
+from esp.users.models import ESPUser
+
+class Command(BaseCommand):
+    """
+    Measures the change log traffic of the AJAX scheduler during a simulated
+    session of several admins scheduling the same program, comparing the
+    clients which poll on a timer with those which long-poll.
+
+    Each simulated admin fetches the change log in its own thread, through
+    the real view, for the given duration, while the main thread makes
+    changes to the log at a steady rate.  For each mode, this reports the
+    requests and queries per scheduler, and the time it took for the changes
+    to reach the schedulers.  The changes are comments on one of the
+    program's sections, which are deleted at the end.
+
+    Long-polling requests each hold a worker while they wait, and only
+    AJAX_SCHEDULING_MAX_WAITERS of them wait at once; run with more admins
+    than that to see the others fall back to the timer.
+    """
+    help = 'Benchmark the AJAX scheduler change log with several simulated admins'
+
+    def add_arguments(self, parser):
+        parser.add_argument('program', type=int, help='ID of a program using the AJAX scheduler')
+        parser.add_argument('--admins', type=int, default=4)
+        parser.add_argument('--duration', type=float, default=60, help='Seconds per mode')
+        parser.add_argument('--changes', type=int, default=30, help='Changes per mode')
+        parser.add_argument('--interval', type=float, default=5,
+                            help='Seconds between polls of the timer clients')
+        parser.add_argument('--wait', type=float, default=20,
+                            help='Seconds the long-polling clients ask the server to wait')
+        parser.add_argument('--host', help='Host name for the requests (default: the current site)')
+
+    def handle(self, *args, **options):
+        try:
+            self.program = Program.objects.get(id=options['program'])
+        except Program.DoesNotExist:
+            raise CommandError('No program with ID %d' % options['program'])
+        self.section = ClassSection.objects.filter(parent_class__parent_program=self.program).first()
+        if self.section is None:
+            raise CommandError('%s has no sections' % self.program)
+        self.admin = ESPUser.objects.filter(groups__name='Administrator').first()
+        if self.admin is None:
+            raise CommandError('There are no admins to make the requests as')
+        self.host = options['host'] or Site.objects.get_current().domain
+        self.url = '/manage/%s/ajax_change_log' % self.program.getUrlBase()
+        self.change_log, created = AJAXChangeLog.objects.get_or_create(program=self.program)
+
+        for (name, wait) in [('timer', 0), ('long-poll', options['wait'])]:
+            self.run(name, wait, options)
+
+    def run(self, name, wait, options):
+        start_index = self.change_log.get_latest_index()
+        deadline = time.time() + options['duration']
+        #   index -> time changed, and (admin, index) -> time received
+        changed = {}
+        received = {}
+        counts = [{'requests': 0, 'queries': 0, 'errors': 0} for i in range(options['admins'])]
+
+        def admin(i):
+            client = Client(SERVER_NAME=self.host)
+            client.force_login(self.admin)
+            last_index = start_index
+            def count_query(execute, sql, params, many, context):
+                counts[i]['queries'] += 1
+                return execute(sql, params, many, context)
+            try:
+                with connection.execute_wrapper(count_query):
+                    while time.time() < deadline:
+                        response = client.get(self.url, {'last_fetched_index': last_index, 'wait': wait})
+                        counts[i]['requests'] += 1
+                        if response.status_code != 200:
+                            counts[i]['errors'] += 1
+                            time.sleep(options['interval'])
+                            continue
+                        data = response.json()
+                        now = time.time()
+                        for entry in data.get('changelog', []):
+                            received[(i, entry['index'])] = now
+                            last_index = max(last_index, entry['index'])
+                        other = data.get('other') or [{}]
+                        if not other[0].get('wait'):
+                            time.sleep(max(0, min(options['interval'], deadline - time.time())))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=admin, args=(i,)) for i in range(options['admins'])]
+        for thread in threads:
+            thread.start()
+        try:
+            for j in range(options['changes']):
+                time.sleep(options['duration'] / (options['changes'] + 1))
+                now = time.time()
+                self.change_log.appendComment('Benchmark change %d' % j, False, self.section.id, self.admin)
+                changed[self.change_log.get_latest_index()] = now
+        finally:
+            for thread in threads:
+                thread.join()
+            self.change_log.entries.filter(index__gt=start_index).delete()
+
+        delays = [received[(i, index)] - changed[index] for i in range(options['admins'])
+                  for index in changed if (i, index) in received]
+        missed = options['admins'] * len(changed) - len(delays)
+        requests = sum(count['requests'] for count in counts)
+        queries = sum(count['queries'] for count in counts)
+        self.stdout.write('%s: %.1f requests and %.1f queries per scheduler, %d errors; '
+                          'changes seen after %.2fs on average, %.2fs at most, %d missed'
+                          % (name, requests / options['admins'], queries / options['admins'],
+                             sum(count['errors'] for count in counts),
+                             sum(delays) / len(delays) if delays else 0, max(delays) if delays else 0, missed))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from esp.program.models import StudentRegistration, StudentSubjectInterest
+
+class Command(BaseCommand):
+    """
+    Flags the student registrations and subject interests whose end date has
+    passed as expired, so that queries for the valid ones skip them.  Rows
+    which are expired by saving or updating them are flagged right away;
+    this catches the ones which were given an end date in the future.
+    Meant to be run from cron.
+    """
+    help = 'Flag student registrations whose end date has passed as expired'
+
+    def handle(self, *args, **options):
+        for model in [StudentRegistration, StudentSubjectInterest]:
+            swept = model.sweep_expired()
+            if options['verbosity'] > 0:
+                self.stdout.write('Swept %d %s rows' % (swept, model.__name__))
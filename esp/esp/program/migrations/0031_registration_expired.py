@@ -0,0 +1,49 @@
+# Generated by Django 2.2.28 on 2026-10-19 12:00
+
+from datetime import datetime
+
+from django.db import migrations, models
+
+
+def mark_expired(apps, schema_editor):
+    now = datetime.now()
+    for model_name in ['StudentRegistration', 'StudentSubjectInterest']:
+        model = apps.get_model('program', model_name)
+        model.objects.filter(end_date__lt=now).update(expired=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('program', '0030_auto_20260106_2204'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='studentregistration',
+            name='expired',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AddField(
+            model_name='studentsubjectinterest',
+            name='expired',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.RunPython(mark_expired, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='studentregistration',
+            index=models.Index(condition=models.Q(expired=False), fields=['section', 'relationship'], name='sr_live_section_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='studentregistration',
+            index=models.Index(condition=models.Q(expired=False), fields=['user', 'relationship'], name='sr_live_user_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='studentsubjectinterest',
+            index=models.Index(condition=models.Q(expired=False), fields=['subject'], name='ssi_live_subject_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='studentsubjectinterest',
+            index=models.Index(condition=models.Q(expired=False), fields=['user'], name='ssi_live_user_idx'),
+        ),
+    ]
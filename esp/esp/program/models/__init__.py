@@ -53,7 +53,7 @@
 from django.db.models import Count
 from django.db.models import Q
 from django.db.models.query import QuerySet
-from django.db.models.signals import m2m_changed
+from django.db.models.signals import m2m_changed, post_save
 from django.dispatch import receiver
 from django.template.loader import render_to_string
 from django.utils import timezone
@@ -67,9 +67,10 @@
 from esp.middleware import ESPError, AjaxError
 from esp.tagdict.models import Tag
 from esp.users.models import ContactInfo, StudentInfo, TeacherInfo, EducatorInfo, GuardianInfo, ESPUser, Record
-from esp.utils.expirable_model import ExpirableModel
+from esp.utils.expirable_model import SweptExpirableModel
 from esp.utils.formats import format_lazy
 from esp.qsdmedia.models import Media
+from esp.varnish.varnish import program_surrogate_key, queue_ban_keys
 
 # Create your models here.
 @python_2_unicode_compatible
@@ -727,6 +728,14 @@ def getScheduleConstraints(self):
     getScheduleConstraints.depend_on_model('program.ScheduleTestCategory')
     getScheduleConstraints.depend_on_model('program.ScheduleTestSectionList')
 
+    @cache_function
+    def getCompiledScheduleConstraints(self):
+        """ The program's schedule constraints, compiled so that checking them
+            against a ScheduleMap needs at most one query (see ScheduleMap.category_id()). """
+        return [constraint.compile() for constraint in self.getScheduleConstraints()]
+    getCompiledScheduleConstraints.depend_on_cache(getScheduleConstraints, lambda self=wildcard, **kwargs: {'self': self})
+    getCompiledScheduleConstraints.depend_on_model('program.BooleanExpression')
+
     def lock_schedule(self, lock_level=1):
         """ Locks all schedule assignments for the program, for convenience
             (e.g. between scheduling some sections manually and running
@@ -794,7 +803,9 @@ def getClassrooms(self, timeslot=None):
 
     def getAvailableClassrooms(self, timeslot):
         #   Filters down classrooms to those that are not taken.
-        return [x for x in self.getClassrooms(timeslot) if x.is_available()]
+        from esp.program.controllers.classrooms import ClassroomMatrix
+        free = set(ClassroomMatrix.for_program(self).free_rooms(timeslot.id))
+        return [x for x in self.getClassrooms(timeslot) if x.id in free]
 
     def collapsed_dict(self, resources):
         result = {}
@@ -1813,6 +1824,69 @@ def boolean_value(self, *args, **kwargs):
         else:
             return False
 
+    def compile(self):
+        """ The node standing for this token in a compiled expression (see
+            compile_stack()).  Subclasses whose value depends on a schedule
+            map should override this with a node evaluate_compiled() knows
+            how to handle; otherwise the token itself is kept, and its
+            boolean_value() is called with the map. """
+        if type(self).boolean_value is BooleanToken.boolean_value:
+            return ('const', self.boolean_value())
+        return ('token', self)
+
+    @staticmethod
+    def compile_stack(stack):
+        """ Compile a stack of Boolean tokens into an expression tree, which
+            evaluate_compiled() evaluates the same way as evaluate() would
+            evaluate the stack, without touching the tokens or the database.
+            The tree is made of tuples, so it can be cached. """
+        node = None
+        stack = list(stack)
+        while (node is None) and (len(stack) > 0):
+            token = stack.pop()
+
+            if (token.text == '||') or (token.text.lower() == 'or'):
+                (node1, stack) = BooleanToken.compile_stack(stack)
+                (node2, stack) = BooleanToken.compile_stack(stack)
+                node = ('or', node1, node2)
+            elif (token.text == '&&') or (token.text.lower() == 'and'):
+                (node1, stack) = BooleanToken.compile_stack(stack)
+                (node2, stack) = BooleanToken.compile_stack(stack)
+                node = ('and', node1, node2)
+            elif (token.text == '!') or (token.text == '~') or (token.text.lower() == 'not'):
+                (node1, stack) = BooleanToken.compile_stack(stack)
+                node = ('not', node1)
+            else:
+                node = token.compile()
+
+        return (node, stack)
+
+    @staticmethod
+    def evaluate_compiled(node, schedule_map):
+        """ Evaluate an expression tree from compile_stack() on a ScheduleMap. """
+        if node is None:
+            return None
+        op = node[0]
+        if op == 'const':
+            return node[1]
+        elif op == 'or':
+            value1 = BooleanToken.evaluate_compiled(node[1], schedule_map)
+            return value1 or BooleanToken.evaluate_compiled(node[2], schedule_map)
+        elif op == 'and':
+            value1 = BooleanToken.evaluate_compiled(node[1], schedule_map)
+            return value1 and BooleanToken.evaluate_compiled(node[2], schedule_map)
+        elif op == 'not':
+            return not BooleanToken.evaluate_compiled(node[1], schedule_map)
+        elif op == 'occupied':
+            return len(schedule_map.map.get(node[1], [])) > 0
+        elif op == 'category':
+            return any(schedule_map.category_id(sec) == node[2] for sec in schedule_map.map.get(node[1], []))
+        elif op == 'sections':
+            return any(sec.id in node[2] for sec in schedule_map.map.get(node[1], []))
+        elif op == 'token':
+            return node[1].boolean_value(map=schedule_map.map)
+        raise ValueError('Unknown compiled Boolean operation %r' % (op,))
+
 @python_2_unicode_compatible
 class BooleanExpression(models.Model):
     """ A combination of BooleanTokens that can be manipulated and evaluated.
@@ -1874,6 +1948,11 @@ def evaluate(self, *args, **kwargs):
         (value, post_stack) = BooleanToken.evaluate(stack, *args, **kwargs)
         return value
 
+    def compile(self):
+        """ The expression as a tree for BooleanToken.evaluate_compiled(). """
+        (node, post_stack) = BooleanToken.compile_stack(self.get_stack())
+        return node
+
 @python_2_unicode_compatible
 class ScheduleMap:
     """ The schedule map is a dictionary mapping Event IDs to lists of class sections.
@@ -1895,8 +1974,19 @@ def populate(self):
             for m in s._timeslot_ids:
                 result[m].append(s)
         self.map = result
+        self._categories = {}
         return self.map
 
+    def category_id(self, sec):
+        """ The ID of the category of a section in the map.  The first call
+            looks them up for every section in the map with one query. """
+        if sec.id not in self._categories:
+            from esp.program.models.class_ import ClassSection
+            section_ids = set(s.id for sections in self.map.values() for s in sections)
+            section_ids.add(sec.id)
+            self._categories.update(ClassSection.objects.filter(id__in=section_ids).values_list('id', 'parent_class__category'))
+        return self._categories[sec.id]
+
     def add_section(self, sec):
         for t in sec.timeslot_ids():
             self.map[t].append(sec)
@@ -1942,17 +2032,61 @@ class Meta:
     def __str__(self):
         return '%s: "%s" requires "%s"' % (self.program.niceName(), str(self.condition), str(self.requirement))
 
+    def compile(self):
+        """ The constraint with its condition and requirement compiled, for
+            evaluating without queries.  See Program.getCompiledScheduleConstraints(). """
+        return CompiledScheduleConstraint(self.id, self.condition.compile(), self.requirement.compile(),
+                                          self.requirement.label, self.on_failure)
+
+    def evaluate(self, smap, recursive=True):
+        compiled = self.compile()
+        result = compiled.evaluate(smap, recursive)
+        self.schedule_map = compiled.schedule_map
+        return result
+
+    def handle_failure(self):
+        return run_failure_handler(self.on_failure, self.schedule_map)
+
+def run_failure_handler(on_failure, schedule_map):
+    """ Run the on_failure code of a ScheduleConstraint on a schedule map. """
+    #   Try the on_failure callback but be very lenient about it (fail silently)
+    try:
+        func_str = """def _f(schedule_map):
+%s""" % ('\n'.join('    %s' % l.rstrip() for l in on_failure.strip().split('\n')))
+        exec(func_str)
+        result = _f(schedule_map)
+        return result
+    except Exception as inst:
+        #   raise ESPError('Schedule constraint handler error: %s' % inst, log=False)
+        pass
+    #   If we got nothing from the on_failure function, just provide Nones.
+    return (None, None)
+
+class CompiledScheduleConstraint(object):
+    """ A ScheduleConstraint whose condition and requirement have been
+        compiled into expression trees (see BooleanToken.compile_stack()),
+        so that it can be cached and evaluated on a ScheduleMap without
+        looking up its tokens, their timeblocks or categories. """
+
+    def __init__(self, constraint_id, condition, requirement, requirement_label, on_failure):
+        self.id = constraint_id
+        self.condition = condition
+        self.requirement = requirement
+        self.requirement_label = requirement_label
+        self.on_failure = on_failure
+
     def evaluate(self, smap, recursive=True):
+        """ Same as ScheduleConstraint.evaluate(). """
         self.schedule_map = smap
-        cond_state = self.condition.evaluate(map=self.schedule_map.map)
+        cond_state = BooleanToken.evaluate_compiled(self.condition, self.schedule_map)
         if cond_state:
-            result = self.requirement.evaluate(map=self.schedule_map.map)
+            result = BooleanToken.evaluate_compiled(self.requirement, self.schedule_map)
             if result:
                 return True
             else:
                 if recursive:
                     #   Try using the execution hook for arbitrary code... and running again to see if it helped.
-                    (fail_result, data) = self.handle_failure()
+                    (fail_result, data) = run_failure_handler(self.on_failure, self.schedule_map)
                     if isinstance(fail_result, ScheduleMap):
                         self.schedule_map = fail_result
                     #   raise AjaxError('ScheduleConstraint says %s' % data)
@@ -1962,20 +2096,6 @@ def evaluate(self, smap, recursive=True):
         else:
             return True
 
-    def handle_failure(self):
-        #   Try the on_failure callback but be very lenient about it (fail silently)
-        try:
-            func_str = """def _f(schedule_map):
-%s""" % ('\n'.join('    %s' % l.rstrip() for l in self.on_failure.strip().split('\n')))
-            exec(func_str)
-            result = _f(self.schedule_map)
-            return result
-        except Exception as inst:
-            #   raise ESPError('Schedule constraint handler error: %s' % inst, log=False)
-            pass
-        #   If we got nothing from the on_failure function, just provide Nones.
-        return (None, None)
-
 class ScheduleTestTimeblock(BooleanToken):
     """ A boolean value that keeps track of a timeblock.
         This is an abstract base class that doesn't define
@@ -2001,6 +2121,9 @@ def boolean_value(self, *args, **kwargs):
                 return True
         return False
 
+    def compile(self):
+        return ('occupied', self.timeblock_id)
+
 class ScheduleTestCategory(ScheduleTestTimeblock):
     """ Boolean value testing: Does the schedule contain at least one section
         in the specified category at the specified time?
@@ -2015,6 +2138,9 @@ def boolean_value(self, *args, **kwargs):
                     return True
         return False
 
+    def compile(self):
+        return ('category', self.timeblock_id, self.category_id)
+
     class Meta:
         app_label = 'program'
         verbose_name_plural = 'Schedule test categories'
@@ -2038,6 +2164,9 @@ def boolean_value(self, *args, **kwargs):
                     return True
         return False
 
+    def compile(self):
+        return ('sections', self.timeblock_id, frozenset(int(a) for a in self.section_ids.split(',')))
+
     @classmethod
     def filter_by_section(cls, section):
         return cls.filter_by_sections([section])
@@ -2187,7 +2316,7 @@ class Meta:
         app_label = 'program'
 
 @python_2_unicode_compatible
-class StudentRegistration(ExpirableModel):
+class StudentRegistration(SweptExpirableModel):
     """
     Model relating a student with a class section (interest, priority,
     enrollment, etc.).
@@ -2198,12 +2327,18 @@ class StudentRegistration(ExpirableModel):
 
     class Meta:
         app_label = 'program'
+        #   Indexes over the registrations which haven't expired, which
+        #   valid_objects() queries use; see SweptExpirableModel.
+        indexes = [
+            models.Index(fields=['section', 'relationship'], name='sr_live_section_idx', condition=Q(expired=False)),
+            models.Index(fields=['user', 'relationship'], name='sr_live_user_idx', condition=Q(expired=False)),
+        ]
 
     def __str__(self):
         return '%s %s in %s' % (self.user, self.relationship, self.section)
 
 @python_2_unicode_compatible
-class StudentSubjectInterest(ExpirableModel):
+class StudentSubjectInterest(SweptExpirableModel):
     """
     Model indicating a student interest in a class section.
     """
@@ -2212,12 +2347,21 @@ class StudentSubjectInterest(ExpirableModel):
 
     class Meta:
         app_label = 'program'
+        indexes = [
+            models.Index(fields=['subject'], name='ssi_live_subject_idx', condition=Q(expired=False)),
+            models.Index(fields=['user'], name='ssi_live_user_idx', condition=Q(expired=False)),
+        ]
 
     def __str__(self):
         return '%s interest in %s' % (self.user, self.subject)
 
 
 # Hooked up in program.modules.signals and formstack.signals
+@receiver(post_save, sender=Program, dispatch_uid='purge_program_pages')
+def purge_program_pages(sender, instance, **kwargs):
+    """ Ban every cached page of the program from Varnish. """
+    queue_ban_keys([program_surrogate_key(instance.id)])
+
 def maybe_create_module_ext(handler, ext):
     """Registers a signal handler which creates program module extensions.
 
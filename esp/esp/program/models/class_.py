@@ -47,7 +47,7 @@
 from django.conf import settings
 from django.db import models, transaction
 from django.db.models.query import Q
-from django.db.models import signals, Sum
+from django.db.models import signals, Max, Sum
 from django.db.models.manager import Manager
 from collections import OrderedDict
 from django.template.loader import render_to_string
@@ -57,6 +57,7 @@
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.sites.models import Site
 from django.core.validators import RegexValidator
+from django.dispatch import receiver
 
 from django_extensions.db.fields.json import JSONField
 
@@ -82,6 +83,7 @@
 from argcache                     import cache_function, wildcard
 from argcache.extras.derivedfield import DerivedField
 from esp.program.class_status import ClassStatus
+from esp.varnish.varnish import catalog_surrogate_key, queue_ban_keys
 
 from esp.middleware.threadlocalrequest import get_current_request
 
@@ -344,7 +346,7 @@ def prefetch_catalog_data(cls, queryset):
         now = datetime.datetime.now()
         enrolled_type = RegistrationType.get_map()['Enrolled']
 
-        select = OrderedDict([( '_count_students', 'SELECT COUNT(DISTINCT "program_studentregistration"."user_id") FROM "program_studentregistration" WHERE ("program_studentregistration"."relationship_id" = %s AND "program_studentregistration"."section_id" = "program_classsection"."id" AND ("program_studentregistration"."start_date" IS NULL OR "program_studentregistration"."start_date" <= %s) AND ("program_studentregistration"."end_date" IS NULL OR "program_studentregistration"."end_date" >= %s))')])
+        select = OrderedDict([( '_count_students', 'SELECT COUNT(DISTINCT "program_studentregistration"."user_id") FROM "program_studentregistration" WHERE ("program_studentregistration"."relationship_id" = %s AND "program_studentregistration"."section_id" = "program_classsection"."id" AND NOT "program_studentregistration"."expired" AND ("program_studentregistration"."start_date" IS NULL OR "program_studentregistration"."start_date" <= %s) AND ("program_studentregistration"."end_date" IS NULL OR "program_studentregistration"."end_date" >= %s))')])
 
         select_params = [ enrolled_type.id,
                           now,
@@ -470,6 +472,60 @@ def _get_capacity(self, ignore_changes=False):
 
     capacity = property(_get_capacity)
 
+    @classmethod
+    def capacities(cls, section_ids, program):
+        """ The capacities of the given sections of a program, by section ID.
+            This works out the capacity property for all of them with three
+            queries, however many sections there are. """
+        options = program.studentclassregmoduleinfo
+
+        room_sizes = defaultdict(lambda: defaultdict(int))
+        rooms = ResourceAssignment.objects.filter(target__in=section_ids, resource__res_type__name='Classroom')
+        for (section_id, resource_id, event_id, num_students) in rooms.values_list(
+                'target', 'resource', 'resource__event', 'resource__num_students').distinct():
+            room_sizes[section_id][event_id] += num_students
+
+        def room_capacity(section_id):
+            #   The summed classroom capacity for each timeblock, minimized.
+            rc = min(room_sizes[section_id].values())
+            if options.apply_multiplier_to_room_cap:
+                rc = int(rc * options.class_cap_multiplier + options.class_cap_offset)
+            return rc
+
+        capacities = {}
+        sections = cls.objects.filter(id__in=section_ids).order_by().values(
+            'id', 'max_class_capacity', 'parent_class__class_size_max', 'parent_class__class_size_optimal'
+        ).annotate(max_range=Max('parent_class__allowable_class_size_ranges__range_max'))
+        for sec in sections:
+            has_rooms = sec['id'] in room_sizes
+            class_size_max = sec['parent_class__class_size_max']
+            class_size_optimal = sec['parent_class__class_size_optimal']
+            ans = None
+            if sec['max_class_capacity'] is not None:
+                ans = sec['max_class_capacity']
+            elif not has_rooms:
+                ans = class_size_max
+            else:
+                ans = min(class_size_max, room_capacity(sec['id']))
+
+            if ans is None or ans == 0:
+                if sec['max_range'] is not None and has_rooms:
+                    ans = min(max(sec['max_range'], class_size_optimal), room_capacity(sec['id']))
+                elif class_size_optimal and has_rooms:
+                    ans = min(class_size_optimal, room_capacity(sec['id']))
+                elif class_size_optimal:
+                    ans = class_size_optimal
+                elif has_rooms:
+                    ans = room_capacity(sec['id'])
+                else:
+                    ans = 0
+
+            if not options.apply_multiplier_to_room_cap:
+                capacities[sec['id']] = int(ans * options.class_cap_multiplier + options.class_cap_offset)
+            else:
+                capacities[sec['id']] = int(ans)
+        return capacities
+
     def title(self):
         return self.parent_class.title
 
@@ -739,33 +795,24 @@ def assign_room(self, base_room, clear_others=False, allow_partial=False, lock=0
 
         return (status, errors)
 
-    def viable_times(self, ignore_classes=False):
-        """ Return a list of Events for which all of the teachers are available. """
-
-        def intersect_lists(list_of_lists):
-            if len(list_of_lists) == 0:
-                return []
+    def viable_times(self, ignore_classes=False, index=None):
+        """ Return a list of Events for which all of the teachers are available.
 
-            base_list = list_of_lists[0]
-            for other_list in list_of_lists[1:]:
-                i = 0
-                for elt in base_list:
-                    if elt not in other_list:
-                        base_list.remove(elt)
-            return base_list
+        index is an AvailabilityIndex for the program to use, which saves
+        loading everyone's availability again when checking many sections. """
+        from esp.program.controllers.availability import AvailabilityIndex
 
         teachers = self.parent_class.get_teachers()
+        if index is None:
+            index = AvailabilityIndex(self.parent_program, teachers)
 
-        timeslot_list = []
-        for t in teachers:
-            timeslot_list.append(list(t.getAvailableTimes(self.parent_program, ignore_classes)))
-
-        available_times = intersect_lists(timeslot_list)
+        available_times = index.times(index.common_mask(teachers, ignore_classes=ignore_classes))
 
         #   If the class is already scheduled, put its time in.
         if self.isScheduled():
+            available_ids = {e.id for e in available_times}
             for k in self.meeting_times.all():
-                if k not in available_times:
+                if k.id not in available_ids:
                     available_times.append(k)
 
         timeslots = Event.group_contiguous(available_times, int(Tag.getProgramTag('timeblock_contiguous_tolerance', program = self.parent_class.parent_program)))
@@ -785,32 +832,23 @@ def viable_rooms(self):
         """ Returns a list of Resources (classroom type) that satisfy all of this class's resource requests.
         Resources matching the first time block of the class will be returned. """
 
-        def room_satisfies_times(room, times):
-            room_times = room.matching_times()
-            satisfaction = True
-            for t in times:
-                if t not in room_times:
-                    satisfaction = False
-            return satisfaction
+        from esp.program.controllers.classrooms import ClassroomMatrix
 
         #   This function is only meaningful if the times have already been set.  So, back out if they haven't.
         if not self.sufficient_length():
             return []
 
-        #   Start with all rooms the program has.
-        #   Filter the ones that are available at all times needed by the class.
-        filter_qs = []
-        ordered_times = self.meeting_times.order_by('start')
-        first_time = ordered_times[0]
-        possible_rooms = self.parent_program.getAvailableClassrooms(first_time)
-
-        viable_list = [x for x in possible_rooms if room_satisfies_times(x, ordered_times)]
-
-        return viable_list
+        #   Start with the rooms that are free at the first time needed by the
+        #   class, and keep the ones that exist at all of the times.
+        matrix = ClassroomMatrix.for_program(self.parent_program)
+        room_ids = matrix.viable_rooms(list(self.meeting_times.order_by('start').values_list('id', flat=True)))
+        rooms = Resource.objects.select_related('event').in_bulk(room_ids)
+        return [rooms[room_id] for room_id in room_ids]
 
     viable_rooms.depend_on_row('program.ClassSection', lambda cs: {'self': cs})
     viable_rooms.depend_on_m2m('program.ClassSection', 'meeting_times', lambda cs, ev: {'self': cs})
     viable_rooms.depend_on_model('resources.Resource')
+    viable_rooms.depend_on_model('resources.ResourceAssignment')
 
     def clearRooms(self):
         self.classroomassignments().delete()
@@ -846,13 +884,13 @@ def timeslot_ids(self):
     timeslot_ids.depend_on_m2m('program.ClassSection', 'meeting_times', lambda instance, object: {'self': instance})
 
     def cannotRemove(self, user):
-        relevantConstraints = self.parent_program.getScheduleConstraints()
+        relevantConstraints = self.parent_program.getCompiledScheduleConstraints()
         if relevantConstraints:
             sm = ScheduleMap(user, self.parent_program)
             sm.remove_section(self)
             for exp in relevantConstraints:
                 if not exp.evaluate(sm, recursive=False):
-                    return "You can't remove this class from your schedule because it would violate the requirement that you %s.  You can go back and correct this." % exp.requirement.label
+                    return "You can't remove this class from your schedule because it would violate the requirement that you %s.  You can go back and correct this." % exp.requirement_label
         return False
 
     def cannotAdd(self, user, checkFull=True, autocorrect_constraints=True, ignore_constraints=False, webapp=False):
@@ -867,7 +905,7 @@ def cannotAdd(self, user, checkFull=True, autocorrect_constraints=True, ignore_c
         if ignore_constraints:
             relevantConstraints = ScheduleConstraint.objects.none()
         else:
-            relevantConstraints = self.parent_program.getScheduleConstraints()
+            relevantConstraints = self.parent_program.getCompiledScheduleConstraints()
 
         if relevantConstraints:
             # Set up a ScheduleMap; fake-insert this class into it
@@ -876,7 +914,7 @@ def cannotAdd(self, user, checkFull=True, autocorrect_constraints=True, ignore_c
 
             for exp in relevantConstraints:
                 if not exp.evaluate(sm, recursive=autocorrect_constraints):
-                    return "Adding <i>%s</i> to your schedule requires that you %s.  You can go back and correct this." % (self.title(), exp.requirement.label)
+                    return "Adding <i>%s</i> to your schedule requires that you %s.  You can go back and correct this." % (self.title(), exp.requirement_label)
 
         scrmi = self.parent_program.studentclassregmoduleinfo
         section_list = user.getEnrolledSectionsFromProgram(self.parent_program)
@@ -914,17 +952,18 @@ def cannotAdd(self, user, checkFull=True, autocorrect_constraints=True, ignore_c
         # this user *can* add this class!
         return False
 
-    def conflicts(self, teacher, meeting_times=None):
+    def conflicts(self, teacher, meeting_times=None, index=None):
         """Return a scheduling conflict if one exists, or None."""
-        user = teacher
+        from esp.program.controllers.availability import AvailabilityIndex
+
+        if index is None:
+            index = AvailabilityIndex(self.parent_program, [teacher])
         if meeting_times is None:
             meeting_times = self.meeting_times.all()
-        for sec in user.getTaughtSections(self.parent_program, include_cancelled = False).exclude(id=self.id):
-            for time in sec.meeting_times.all():
-                if meeting_times.filter(id = time.id).exists():
-                    return (sec, time)
-
-        return None
+        conflict = index.conflict(teacher, index.mask(meeting_times), exclude_section=self)
+        if conflict is None:
+            return None
+        return (ClassSection.objects.get(id=conflict[0]), Event.objects.get(id=conflict[1]))
 
     def cannotSchedule(self, meeting_times, ignore_classes=True):
         """
@@ -933,17 +972,21 @@ def cannotSchedule(self, meeting_times, ignore_classes=True):
         Assumes meeting_times is a sorted QuerySet of correct length.
 
         """
+        from esp.program.controllers.availability import AvailabilityIndex
+
         # check if proposed times are the same as the current meeting_times
         current_times = self.meeting_times.all()
         if all(time in current_times for time in meeting_times):
             return False
         # otherwise, check if all teachers are available
-        for t in self.teachers:
-            available = t.getAvailableTimes(self.parent_program, ignore_classes=ignore_classes, ignore_sections=[self])
+        teachers = list(self.teachers)
+        index = AvailabilityIndex(self.parent_program, teachers)
+        for t in teachers:
+            available = index.available_mask(t, ignore_classes=ignore_classes, ignore_sections=[self])
             for e in meeting_times:
-                if e not in available:
+                if not index.bit(e.id) & available:
                     return "The teacher %s has not indicated availability during %s." % (t.name(), e.pretty_time())
-            conflicts = self.conflicts(t, meeting_times)
+            conflicts = self.conflicts(t, meeting_times, index=index)
             if conflicts:
                 return "The teacher %s is teaching %s during %s." % (t.name(), conflicts[0].emailcode(), conflicts[1].pretty_time())
             # Fallback in case we couldn't come up with details
@@ -1406,6 +1449,19 @@ def save(self, *args, **kwargs):
             self.parent_class.status = int(self.status)
             self.parent_class.save()
 
+    #   Fields shown in the catalog; saves which change none of them (such as
+    #   recomputing the enrollment counts) don't need to ban the catalog.
+    CATALOG_FIELDS = ('status', 'registration_status', 'duration', 'max_class_capacity', 'parent_class')
+
+    def catalog_state(self):
+        return tuple(self.serializable_value(name) for name in self.CATALOG_FIELDS)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_catalog_state = instance.catalog_state()
+        return instance
+
     class Meta:
         db_table = 'program_classsection'
         app_label = 'program'
@@ -1841,13 +1897,13 @@ def getResourceRequests(self): # get all resource requests associated with this
         return ResourceRequest.objects.filter(target__parent_class=self)
 
     def conflicts(self, teacher):
+        from esp.program.controllers.availability import AvailabilityIndex
+
         user = teacher
-        for cls in user.getTaughtClasses(self.parent_program, include_cancelled = False):
-            for section in cls.get_sections():
-                for time in section.meeting_times.all():
-                    for sec in self.sections.all().exclude(id=section.id):
-                        if sec.meeting_times.filter(id = time.id).exists():
-                            return True
+        index = AvailabilityIndex(self.parent_program, [user])
+        for sec in self.sections.all().prefetch_related('meeting_times'):
+            if index.conflict(user, index.mask(sec.meeting_times.all()), exclude_section=sec):
+                return True
 
         #   Check that adding this teacher as a coteacher would not overcommit them
         #   to more hours of teaching than the program allows.
@@ -2156,6 +2212,118 @@ def sections_in_program_by_id(prog):
 sections_in_program_by_id.depend_on_model(ClassSection)
 sections_in_program_by_id.depend_on_model(ClassSubject)
 
+@receiver(signals.post_save, sender=ClassSubject, dispatch_uid='purge_catalog_subject_save')
+@receiver(signals.post_delete, sender=ClassSubject, dispatch_uid='purge_catalog_subject_delete')
+def purge_catalog_for_subject(sender, instance, **kwargs):
+    """ Ban the cached catalog pages of the class's program from Varnish. """
+    queue_ban_keys([catalog_surrogate_key(instance.parent_program_id)])
+
+def _section_program_id(section):
+    if ClassSection.parent_class.is_cached(section):
+        return section.parent_class.parent_program_id
+    return ClassSubject.objects.filter(id=section.parent_class_id).values_list('parent_program_id', flat=True).first()
+
+@receiver(signals.post_save, sender=ClassSection, dispatch_uid='purge_catalog_section_save')
+def purge_catalog_for_section(sender, instance, created, update_fields=None, **kwargs):
+    """ Ban the cached catalog pages of the section's program from Varnish,
+        if the save changed anything shown in the catalog. """
+    state = instance.catalog_state()
+    if not created:
+        if update_fields is not None and not set(update_fields) & set(ClassSection.CATALOG_FIELDS):
+            return
+        if getattr(instance, '_loaded_catalog_state', None) == state:
+            return
+    instance._loaded_catalog_state = state
+    program_id = _section_program_id(instance)
+    if program_id is not None:
+        queue_ban_keys([catalog_surrogate_key(program_id)])
+
+@receiver(signals.post_delete, sender=ClassSection, dispatch_uid='purge_catalog_section_delete')
+def purge_catalog_for_deleted_section(sender, instance, **kwargs):
+    """ Ban the cached catalog pages of the section's program from Varnish. """
+    program_id = _section_program_id(instance)
+    #   If the parent class is gone too, it took care of the ban.
+    if program_id is not None:
+        queue_ban_keys([catalog_surrogate_key(program_id)])
+
+def _ban_catalogs_for_sections(section_ids):
+    program_ids = ClassSubject.objects.filter(sections__in=section_ids).values_list('parent_program_id', flat=True).distinct()
+    queue_ban_keys([catalog_surrogate_key(program_id) for program_id in program_ids])
+
+@receiver(signals.m2m_changed, sender=ClassSection.meeting_times.through, dispatch_uid='purge_catalog_meeting_times')
+def purge_catalog_for_meeting_times(sender, instance, action, reverse, pk_set, **kwargs):
+    """ The catalog shows the times of each section. """
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        program_id = _section_program_id(instance)
+        if program_id is not None:
+            queue_ban_keys([catalog_surrogate_key(program_id)])
+    elif pk_set:
+        _ban_catalogs_for_sections(pk_set)
+    elif instance.program_id is not None:
+        #   An event's sections were cleared; they belong to its program.
+        queue_ban_keys([catalog_surrogate_key(instance.program_id)])
+
+@receiver(signals.m2m_changed, sender=ClassSubject.teachers.through, dispatch_uid='purge_catalog_teachers')
+def purge_catalog_for_teachers(sender, instance, action, reverse, pk_set, **kwargs):
+    """ The catalog shows the teachers of each class. """
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        program_ids = [instance.parent_program_id]
+    elif pk_set:
+        program_ids = ClassSubject.objects.filter(id__in=pk_set).values_list('parent_program_id', flat=True).distinct()
+    else:
+        #   All of a teacher's classes were removed, and we can't tell which
+        #   they were, so ban every program's catalog.
+        program_ids = Program.objects.values_list('id', flat=True)
+    queue_ban_keys([catalog_surrogate_key(program_id) for program_id in program_ids])
+
+@receiver(signals.post_save, sender=ResourceAssignment, dispatch_uid='purge_catalog_assignment_save')
+@receiver(signals.post_delete, sender=ResourceAssignment, dispatch_uid='purge_catalog_assignment_delete')
+def purge_catalog_for_assignment(sender, instance, **kwargs):
+    """ The catalog shows the rooms and capacities of each section. """
+    if instance.target_id is not None:
+        _ban_catalogs_for_sections([instance.target_id])
+    if instance.target_subj_id is not None:
+        program_id = ClassSubject.objects.filter(id=instance.target_subj_id).values_list('parent_program_id', flat=True).first()
+        if program_id is not None:
+            queue_ban_keys([catalog_surrogate_key(program_id)])
+
+@receiver(signals.post_save, sender=StudentRegistration, dispatch_uid='section_status_registration_save')
+@receiver(signals.post_delete, sender=StudentRegistration, dispatch_uid='section_status_registration_delete')
+@receiver(signals.post_save, sender=ResourceAssignment, dispatch_uid='section_status_assignment_save')
+@receiver(signals.post_delete, sender=ResourceAssignment, dispatch_uid='section_status_assignment_delete')
+def mark_section_status_for_target(sender, instance, **kwargs):
+    """ Registrations and room assignments change the enrollment, capacity
+        and fullness of their section in the onsite status feed. """
+    from esp.program.controllers.sectionstatus import mark_sections_dirty
+    section_id = instance.section_id if sender is StudentRegistration else instance.target_id
+    mark_sections_dirty([section_id])
+
+@receiver(signals.post_save, sender=ClassSection, dispatch_uid='section_status_section_save')
+@receiver(signals.post_delete, sender=ClassSection, dispatch_uid='section_status_section_delete')
+def mark_section_status_for_section(sender, instance, **kwargs):
+    from esp.program.controllers.sectionstatus import mark_sections_dirty
+    mark_sections_dirty([instance.id])
+
+@receiver(signals.m2m_changed, sender=ClassSection.meeting_times.through, dispatch_uid='section_status_meeting_times')
+def mark_section_status_for_meeting_times(sender, instance, reverse, pk_set, **kwargs):
+    if kwargs['action'] not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    from esp.program.controllers.sectionstatus import mark_sections_dirty
+    if reverse:
+        mark_sections_dirty(pk_set or [])
+    else:
+        mark_sections_dirty([instance.id])
+
+@receiver(signals.post_save, sender=ClassSubject, dispatch_uid='section_status_subject_save')
+def mark_section_status_for_subject(sender, instance, **kwargs):
+    """ The subject's status and maximum size affect all of its sections. """
+    from esp.program.controllers.sectionstatus import mark_sections_dirty
+    mark_sections_dirty(instance.sections.values_list('id', flat=True))
+
 def install():
     """ Initialize the default class categories. """
     logger.info("Installing esp.program.class initial data...")
@@ -33,6 +33,7 @@
   Email: web-team@learningu.org
 """
 from esp.program.class_status import ClassStatus
+from esp.program.controllers.availability import AvailabilityIndex
 from esp.program.modules.base import ProgramModuleObj, needs_admin, aux_call
 from esp.program.modules.handlers.teacherclassregmodule import TeacherClassRegModule
 
@@ -383,18 +384,24 @@ def classavailability(self, request, tl, one, two, module, extra, prog):
         teaching_teachers = {}
         moderating_teachers = {}
         conflict_found = False
+        index = AvailabilityIndex(prog, teachers)
+        cls_sections = cls.get_sections()
+        available = {teacher.id: index.available_mask(teacher, ignore_classes=True) for teacher in teachers}
+        teaching = {teacher.id: index.teaching_mask(teacher, ignore_sections=cls_sections) for teacher in teachers}
+        moderating = {teacher.id: index.moderating_mask(teacher) for teacher in teachers}
         for time in time_options:
             unavail_teachers[time] = []
             teaching_teachers[time] = []
             moderating_teachers[time] = []
+            bit = index.bit(time.id)
             for teacher in teachers:
-                if time not in teacher.getAvailableTimes(prog, True):
+                if not available[teacher.id] & bit:
                     unavail_teachers[time].append(teacher)
                     if time in meeting_times:
                         conflict_found = True
-                if time in teacher.getTaughtTimes(prog, exclude = [cls]):
+                if teaching[teacher.id] & bit:
                     teaching_teachers[time].append(teacher)
-                if time in teacher.getModeratingTimesFromProgram(prog):
+                if moderating[teacher.id] & bit:
                     moderating_teachers[time].append(teacher)
             if (len(unavail_teachers[time]) + len(teaching_teachers[time]) + len(moderating_teachers[time])) == 0:
                 viable_times.append(time)
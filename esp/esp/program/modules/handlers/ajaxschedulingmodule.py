@@ -36,6 +36,7 @@
 from esp.program.modules         import module_ext
 from esp.program.models          import ClassSection
 from esp.utils.web               import render_to_response
+from django.conf                 import settings
 from django.http                 import HttpResponse
 from esp.cal.models              import Event
 from esp.users.models            import ESPUser
@@ -181,16 +182,46 @@ def ajax_schedule_swap(self, prog, assignments, user=None, override=False):
     @needs_admin
     @json_response()
     def ajax_change_log(self, request, tl, one, two, module, extra, prog):
+        """ Return the change log entries after last_fetched_index.
+
+            If the optional 'wait' parameter is given and there are no new
+            entries, hold the request for up to that many seconds (capped at
+            settings.AJAX_SCHEDULING_MAX_WAIT, 20 by default) until another
+            scheduler commits a change, so that clients can long-poll rather
+            than poll on a timer.  Each waiting request holds a worker, so
+            only a few may wait at once (see AJAXChangeLog.start_waiting);
+            the others get their answer straight away.  The wait actually
+            used is returned in 'other', so clients know whether they may
+            re-request at once. """
         cl = self.get_change_log(prog)
         last_fetched_index = int(request.GET['last_fetched_index'])
+        try:
+            wait = max(0, min(float(request.GET.get('wait', 0)),
+                              getattr(settings, 'AJAX_SCHEDULING_MAX_WAIT', 20)))
+        except ValueError:
+            wait = 0
+        #   Read this before the log, so that we can't miss a change
+        #   committed in between.
+        generation = module_ext.AJAXChangeLog.get_generation(prog.id)
 
         #check whether we have a log entry at least as old as the last fetched time
         #if not, we return a command to reload instead of the log
         #note: negative number implies we want to debug dump changelog
-        if cl.get_earliest_index() is not None and last_fetched_index !=0 and cl.get_earliest_index() > last_fetched_index:
-            return { "other" : [ { 'command' : "reload", 'earliest_index' : cl.get_earliest_index(), 'latest_index' : cl.get_latest_index(), 'time' : time.time() } ] }
-
-        return { "changelog" : cl.get_log(last_fetched_index), 'other' : [ { 'time': time.time() } ] }
+        earliest_index = cl.get_earliest_index()
+        if earliest_index is not None and last_fetched_index !=0 and earliest_index > last_fetched_index:
+            return { "other" : [ { 'command' : "reload", 'earliest_index' : earliest_index, 'latest_index' : cl.get_latest_index(), 'time' : time.time() } ] }
+
+        changelog = cl.get_log(last_fetched_index)
+        if not changelog and wait:
+            if module_ext.AJAXChangeLog.start_waiting():
+                try:
+                    if module_ext.AJAXChangeLog.wait_for_change(prog.id, generation, wait):
+                        changelog = cl.get_log(last_fetched_index)
+                finally:
+                    module_ext.AJAXChangeLog.stop_waiting()
+            else:
+                wait = 0
+        return { "changelog" : changelog, 'other' : [ { 'time': time.time(), 'wait': wait } ] }
 
     @aux_call
     @needs_admin
@@ -204,14 +235,12 @@ def ajax_clear_change_log(self, request, tl, one, two, module, extra, prog):
         return render_to_response(self.baseDir()+'clear_cache_confirmation.html', request, context)
 
     def get_change_log(self, prog):
-        change_log = module_ext.AJAXChangeLog.objects.filter(program=prog)
+        change_log = module_ext.AJAXChangeLog.objects.filter(program=prog).first()
 
-        if change_log.count() == 0:
+        if change_log is None:
             change_log = module_ext.AJAXChangeLog()
             change_log.update(prog)
             change_log.save()
-        else:
-            change_log = change_log[0]
 
         return change_log
 
@@ -1,7 +1,12 @@
 import datetime
-import subprocess
-
-from django.db.models.aggregates import Count, Min
+import os
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Exists, OuterRef
+from django.db.models.aggregates import Count
+from django.db.models.functions import Trunc
 from django.db.models.query import Q
 
 from argcache import cache_function_for, cache_function
@@ -12,6 +17,84 @@
 from esp.utils.web import render_to_response
 
 
+# How long the numbers on the big board are cached for, in seconds
+CACHE_TIME = getattr(settings, 'BIGBOARD_CACHE_TIME', 15)
+
+def first_times(queryset, time_field, earlier=()):
+    """Restrict `queryset` to the rows which are the first for their user.
+
+    A row is left out if the same user has a row in `queryset` with an earlier
+    `time_field`, or a row in one of the querysets in `earlier`, which should
+    be triples (queryset, time field, inclusive), at an earlier time (or at
+    the same time, if `inclusive`).  Rows without a time are left out.
+    """
+    result = queryset.filter(**{time_field + '__isnull': False})
+    others = [(queryset, time_field, False)] + list(earlier)
+    for i, (other, other_field, inclusive) in enumerate(others):
+        name = '_earlier_%d' % i
+        lookup = '%s__%s' % (other_field, 'lte' if inclusive else 'lt')
+        result = result.annotate(**{name: Exists(other.filter(
+            user=OuterRef('user'), **{lookup: OuterRef(time_field)}))}
+        ).filter(**{name: False})
+    return result
+
+def hourly_counts(queryset, time_field, since=None):
+    """Count the distinct users in `queryset` by the hour of `time_field`.
+
+    Returns a dict mapping the start of each hour to the number of users, for
+    the hours starting at or after `since` (or all hours, if it is None).
+    """
+    if since is not None:
+        queryset = queryset.filter(**{time_field + '__gte': since})
+    rows = (queryset.annotate(hour=Trunc(time_field, 'hour'))
+            .values('hour').annotate(num=Count('user', distinct=True))
+            .order_by())
+    return {row['hour']: row['num'] for row in rows}
+
+class HourlyFirstTimes(object):
+    """Hourly counts of when users first did something, kept up to date
+    incrementally.
+
+    `querysets` should be a list of pairs (queryset, time field) of querysets
+    from first_times(); the counts are summed over them, so they should not
+    overlap.  The counts for hours which have ended are kept in the cache, so
+    each call to counts() only counts the rows of the current hour (with a
+    little slack for registrations committed just after the hour ends).
+    Every FULL_REFRESH seconds everything is counted again, to pick up rows
+    that were deleted or backdated.
+    """
+
+    FULL_REFRESH = getattr(settings, 'BIGBOARD_FULL_REFRESH', 3600)
+    # Rows may be committed this long after their time
+    SLACK = datetime.timedelta(minutes=5)
+
+    def __init__(self, key, querysets):
+        self.key = key
+        self.querysets = querysets
+
+    def counts(self):
+        """Return a list of pairs (number of users, start of hour), sorted by
+        hour, suitable for BigBoardModule.make_graph_data(weighted=True)."""
+        state = cache.get(self.key)
+        if state is None or time.time() - state['refreshed'] >= self.FULL_REFRESH:
+            state = {'hour': None, 'buckets': {}, 'refreshed': time.time()}
+        buckets = dict(state['buckets'])
+        for queryset, time_field in self.querysets:
+            for hour, num in hourly_counts(queryset, time_field, state['hour']).items():
+                buckets[hour] = buckets.get(hour, 0) + num
+
+        # Keep the counts of the hours which are over, and count the rest
+        # again next time.
+        hour = (datetime.datetime.now() - self.SLACK).replace(minute=0, second=0, microsecond=0)
+        if state['hour'] is not None:
+            hour = max(hour, state['hour'])
+        cache.set(self.key, {
+            'hour': hour,
+            'buckets': {h: num for h, num in buckets.items() if h < hour},
+            'refreshed': state['refreshed'],
+        }, None)
+        return [(num, h) for h, num in sorted(buckets.items())]
+
 class BigBoardModule(ProgramModuleObj):
     doc = """Shows statistics about student registration that refresh automatically."""
 
@@ -62,12 +145,12 @@ def bigboard(self, request, tl, one, two, module, extra, prog):
         numbers = [(desc, num) for desc, num in numbers if num]
 
         timess = [
-            ("completed the medical form", [(1, time) for time in self.times_medical(prog)], True),
-            ("set class lottery preferences", [(1, time) for time in self.times_lottery(prog)], True),
-            ("enrolled in classes", [(1, time) for time in self.times_enrolled(prog)], True),
+            ("completed the medical form", self.times_medical(prog), True),
+            ("set class lottery preferences", self.times_lottery(prog), True),
+            ("enrolled in classes", self.times_enrolled(prog), True),
         ]
 
-        timess_data, start = self.make_graph_data(timess, 4, 0, 5)
+        timess_data, start = self.make_graph_data(timess, 4, 0, 5, weighted=True)
 
         left_axis_data = [
             {"axis_name": "#", "series_data": timess_data},
@@ -86,12 +169,15 @@ def bigboard(self, request, tl, one, two, module, extra, prog):
         return render_to_response(self.baseDir()+'bigboard.html',
                                   request, context)
 
-    # Numbers computed for the big board are below.  They're cached for 105
-    # seconds, which is long enough that they hopefully won't get recomputed a
-    # bunch if multiple admins are loading the page, but short enough that each
-    # time the page refreshes for the same admin, they will get new numbers
+    # Numbers computed for the big board are below.  They're cached for
+    # CACHE_TIME seconds, so that they won't get recomputed a bunch if
+    # multiple admins are loading the page.  Each cached count is a single
+    # aggregate query (num_prefs adds up two of them, the lottery
+    # preferences from registration_counts and the stars from num_ssis), so
+    # they are cheap to recompute no matter how many students have
+    # registered.
 
-    @cache_function_for(105)
+    @cache_function_for(CACHE_TIME)
     def users_enrolled(prog):
         # Querying for SRs and then extracting the users saves us joining the
         # users table.
@@ -101,11 +187,35 @@ def users_enrolled(prog):
         ).values_list('user', flat = True).distinct()
     users_enrolled = staticmethod(users_enrolled)
 
-    @cache_function_for(105)
+    @cache_function_for(CACHE_TIME)
+    def registration_counts(prog):
+        """Count enrolled students, first choices and lottery preferences in
+        one pass over the program's registrations."""
+        lottery = Q(relationship__name='Interested') | Q(relationship__name__contains='Priority/')
+        return StudentRegistration.valid_objects().filter(
+            section__parent_class__parent_program=prog,
+        ).aggregate(
+            enrolled_users=Count('user', distinct=True, filter=Q(relationship__name='Enrolled')),
+            priority1s=Count('id', filter=Q(relationship__name='Priority/1')),
+            prefs=Count('id', filter=lottery),
+        )
+    registration_counts = staticmethod(registration_counts)
+
+    @cache_function_for(CACHE_TIME)
+    def record_counts(prog):
+        """Count medical forms and checked-in students in one query."""
+        return Record.objects.filter(
+            program=prog, event__name__in=['med', 'med_bypass', 'attended'],
+        ).aggregate(
+            medical=Count('id', filter=Q(event__name__in=['med', 'med_bypass'])),
+            checked_in_users=Count('user', distinct=True, filter=Q(event__name='attended')),
+        )
+    record_counts = staticmethod(record_counts)
+
     def num_users_enrolled(self, prog):
-        return self.users_enrolled(prog).count()
+        return self.registration_counts(prog)['enrolled_users']
 
-    @cache_function_for(105)
+    @cache_function_for(CACHE_TIME)
     def users_with_lottery(prog):
         # Past empirical observation has shown that doing the union in SQL is
         # much, much slower for unknown reasons; it also means we would have to
@@ -124,72 +234,75 @@ def users_with_lottery(prog):
         return users_with_ssis | users_with_srs
     users_with_lottery = staticmethod(users_with_lottery)
 
-    @cache_function_for(105)
+    @cache_function_for(CACHE_TIME)
     def num_users_with_lottery(self, prog):
-        return len(self.users_with_lottery(prog))
+        # Unlike in users_with_lottery(), this is a UNION of the two lists of
+        # user IDs rather than a join with the users table, so the database
+        # can count it without sending us the IDs.
+        users_with_ssis = (
+            StudentSubjectInterest.valid_objects()
+            .filter(subject__parent_program=prog)
+            .values_list('user'))
+        users_with_srs = (
+            StudentRegistration.valid_objects()
+            .filter(
+                Q(relationship__name='Interested') |
+                Q(relationship__name__contains='Priority/'),
+                section__parent_class__parent_program=prog)
+            .values_list('user'))
+        return users_with_ssis.union(users_with_srs).count()
 
-    @cache_function_for(105)
+    @cache_function_for(CACHE_TIME)
     def num_active_users(self, prog, minutes=10):
         recent = datetime.datetime.now() - datetime.timedelta(0, minutes * 60)
-        users_with_ssis = set(
+        users_with_ssis = (
             StudentSubjectInterest.objects
             .filter(subject__parent_program=prog)
             .filter(start_date__gt=recent)
-            .values_list('user').distinct())
-        users_with_srs = set(
+            .values_list('user'))
+        users_with_srs = (
             StudentRegistration.objects
             .filter(section__parent_class__parent_program=prog)
             .filter(start_date__gt=recent)
-            .values_list('user').distinct())
-        users_with_meds = set(
+            .values_list('user'))
+        users_with_meds = (
             Record.objects
             .filter(program=prog, event__name__in=['med', 'med_bypass'])
             .filter(time__gt=recent)
-            .values_list('user').distinct())
-        return len(users_with_ssis | users_with_srs | users_with_meds)
+            .values_list('user'))
+        return users_with_ssis.union(users_with_srs, users_with_meds).count()
 
-    @cache_function_for(105)
+    @cache_function_for(CACHE_TIME)
     def num_ssis(self, prog):
         return StudentSubjectInterest.valid_objects().filter(
             subject__parent_program=prog).count()
 
-    @cache_function_for(105)
     def num_priority1s(self, prog):
-        return StudentRegistration.valid_objects().filter(
-            relationship__name='Priority/1',
-            section__parent_class__parent_program=prog).count()
+        return self.registration_counts(prog)['priority1s']
 
-    @cache_function_for(105)
     def num_prefs(self, prog):
-        num_srs = StudentRegistration.valid_objects().filter(
-            Q(relationship__name='Interested') |
-            Q(relationship__name__contains='Priority/'),
-            section__parent_class__parent_program=prog).count()
-        return num_srs + self.num_ssis(prog)
+        return self.registration_counts(prog)['prefs'] + self.num_ssis(prog)
 
-    @cache_function_for(105)
     def num_medical(self, prog):
-        return Record.objects.filter(program=prog,
-                                     event__name__in=['med', 'med_bypass']).count()
+        return self.record_counts(prog)['medical']
 
-    @cache_function_for(105)
+    @cache_function_for(CACHE_TIME)
     def checked_in_users(prog):
         return Record.objects.filter(program=prog, event__name='attended').values_list('user', flat = True).distinct()
     checked_in_users = staticmethod(checked_in_users)
 
-    @cache_function_for(105)
     def num_checked_in_users(self, prog):
-        return self.checked_in_users(prog).count()
+        return self.record_counts(prog)['checked_in_users']
 
-    @cache_function_for(105)
+    @cache_function_for(CACHE_TIME)
     def popular_classes_wrapper(self, prog):
         # this caches this based on time, so even if the dependencies are updated,
-        # we only update the cache every 105 seconds
+        # we only update the cache every CACHE_TIME seconds
         return self.popular_classes(prog)
 
     @cache_function
     def popular_classes(self, prog):
-        # this caches this based on dependencies, so even if the 105 second
+        # this caches this based on dependencies, so even if the CACHE_TIME
         # timer runs out, we only update if the dependencies have changed
         sections = ClassSection.objects.filter(
             parent_class__parent_program=prog).exclude(parent_class__category__category='Lunch')
@@ -255,40 +368,36 @@ def popular_classes(self, prog):
                                                        filter = lambda sr: (sr.relationship.name in ["Priority/1", "Enrolled"]))
     popular_classes.depend_on_row(StudentSubjectInterest, lambda ssi: {'prog': ssi.subject.parent_program})
 
-    @cache_function_for(105)
+    # The time series below are lists of pairs (number of users, start of
+    # hour), counting the users who first did something in each hour.  See
+    # HourlyFirstTimes for how they are kept up to date.
+
     def times_medical(self, prog):
-        return list(
-            Record.objects
-            .filter(program=prog, event__name__in=('med', 'med_bypass'))
-            .values('user').annotate(Min('time'))
-            .order_by('time__min').values_list('time__min', flat=True))
+        records = Record.objects.filter(program=prog, event__name__in=('med', 'med_bypass'))
+        return HourlyFirstTimes('bigboard_times_medical:%d' % prog.id, [
+            (first_times(records, 'time'), 'time'),
+        ]).counts()
 
-    @cache_function_for(105)
     def times_lottery(self, prog):
-        # stars or priorities
-        ssi_times_dict = dict(
-            StudentSubjectInterest.objects.filter(subject__parent_program=prog)
-            # GROUP BY user, SELECT user and min start date.
-            # Don't you love django ORM syntax?
-            .values_list('user').annotate(Min('start_date')))
-        sr_times = StudentRegistration.objects.filter(
-            section__parent_class__parent_program=prog, relationship__name__startswith="Priority"
-        ).values_list('user').annotate(Min('start_date'))
-        for id, sr_time in sr_times:
-            if id not in ssi_times_dict or sr_time < ssi_times_dict[id]:
-                ssi_times_dict[id] = sr_time
-        return sorted(ssi_times_dict.values())
-
-    @cache_function_for(105)
+        # stars or priorities; a user who did both at the same time is
+        # counted with their stars.
+        ssis = StudentSubjectInterest.objects.filter(subject__parent_program=prog)
+        srs = StudentRegistration.objects.filter(
+            section__parent_class__parent_program=prog, relationship__name__startswith="Priority")
+        return HourlyFirstTimes('bigboard_times_lottery:%d' % prog.id, [
+            (first_times(ssis, 'start_date', [(srs, 'start_date', False)]), 'start_date'),
+            (first_times(srs, 'start_date', [(ssis, 'start_date', True)]), 'start_date'),
+        ]).counts()
+
     def times_enrolled(self, prog):
         # we don't use valid_objects() here because we want to know exactly when each user first
         # enrolled in a class, even if they aren't enrolled in that class anymore; however,
         # this also means that the final number here might not match that from users_enrolled()
-        return list(
-            StudentRegistration.objects
-            .filter(section__parent_class__parent_program=prog, relationship__name="Enrolled")
-            .values('user').annotate(Min('start_date'))
-            .order_by('start_date__min').values_list('start_date__min', flat=True))
+        srs = StudentRegistration.objects.filter(
+            section__parent_class__parent_program=prog, relationship__name="Enrolled")
+        return HourlyFirstTimes('bigboard_times_enrolled:%d' % prog.id, [
+            (first_times(srs, 'start_date'), 'start_date'),
+        ]).counts()
 
     @staticmethod
     def chunk_times(times, start, end, delta=datetime.timedelta(0, 3600), cumulative = True):
@@ -322,27 +431,51 @@ def chunk_times(times, start, end, delta=datetime.timedelta(0, 3600), cumulative
         return chunks
 
     @staticmethod
-    def make_graph_data(timess, drop_beg = 0, drop_end = 0, cutoff = 1):
+    def weighted_index(times, n):
+        """Return the index of the tuple in `times` holding item n (counting
+        from 0), where each tuple holds as many items as its metric."""
+        total = 0
+        for i, (metric, _) in enumerate(times):
+            total += metric
+            if total > n:
+                return i
+        return len(times)
+
+    @staticmethod
+    def make_graph_data(timess, drop_beg = 0, drop_end = 0, cutoff = 1, weighted = False):
         """Given a list of time series, return graph data series.
 
         `timess` should be a list of tuples (description, sorted tuples of metrics and datetime.datetime objects, whether counts should be cumulative).
         `drop_beg` should be a number of items to drop from the beginning of each list
         `drop_end` should be a number of items to drop from the end of each list
         `cutoff` should be the minimum number of items that must exist in a time series
+        `weighted` should be a boolean determining whether each tuple counts as as many items as its metric (e.g. for counts bucketed by hour) or as one item
 
         Returns a dict of cleaned time series and the start time for graphing
         """
+        def size(times):
+            if weighted:
+                return sum(metric for metric, _ in times)
+            return len(times)
+
+        def trim(times):
+            if weighted:
+                beg = BigBoardModule.weighted_index(times, drop_beg)
+                end = len(times) - BigBoardModule.weighted_index(times[::-1], drop_end)
+                return times[beg:end]
+            return times[drop_beg:(len(times)-drop_end)]
+
         #Remove any time series without at least 'cutoff' times
-        timess = [(desc, times, cumulative) for desc, times, cumulative in timess if len(times) >= cutoff]
+        timess = [(desc, times, cumulative) for desc, times, cumulative in timess if size(times) >= cutoff]
         # Drop the first and last times if specified
         # Then round start down and end up to the nearest day.
         if not timess:
             graph_data = []
             start = None
         else:
-            start = min([times[drop_beg:(len(times)-drop_end)][0][1] for desc, times, cumulative in timess])
+            start = min([trim(times)[0][1] for desc, times, cumulative in timess])
             start = start.replace(hour=0, minute=0, second=0, microsecond=0)
-            end = max([times[drop_beg:(len(times)-drop_end)][-1][1] for desc, times, cumulative in timess])
+            end = max([trim(times)[-1][1] for desc, times, cumulative in timess])
             end = end.replace(hour=0, minute=0, second=0, microsecond=0)
             end += datetime.timedelta(1)
             end = min(end, datetime.datetime.now())
@@ -351,13 +484,10 @@ def make_graph_data(timess, drop_beg = 0, drop_end = 0, cutoff = 1):
                           for desc, times, cumulative in timess]
         return graph_data, start
 
-    # runs in 9ms, so don't bother caching
     def load_averages(self):
         try:
-            uptime = subprocess.check_output('uptime')
-            # The output ends in e.g. "load average: 1.65, 1.84, 1.67\n"
-            return [float(x.strip(',')) for x in uptime.strip().split()[-3:]]
-        except:
+            return list(os.getloadavg())
+        except OSError:
             return []
 
     def isStep(self):
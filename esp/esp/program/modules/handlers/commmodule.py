@@ -40,6 +40,7 @@
 from esp.users.controllers.usersearch import UserSearchController
 from esp.users.views.usersearch import get_user_checklist
 from esp.dbmail.models import ActionHandler
+from esp.dbmail.sendto_fns import count_addresses
 from esp.tagdict.models import Tag
 from django.template import Template
 from django.template import Context as DjangoContext
@@ -149,25 +150,12 @@ def commprev(self, request, tl, one, two, module, extra, prog):
     @staticmethod
     def approx_num_of_recipients(filterObj, sendto_fn):
         """
-        Approximates the number of recipients of a message, given the filter
-        and the sendto function.
+        Counts the number of emails a message will generate, given the filter
+        and the sendto function.  (Despite the name, this used to be
+        estimated from a few users, but the count is now exact.)
         """
         userlist = filterObj.getList(ESPUser).distinct()
-        numusers = userlist.count()
-        if numusers > 0:
-            # Approximate the number of emails that each user will receive, by
-            # taking the maximum number of emails per user over a small subset.
-            # This is approximate because different users may receive different
-            # numbers of emails, since the sendto functions remove duplicates.
-            # And we don't attempt to get the exact number, because it doesn't
-            # matter much and it would be expensive to evaluate the sendto
-            # function for all users just to get that one number.
-            emails_per_user = 1
-            short_userlist = userlist[:min(numusers, 10)]
-            for user in short_userlist:
-                emails_per_user = max(emails_per_user, len(sendto_fn(user)))
-            numusers *= emails_per_user
-        return numusers
+        return count_addresses(userlist, sendto_fn)
 
 
     @aux_call
@@ -272,7 +260,8 @@ def commpanel(self, request, tl, one, two, module, extra, prog):
             if ('base_list' in data and 'recipient_type' in data) or ('combo_base_list' in data):
 
                 selected = usc.selected_list_from_postdata(data)
-                filterObj = usc.filter_from_postdata(prog, data)
+                query = usc.query_from_postdata(prog, data)
+                filterObj = usc.filter_from_postdata(prog, data, query)
                 sendto_fn_name = usc.sendto_fn_from_postdata(data)
                 sendto_fn = MessageRequest.assert_is_valid_sendto_fn_or_ESPError(sendto_fn_name)
 
@@ -282,7 +271,9 @@ def commpanel(self, request, tl, one, two, module, extra, prog):
 
                 context['filterid'] = filterObj.id
                 context['sendto_fn_name'] = sendto_fn_name
-                context['listcount'] = self.approx_num_of_recipients(filterObj, sendto_fn)
+                #   The query still holds the cached members of the program lists,
+                #   so counting with it is cheaper than with the stored filter.
+                context['listcount'] = count_addresses(ESPUser.objects.filter(query).distinct(), sendto_fn)
                 context['selected'] = selected
                 # Use the info redirect (make one for the default email address if it doesn't exist)
                 prs = PlainRedirect.objects.filter(original = "info")
@@ -45,10 +45,13 @@
 
 from argcache import cache_function
 
-from esp.cal.models import Event, EventType
+from esp.cal.models import Event
 from esp.dbmail.models import MessageRequest
 from esp.middleware import ESPError
 from esp.program.class_status import ClassStatus
+from esp.program.controllers.availability import AvailabilityIndex
+from esp.program.controllers.classrooms import ClassroomMatrix
+from esp.program.controllers.dashboard import DashboardStats, STATS_TIMEOUT
 from esp.program.models import Program, ClassSection, ClassSubject, StudentRegistration, ClassCategories, StudentSubjectInterest, ClassFlagType, ClassFlag, ModeratorRecord, RegistrationProfile, TeacherBio, PhaseZeroRecord, FinancialAidRequest, VolunteerOffer
 from esp.program.modules.base import ProgramModuleObj, CoreModule, needs_student_in_grade, needs_admin, no_auth, aux_call
 from esp.resources.models import ResourceAssignment, ResourceRequest, ResourceType
@@ -79,40 +82,15 @@ def module_properties(cls):
 
     @staticmethod
     def _bulk_availability(prog, user_ids, subtract_moderation=False):
-        """Bulk-fetch availability for multiple users in one query.
+        """Bulk-fetch availability for multiple users.
 
         Returns {user_id: [event_id, ...]} lookup.
         When subtract_moderation=True, subtracts moderating section times.
         """
-        avail_by_user = defaultdict(set)
-        if prog.hasModule('AvailabilityModule'):
-            et = EventType.get_from_desc('Class Time Block')
-            for uid, eid in UserAvailability.objects.filter(
-                event__program=prog,
-                event__event_type=et,
-                user_id__in=user_ids,
-            ).values_list('user_id', 'event_id'):
-                avail_by_user[uid].add(eid)
-        else:
-            all_ts = set(prog.getTimeSlots().values_list('id', flat=True))
-            for uid in user_ids:
-                avail_by_user[uid] = set(all_ts)
-
-        if subtract_moderation:
-            #   Bulk-subtract moderating section times
-            mod_times = (
-                ClassSection.objects
-                .filter(
-                    parent_class__parent_program=prog,
-                    moderators__id__in=user_ids,
-                )
-                .values_list('moderators__id', 'meeting_times__id')
-            )
-            for uid, tid in mod_times:
-                if tid is not None:
-                    avail_by_user.get(uid, set()).discard(tid)
-
-        return {uid: list(events) for uid, events in avail_by_user.items()}
+        index = AvailabilityIndex(prog, user_ids)
+        return {uid: index.event_ids(index.available_mask(uid, ignore_classes=True,
+                                                          ignore_moderation=not subtract_moderation))
+                for uid in user_ids}
 
 
     @aux_call
@@ -129,25 +107,24 @@ def counts(prog):
     @needs_admin
     @cached_module_view
     def rooms(prog):
-        classrooms = prog.getResources().filter(res_type__name="Classroom")
-        classrooms_grouped = defaultdict(list)
-        for room in classrooms:
-            classrooms_grouped[room.name].append(room)
-        classrooms_dicts = [
-            {
-                'id': classrooms_grouped[room_id][0].identical_id(prog),
-                'uid': classrooms_grouped[room_id][0].identical_id(prog),
-                'text': classrooms_grouped[room_id][0].name,
-                'availability': [ r.event_id for r in classrooms_grouped[room_id] ],
+        matrix = ClassroomMatrix.for_program(prog)
+        classrooms_dicts = []
+        for (name, resources) in matrix.rooms.items():
+            first_id = next(iter(resources.values()))
+            classrooms_dicts.append({
+                'id': matrix.identical_ids[name],
+                'uid': matrix.identical_ids[name],
+                'text': name,
+                'availability': matrix.times(name),
                 'associated_resources': [
                     {
-                        'res_type_id': ar.res_type_id,
-                        'value': ar.attribute_value,
+                        'res_type_id': res_type_id,
+                        'value': value,
                     }
-                    for ar in classrooms_grouped[room_id][0].associated_resources()
+                    for (res_type_id, value) in matrix.furnishings[first_id]
                 ],
-                'num_students': classrooms_grouped[room_id][0].num_students,
-            } for room_id in classrooms_grouped.keys() ]
+                'num_students': matrix.capacities[first_id],
+            })
 
         return {'rooms': classrooms_dicts}
     rooms.method.cached_function.depend_on_model('resources.Resource')
@@ -890,23 +867,7 @@ def cat_nums(prog):
 
     @cache_function
     def grade_nums(prog):
-        students = prog.students()
-        classes = prog.classes().select_related()
-        grades = [i for i in range(prog.grade_min, prog.grade_max+1)]
-        # We can't perfectly trust most_recent_profile, but it's good enough for stats
-        students_grades = students['enrolled'].filter(registrationprofile__most_recent_profile=True)
-        students_grades = students_grades.values_list('registrationprofile__student_info__graduation_year')
-        students_grades = students_grades.annotate(Count('id', distinct=True))
-        grades_dict = {result[0]: result[1] for result in students_grades}
-        grades_results = []
-        for g in grades:
-            year = ESPUser.YOGFromGrade(g, ESPUser.program_schoolyear(prog))
-            grade_classes = classes.filter(status__gte=0, grade_min__lte=g, grade_max__gte=g)
-            grade_sections = prog.sections().filter(status__gte=0, parent_class__in=grade_classes)
-            grades_results.append({'grade': g, 'num_subjects': grade_classes.count(),
-                                   'num_sections': grade_sections.count(),
-                                   'num_students': grades_dict[year] if year in grades_dict else 0})
-        return grades_results
+        return DashboardStats(prog).grade_counts()
     grade_nums.depend_on_row(ClassSubject, lambda cls: {'prog': cls.parent_program})
     grade_nums.depend_on_row(ClassSection, lambda sec: {'prog': sec.parent_class.parent_program})
     grade_nums.depend_on_model(StudentInfo) # I can't think of a more efficient way to depend on graduation year with depend_on_row -WG
@@ -914,24 +875,22 @@ def grade_nums(prog):
 
     @cache_function
     def teacher_nums(prog):
-        teachers = prog.teachers()
-        teachers_qobjects = prog.teachers(QObjects = True)
+        teachers = prog.teachers(QObjects = True)
         list_labels = prog.teacherDesc()
-        teacher_num_list = []
+        # This is useful for AUL/comm panel, but doesn't need to be on program dashboard
+        keys = [key for key in teachers.keys() if key not in ['taught_before']]
+        combined_label = """Teachers who have submitted a class and have not taught for a previous program"""
+        combined = []
+        if 'class_submitted' in teachers and 'taught_before' in teachers:
+            combined.append((combined_label, lambda lists: ~lists['taught_before'] & lists['class_submitted']))
+        counts = DashboardStats.count_lists(teachers, keys, combined)
 
-        ## Ew, queries in a for loop...
-        ## Not much to be done about it, though;
-        ## the loop is iterating over a list of independent queries and running each.
-        for key in teachers.keys():
-            # This is useful for AUL/comm panel, but doesn't need to be on program dashboard
-            if key not in ['taught_before']:
-                if key in list_labels:
-                    teacher_num_list.append((list_labels[key], teachers[key].filter(is_active = True).distinct().count()))
-                else:
-                    teacher_num_list.append((key, teachers[key].filter(is_active = True).distinct().count()))
-                # Hack to insert this combined count in a logical position
-                if key == 'class_submitted':
-                    teacher_num_list.append(("""Teachers who have submitted a class and have not taught for a previous program""", ESPUser.objects.filter(~teachers_qobjects['taught_before'] & teachers_qobjects['class_submitted'] & Q(is_active = True)).distinct().count()))
+        teacher_num_list = []
+        for key in keys:
+            teacher_num_list.append((list_labels.get(key, key), counts[key]))
+            # Hack to insert this combined count in a logical position
+            if key == 'class_submitted' and combined:
+                teacher_num_list.append((combined_label, counts[combined_label]))
         return teacher_num_list
     teacher_nums.depend_on_row(ClassSubject, lambda cls: {'prog': cls.parent_program})
     teacher_nums.depend_on_row(ClassSection, lambda sec: {'prog': sec.parent_class.parent_program})
@@ -946,26 +905,27 @@ def teacher_nums(prog):
 
     @cache_function
     def student_nums(prog):
-        students = prog.students()
-        students_qobjects = prog.students(QObjects = True)
+        students = prog.students(QObjects = True)
         list_labels = prog.studentDesc()
-        student_num_list = []
+        # These lists are useful for AUL/comm panel, but don't need to be on program dashboard
+        keys = [key for key in students.keys() if key not in ['attended_past', 'enrolled_past']]
+        combined_label = """Students who are enrolled and have not enrolled in the past"""
+        combined = []
+        if 'enrolled' in students and 'enrolled_past' in students:
+            combined.append((combined_label, lambda lists: ~lists['enrolled_past'] & lists['enrolled']))
+        counts = DashboardStats.count_lists(students, keys, combined)
 
-        ## Ew, another set of queries in a for loop...
-        ## Same justification, though.
-        for key in students.keys():
-            # These lists are useful for AUL/comm panel, but don't need to be on program dashboard
-            if key not in ['attended_past', 'enrolled_past']:
-                if key in list_labels:
-                    student_num_list.append((list_labels[key], students[key].filter(is_active = True).distinct().count()))
-                else:
-                    student_num_list.append((key, students[key].filter(is_active = True).distinct().count()))
-                # Hack to insert this combined count into a logical position
-                if key == 'enrolled':
-                    student_num_list.append(("""Students who are enrolled and have not enrolled in the past""", ESPUser.objects.filter(~students_qobjects['enrolled_past'] & students_qobjects['enrolled'] & Q(is_active = True)).distinct().count()))
+        student_num_list = []
+        for key in keys:
+            student_num_list.append((list_labels.get(key, key), counts[key]))
+            # Hack to insert this combined count into a logical position
+            if key == 'enrolled' and combined:
+                student_num_list.append((combined_label, counts[combined_label]))
         return student_num_list
+    #   Registrations change these too often to recompute them after each
+    #   one, so they are only refreshed every STATS_TIMEOUT seconds.
+    student_nums.timeout_seconds = STATS_TIMEOUT
     student_nums.depend_on_row(StudentSubjectInterest, lambda ssi: {'prog': ssi.subject.parent_program})
-    student_nums.depend_on_row(StudentRegistration, lambda sr: {'prog': sr.section.parent_class.parent_program})
     student_nums.depend_on_row(RegistrationProfile, lambda prof: {'prog': prof.program})
     student_nums.depend_on_row(Record, lambda rec: {'prog': rec.program})
     student_nums.depend_on_row(PhaseZeroRecord, lambda rec: {'prog': rec.program})
@@ -975,81 +935,20 @@ def student_nums(prog):
 
     @cache_function
     def volunteer_nums(prog):
-        volunteers = prog.volunteers()
+        volunteers = prog.volunteers(QObjects = True)
         list_labels = prog.volunteerDesc()
-        volunteer_num_list = []
-
-        ## Ew, another set of queries in a for loop...
-        ## Same justification, though.
-        for key in volunteers.keys():
-            if key in list_labels:
-                volunteer_num_list.append((list_labels[key], volunteers[key].filter(is_active = True).distinct().count()))
-            else:
-                volunteer_num_list.append((key, volunteers[key].filter(is_active = True).distinct().count()))
-        return volunteer_num_list
+        counts = DashboardStats.count_lists(volunteers)
+        return [(list_labels.get(key, key), counts[key]) for key in volunteers.keys()]
     volunteer_nums.depend_on_row(VolunteerOffer, lambda vo: {'prog': vo.request.program})
     volunteer_nums = staticmethod(volunteer_nums)
 
-    @staticmethod
-    def calc_hours(classes):
-        hours = {"class-hours": 0, "class-student-hours": 0, "class-registered-hours": 0, "class-checked-in-hours": 0}
-        for cls in classes:
-            if cls['subject_duration']:
-                hours["class-hours"] += float(cls['subject_duration'])
-                hours["class-student-hours"] += float(cls['subject_duration']) * (float(cls['class_size_max']) if cls['class_size_max'] else 0)
-                hours["class-registered-hours"] += float(cls['subject_duration']) * float(cls['subject_students']) / float(cls['num_sections'])
-                hours["class-checked-in-hours"] += float(cls['subject_duration']) * float(cls['subject_checked_in_students']) / float(cls['num_sections'])
-        return hours
-
-    @staticmethod
-    def calc_section_hours(sections):
-        hours = {"class-hours": 0, "class-student-hours": 0, "class-registered-hours": 0}
-        for sec in sections:
-            if sec['duration']:
-                hours["class-hours"] += float(sec['duration'])
-                capacity = ClassSection.objects.get(id=sec['id']).capacity
-                hours["class-student-hours"] += float(sec['duration']) * float(capacity)
-                hours["class-registered-hours"] += float(sec['duration']) * float(sec['enrolled_students'])
-        return hours
-
     @cache_function
     def hour_nums(prog):
-        ## Write this as a 'for' loop because PostgreSQL can't do it in
-        ## one go without a subquery or duplicated logic, and Django
-        ## doesn't have enough power to expose either approach directly.
-        ## At least there aren't any queries in the for loop...
-        ## (In MySQL, this could I believe be done with a minimally-painful extra() clause.)
-        ## Also, since we're iterating over a big data set, use .values()
-        ## minimize the number of objects that we're creating.
-        ## One dict and two Decimals per row, as opposed to
-        ## an Object per field and all kinds of stuff...
-        reg_classes = prog.classes().exclude(category__category='Lunch').annotate(num_sections=Count('sections'), subject_duration=Sum('sections__duration'), subject_students=Sum('sections__enrolled_students'))
-        for cls in reg_classes:
-            cls.subject_checked_in_students = sum([sec.count_ever_checked_in_students() for sec in cls.get_sections()])
-        reg_hours = JSONDataModule.calc_hours([{'num_sections': cls.num_sections, 'subject_duration': cls.subject_duration, 'subject_students': cls.subject_students, 'subject_checked_in_students': cls.subject_checked_in_students, 'class_size_max': cls.class_size_max} for cls in reg_classes])
-        app_classes = prog.classes().filter(status__gt=0, sections__status__gt=0).exclude(category__category='Lunch').annotate(num_sections=Count('sections'), subject_duration=Sum('sections__duration'), subject_students=Sum('sections__enrolled_students'))
-        for cls in app_classes:
-            cls.subject_checked_in_students = sum([sec.count_ever_checked_in_students() for sec in cls.get_sections()])
-        app_hours = JSONDataModule.calc_hours([{'num_sections': cls.num_sections, 'subject_duration': cls.subject_duration, 'subject_students': cls.subject_students, 'subject_checked_in_students': cls.subject_checked_in_students, 'class_size_max': cls.class_size_max} for cls in app_classes])
-        sched_sections = prog.sections().filter(status__gt=0, meeting_times__isnull=False).exclude(parent_class__category__category='Lunch').values('duration', 'enrolled_students', 'id')
-        sched_hours = JSONDataModule.calc_section_hours(sched_sections)
-        hour_num_list = []
-        hour_num_list.append(("Total # of Class-Hours (registered)", round(reg_hours["class-hours"], 2)))
-        hour_num_list.append(("Total # of Class-Hours (approved)", round(app_hours["class-hours"], 2)))
-        hour_num_list.append(("Total # of Class-Hours (scheduled)", round(sched_hours["class-hours"], 2)))
-        hour_num_list.append(("Total # of Class-Student-Hours (registered)", round(reg_hours["class-student-hours"], 2)))
-        hour_num_list.append(("Total # of Class-Student-Hours (approved)", round(app_hours["class-student-hours"], 2)))
-        hour_num_list.append(("Total # of Class-Student-Hours (scheduled)", round(sched_hours["class-student-hours"], 2)))
-        hour_num_list.append(("Total # of Class-Student-Hours (enrolled)", round(reg_hours["class-registered-hours"], 2)))
-        hour_num_list.append(("Total # of Class-Student-Hours (attended program)", round(reg_hours["class-checked-in-hours"], 2)))
-        if sched_hours["class-student-hours"]:
-            hour_num_list.append(("Class-Student-Hours Utilization", str(round(100 * reg_hours["class-registered-hours"] / sched_hours["class-student-hours"], 2)) + "%"))
-        return hour_num_list
+        return DashboardStats(prog).hours()
+    hour_nums.timeout_seconds = STATS_TIMEOUT
     hour_nums.depend_on_row(ClassSubject, lambda cls: {'prog': cls.parent_program})
     hour_nums.depend_on_row(ClassSection, lambda sec: {'prog': sec.parent_class.parent_program})
     hour_nums.depend_on_m2m(ClassSection, 'meeting_times', lambda sec, event: {'prog': sec.parent_class.parent_program})
-    hour_nums.depend_on_row(StudentRegistration, lambda sr: {'prog': sr.section.parent_class.parent_program})
-    hour_nums.depend_on_row(Record, lambda rec: {'prog': rec.program}, lambda rec: rec.event and rec.event.name == 'attended')
     hour_nums = staticmethod(hour_nums)
 
     @cache_function
@@ -32,14 +32,21 @@
   Phone: 617-379-0178
   Email: web-team@learningu.org
 """
+import csv
+
 from esp.program.modules.base import ProgramModuleObj, needs_admin, main_call, aux_call
 from esp.utils.web import render_to_response
 from esp.users.models   import ESPUser, PersistentQueryFilter
 from esp.users.controllers.usersearch import UserSearchController
 from esp.users.forms.generic_search_form import StudentSearchForm
 from esp.middleware import ESPError
-from esp.program.models import StudentRegistration, PhaseZeroRecord, SplashInfo
+from esp.program.models import StudentRegistration, PhaseZeroRecord, SplashInfo, RegistrationProfile, ClassSection, StudentApplication, StudentAppResponse
 from django import forms
+from django.db.models import Count, Max, Min, Prefetch
+from django.db.models.functions import Upper
+from django.http import StreamingHttpResponse
+from django.template.loader import render_to_string
+from django.utils.functional import cached_property
 
 class UserAttributeGetter(object):
     @staticmethod
@@ -94,16 +101,21 @@ def getFunctions():
 
         return result
 
-    def __init__(self, user, program):
+    def __init__(self, user, program, profile=None):
         self.user = user
         self.program = program
-        self.profile = self.user.getLastProfile()
+        if profile is None:
+            profile = self.user.getLastProfile()
+        self.profile = profile
 
     def get(self, attr):
         attr = attr.lstrip('0123456789_')
         #if attr = 'classapplication':
 
-        result = getattr(self, 'get_' + attr)()
+        return self.format_value(getattr(self, 'get_' + attr)())
+
+    @staticmethod
+    def format_value(result):
         if result is None or result == '':
             return 'N/A'
         else:
@@ -253,25 +265,150 @@ def get_sibling_name(self):
         else:
             return None
 
-    def get_class_application_1(self):
+    @staticmethod
+    def format_app_response(response):
+        return str(response.question.subject) + ':  ' + str(response)
+
+    def get_class_application(self, index):
         responses = self.user.listAppResponses(self.program)
-        if len(responses) > 0:
-            return str(responses[0].question.subject) + ':  ' + str(responses[0])
+        if len(responses) > index:
+            return self.format_app_response(responses[index])
         else:
             return None
 
+    def get_class_application_1(self):
+        return self.get_class_application(0)
+
     def get_class_application_2(self):
-        responses = self.user.listAppResponses(self.program)
-        if len(responses) > 1:
-            return str(responses[1].question.subject) + ':  ' + str(responses[0])
-        else:
-            return None
+        return self.get_class_application(1)
+
     def get_class_application_3(self):
-        responses = self.user.listAppResponses(self.program)
-        if len(responses) > 2:
-            return str(responses[2].question.subject) + ':  ' + str(responses[0])
+        return self.get_class_application(2)
+
+class UserAttributeResolver(object):
+    """ Looks up the fields of UserAttributeGetter for many users at once.
+
+        UserAttributeGetter runs its own queries for each user and field;
+        this fetches each field for all of the users in a few queries.
+        Fields which only depend on the user and their profile use the
+        getter's methods, with all of the profiles fetched together.  The
+        other fields have a bulk_<name> method, which returns a dict mapping
+        user IDs to values (users left out of the dict get None).
+    """
+
+    #   The number of users whose fields are fetched at a time by iter_rows()
+    CHUNK_SIZE = 1000
+
+    def __init__(self, users, program):
+        self.users = list(users)
+        self.user_ids = [user.id for user in self.users]
+        self.program = program
+
+    @classmethod
+    def iter_rows(cls, user_ids, program, attrs, chunk_size=None):
+        """ Yield lists of rows of the fields attrs for the users with the
+            given IDs, in order, fetching chunk_size users at a time. """
+        if chunk_size is None:
+            chunk_size = cls.CHUNK_SIZE
+        for i in range(0, len(user_ids), chunk_size):
+            chunk_ids = user_ids[i:i + chunk_size]
+            users = ESPUser.objects.in_bulk(chunk_ids)
+            yield cls([users[user_id] for user_id in chunk_ids], program).rows(attrs)
+
+    def rows(self, attrs):
+        """ Return the fields attrs of each of the users, as a list of rows. """
+        columns = [self.column(attr) for attr in attrs]
+        return [list(row) for row in zip(*columns)]
+
+    def column(self, attr):
+        """ Return the field attr of each of the users, formatted as by
+            UserAttributeGetter.get(). """
+        attr = attr.lstrip('0123456789_')
+        if hasattr(self, 'bulk_' + attr):
+            values = getattr(self, 'bulk_' + attr)()
+            return [UserAttributeGetter.format_value(values.get(user_id)) for user_id in self.user_ids]
         else:
-            return None
+            return [getter.get(attr) for getter in self.getters]
+
+    @cached_property
+    def profiles(self):
+        """ The latest profile of each user, or an empty profile, by user ID. """
+        profiles = RegistrationProfile.objects.filter(user__in=self.user_ids).order_by('user_id', '-last_ts').distinct('user_id')
+        profiles = profiles.select_related('contact_user', 'contact_guardian', 'student_info__k12school', 'teacher_info')
+        result = {profile.user_id: profile for profile in profiles}
+        for user in self.users:
+            if user.id not in result:
+                result[user.id] = RegistrationProfile(user=user)
+        return result
+
+    @cached_property
+    def getters(self):
+        return [UserAttributeGetter(user, self.program, profile=self.profiles[user.id]) for user in self.users]
+
+    def enrollments(self):
+        return StudentRegistration.valid_objects().filter(
+            user__in=self.user_ids, section__parent_class__parent_program=self.program,
+            relationship__name='Enrolled').order_by()
+
+    @cached_property
+    def regdates(self):
+        dates = self.enrollments().values('user').annotate(first=Min('start_date'), last=Max('start_date'))
+        return {row['user']: row for row in dates}
+
+    def _bulk_regdate(self, key):
+        return {user_id: dates[key].strftime("%Y-%m-%d %H:%M:%S")
+                for (user_id, dates) in self.regdates.items() if dates[key] is not None}
+
+    def bulk_first_regdate(self):
+        return self._bulk_regdate('first')
+
+    def bulk_last_regdate(self):
+        return self._bulk_regdate('last')
+
+    def bulk_classhours(self):
+        enrollments = list(self.enrollments().values_list('user', 'section').distinct())
+        sections = ClassSection.objects.filter(id__in={section_id for (user_id, section_id) in enrollments})
+        num_times = dict(sections.order_by().annotate(num_times=Count('meeting_times')).values_list('id', 'num_times'))
+        result = dict.fromkeys(self.user_ids, 0)
+        for (user_id, section_id) in enrollments:
+            result[user_id] += num_times[section_id]
+        return result
+
+    def bulk_lottery_ticket_id(self):
+        records = PhaseZeroRecord.user.through.objects.filter(
+            espuser__in=self.user_ids, phasezerorecord__program=self.program)
+        records = records.order_by('espuser_id', 'phasezerorecord__time', 'phasezerorecord_id').distinct('espuser_id')
+        return dict(records.values_list('espuser_id', 'phasezerorecord_id'))
+
+    def bulk_sibling_name(self):
+        infos = SplashInfo.objects.filter(student__in=self.user_ids, program=self.program)
+        return dict(infos.order_by('student_id', 'id').distinct('student_id').values_list('student_id', 'siblingname'))
+
+    @cached_property
+    def app_responses(self):
+        apps = StudentApplication.objects.filter(user__in=self.user_ids, program=self.program)
+        apps = apps.order_by('user_id', 'id').distinct('user_id').prefetch_related(Prefetch(
+            'responses', queryset=StudentAppResponse.objects.select_related('question__subject').order_by('id')))
+        return {app.user_id: list(app.responses.all()) for app in apps}
+
+    def _bulk_class_application(self, index):
+        return {user_id: UserAttributeGetter.format_app_response(responses[index])
+                for (user_id, responses) in self.app_responses.items() if len(responses) > index}
+
+    def bulk_class_application_1(self):
+        return self._bulk_class_application(0)
+
+    def bulk_class_application_2(self):
+        return self._bulk_class_application(1)
+
+    def bulk_class_application_3(self):
+        return self._bulk_class_application(2)
+
+class Echo(object):
+    """ A file-like object which returns what is written to it, so that
+        csv.writer can be used to produce the lines of a streamed CSV. """
+    def write(self, value):
+        return value
 
 class ListGenForm(forms.Form):
     attr_choices = list(UserAttributeGetter.getFunctions().items())
@@ -322,50 +459,39 @@ def generateList(self, request, tl, one, two, module, extra, prog, filterObj=Non
             #   Parse the contents of the form
             form = ListGenForm(request.POST, usertype=usertype)
             if form.is_valid():
-                lists = []
-                lists_indices = {}
                 split_by = form.cleaned_data['split_by']
 
                 labels_dict = UserAttributeGetter.getFunctions()
-                fields = [labels_dict[f]['label'] for f in form.cleaned_data['fields']]
+                attrs = list(form.cleaned_data['fields'])
                 #   If a split field is specified, make sure we fetch its data
-                if split_by and labels_dict[split_by]['label'] not in fields:
-                    fields.append(labels_dict[split_by]['label'])
+                if split_by and split_by not in attrs:
+                    attrs.append(split_by)
+                fields = [labels_dict[f]['label'] for f in attrs]
                 output_type = form.cleaned_data['output_type']
 
-                users = sorted(ESPUser.objects.filter(filterObj.get_Q()).filter(is_active=True).distinct())
-                for u in users:
-                    ua = UserAttributeGetter(u, self.program)
-                    user_fields = [ua.get(x) for x in form.cleaned_data['fields']]
-                    u.fields = user_fields
-                    #   Add information for split lists if desired
-                    if split_by:
-                        if ua.get(split_by) not in lists_indices:
-                            lists.append({'key': labels_dict[split_by]['label'], 'value': ua.get(split_by), 'users': []})
-                            lists_indices[ua.get(split_by)] = len(lists) - 1
-                        lists[lists_indices[ua.get(split_by)]]['users'].append(u)
-
-                if split_by:
-                    lists.sort(key=lambda x: x['value'])
-                else:
-                    lists.append({'users': users})
+                #   Sort the users the same way as ESPUser's comparison methods
+                users = ESPUser.objects.filter(id__in=ESPUser.objects.filter(filterObj.get_Q()).values('id'), is_active=True)
+                user_ids = list(users.order_by(Upper('last_name'), Upper('first_name'), 'id').values_list('id', flat=True))
 
                 if output_type == 'csv':
                     # properly speaking, this should be text/csv, but that
                     # causes Chrome to open in an external editor, which is
                     # annoying
-                    mimetype = 'text/plain'
-                elif output_type == 'html':
-                    mimetype = 'text/html'
+                    return StreamingHttpResponse(self.list_csv(user_ids, attrs, fields), content_type='text/plain')
                 else:
-                    # WTF?
-                    mimetype = 'text/html'
-                return render_to_response(
-                    self.baseDir()+('list_%s.html' % output_type),
-                    request,
-                    {'users': users, 'lists': lists, 'fields': fields, 'listdesc': filterObj.useful_name},
-                    content_type=mimetype,
-                )
+                    lists = []
+                    if split_by:
+                        lists_indices = {}
+                        split_values = (row[0] for rows in UserAttributeResolver.iter_rows(user_ids, self.program, [split_by]) for row in rows)
+                        for (user_id, value) in zip(user_ids, split_values):
+                            if value not in lists_indices:
+                                lists.append({'key': labels_dict[split_by]['label'], 'value': value, 'user_ids': []})
+                                lists_indices[value] = len(lists) - 1
+                            lists[lists_indices[value]]['user_ids'].append(user_id)
+                        lists.sort(key=lambda x: x['value'])
+                    else:
+                        lists.append({'user_ids': user_ids})
+                    return StreamingHttpResponse(self.list_html(lists, attrs, fields, filterObj.useful_name), content_type='text/html')
             else:
                 context = {
                     'form': form,
@@ -385,6 +511,30 @@ def generateList(self, request, tl, one, two, module, extra, prog, filterObj=Non
             }
             return render_to_response(self.baseDir()+'options.html', request, context)
 
+    def list_csv(self, user_ids, attrs, fields):
+        """ Yield the lines of a CSV list of the given users. """
+        writer = csv.writer(Echo(), quoting=csv.QUOTE_ALL, lineterminator='\n')
+        yield writer.writerow(['#'] + fields)
+        num = 0
+        for rows in UserAttributeResolver.iter_rows(user_ids, self.program, attrs):
+            for row in rows:
+                num += 1
+                yield writer.writerow([num] + row)
+
+    def list_html(self, lists, attrs, fields, listdesc):
+        """ Yield an HTML page of tables of the users in each of lists. """
+        yield render_to_string(self.baseDir() + 'list_html_header.html', {'listdesc': listdesc})
+        for user_list in lists:
+            context = {'list': user_list, 'fields': fields}
+            yield render_to_string(self.baseDir() + 'list_html_table.html', dict(context, first=True))
+            num = 0
+            for rows in UserAttributeResolver.iter_rows(user_list['user_ids'], self.program, attrs):
+                yield render_to_string(self.baseDir() + 'list_html_table.html',
+                                       dict(context, rows=enumerate(rows, num + 1)))
+                num += len(rows)
+            yield render_to_string(self.baseDir() + 'list_html_table.html', dict(context, last=True))
+        yield render_to_string(self.baseDir() + 'list_html_footer.html', {})
+
     @staticmethod
     def processPost(request):
         #   Turn multi-valued QueryDict into standard dictionary
@@ -57,6 +57,7 @@
 from esp.tagdict.models import Tag
 from esp.accounting.controllers import IndividualAccountingController
 from esp.program.controllers.studentclassregmodule import RegistrationTypeController as RTC
+from esp.program.controllers.sectionstatus import SectionStatusFeed
 
 class OnSiteClassList(ProgramModuleObj):
     doc = """Display lists of classes for onsite registration purposes."""
@@ -94,8 +95,14 @@ def catalog_status(self, request, tl, one, two, module, extra, prog):
         resp = HttpResponse(content_type='application/json')
         #   Fetch a reduced version of the catalog to save time
         sections = list(ClassSection.objects.filter(parent_class__parent_program=prog, status__gt=0).extra({'event_ids':  """ARRAY(SELECT "cal_event"."id" FROM "cal_event", "program_classsection_meeting_times" WHERE ("program_classsection_meeting_times"."event_id" = "cal_event"."id" AND "program_classsection_meeting_times"."classsection_id" = "program_classsection"."id"))"""}).values('id', 'parent_class__id', 'enrolled_students', 'event_ids', 'registration_status'))
-        for i in range(0, len(sections)):
-            sections[i]['capacity'] = ClassSection.objects.get(id=sections[i]['id']).capacity
+        statuses = SectionStatusFeed(prog).statuses()
+        #   Sections the feed doesn't know about yet get their capacities
+        #   all at once, rather than with a few queries each.
+        missing = [section['id'] for section in sections if not statuses.get(section['id'])]
+        capacities = ClassSection.capacities(missing, prog) if missing else {}
+        for section in sections:
+            status = statuses.get(section['id'])
+            section['capacity'] = status['capacity'] if status else capacities[section['id']]
         data = {
             #   Todo: section current capacity ? (see ClassSection.get_capacity())
             'classes': list(ClassSubject.objects.filter(parent_program=prog, status__gt=0).extra({'teacher_names': """array_to_string(ARRAY(SELECT auth_user.first_name || ' ' || auth_user.last_name FROM auth_user,program_class_teachers WHERE program_class_teachers.classsubject_id=program_class.id AND auth_user.id=program_class_teachers.espuser_id), ', ')""", 'class_size_max_optimal': """SELECT program_classsizerange.range_max FROM program_classsizerange WHERE program_classsizerange.id = optimal_class_size_range_id"""}).values('id', 'class_size_max', 'class_size_max_optimal', 'class_info', 'prereqs', 'hardness_rating', 'grade_min', 'grade_max', 'title', 'teacher_names', 'category__symbol', 'category__id')),
@@ -206,12 +213,26 @@ def counts_status(self, request, tl, one, two, module, extra, prog):
     @needs_onsite
     def full_status(self, request, tl, one, two, module, extra, prog):
         resp = HttpResponse(content_type='application/json')
-        data = [[section.id, section.isFull(webapp=True)] for section in
-                     ClassSection.objects.filter(status__gt=0, parent_class__status__gt=0,
-                                                 parent_class__parent_program=prog)]
+        data = [[section_id, status['full']] for (section_id, status) in SectionStatusFeed(prog).statuses().items()]
         json.dump(data, resp)
         return resp
 
+    @aux_call
+    @needs_onsite
+    def section_status_feed(self, request, tl, one, two, module, extra, prog):
+        """ The capacity, enrollment, attendance, fullness and registration
+            status of the sections which changed since the version given in
+            the 'since' parameter (or of all sections, without it).  Removed
+            sections are given as null. """
+        resp = HttpResponse(content_type='application/json')
+        try:
+            since = int(request.GET['since'])
+        except (KeyError, ValueError):
+            since = None
+        version, sections = SectionStatusFeed(prog).changes(since)
+        json.dump({'version': version, 'sections': sections}, resp)
+        return resp
+
     @aux_call
     @needs_onsite
     def rooms_status(self, request, tl, one, two, module, extra, prog):
@@ -38,16 +38,18 @@
 from esp.program.models  import ClassSubject, ClassSection, StudentRegistration
 from esp.program.models  import ClassFlagType
 from esp.program.class_status import ClassStatus
+from esp.program.controllers.availability import AvailabilityIndex
+from esp.program.controllers.classrooms import ClassroomMatrix
 from esp.users.views     import search_for_user
 from esp.users.controllers.usersearch import UserSearchController
-from esp.utils.latex  import render_to_latex
-from esp.accounting.controllers import ProgramAccountingController, IndividualAccountingController
+from esp.utils.latex  import render_to_latex, render_latex_source, shard_items, start_latex_job, get_latex_job, gen_latex_parallel, LATEX_SHARD_SIZE
+from esp.accounting.controllers import ProgramAccountingController, IndividualAccountingController, BatchAccountingController
 from esp.tagdict.models import Tag
 from esp.cal.models import Event
 from esp.middleware import ESPError
 from esp.utils.query_utils import nest_Q
 from esp.utils import cmp
-from esp.program.models import VolunteerOffer
+from esp.program.models import VolunteerOffer, FinancialAidRequest
 
 from django import forms
 from django.conf import settings
@@ -306,7 +308,11 @@ def coursecatalog(self, request, tl, one, two, module, extra, prog):
         context['group_name'] = group_name
 
         #   Hack for timeblock sorting (sorting by category is the default)
+        #   Each template starts a new page whenever the category (or start
+        #   time) changes, so a long catalog can be split between those.
         template_name = 'catalog_category.tex'
+        items_key = 'classes'
+        group_key = lambda cls: cls.category_id
         if sort_order[0] == 'meeting_times__start':
             template_name = 'catalog_timeblock.tex'
             sections = []
@@ -314,10 +320,16 @@ def coursecatalog(self, request, tl, one, two, module, extra, prog):
                 sections += list(x for x in cls.sections.all().filter(status__gt=0, meeting_times__isnull=False).distinct() if not ('open' in request.GET and x.isFull()))
             sections.sort(key=lambda x: x.start_time())
             context['sections'] = sections
+            items_key = 'sections'
+            group_key = lambda sec: sec.start_time().start
 
         if extra is None or len(str(extra).strip()) == 0:
             extra = 'pdf'
 
+        if extra == 'pdf' and context[items_key]:
+            return ProgramPrintables.render_latex_sharded(
+                request, self.baseDir()+template_name, context, items_key, context[items_key],
+                'Course catalog for %s' % prog.niceName(), 'catalog', group_key=group_key, disposition='inline')
         return render_to_latex(self.baseDir()+template_name, context, extra)
 
     @aux_call
@@ -770,12 +782,15 @@ def roomsbyFOO(self, request, tl, one, two, module, extra, prog, sort_exp = lamb
     @needs_admin
     def roomsbytime(self, request, tl, one, two, module, extra, prog):
         #   List of open classrooms, sorted by the first time they are available
+        matrix = ClassroomMatrix.for_program(self.program)
+
         def filt(one):
-            return one.available_any_time(self.program)
+            return len(matrix.available_times(one.name)) > 0
 
         def cmpsort(one, other):
             #   Find when available
-            return cmp(one.available_times(self.program)[0], other.available_times(self.program)[0])
+            return cmp(matrix.event_order[matrix.available_times(one.name)[0]],
+                       matrix.event_order[matrix.available_times(other.name)[0]])
 
         return self.roomsbyFOO(request, tl, one, two, module, extra, prog, cmpsort, filt)
 
@@ -1152,9 +1167,13 @@ def student_financial_spreadsheet(self, request, tl, one, two, module, extra, pr
         response = HttpResponse(content_type='text/csv')
         writer = csv.writer(response)
         writer.writerow(('Control ID', 'Student ID', 'Last name', 'First name', 'Total cost', 'Finaid grant', 'Amount paid', 'Amount owed'))
+        #   Count any missing required costs without creating them, since
+        #   making a spreadsheet shouldn't write to the accounting records.
+        bac = BatchAccountingController(self.program, students, ensure_required=False)
+        bac.ensure_required_transfers(save=False)
         for student in students:
-            iac = IndividualAccountingController(self.program, student)
-            writer.writerow((iac.get_id(), student.id, student.last_name.encode('ascii', 'replace'), student.first_name.encode('ascii', 'replace'), '%.2f' % iac.amount_requested(), '%.2f' % iac.amount_finaid(), '%.2f' % iac.amount_paid(), '%.2f' % iac.amount_due()))
+            balance = bac.balance(student)
+            writer.writerow((bac.get_id(student), student.id, student.last_name.encode('ascii', 'replace'), student.first_name.encode('ascii', 'replace'), '%.2f' % balance['requested'], '%.2f' % balance['finaid'], '%.2f' % balance['paid'], '%.2f' % balance['due']))
 
         return response
 
@@ -1262,8 +1281,15 @@ def get_student_schedules(request, students, prog, extra='', onsite=False):
 
         show_empty_blocks = Tag.getBooleanTag('studentschedule_show_empty_blocks', prog)
         timeslots = list(prog.getTimeSlots())
+
+        # get payment information for everyone at once, counting any missing
+        # required transfers without creating them (printing shouldn't write
+        # to the accounting records)
+        bac = BatchAccountingController(prog, students, ensure_required=False)
+        bac.ensure_required_transfers(save=False)
+        admission_lit = bac.default_admission_lineitemtype()
+
         for student in students:
-            student.updateOnsite(request)
             # get list of valid classes
             classes = classes_by_student[student.id]
 
@@ -1311,19 +1337,16 @@ def get_student_schedules(request, students, prog, extra='', onsite=False):
                     classes.append(t)
                 min_index = i
 
-            # get payment information
-            iac = IndividualAccountingController(prog, student)
-
             # attach payment information to student
-            student.invoice_id = iac.get_id()
-            student.itemizedcosts = iac.get_transfers()
-            student.meals = iac.get_transfers(optional_only=True)  # catch everything that's not admission to the program.
-            student.required = iac.get_transfers(required_only=True).exclude(line_item=iac.default_admission_lineitemtype())
-            student.admission = iac.get_transfers(line_items = [iac.default_admission_lineitemtype()])  # Program admission
-            student.paid_online = iac.has_paid()
-            student.amount_finaid = iac.amount_finaid()
-            student.amount_siblingdiscount = iac.amount_siblingdiscount()
-            student.itemizedcosttotal = iac.amount_due()
+            student.invoice_id = bac.get_id(student)
+            student.itemizedcosts = bac.get_transfers(student)
+            student.meals = bac.get_transfers(student, optional_only=True)  # catch everything that's not admission to the program.
+            student.required = [t for t in bac.get_transfers(student, required_only=True) if t.line_item != admission_lit]
+            student.admission = bac.get_transfers(student, line_items = [admission_lit])  # Program admission
+            student.paid_online = bac.has_paid(student)
+            student.amount_siblingdiscount = bac.amount_siblingdiscount(student)
+            student.amount_finaid = bac.amount_finaid(student, student.amount_siblingdiscount)
+            student.itemizedcosttotal = bac.amount_due(student)
 
             student.has_paid = ( student.itemizedcosttotal == 0 )
             student.payment_info = True
@@ -1345,16 +1368,49 @@ def get_student_schedules(request, students, prog, extra='', onsite=False):
         context["posttext"] = Tag.getProgramTag("student_schedule_posttext", prog)
         if file_type == 'html':
             return render_to_response(basedir+'studentschedule.html', request, context)
-        elif file_type == 'pdf':
-            if len(students) > 1:
-                response = render_to_latex(basedir+'studentschedule.tex', context, 'pdf')
-                response['Content-Disposition'] = 'attachment; filename="studentschedules.pdf"'
-                return response
-            else:
-                return render_to_latex(basedir+'studentschedule.tex', context, 'pdf')
+        elif file_type == 'pdf' and len(students) > 1:
+            return ProgramPrintables.render_latex_sharded(
+                request, basedir+'studentschedule.tex', context, 'students', students,
+                'Student schedules for %s' % prog.niceName(), 'studentschedules')
         else:
             return render_to_latex(basedir+'studentschedule.tex', context, file_type)
 
+    @staticmethod
+    def render_latex_sharded(request, template, context, items_key, items, title, filename, group_key=None, disposition='attachment'):
+        """ Render a PDF printable whose pages come from iterating over
+            context[items_key], e.g. one page per student.
+
+            Small documents are compiled right away.  Larger ones are split
+            into shards of at most LATEX_SHARD_SIZE items (never splitting a
+            group of consecutive items with the same group_key, e.g. the
+            classes in one category), which are compiled in parallel.  Users
+            who are logged in watch a progress page while that happens in
+            the background; anyone else (e.g. on the public PDF catalog)
+            waits for the merged document. """
+        if len(items) <= LATEX_SHARD_SIZE:
+            context[items_key] = items
+            response = render_to_latex(template, context, 'pdf')
+            response['Content-Disposition'] = '%s; filename="%s.pdf"' % (disposition, filename)
+            return response
+
+        #   Templates with front matter (e.g. the catalog's opening page)
+        #   only render it when shard_index is 0.
+        texcodes = []
+        for (i, shard) in enumerate(shard_items(items, LATEX_SHARD_SIZE, group_key)):
+            context[items_key] = shard
+            context['shard_index'] = i
+            texcodes.append(render_latex_source(template, context, 'pdf'))
+        if not request.user.is_authenticated:
+            response = HttpResponse(gen_latex_parallel(texcodes, 'pdf'), content_type='application/pdf')
+            response['Content-Disposition'] = '%s; filename="%s.pdf"' % (disposition, filename)
+            return response
+        job_id = start_latex_job(texcodes, 'pdf', user=request.user, filename=filename)
+        return render_to_response('utils/latex_job.html', request, {
+            'job_id': job_id,
+            'job': get_latex_job(job_id),
+            'title': title,
+        })
+
     @aux_call
     @needs_admin
     def flatstudentschedules(self, request, tl, one, two, module, extra, prog):
@@ -1587,22 +1643,33 @@ def studentchecklist(self, request, tl, one, two, module, extra, prog):
         tag_data = Tag.getProgramTag('student_reg_records', prog)
         if tag_data:
             records = [event for event in [x.strip().lower() for x in tag_data.split(',') if RecordType.objects.filter(name = x.strip().lower()).exists()] if event not in ['attended', 'med', 'liab']]
+        #   Get the financial aid requests and payment information for
+        #   everyone at once
+        latest_requests = {}
+        applied = set()
+        for finaid_request in FinancialAidRequest.objects.filter(program=prog, user__in=students).order_by('id'):
+            latest_requests[finaid_request.user_id] = finaid_request
+            if finaid_request.done:
+                applied.add(finaid_request.user_id)
+        bac = BatchAccountingController(self.program, students, ensure_required=False)
+        bac.ensure_required_transfers(save=False)
+
         studentList = []
         for student in students:
             finaid_status = 'None'
-            if student.appliedFinancialAid(prog):
-                if student.financialaidrequest_set.filter(program=prog).order_by('-id')[0].reduced_lunch:
+            if student.id in applied:
+                if latest_requests[student.id].reduced_lunch:
                     finaid_status = 'Req. (RL)'
                 else:
                     finaid_status = 'Req. (No RL)'
 
-            iac = IndividualAccountingController(self.program, student)
-            if student.hasFinancialAid(self.program):
+            balance = bac.balance(student)
+            if balance['finaid'] > 0:
                 finaid_status = 'Approved'
 
             studentList.append({'user': student,
-                                'paid': iac.has_paid(in_full=True),
-                                'amount_due': iac.amount_due(),
+                                'paid': balance['paid'] > 0 and balance['due'] <= 0,
+                                'amount_due': balance['due'],
                                 'finaid': finaid_status,
                                 'checked_in': Record.user_completed(student, "attended", self.program),
                                 'med': Record.user_completed(student, "med", self.program),
@@ -1625,6 +1692,8 @@ def classchecklists(self, request, tl, one, two, module, extra, prog):
         students= sorted([ user for user in self.program.students()['confirmed']])
 
         class_list = []
+        bac = BatchAccountingController(self.program, students, ensure_required=False)
+        bac.ensure_required_transfers(save=False)
 
         for c in self.program.classes():
             class_dict = {'cls': c}
@@ -1632,8 +1701,7 @@ def classchecklists(self, request, tl, one, two, module, extra, prog):
 
             for student in students:
                 if c in student.getEnrolledClasses(self.program):
-                    iac = IndividualAccountingController(self.program, student)
-                    if iac.amount_due() <= 0:
+                    if bac.amount_due(student) <= 0:
                         paid_symbol = 'X'
                     else:
                         paid_symbol = ''
@@ -1719,10 +1787,11 @@ def oktimes_spr(self, request, tl, one, two, module, extra, prog):
             sections = sections.filter(meeting_times__isnull=True, status=ClassStatus.ACCEPTED)
 
         times = prog.getTimeSlots()
+        index = AvailabilityIndex(prog)
         if extra == "unscheduled":
-            sections_possible_times = [(section, section.viable_times(True)) for section in sections]
+            sections_possible_times = [(section, section.viable_times(True, index=index)) for section in sections]
         else:
-            sections_possible_times = [(section, section.viable_times(False)) for section in sections]
+            sections_possible_times = [(section, section.viable_times(False, index=index)) for section in sections]
 
         # functions to determine what will fill in the spreadsheet cell for each thing
         def time_possible(time, sections_list):
@@ -1752,7 +1821,7 @@ def needs_resource(resname, section):
         # this writes each row associated with a section, for the columns determined above.
         for section, timeslist in sections_possible_times:
             if Tag.getBooleanTag('oktimes_collapse'):
-                time_values = [', '.join([e.start.strftime('%a %I:%M %p') for e in section.viable_times()])]
+                time_values = [', '.join([e.start.strftime('%a %I:%M %p') for e in section.viable_times(index=index)])]
             else:
                 time_values = [time_possible(time, timeslist) for time in times]
 
@@ -1800,10 +1869,11 @@ class number
         #    sections = sections.filter(meeting_times__isnull=True, status=ClassStatus.ACCEPTED)
 
         times = prog.getTimeSlots()
+        index = AvailabilityIndex(prog)
         if extra == "unscheduled":
-            sections_possible_times = [(section, section.viable_times(True)) for section in sections]
+            sections_possible_times = [(section, section.viable_times(True, index=index)) for section in sections]
         else:
-            sections_possible_times = [(section, section.viable_times(False)) for section in sections]
+            sections_possible_times = [(section, section.viable_times(False, index=index)) for section in sections]
 
         # functions to determine what will fill in the spreadsheet cell for each thing
         def time_possible(time, sections_list):
@@ -1,19 +1,28 @@
+from django.conf import settings
+from django.db.models import Prefetch
 from django.http import HttpResponse
-from esp.program.models import ClassSection, ClassSubject, ModeratorRecord
+from django.utils.functional import cached_property
+from esp.program.class_status import ClassStatus
+from esp.program.controllers.availability import AvailabilityIndex
+from esp.program.models import ClassSubject, ModeratorRecord
 from esp.program.modules.base import ProgramModuleObj, needs_admin, main_call
-from esp.resources.models import ResourceRequest
+from esp.resources.models import Resource, ResourceAssignment, ResourceRequest
+from collections import defaultdict
 from copy import deepcopy
-from esp.cal.models import *
-from datetime import date
+from datetime import timedelta
 from esp.utils.web import render_to_response
-from esp.users.models import ESPUser
+from esp.users.models import ESPUser, Permission
 from esp.tagdict.models import Tag
 from esp.cal.models import Event
 
 from esp.middleware.threadlocalrequest import get_current_request
 
 import json
+import logging
 import re
+import time
+
+logger = logging.getLogger(__name__)
 
 
 class SchedulingCheckModule(ProgramModuleObj):
@@ -33,7 +42,13 @@ def module_properties(cls):
     @needs_admin
     def scheduling_checks(self, request, tl, one, two, module, extra, prog):
         s = SchedulingCheckRunner(prog)
-        if extra:
+        if extra == 'all':
+            #   Run every check in one request, so that they share one
+            #   snapshot of the schedule.
+            results, timings = s.run_all()
+            return HttpResponse(json.dumps({'results': results, 'timings': timings}),
+                                content_type='application/json')
+        elif extra:
             results = s.run_diagnostics([extra])
             return HttpResponse(results)
         else:
@@ -104,49 +119,265 @@ def _format_dict_table(self, d, headings, help_text=""): #needs verify
         output["body"] = [self._table_row([key] + [row[h] for h in headings if h]) for key, row in sorted(d.items())]
         return output
 
+class ScheduleSnapshot(object):
+    """ The schedule of a program, as seen by the scheduling checks.
+
+    Each kind of data (sections with their times, rooms, teachers and
+    moderators; availability; resource requests; ...) is loaded with a fixed
+    number of queries the first time a check needs it, and is then shared by
+    every check, so running all of them costs a bounded number of queries no
+    matter how big the program is.  The helper methods mirror the ClassSection
+    and ESPUser methods the checks would otherwise call, but only look at the
+    loaded data.  Timeslots are compared by ID rather than with Event's
+    comparison methods, which only look at start times.
+    """
+
+    def __init__(self, program, incl_unreview=False):
+        self.p = program
+        self.incl_unreview = incl_unreview
+
+    @cached_property
+    def timeslots(self):
+        return self.p.getTimeSlotList()
+
+    @cached_property
+    def sections(self):
+        """ All sections of the program, in order of ID. """
+        assignments = ResourceAssignment.objects.select_related('resource__res_type', 'resource__event')
+        return list(self.p.sections()
+                    .select_related('parent_class__category', 'parent_class__parent_program')
+                    .prefetch_related('meeting_times',
+                                      Prefetch('resourceassignment_set', queryset=assignments),
+                                      'parent_class__teachers', 'moderators'))
+
+    @cached_property
+    def sections_by_id(self):
+        return {s.id: s for s in self.sections}
+
+    @cached_property
+    def open_class_category_id(self):
+        category = self.p.open_class_category
+        return category.id if category else None
+
+    def scheduled_sections(self, include_walkins=True):
+        """ The sections most checks look at: approved (or, with
+        incl_unreview, not rejected or cancelled) sections with resources
+        assigned, other than lunch. """
+        min_status = 0 if self.incl_unreview else 1
+        return [s for s in self.sections
+                if s.status >= min_status and s.resourceassignment_set.all()
+                and s.category.category != 'Lunch'
+                and (include_walkins or s.category.id != self.open_class_category_id)]
+
+    def meeting_times(self, section):
+        return sorted(section.meeting_times.all(), key=lambda e: e.start)
+
+    def resources(self, section):
+        return [a.resource for a in section.resourceassignment_set.all()]
+
+    def classroom_assignments(self, section):
+        return [a for a in section.resourceassignment_set.all()
+                if a.resource.res_type is not None and a.resource.res_type.name == 'Classroom']
+
+    def classrooms(self, section):
+        """ Like section.classrooms(), in order of ID. """
+        rooms = {a.resource.id: a.resource for a in self.classroom_assignments(section)}
+        return [rooms[room_id] for room_id in sorted(rooms)]
+
+    def initial_rooms(self, section):
+        times = self.meeting_times(section)
+        if not times:
+            return []
+        return [room for room in self.classrooms(section) if room.event_id == times[0].id]
+
+    def teachers(self, section):
+        """ Like section.teachers, ordered by last name. """
+        return sorted(section.parent_class.teachers.all(), key=lambda t: t.last_name)
+
+    def moderators(self, section):
+        return list(section.moderators.all())
+
+    @cached_property
+    def lunch_blocks(self):
+        """ The timeslots of the program's lunch sections, as a list for each
+        day of the program. """
+        dates = []
+        for ts in self.timeslots:
+            if ts.start.date() not in dates:
+                dates.append(ts.start.date())
+        lunch_timeslots = {}
+        for s in self.sections:
+            if s.category.category == 'Lunch':
+                for ts in s.meeting_times.all():
+                    lunch_timeslots[ts.id] = ts
+        lunch_by_day = [[] for x in dates]
+        for ts in sorted(lunch_timeslots.values(), key=lambda e: e.start):
+            lunch_by_day[dates.index(ts.start.date())].append(ts)
+        return lunch_by_day
+
+    @cached_property
+    def teacher_lists(self):
+        return self.p.teachers()
+
+    @cached_property
+    def _sections_by_teacher(self):
+        sections = defaultdict(list)
+        for s in self.sections:
+            for t in s.parent_class.teachers.all():
+                sections[t.id].append(s)
+        return sections
+
+    def taught_sections(self, user):
+        """ Like user.getTaughtSectionsFromProgram(program). """
+        return [s for s in self._sections_by_teacher.get(user.id, [])
+                if s.status != ClassStatus.REJECTED and s.parent_class.status != ClassStatus.REJECTED]
+
+    def taught_time(self, user, round_to=0.0):
+        """ Like user.getTaughtTime(program, round_to=round_to). """
+        total_time = timedelta()
+        for s in self.taught_sections(user):
+            if s.status >= 0 and s.parent_class.status >= 0:
+                hours = float(s.duration or 0)
+                if round_to:
+                    hours = round_to * round(hours / round_to)
+                total_time += timedelta(hours=hours)
+        return total_time
+
+    @cached_property
+    def availability(self):
+        return AvailabilityIndex(self.p)
+
+    def available_times(self, user, ignore_moderation=True):
+        """ Like user.getAvailableTimes(program, ignore_classes=True), as a
+        set of timeslot IDs. """
+        index = self.availability
+        return set(index.event_ids(index.available_mask(user, ignore_classes=True,
+                                                        ignore_moderation=ignore_moderation)))
+
+    @cached_property
+    def _admin_ids(self):
+        """ The IDs of the teachers who are administrators, as in
+        ESPUser.isAdministrator(). """
+        teacher_ids = list(self._sections_by_teacher)
+        admins = set(ESPUser.objects.filter(id__in=teacher_ids, groups__name='Administrator')
+                     .values_list('id', flat=True))
+        permissions = Permission.objects.filter(Permission.is_valid_qobject(),
+                                                permission_type='Administer', program=None)
+        admins.update(permissions.filter(user__in=teacher_ids).values_list('user', flat=True))
+        admins.update(ESPUser.objects.filter(id__in=teacher_ids,
+                                             groups__in=permissions.filter(user=None).values('role'))
+                      .values_list('id', flat=True))
+        return admins
+
+    def is_admin(self, user):
+        return user.id in self._admin_ids
+
+    @cached_property
+    def _requests(self):
+        requests = defaultdict(list)
+        for rr in ResourceRequest.objects.filter(
+                target__parent_class__parent_program=self.p).select_related('res_type'):
+            requests[rr.target_id].append(rr)
+        return requests
+
+    def resource_requests(self, section):
+        return self._requests.get(section.id, [])
+
+    @cached_property
+    def _furnishings(self):
+        """ Map the IDs of the rooms in use to the IDs of the types of the
+        other resources in their groups (see Resource.associated_resources). """
+        rooms = {}
+        for s in self.sections:
+            for room in self.classrooms(s):
+                rooms[room.id] = room
+        group_ids = {room.res_group_id for room in rooms.values() if room.res_group_id is not None}
+        groups = defaultdict(list)
+        for res_id, group_id, res_type_id in (Resource.objects.filter(res_group__in=group_ids)
+                                              .exclude(res_type__name='Classroom')
+                                              .values_list('id', 'res_group', 'res_type')):
+            groups[group_id].append((res_id, res_type_id))
+        return {room_id: {res_type_id for res_id, res_type_id in groups.get(room.res_group_id, []) if res_id != room_id}
+                for room_id, room in rooms.items()}
+
+    def unsatisfied_requests(self, section):
+        """ Like section.unsatisfied_requests(). """
+        requests = self.resource_requests(section)
+        rooms = self.classrooms(section)
+        if not rooms:
+            return requests
+        furnishings = self._furnishings[rooms[0].id]
+        return [rr for rr in requests if rr.res_type_id not in furnishings]
+
+    @cached_property
+    def _moderator_records(self):
+        records = {}
+        for record in ModeratorRecord.objects.filter(program=self.p).prefetch_related('class_categories'):
+            records.setdefault(record.user_id, record)
+        return records
+
+    def moderator_record(self, user):
+        return self._moderator_records.get(user.id)
+
 class SchedulingCheckRunner:
     # Generate html report and generate text report functions?lingCheckRunner:
-    def __init__(self, program, formatter=JSONFormatter()):
+
+    # Running all checks should take less than this many seconds; if it
+    # takes longer, a warning is logged with the time each check took.
+    TIME_TARGET = getattr(settings, 'SCHEDULING_CHECKS_TIME_TARGET', 10)
+
+    def __init__(self, program, formatter=JSONFormatter(), incl_unreview=None):
         """
-        high_school_only and lunch should be lists of indices of timeslots for the high school
-        only block and for lunch respectively
+        If incl_unreview is not given, unreviewed classes are included if the
+        current request has an "unreviewed" parameter.
         """
         self.p = program
         self.formatter = formatter
 
-        request = get_current_request()
-        self.incl_unreview = "unreviewed" in request.GET
+        if incl_unreview is None:
+            request = get_current_request()
+            incl_unreview = "unreviewed" in request.GET
+        self.incl_unreview = incl_unreview
 
-        self.lunch_blocks = self._getLunchByDay()
+        self.snapshot = ScheduleSnapshot(program, incl_unreview)
 
         #things that we'll calculate lazilly
-        self.listed_sections = False
-        self.listed_nonwalkins = False
         self.calculated_classes_missing_resources = False
         self.d_categories = []
         self.d_grades = []
 
-    def _getLunchByDay(self):
-        #   Get IDs of timeslots allocated to lunch by day
-        #   (note: requires that this is constant across days)
-        lunch_timeslots = Event.objects.filter(meeting_times__parent_class__parent_program=self.p, meeting_times__parent_class__category__category='Lunch').order_by('start').distinct()
-        #   Note: this code should not be necessary once lunch-constraints branch is merged (provides Program.dates())
-        dates = []
-        for ts in self.p.getTimeSlots():
-            ts_day = date(ts.start.year, ts.start.month, ts.start.day)
-            if ts_day not in dates:
-                dates.append(ts_day)
-        lunch_by_day = [[] for x in dates]
-        for ts in lunch_timeslots:
-            d = date(ts.start.year, ts.start.month, ts.start.day)
-            lunch_by_day[dates.index(d)].append(ts)
-        return lunch_by_day
+    @property
+    def lunch_blocks(self):
+        return self.snapshot.lunch_blocks
 
     def run_diagnostics(self, diagnostics=None):
         if diagnostics is None:
              diagnostics = self.all_diagnostics()
         return [getattr(self, diag)() for diag in diagnostics]
 
+    def run_all(self):
+        """
+        Run every diagnostic against the same snapshot of the schedule.
+        Returns a dict mapping the name of each diagnostic to its output (or
+        to None, if it failed), and a dict of the time each one took.
+        """
+        results = {}
+        timings = {}
+        start = time.time()
+        for diag, title in self.all_diagnostics():
+            diag_start = time.time()
+            try:
+                results[diag] = getattr(self, diag)()
+            except Exception:
+                logger.exception('Scheduling check %s failed for %s', diag, self.p.url)
+                results[diag] = None
+            timings[diag] = time.time() - diag_start
+        total = time.time() - start
+        if total > self.TIME_TARGET:
+            logger.warning('Scheduling checks for %s took %.1fs (target %ss): %s', self.p.url, total, self.TIME_TARGET,
+                           ', '.join('%s %.2fs' % item for item in sorted(timings.items(), key=lambda item: -item[1])))
+        return results, timings
+
     # Update this to add a scheduling check.
     def all_diagnostics(self):
         if self.p.hasModule("TeacherModeratorModule"):
@@ -197,41 +428,12 @@ def all_diagnostics(self):
 
     def _timeslot_dict(self, slot=lambda: 0):
         d = {}
-        for i in self.p.getTimeSlotList():
+        for i in self.snapshot.timeslots:
             d[i] = slot()
         return d
 
-    #memoize the list of all class sections in this program
     def _all_class_sections(self, include_walkins=True):
-        if include_walkins and self.listed_sections:
-            return self.all_sections
-        elif (include_walkins == False) and self.listed_nonwalkins:
-            return self.all_nonwalkins
-        else:
-            qs = self.p.sections()
-            if include_walkins == False:
-                #filter out walkins
-                qs = qs.exclude(parent_class__category__id=self.p.open_class_category.id)
-            if self.incl_unreview:
-                #filter out rejected/cancelled sections
-                qs = qs.exclude(status__lt=0)
-            else:
-                #filter out non-approved
-                qs = qs.exclude(status__lte=0)
-            #filter out unscheduled classes
-            qs = qs.exclude(resourceassignment__isnull=True)
-            #filter out lunch
-            qs = qs.exclude(parent_class__category__category='Lunch')
-            qs = qs.select_related('parent_class', 'parent_class__parent_program', 'parent_class__category')
-            qs = qs.prefetch_related('meeting_times', 'resourceassignment_set', 'resourceassignment_set__resource', 'parent_class__teachers', 'moderators')
-            if include_walkins:
-                self.all_sections = list(qs)
-                self.listed_sections = True
-                return self.all_sections
-            else:
-                self.all_nonwalkins = list(qs)
-                self.listed_nonwalkins = True
-                return self.all_nonwalkins
+        return self.snapshot.scheduled_sections(include_walkins)
 
     #################################################
     #
@@ -248,8 +450,8 @@ def lunch_blocks_setup(self):
     def incompletely_scheduled_classes(self):
         problem_classes = []
         for s in self._all_class_sections():
-            mt =  sorted(s.get_meeting_times())
-            rooms = [a.resource for a in s.classroomassignments()]
+            mt = self.snapshot.meeting_times(s)
+            rooms = self.snapshot.classroom_assignments(s)
             if(len(rooms) != len(mt)):
                 problem_classes.append(s)
             else:
@@ -261,10 +463,10 @@ def incompletely_scheduled_classes(self):
     def inconsistent_rooms_and_times(self):
         output = []
         for s in self._all_class_sections():
-            mt = sorted(s.get_meeting_times())
-            rooms = [a.resource for a in s.classroomassignments()]
-            res_events = sorted([x.event for x in rooms])
-            if res_events != mt:
+            mt = self.snapshot.meeting_times(s)
+            rooms = [a.resource for a in self.snapshot.classroom_assignments(s)]
+            res_events = sorted([x.event for x in rooms], key=lambda e: e.start)
+            if [e.id for e in res_events] != [e.id for e in mt]:
                 output.append({"Section": s, "Resource events": res_events,
                                "Meeting times": mt})
         return self.formatter.format_table(output,
@@ -273,11 +475,11 @@ def inconsistent_rooms_and_times(self):
     def classes_which_cover_lunch(self):
         l = []
         for s in self._all_class_sections(include_walkins=False):
-            mt =  s.get_meeting_times()
+            mt = {e.id for e in self.snapshot.meeting_times(s)}
             for lunch in self.lunch_blocks:
                 if len(lunch) == 0:
                     pass
-                elif not (False in [b in mt for b in lunch]):
+                elif not (False in [b.id in mt for b in lunch]):
                     l.append(s)
         return self.formatter.format_list(l, ["Classes"])
 
@@ -293,29 +495,29 @@ def classes_wrong_length(self):
 
     def unapproved_scheduled_classes(self):
         output = []
-        sections = ClassSection.objects.filter(status__lt=10, parent_class__parent_program=self.p)
-        for sec in sections:
-            if sec.get_meeting_times() or sec.getResources():
+        for sec in self.snapshot.sections:
+            if sec.status < 10 and (self.snapshot.meeting_times(sec) or self.snapshot.resources(sec)):
                 output.append(sec)
         return self.formatter.format_list(output, ["Classes"])
 
     def teachers_teaching_two_classes_same_time(self):
-        if self.p.hasModule("TeacherModeratorModule"):
+        has_moderators = self.p.hasModule("TeacherModeratorModule")
+        if has_moderators:
             name_heading = 'Teacher/' + self.p.getModeratorTitle().capitalize() + "'s Name"
         else:
             name_heading = "Teacher's Name"
         d = self._timeslot_dict(slot=lambda: {})
         l = []
         for s in self._all_class_sections():
-            mt =  s.get_meeting_times()
+            mt = self.snapshot.meeting_times(s)
             for t in mt:
-                for teach in s.teachers:
+                for teach in self.snapshot.teachers(s):
                     if not teach in d[t]:
-                        d[t][teach] = str(s) + (" (Teacher)" if self.p.hasModule("TeacherModeratorModule") else "")
+                        d[t][teach] = str(s) + (" (Teacher)" if has_moderators else "")
                     else:
                         l.append({"Username": teach, name_heading: teach.name(), "Timeslot": t,
-                                  "Section 1": str(s) + (" (Teacher)" if self.p.hasModule("TeacherModeratorModule") else ""), "Section 2": d[t][teach]})
-                for mod in s.get_moderators():
+                                  "Section 1": str(s) + (" (Teacher)" if has_moderators else ""), "Section 2": d[t][teach]})
+                for mod in self.snapshot.moderators(s):
                     if not mod in d[t]:
                         d[t][mod] = str(s) + " (" + str(self.p.getModeratorTitle().capitalize()) + ")"
                     else:
@@ -327,8 +529,8 @@ def multiple_classes_same_resource_same_time(self):
         d = self._timeslot_dict(slot=lambda: {})
         l = []
         for s in self._all_class_sections(include_walkins=False):
-            mt =  s.get_meeting_times()
-            resources = s.getResources()
+            mt = self.snapshot.meeting_times(s)
+            resources = self.snapshot.resources(s)
             for t in mt:
                 for r in resources:
                     if not r in d[t]:
@@ -340,7 +542,7 @@ def multiple_classes_same_resource_same_time(self):
     def room_capacity_mismatch(self, lower_reporting_ratio=0.5, upper_reporting_ratio=1.5):
         l = []
         for s in self._all_class_sections(include_walkins=False):
-            r = s.classrooms()
+            r = self.snapshot.classrooms(s)
             if len(r) > 0:
                 room = r[0]
                 cls = s.parent_class
@@ -349,21 +551,26 @@ def room_capacity_mismatch(self, lower_reporting_ratio=0.5, upper_reporting_rati
         return self.formatter.format_table(l, {'headings': ["Section", "Class Max", "Room Max"]})
 
     def hungry_teachers(self, ignore_open_classes=True):
-        lunches = self.lunch_blocks
-        if ignore_open_classes:
-            open_class_cat = self.p.open_class_category
+        open_class_cat_id = self.snapshot.open_class_category_id if ignore_open_classes else None
         bads = []
-        for lunch in lunches:
+        for lunch in self.lunch_blocks:
             if lunch:
-                q=ESPUser.objects.all()
-                for block in lunch:
-                    q=q.filter(classsubject__sections__meeting_times=block)
-                for t in q.distinct():
-                    classes = [ClassSection.objects.filter(parent_class__teachers=t,meeting_times=block)[0] for block in lunch]
-                    if open_class_cat.id not in [c.category.id for c in classes]:
+                lunch_ids = {block.id for block in lunch}
+                #   The first section each teacher teaches in each lunch block
+                lunch_sections = defaultdict(dict)
+                for s in self.snapshot.sections:
+                    for block in self.snapshot.meeting_times(s):
+                        if block.id in lunch_ids:
+                            for t in s.parent_class.teachers.all():
+                                lunch_sections[t].setdefault(block.id, s)
+                for t, sections in lunch_sections.items():
+                    if len(sections) < len(lunch_ids):
+                        continue
+                    classes = [sections[block.id] for block in lunch]
+                    if open_class_cat_id not in [c.category.id for c in classes]:
                         #converts the list of class section objects to a single string
                         str1 = ', '
-                        classes = str1.join([unicode(c) for c in classes])
+                        classes = str1.join([str(c) for c in classes])
                         bads.append({
                             'Username': t,
                             'Teacher Name': t.name(),
@@ -402,7 +609,7 @@ def class_category_dict():
         d_classes = self._timeslot_dict(slot=class_category_dict)
         d_capacity = self._timeslot_dict(slot=class_category_dict)
         for s in self._all_class_sections():
-            mt =  s.get_meeting_times()
+            mt = self.snapshot.meeting_times(s)
             for t in mt:
                 #   Handle classes not in program's list of class categories
                 #   (edge case in the event of manual modifications)
@@ -443,7 +650,7 @@ def grade_dict():
         d_capacity = self._timeslot_dict(slot=grade_dict)
         for s in self._all_class_sections(include_walkins=False):
             cls = s.parent_class
-            mt =  s.get_meeting_times()
+            mt = self.snapshot.meeting_times(s)
             for t in mt:
                 for grade in range(cls.grade_min, cls.grade_max + 1, 1):
                     d_classes[t][grade] += 1
@@ -468,10 +675,10 @@ def admin_dict():
 
         d = self._timeslot_dict(slot=admin_dict)
         for s in self._all_class_sections():
-            teachers = s.parent_class.get_teachers()
-            admin_teachers = [t for t in teachers if t.isAdministrator()]
+            teachers = self.snapshot.teachers(s)
+            admin_teachers = [t for t in teachers if self.snapshot.is_admin(t)]
             for a in admin_teachers:
-                 mt =  s.get_meeting_times()
+                 mt = self.snapshot.meeting_times(s)
                  for t in mt:
                       d[t][name_string].append(a.name())
                       d[t][key_string].append(str(a))
@@ -491,11 +698,11 @@ def _calculate_classes_missing_resources(self):
         l_classrooms = []
         l_mod = []
         for s in self._all_class_sections():
-            meeting_times = s.get_meeting_times()
+            meeting_times = self.snapshot.meeting_times(s)
             first_hour = meeting_times[0] if meeting_times else None
-            classrooms = s.classrooms()
+            classrooms = self.snapshot.classrooms(s)
             classroom = classrooms[0] if classrooms else None
-            unsatisfied_requests = s.unsatisfied_requests()
+            unsatisfied_requests = self.snapshot.unsatisfied_requests(s)
             if len(unsatisfied_requests) > 0:
                 for u in unsatisfied_requests:
                     #I'm not sure how MIT specific is.  I don't have access to other databases to know whether this will work
@@ -505,13 +712,14 @@ def _calculate_classes_missing_resources(self):
                             l_classrooms.append({ "Section": s, "First Hour": first_hour, "Requested Type": u.desired_value, "Classroom": classroom })
                     else:
                         l_resources.append({ "Section": s, "First Hour": first_hour, "Unfulfilled Request": u, "Classroom": classroom })
-            for moderator in s.get_moderators():
-               mod_recs = ModeratorRecord.objects.filter(program=s.parent_class.parent_program, user=moderator)
-               if mod_recs.count() == 0 or s.parent_class.category not in mod_recs[0].class_categories.all():
-                   if mod_recs.count() == 0:
-                       mod_recs_text = "No selection"
+            for moderator in self.snapshot.moderators(s):
+               mod_rec = self.snapshot.moderator_record(moderator)
+               mod_categories = list(mod_rec.class_categories.all()) if mod_rec else []
+               if mod_rec is None or s.parent_class.category not in mod_categories:
+                   if mod_rec is None:
+                       mod_recs_text = ["No selection"]
                    else:
-                       mod_recs_text = [cat.category for cat in list(mod_recs[0].class_categories.all())]
+                       mod_recs_text = [cat.category for cat in mod_categories]
                    if not mod_recs_text:
                        mod_recs_text.append("No Selection")
                    mod_recs_list = ", ".join(mod_recs_text)
@@ -535,10 +743,10 @@ def ts_dict():
 
         timeslots = self._timeslot_dict(slot=ts_dict)
         for sec in self.l_missing_resources:
-            sec_times = sec["Section"].get_meeting_times()
-            for time in sec_times:
-                timeslots[time][sec["Unfulfilled Request"].res_type] = \
-                    timeslots[time].get(sec["Unfulfilled Request"].res_type, 0) + 1
+            sec_times = self.snapshot.meeting_times(sec["Section"])
+            for ts in sec_times:
+                timeslots[ts][sec["Unfulfilled Request"].res_type] = \
+                    timeslots[ts].get(sec["Unfulfilled Request"].res_type, 0) + 1
         final_data = []
         for t in timeslots:
             for r in timeslots[t]:
@@ -556,33 +764,33 @@ def wrong_classroom_type(self):
     def teachers_unavailable(self):
         l = []
         for s in self._all_class_sections():
-            for t in s.teachers:
-                available = t.getAvailableTimes(s.parent_program, ignore_classes=True, ignore_moderation=True)
-                for e in s.get_meeting_times():
-                    if e not in available:
+            for t in self.snapshot.teachers(s):
+                available = self.snapshot.available_times(t)
+                for e in self.snapshot.meeting_times(s):
+                    if e.id not in available:
                         l.append({"Teacher": t, "Time": e, "Section": s})
         return self.formatter.format_table(l, {"headings": ["Section", "Teacher", "Time"]})
 
     def teachers_who_like_running(self):
         l = []
-        teachers = self.p.teachers()['class_approved'].distinct()
+        min_status = 0 if self.incl_unreview else 1
+        teachers = self.snapshot.teacher_lists['class_approved'].distinct()
         for teacher in teachers:
-            if self.incl_unreview:
-                sections = ClassSection.objects.filter(
-                    parent_class__in=teacher.getTaughtClassesFromProgram(self.p).filter(status__gte=0).distinct(),status__gte=0).distinct().order_by('meeting_times__start')
-            else:
-                sections = ClassSection.objects.filter(
-                    parent_class__in=teacher.getTaughtClassesFromProgram(self.p).filter(status__gt=0).distinct(),status__gt=0).distinct().order_by('meeting_times__start')
-            for i in range(sections.count()-1):
-                try:
-                    time1 = sections[i+1].meeting_times.all().order_by('start')[0]
-                    time0 = sections[i].meeting_times.all().order_by('-end')[0]
-                    room0 = sections[i].initial_rooms()[0]
-                    room1 = sections[i+1].initial_rooms()[0]
-                    if (time1.start-time0.end).total_seconds() < 1200 and sections[i].initial_rooms().count() + sections[i+1].initial_rooms().count() and room0.name != room1.name:
-                        l.append({"Username": teacher, "Teacher Name": teacher.name(), "Section 1": sections[i], "Section 2": sections[i+1], "Room 1": room0, "Room 2": room1})
-                except BaseException:
+            sections = [sec for sec in self.snapshot.taught_sections(teacher)
+                        if sec.status >= min_status and sec.parent_class.status >= min_status
+                        and self.snapshot.meeting_times(sec)]
+            sections.sort(key=lambda sec: self.snapshot.meeting_times(sec)[0].start)
+            for sec0, sec1 in zip(sections, sections[1:]):
+                time1 = self.snapshot.meeting_times(sec1)[0]
+                time0 = max(self.snapshot.meeting_times(sec0), key=lambda e: e.end)
+                rooms0 = self.snapshot.initial_rooms(sec0)
+                rooms1 = self.snapshot.initial_rooms(sec1)
+                if not (rooms0 and rooms1):
                     continue
+                room0 = rooms0[0]
+                room1 = rooms1[0]
+                if (time1.start-time0.end).total_seconds() < 1200 and room0.name != room1.name:
+                    l.append({"Username": teacher, "Teacher Name": teacher.name(), "Section 1": sec0, "Section 2": sec1, "Room 1": room0, "Room 2": room1})
         return self.formatter.format_table(l,
                         {"headings": ["Username", "Teacher Name", "Section 1", "Section 2",
                                       "Room 1", "Room 2"]},
@@ -635,20 +843,23 @@ def special_classroom_types(self):
         HEADINGS = ["Class Section", "Unfulfilled Request", "Current Room"]
         mismatches = []
 
+        resource_requests = [rr for s in self.snapshot.sections for rr in self.snapshot.resource_requests(s)
+                             if rr.res_type is not None and rr.res_type.program_id == self.p.id]
         for type_regex, matching_rooms in DEFAULT_CONFIG.items():
-            resource_requests = ResourceRequest.objects.filter(
-                res_type__program=self.p, desired_value__iregex=type_regex)
-
             for rr in resource_requests:
+                if not re.search(type_regex, rr.desired_value or '', re.IGNORECASE):
+                    continue
+                target = self.snapshot.sections_by_id[rr.target_id]
+                classrooms = self.snapshot.classrooms(target)
                 if all(room.id in matching_rooms or
                        re.match(type_regex, room.name, re.IGNORECASE)
-                       for room in rr.target.classrooms()):
+                       for room in classrooms):
                     continue
 
                 mismatches.append({
-                        HEADINGS[0]: rr.target,
+                        HEADINGS[0]: target,
                         HEADINGS[1]: rr.desired_value,
-                        HEADINGS[2]: rr.target.classrooms()[0].name
+                        HEADINGS[2]: classrooms[0].name
                         })
 
         return self.formatter.format_table(mismatches,
@@ -665,13 +876,13 @@ def inflexible_teachers(self):
         as hours of availability. Intended to be run before scheduling,
         and will not change as classes are scheduled.
         """
-        teachers = self.p.teachers()['class_submitted']
+        teachers = self.snapshot.teacher_lists['class_submitted']
         inflexible = []
         for teacher in teachers:
             # This will break if we ever start having class blocks
             # that aren't an hour long
-            availability = len(teacher.getAvailableTimes(self.p, ignore_classes=True))
-            class_hours = teacher.getTaughtTime(program=self.p, round_to=1).seconds/3600
+            availability = len(self.snapshot.available_times(teacher, ignore_moderation=False))
+            class_hours = self.snapshot.taught_time(teacher, round_to=1).seconds/3600
             delta = availability - class_hours
             # Arbitrary formula, seems to do a good job of catching the cases I care about
             if (availability == 0) or (class_hours/float(availability) >= 2/float(3)):
@@ -699,9 +910,9 @@ def unavailable_moderators(self):
         """
         l = []
         for s in self._all_class_sections():
-            for m in s.get_moderators():
-                available = m.getAvailableTimes(s.parent_program, ignore_classes=True, ignore_moderation=True)
-                for e in s.get_meeting_times():
-                    if e not in available:
+            for m in self.snapshot.moderators(s):
+                available = self.snapshot.available_times(m)
+                for e in self.snapshot.meeting_times(s):
+                    if e.id not in available:
                         l.append({self.p.getModeratorTitle(): m, "Time": e, "Section": s})
         return self.formatter.format_table(l, {"headings": ["Section", self.p.getModeratorTitle(), "Time"]})
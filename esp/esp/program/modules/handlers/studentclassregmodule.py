@@ -54,11 +54,12 @@
 from esp.middleware      import ESPError, AjaxError, ESPError_NoLog
 from esp.users.models    import ESPUser, Permission
 from esp.tagdict.models  import Tag
-from esp.utils.no_autocookie import disable_csrf_cookie_update
+from esp.utils.no_autocookie import cookie_free, disable_csrf_cookie_update
 from esp.cal.models import Event, EventType
 from esp.program.templatetags.class_render import render_class_direct
 from esp.middleware.threadlocalrequest import get_current_request
 from esp.utils.query_utils import nest_Q
+from esp.varnish.varnish import add_surrogate_keys, catalog_surrogate_key
 
 def json_encode(obj):
     if isinstance(obj, ClassSubject):
@@ -89,7 +90,7 @@ def json_encode(obj):
                  'duration': obj.duration,
                  'get_meeting_times': sorted(list(obj.get_meeting_times()), key=lambda e: e.start),
                  'num_students': obj.num_students(),
-                 'capacity': obj.capacity
+                 'capacity': obj._capacity if hasattr(obj, '_capacity') else obj.capacity
                  }
     elif isinstance(obj, ClassCategories):
         return { 'id': obj.id,
@@ -560,19 +561,27 @@ def timeslots_json(self, request, tl, one, two, module, extra, prog, timeslot=No
 
         return resp"""
 
+    @cookie_free
     @cache_control(public=True, max_age=3600)
     @no_auth
     @aux_call
     def catalog_json(self, request, tl, one, two, module, extra, prog, timeslot=None):
         """ Return the program class catalog """
         # using .extra() to select all the category text simultaneously
-        classes = ClassSubject.objects.catalog(self.program)
+        classes = list(ClassSubject.objects.catalog(self.program))
+
+        #   Work out the capacities of all the sections at once, rather than
+        #   with a few queries each.
+        sections = [sec for cls in classes for sec in cls._sections]
+        capacities = ClassSection.capacities([sec.id for sec in sections], self.program) if sections else {}
+        for sec in sections:
+            sec._capacity = capacities[sec.id]
 
         resp = HttpResponse(content_type='application/json')
 
-        json.dump(list(classes), resp, default=json_encode)
+        json.dump(classes, resp, default=json_encode)
 
-        return resp
+        return add_surrogate_keys(resp, [catalog_surrogate_key(prog.id)])
 
     def catalog_student_count_json(self, request, tl, one, two, module, extra, prog, timeslot=None):
         clean_counts = prog.student_counts_by_section_id()
@@ -582,6 +591,7 @@ def catalog_student_count_json(self, request, tl, one, two, module, extra, prog,
 
     @aux_call
     @needs_student_in_grade
+    @cache_control(private=True)
     @vary_on_cookie
     def catalog_registered_classes_json(self, request, tl, one, two, module, extra, prog, timeslot=None):
         reg_bits = StudentRegistration.valid_objects().filter(user=request.user, section__parent_class__parent_program=prog).select_related()
@@ -597,12 +607,13 @@ def catalog_registered_classes_json(self, request, tl, one, two, module, extra,
         json.dump(reg_bits_data, resp)
         return resp
 
-    @disable_csrf_cookie_update
+    @cookie_free
     @aux_call
     @no_auth
     @cache_control(public=True, max_age=120)
     def catalog(self, request, tl, one, two, module, extra, prog, timeslot=None):
-        return self.catalog_render(request, tl, one, two, module, extra, prog, timeslot)
+        response = self.catalog_render(request, tl, one, two, module, extra, prog, timeslot)
+        return add_surrogate_keys(response, [catalog_surrogate_key(prog.id)])
 
     @disable_csrf_cookie_update
     @aux_call
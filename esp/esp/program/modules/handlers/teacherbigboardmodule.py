@@ -1,5 +1,5 @@
 import datetime
-import subprocess
+import os
 
 from django.db.models.aggregates import Min
 from django.db.models.query import Q
@@ -229,13 +229,10 @@ def static_hours(prog, approved = False, scheduled = False, teachers = None):
             return [0, 0]
     static_hours = staticmethod(static_hours)
 
-    # runs in 9ms, so don't bother caching
     def load_averages(self):
         try:
-            uptime = subprocess.check_output('uptime')
-            # The output ends in e.g. "load average: 1.65, 1.84, 1.67\n"
-            return [float(x.strip(',')) for x in uptime.strip().split()[-3:]]
-        except:
+            return list(os.getloadavg())
+        except OSError:
             return []
 
     def isStep(self):
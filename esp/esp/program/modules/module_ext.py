@@ -35,10 +35,13 @@
 """
 
 from datetime import timedelta
+import threading
 import time
 
+from django.conf import settings
 from django.core.validators import RegexValidator, validate_comma_separated_integer_list
-from django.db import models
+from django.core.cache import cache
+from django.db import models, transaction
 
 from esp.db.fields import AjaxForeignKey
 from esp.program.models import Program, RegistrationType, ClassSection
@@ -350,6 +353,9 @@ def toDict(self):
             d['locked'] = self.locked
         return d
 
+# Wakes up requests in this process waiting for a change log to change
+_change_condition = threading.Condition()
+
 class AJAXChangeLog(models.Model):
     # program this change log stores changes for
     program = AjaxForeignKey(Program, on_delete=models.CASCADE)
@@ -360,6 +366,84 @@ class AJAXChangeLog(models.Model):
     # log entries older than this are deleted
     max_log_age = timedelta(hours=12).total_seconds()
 
+    # how often waiters check for changes committed by other processes
+    wait_poll_interval = 0.5
+
+    #   Waiting for changes: every commit of new entries bumps a counter for
+    #   the program in the cache and wakes the waiters in this process.
+    #   Waiters in other processes notice the counter within
+    #   wait_poll_interval, without querying the database.
+    #
+    #   A waiting request holds its (synchronous) worker for as long as it
+    #   waits, up to settings.AJAX_SCHEDULING_MAX_WAIT seconds.  So that the
+    #   schedulers can't tie up every worker, at most
+    #   settings.AJAX_SCHEDULING_MAX_WAITERS requests (4 by default) wait at
+    #   once, across all processes; the others return straight away, and
+    #   their clients poll on a timer until a slot is free.  The count lives
+    #   in the cache and expires after waiter_count_timeout, so that slots
+    #   leaked by killed workers come back.
+
+    waiters_key = 'ajax_change_log_waiters'
+    waiter_count_timeout = 300
+
+    @staticmethod
+    def _generation_key(program_id):
+        return 'ajax_change_log_generation:%d' % program_id
+
+    @classmethod
+    def get_generation(cls, program_id):
+        """ A value which changes whenever entries are committed to the
+            program's change log. """
+        return cache.get(cls._generation_key(program_id), 0)
+
+    @classmethod
+    def notify(cls, program_id):
+        """ Tell waiters that the program's change log has changed. """
+        key = cls._generation_key(program_id)
+        try:
+            cache.incr(key)
+        except ValueError:
+            if not cache.add(key, 1, None):
+                cache.incr(key)
+        with _change_condition:
+            _change_condition.notify_all()
+
+    @classmethod
+    def start_waiting(cls):
+        """ Take one of the slots for waiting requests, returning whether
+            one was free.  If so, call stop_waiting() when done. """
+        limit = getattr(settings, 'AJAX_SCHEDULING_MAX_WAITERS', 4)
+        cache.add(cls.waiters_key, 0, cls.waiter_count_timeout)
+        try:
+            waiters = cache.incr(cls.waiters_key)
+        except ValueError:
+            return False
+        if waiters > limit:
+            cls.stop_waiting()
+            return False
+        return True
+
+    @classmethod
+    def stop_waiting(cls):
+        try:
+            cache.decr(cls.waiters_key)
+        except ValueError:
+            #   The count expired while we waited.
+            pass
+
+    @classmethod
+    def wait_for_change(cls, program_id, generation, timeout):
+        """ Block until the program's generation differs from `generation`,
+            or for `timeout` seconds.  Returns whether it changed. """
+        deadline = time.time() + timeout
+        while cls.get_generation(program_id) == generation:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            with _change_condition:
+                _change_condition.wait(min(remaining, cls.wait_poll_interval))
+        return True
+
     def update(self, program):
         self.program = program
         self.age = time.time()
@@ -378,6 +462,8 @@ def append(self, entry, user=None):
         self.save()
         self.entries.add(entry)
         self.save()
+        program_id = self.program_id
+        transaction.on_commit(lambda: AJAXChangeLog.notify(program_id))
 
     def appendScheduling(self, timeslots, room_name, cls_id, user=None):
         entry = AJAXChangeLogEntry()
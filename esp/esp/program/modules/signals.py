@@ -1,5 +1,13 @@
+from django.db.models import signals
+
+from esp.accounting.models import FinancialAidGrant, Transfer
+from esp.program.controllers.userlists import invalidate_user_lists
 from esp.program.models import maybe_create_module_ext
+from esp.program.models import ClassSection, ClassSubject, FinancialAidRequest, ModeratorRecord, PhaseZeroRecord, RegistrationProfile, StudentRegistration, StudentSubjectInterest, TeacherBio, VolunteerOffer
+from esp.program.models.app_ import StudentApplication
+from esp.program.models.flags import ClassFlag
 from esp.program.modules.module_ext import StudentClassRegModuleInfo, ClassRegModuleInfo
+from esp.users.models import ESPUser, Record, UserAvailability
 
 # TODO(benkraft): There are actually a lot more modules that depend on these
 # module extensions.  In practice it's probably fine because very few programs
@@ -9,3 +17,76 @@
 # but doing that in practice might be hard.
 maybe_create_module_ext('StudentClassRegModule', StudentClassRegModuleInfo)
 maybe_create_module_ext('TeacherClassRegModule', ClassRegModuleInfo)
+
+#   The program user lists used by the user search (see
+#   esp.program.controllers.userlists) are cached, so forget them when the
+#   data they are based on changes.  Each model maps to the lookup from it to
+#   its program.  A row without a program (such as a profile saved outside
+#   any program) affects no program's lists; if the program can't be found,
+#   every program's lists are forgotten.
+USER_LIST_PROGRAM_LOOKUPS = {
+    ClassSection: 'parent_class__parent_program',
+    ClassSubject: 'parent_program',
+    ClassFlag: 'subject__parent_program',
+    FinancialAidGrant: 'request__program',
+    FinancialAidRequest: 'program',
+    ModeratorRecord: 'program',
+    PhaseZeroRecord: 'program',
+    Record: 'program',
+    RegistrationProfile: 'program',
+    StudentApplication: 'program',
+    StudentRegistration: 'section__parent_class__parent_program',
+    StudentSubjectInterest: 'subject__parent_program',
+    TeacherBio: 'program',
+    Transfer: 'line_item__program',
+    UserAvailability: 'event__program',
+    VolunteerOffer: 'request__program',
+}
+
+def _user_list_program_ids(model, instance):
+    """ The IDs of the programs whose lists may depend on the instance, with
+        None standing for every program.  Related objects which are already
+        loaded (e.g. the section of a new registration) are followed without
+        a query. """
+    lookup = USER_LIST_PROGRAM_LOOKUPS[model].split('__')
+    obj = instance
+    while True:
+        field = type(obj)._meta.get_field(lookup[0])
+        value = getattr(obj, field.attname)
+        if value is None:
+            return []
+        if len(lookup) == 1:
+            return [value]
+        if not field.is_cached(obj):
+            break
+        obj = getattr(obj, field.name)
+        lookup = lookup[1:]
+    program_ids = list(field.related_model.objects.filter(pk=value).values_list('__'.join(lookup[1:]), flat=True))
+    if not program_ids:
+        #   The related row is gone, e.g. deleted along with the instance.
+        return [None]
+    return [program_id for program_id in program_ids if program_id is not None]
+
+def invalidate_user_lists_on_change(sender, instance, **kwargs):
+    for program_id in _user_list_program_ids(sender, instance):
+        invalidate_user_lists(program_id)
+
+def invalidate_user_lists_on_m2m_change(sender, instance, action, reverse, model, pk_set, **kwargs):
+    if not action.startswith('post'):
+        return
+    if reverse and model in USER_LIST_PROGRAM_LOOKUPS and pk_set:
+        #   e.g. classes added to a teacher's user.teaching_classes
+        program_ids = set(model.objects.filter(pk__in=pk_set).values_list(USER_LIST_PROGRAM_LOOKUPS[model], flat=True))
+    elif not reverse and type(instance) in USER_LIST_PROGRAM_LOOKUPS:
+        program_ids = set(_user_list_program_ids(type(instance), instance))
+    else:
+        #   Group changes, and clearing a user's classes, may affect any program.
+        program_ids = {None}
+    for program_id in program_ids:
+        invalidate_user_lists(program_id)
+
+for model in USER_LIST_PROGRAM_LOOKUPS:
+    signals.post_save.connect(invalidate_user_lists_on_change, sender=model, dispatch_uid='user_lists_save_%s' % model.__name__)
+    signals.post_delete.connect(invalidate_user_lists_on_change, sender=model, dispatch_uid='user_lists_delete_%s' % model.__name__)
+for through in [ClassSubject.teachers.through, ClassSection.moderators.through, ESPUser.groups.through]:
+    signals.m2m_changed.connect(invalidate_user_lists_on_m2m_change, sender=through, dispatch_uid='user_lists_m2m_%s' % through.__name__)
@@ -51,3 +51,7 @@
 from esp.program.modules.tests.auth import ProgramModuleAuthTest
 from esp.program.modules.tests.unenrollmodule import UnenrollModuleTest
 from esp.program.modules.tests.testallviews import AllViewsTest
+from esp.program.modules.tests.onsiteclasslist import OnSiteClassListTest
+from esp.program.modules.tests.bigboardmodule import BigBoardModuleTest
+from esp.program.modules.tests.schedulingcheckmodule import SchedulingCheckModuleTest
+from esp.program.modules.tests.listgenmodule import ListGenModuleTest
@@ -36,6 +36,7 @@
 from esp.program.modules.tests.support import TestProgramManager
 from esp.program.modules.module_ext import AJAXChangeLog
 import json
+import threading
 import time
 
 class AJAXSchedulingModuleTestBase(ProgramFrameworkTest):
@@ -212,3 +213,56 @@ def testChangeLogFailedScheduling(self):
         changelog_response = self.client.get(self.changelog_url, {'last_fetched_index': 1 })
         changelog = json.loads(changelog_response.content)["changelog"]
         self.assertTrue(len(changelog) == 0, "Change log shows unsuccessfully scheduled class: " + str(changelog))
+
+    def testChangeLogWait(self):
+        self.clearScheduleAvailability()
+        (section, times, rooms, success) = self.program_manager.scheduleClass()
+        self.failUnless(success)
+
+        #waiting doesn't delay a response when there are already changes
+        start = time.time()
+        changelog_response = self.client.get(self.changelog_url, {'last_fetched_index': 0, 'wait': 10})
+        self.assertLess(time.time() - start, 5)
+        data = json.loads(changelog_response.content)
+        self.assertEqual(len(data["changelog"]), 1)
+        latest_index = data["changelog"][-1]["index"]
+
+        #with nothing new, the request waits for the timeout and comes back empty
+        start = time.time()
+        changelog_response = self.client.get(self.changelog_url, {'last_fetched_index': latest_index, 'wait': 1})
+        self.assertGreaterEqual(time.time() - start, 1)
+        data = json.loads(changelog_response.content)
+        self.assertEqual(data["changelog"], [])
+        self.assertEqual(data["other"][0]["wait"], 1)
+
+        #a change wakes up the waiting request
+        generation = AJAXChangeLog.get_generation(self.program.id)
+        timer = threading.Timer(0.2, AJAXChangeLog.notify, [self.program.id])
+        timer.start()
+        start = time.time()
+        changelog_response = self.client.get(self.changelog_url, {'last_fetched_index': latest_index, 'wait': 10})
+        timer.join()
+        self.assertLess(time.time() - start, 5)
+        self.assertNotEqual(AJAXChangeLog.get_generation(self.program.id), generation)
+
+    def testChangeLogWaitCapped(self):
+        self.clearScheduleAvailability()
+        with self.settings(AJAX_SCHEDULING_MAX_WAIT=0):
+            changelog_response = self.client.get(self.changelog_url, {'last_fetched_index': 0, 'wait': 10})
+        self.assertEqual(json.loads(changelog_response.content)["other"][0]["wait"], 0)
+
+    def testChangeLogWaitersCapped(self):
+        self.clearScheduleAvailability()
+        latest_index = self.changelog.get_latest_index()
+        #with no free slots, the request doesn't wait
+        start = time.time()
+        with self.settings(AJAX_SCHEDULING_MAX_WAITERS=0):
+            changelog_response = self.client.get(self.changelog_url, {'last_fetched_index': latest_index, 'wait': 5})
+        self.assertLess(time.time() - start, 3)
+        self.assertEqual(json.loads(changelog_response.content)["other"][0]["wait"], 0)
+        #slots are given back after waiting
+        with self.settings(AJAX_SCHEDULING_MAX_WAITERS=1):
+            self.client.get(self.changelog_url, {'last_fetched_index': latest_index, 'wait': 0.1})
+            self.assertTrue(AJAXChangeLog.start_waiting())
+            self.assertFalse(AJAXChangeLog.start_waiting())
+            AJAXChangeLog.stop_waiting()
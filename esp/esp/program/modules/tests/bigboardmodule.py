@@ -0,0 +1,83 @@
+import datetime
+
+from django.core.cache import cache
+
+from esp.program.models import RegistrationType, StudentRegistration, StudentSubjectInterest
+from esp.program.modules.handlers.bigboardmodule import BigBoardModule
+from esp.program.tests import ProgramFrameworkTest
+
+
+class BigBoardModuleTest(ProgramFrameworkTest):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.module = BigBoardModule()
+        self.enrolled, _ = RegistrationType.objects.get_or_create(name='Enrolled')
+        self.priority, _ = RegistrationType.objects.get_or_create(name='Priority/1')
+        self.sections = list(self.program.sections())
+        cache.clear()
+
+    def register(self, student, when, relationship=None, section=None):
+        return StudentRegistration.objects.create(
+            user=student, section=section or self.sections[0],
+            relationship=relationship or self.enrolled, start_date=when)
+
+    def testTimesEnrolled(self):
+        now = datetime.datetime.now()
+        two_days_ago = now - datetime.timedelta(days=2)
+        self.register(self.students[0], two_days_ago)
+        # only a student's first enrollment counts
+        self.register(self.students[0], now, section=self.sections[1])
+        self.register(self.students[1], two_days_ago + datetime.timedelta(minutes=5))
+        self.register(self.students[2], now)
+
+        hour = lambda t: t.replace(minute=0, second=0, microsecond=0)
+        expected = {}
+        for t in [two_days_ago, two_days_ago + datetime.timedelta(minutes=5), now]:
+            expected[hour(t)] = expected.get(hour(t), 0) + 1
+        expected = [(num, h) for h, num in sorted(expected.items())]
+        self.assertEqual(self.module.times_enrolled(self.program), expected)
+
+        # Later calls only count the current hour, and add to the hours
+        # they've kept.
+        self.register(self.students[3], datetime.datetime.now())
+        with self.assertNumQueries(1):
+            times = self.module.times_enrolled(self.program)
+        self.assertEqual(sum(num for num, h in times), 4)
+        self.assertEqual(times[:-1], expected[:-1])
+
+    def testTimesLottery(self):
+        now = datetime.datetime.now()
+        student = self.students[0]
+        # a student who starred and prioritized at once is counted once
+        StudentSubjectInterest.objects.create(
+            user=student, subject=self.sections[0].parent_class, start_date=now)
+        self.register(student, now, relationship=self.priority)
+        self.register(self.students[1], now, relationship=self.priority)
+        self.assertEqual(sum(num for num, h in self.module.times_lottery(self.program)), 2)
+
+    def testCounts(self):
+        now = datetime.datetime.now()
+        self.register(self.students[0], now)
+        self.register(self.students[0], now, section=self.sections[1])
+        self.register(self.students[0], now, relationship=self.priority)
+        self.register(self.students[1], now, relationship=self.priority)
+        self.assertEqual(self.module.num_users_enrolled(self.program), 1)
+        self.assertEqual(self.module.num_priority1s(self.program), 2)
+        self.assertEqual(self.module.num_prefs(self.program), 2)
+        self.assertEqual(self.module.num_users_with_lottery(self.program), 2)
+        self.assertEqual(self.module.num_active_users(self.program), 2)
+
+    def testMakeGraphDataWeighted(self):
+        start = datetime.datetime(2020, 1, 1, 10)
+        times = [start + datetime.timedelta(minutes=20 * i) for i in range(10)]
+        buckets = {}
+        for t in times:
+            hour = t.replace(minute=0)
+            buckets[hour] = buckets.get(hour, 0) + 1
+        unweighted = BigBoardModule.make_graph_data(
+            [('x', [(1, t) for t in times], True)], 4, 0, 5)
+        weighted = BigBoardModule.make_graph_data(
+            [('x', [(num, h) for h, num in sorted(buckets.items())], True)], 4, 0, 5, weighted=True)
+        self.assertEqual(weighted, unweighted)
+        self.assertEqual(BigBoardModule.make_graph_data(
+            [('x', [(4, start)], True)], 4, 0, 5, weighted=True), ([], None))
@@ -35,12 +35,16 @@
 import json
 from collections import Counter
 
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.utils.html import escape
 
+from esp.program.controllers.dashboard import DashboardStats
 from esp.program.tests import ProgramFrameworkTest
 from esp.program.modules.base import ProgramModule, ProgramModuleObj
 from esp.program.models import ClassSubject
 from esp.resources.models import ResourceType
+from esp.users.models import Record, RecordType
 
 class JSONDataModuleTest(ProgramFrameworkTest):
     ## This test is very incomplete.
@@ -212,6 +216,58 @@ def testGradesStats(self):
                 self.assertJSONEqual(json.dumps(res), expected_response)
         self.assertEqual(grades_count, 1)
 
+    def testListCounts(self):
+        """DashboardStats.count_lists() counts every list with one query."""
+        students = self.program.students(QObjects=True)
+        with self.assertNumQueries(1):
+            counts = DashboardStats.count_lists(students, combined=[
+                ('new', lambda lists: lists['enrolled'] & ~lists['enrolled_past'])])
+        for key, query in self.program.students().items():
+            self.assertEqual(counts[key], query.filter(is_active=True).distinct().count(), key)
+        self.assertEqual(counts['new'], len(set(self.program.students()['enrolled'].values_list('id', flat=True))
+                                            - set(self.program.students()['enrolled_past'].values_list('id', flat=True))))
+
+    def testSectionCapacities(self):
+        """The bulk capacities match ClassSection.capacity."""
+        sections = list(self.program.sections())
+        self.assertTrue(sections)
+        stats = DashboardStats(self.program)
+        capacities = stats.section_capacities([sec.id for sec in sections])
+        self.assertEqual(capacities, {sec.id: sec.capacity for sec in sections})
+
+    def testCheckedInCounts(self):
+        """The bulk checked-in counts match count_ever_checked_in_students()."""
+        attended = RecordType.objects.get(name='attended')
+        for student in self.students[::2]:
+            Record.objects.create(event=attended, program=self.program, user=student)
+        counts = DashboardStats(self.program).checked_in_counts()
+        self.assertTrue(any(counts.values()))
+        for cls in self.program.classes():
+            self.assertEqual(counts[cls.id], sum(sec.count_ever_checked_in_students() for sec in cls.get_sections()))
+
+    def testStatsQueriesDontDependOnSize(self):
+        """The grade and hour figures take the same number of queries however
+        many classes are scheduled."""
+        def count_queries():
+            stats = DashboardStats(self.program)
+            with CaptureQueriesContext(connection) as queries:
+                stats.grade_counts()
+                stats.hours()
+            return len(queries)
+
+        count_queries()
+        num_queries = count_queries()
+        added = 0
+        for cls in self.program.classes():
+            section = cls.add_section()
+            times = section.viable_times()
+            if times:
+                section.assign_start_time(times[0])
+                added += 1
+        self.assertTrue(added)
+        count_queries()
+        self.assertEqual(count_queries(), num_queries)
+
     def testClasses(self):
         ## Make sure all classes are listed
         json_classes = self.classes_response.json()
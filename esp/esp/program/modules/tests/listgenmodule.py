@@ -0,0 +1,52 @@
+import csv
+
+from django.db import connection
+from django.db.models import Q
+from django.test.utils import CaptureQueriesContext
+
+from esp.program.models import PhaseZeroRecord, SplashInfo
+from esp.program.modules.handlers.listgenmodule import UserAttributeGetter, UserAttributeResolver
+from esp.program.tests import ProgramFrameworkTest
+from esp.users.models import ESPUser, PersistentQueryFilter
+
+
+class ListGenModuleTest(ProgramFrameworkTest):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.add_user_profiles()
+        self.schedule_randomly()
+        self.classreg_students()
+        record = PhaseZeroRecord.objects.create(program=self.program)
+        record.user.add(self.students[0])
+        SplashInfo.objects.create(student=self.students[1], program=self.program, siblingdiscount=True, siblingname='Sibling')
+        self.attrs = sorted(UserAttributeGetter.getFunctions())
+        self.users = self.students + self.teachers
+
+    def testResolverMatchesGetter(self):
+        resolver = UserAttributeResolver(self.users, self.program)
+        for attr in self.attrs:
+            expected = [UserAttributeGetter(user, self.program).get(attr) for user in self.users]
+            self.assertEqual(resolver.column(attr), expected, attr)
+
+    def testQueriesDontDependOnSize(self):
+        def count_queries(users):
+            resolver = UserAttributeResolver(users, self.program)
+            with CaptureQueriesContext(connection) as queries:
+                resolver.rows(self.attrs)
+            return len(queries)
+
+        self.assertEqual(count_queries(self.users[:2]), count_queries(self.users))
+
+    def testGenerateListCSV(self):
+        self.assertTrue(self.client.login(username=self.admins[0].username, password='password'))
+        filterObj = PersistentQueryFilter.create_from_Q(ESPUser, Q(id__in=[student.id for student in self.students]))
+        response = self.client.post(
+            '/manage/%s/generateList?filterid=%d' % (self.program.getUrlBase(), filterObj.id),
+            {'fields': ['02_username', '25_classhours'], 'split_by': '', 'output_type': 'csv', 'recipient_type': 'Student'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        lines = list(csv.reader(b''.join(response.streaming_content).decode('utf-8').splitlines()))
+        self.assertEqual(lines[0], ['#', 'Username', 'Number of Enrolled Class Blocks'])
+        expected = [[str(num), student.username, str(UserAttributeGetter(student, self.program).get('25_classhours'))]
+                    for (num, student) in enumerate(sorted(self.students), 1)]
+        self.assertEqual(lines[1:], expected)
@@ -0,0 +1,110 @@
+import json
+from unittest.mock import patch
+
+from esp.program.controllers.sectionstatus import SectionStatusFeed, get_section_marks, mark_sections_dirty
+from esp.program.models import ClassSection
+from esp.program.tests import ProgramFrameworkTest
+from esp.users.models import ESPUser
+
+class OnSiteClassListTest(ProgramFrameworkTest):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.add_student_profiles()
+        self.schedule_randomly()
+
+        self.admin, created = ESPUser.objects.get_or_create(username='admin')
+        self.admin.set_password('password')
+        self.admin.makeAdmin()
+
+    def feed(self, since=None):
+        params = {} if since is None else {'since': since}
+        response = self.client.get('/onsite/%s/section_status_feed' % self.program.getUrlBase(), params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode('UTF-8'))
+
+    def test_section_status_feed(self):
+        self.client.login(username='admin', password='password')
+        sections = list(self.program.sections().filter(status__gt=0, parent_class__status__gt=0))
+
+        #   The first poll gets every section.
+        data = self.feed()
+        self.assertEqual({int(sec_id) for sec_id in data['sections']}, {sec.id for sec in sections})
+        section = sections[0]
+        status = data['sections'][str(section.id)]
+        self.assertEqual(status['capacity'], section.capacity)
+        self.assertEqual(status['enrolled'], 0)
+        self.assertEqual(status['full'], section.isFull(webapp=True))
+
+        #   Without changes, later polls get nothing.
+        version = data['version']
+        data = self.feed(version)
+        self.assertEqual(data, {'version': version, 'sections': {}})
+
+        #   After an enrollment, only that section is sent.
+        section.preregister_student(self.students[0], fast_force_create=True)
+        data = self.feed(version)
+        self.assertGreater(data['version'], version)
+        self.assertEqual(list(data['sections']), [str(section.id)])
+        self.assertEqual(section.num_students(), 1)
+        self.assertEqual(data['sections'][str(section.id)]['enrolled'], 1)
+
+        #   Cancelled sections are sent as null.
+        version = data['version']
+        other = sections[1]
+        other.status = -20
+        other.save()
+        data = self.feed(version)
+        self.assertEqual(data['sections'], {str(other.id): None})
+
+        #   An unknown version gets everything still live.
+        data = self.feed(data['version'] + 1)
+        self.assertEqual(len(data['sections']), len(sections) - 1)
+
+    def test_full_status(self):
+        self.client.login(username='admin', password='password')
+        response = self.client.get('/onsite/%s/full_status' % self.program.getUrlBase())
+        data = json.loads(response.content.decode('UTF-8'))
+        statuses = SectionStatusFeed(self.program).statuses()
+        self.assertEqual(sorted(data), sorted([sec_id, status['full']] for (sec_id, status) in statuses.items()))
+
+    def test_compute_matches_sections(self):
+        #   The grouped queries agree with the per-section properties.
+        sections = list(self.program.sections().filter(status__gt=0, parent_class__status__gt=0))
+        sections[0].preregister_student(self.students[0], fast_force_create=True)
+        statuses = SectionStatusFeed(self.program).compute()
+        for section in sections:
+            section = ClassSection.objects.get(id=section.id)
+            status = statuses[section.id]
+            self.assertEqual(status['capacity'], section.capacity)
+            self.assertEqual(status['enrolled'], section.num_students())
+            self.assertEqual(status['full'], section.isFull(webapp=True))
+
+    def test_marks_are_per_section(self):
+        feed = SectionStatusFeed(self.program)
+        #   The second update deals with the marks left by setting up.
+        feed.update()
+        state = feed.update()
+        first, second = list(state['sections'])[:2]
+        mark_sections_dirty([first])
+        mark_sections_dirty([second])
+        #   Neither mark replaced the other.
+        self.assertEqual(set(get_section_marks([first, second])), {first, second})
+        with patch.object(feed, 'compute', wraps=feed.compute) as compute:
+            feed.update()
+            self.assertEqual(sorted(compute.call_args[0][0]), sorted([first, second]))
+            #   Marks already dealt with are not recomputed.
+            feed.update()
+            self.assertEqual(compute.call_count, 1)
+
+    def test_catalog_status_capacities(self):
+        #   Sections missing from the feed get their capacities from one
+        #   grouped call.
+        self.client.login(username='admin', password='password')
+        with patch.object(SectionStatusFeed, 'statuses', return_value={}), \
+                patch.object(ClassSection, 'capacities', wraps=ClassSection.capacities) as capacities:
+            response = self.client.get('/onsite/%s/catalog_status' % self.program.getUrlBase())
+        self.assertEqual(capacities.call_count, 1)
+        data = json.loads(response.content.decode('UTF-8'))
+        self.assertTrue(data['sections'])
+        for section in data['sections']:
+            self.assertEqual(section['capacity'], ClassSection.objects.get(id=section['id']).capacity)
@@ -32,9 +32,12 @@
   Email: web-team@learningu.org
 """
 from django.test.client import RequestFactory
+from unittest.mock import patch
+import time
 
 from esp.program.tests import ProgramFrameworkTest
 from esp.program.models  import ClassSubject
+from esp.utils.latex import run_latex_job
 from ..handlers.programprintables import *
 
 class ProgramPrintablesModuleTest(ProgramFrameworkTest):
@@ -118,6 +121,74 @@ def testSchedules(self):
         print((response['Content-Type']))
         self.assertTrue(response['Content-Type'].startswith('application/pdf'))
 
+    def testShardedSchedules(self):
+        #   Force every schedule into its own shard, so that they get compiled
+        #   in the background and merged.
+        #   The job runs in this process, since a separate one couldn't see
+        #   the test database.
+        with patch('esp.program.modules.handlers.programprintables.LATEX_SHARD_SIZE', 1), \
+             patch('esp.utils.latex._launch_latex_job', run_latex_job):
+            response = self.get_response('studentschedules', 'students', 'enrolled')
+        self.assertTemplateUsed(response, 'utils/latex_job.html')
+        job_id = response.context['job_id']
+        self.assertGreater(response.context['job']['total'], 1)
+
+        for i in range(600):
+            job = get_latex_job(job_id)
+            if job['status'] != 'running':
+                break
+            time.sleep(0.1)
+        self.assertEqual(job['status'], 'done', job.get('error'))
+        self.assertEqual(job['done'], job['total'])
+
+        response = self.client.get('/latex_job/%s/download' % job_id)
+        self.assertTrue(response['Content-Type'].startswith('application/pdf'))
+        self.assertTrue(b''.join(response.streaming_content).startswith(b'%PDF'))
+
+    def testShardedCatalog(self):
+        #   With one class per shard, the catalog is still only split between
+        #   categories, each of which starts on a new page.
+        self._login_admin()
+        classes = [cls for cls in ClassSubject.objects.filter(parent_program=self.program).order_by('category')
+                   if cls.isAccepted() and cls.sections.filter(meeting_times__isnull=False).exists()]
+        num_groups = len([cls for (i, cls) in enumerate(classes) if i == 0 or cls.category_id != classes[i - 1].category_id])
+        jobs = []
+        with patch('esp.program.modules.handlers.programprintables.LATEX_SHARD_SIZE', 1), \
+             patch('esp.program.modules.handlers.programprintables.start_latex_job',
+                   lambda texcodes, *args, **kwargs: jobs.append(texcodes) or 'job'), \
+             patch('esp.program.modules.handlers.programprintables.get_latex_job', lambda job_id: {'total': len(jobs[0])}):
+            response = self.client.get('/manage/%s/coursecatalog?sort_name_list=category' % self.program.getUrlBase())
+        self.assertTemplateUsed(response, 'utils/latex_job.html')
+        self.assertEqual(len(jobs[0]), num_groups)
+        self.assertEqual(sum(texcode.count('Open to students grades') for texcode in jobs[0]), len(classes))
+        #   Only the first shard has the opening page; the others start
+        #   right away with their first category.
+        self.assertEqual(sum(texcode.count('\\vspace{.05in}') for texcode in jobs[0]), 1)
+        self.assertEqual(sum(texcode.count('\\newpage') for texcode in jobs[0]), num_groups - len(jobs[0]) + 1)
+
+    def testPrintablesDontCreateTransfers(self):
+        from esp.accounting.controllers import GlobalAccountingController
+        from esp.accounting.models import Transfer
+        GlobalAccountingController().setup_accounts()
+        pac = ProgramAccountingController(self.program)
+        pac.setup_accounts()
+        pac.setup_lineitemtypes(40.0)
+        num_transfers = Transfer.objects.count()
+
+        self.get_response('studentchecklist', 'students', 'enrolled')
+        self.get_response('student_financial_spreadsheet', 'students', 'enrolled')
+        response = self.client.get('/manage/%s/classchecklists' % self.program.getUrlBase())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Transfer.objects.count(), num_transfers)
+
+        #   The admission cost is still counted for students who don't have
+        #   a transfer for it yet.
+        response = self.get_response('student_financial_spreadsheet', 'students', 'enrolled')
+        rows = list(csv.reader(response.content.decode('UTF-8').splitlines()))[1:]
+        self.assertTrue(rows)
+        for row in rows:
+            self.assertEqual(row[-1], '40.00')
+
     def test_all_classes_spreadsheet_loads(self):
         """
         User must be admin to access the spreadsheet via GET method and that the field selection template
@@ -0,0 +1,62 @@
+import json
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from esp.program.modules.handlers.schedulingcheckmodule import RawSCFormatter, SchedulingCheckRunner
+from esp.program.tests import ProgramFrameworkTest
+
+
+class SchedulingCheckModuleTest(ProgramFrameworkTest):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.schedule_randomly()
+        self.scheduled = [s for s in self.program.sections() if s.get_meeting_times() and s.getResources()]
+        self.assertTrue(self.scheduled)
+
+    def runner(self):
+        return SchedulingCheckRunner(self.program, formatter=RawSCFormatter(), incl_unreview=False)
+
+    def testAllChecks(self):
+        self.assertTrue(self.client.login(username=self.admins[0].username, password='password'))
+        response = self.client.get('/manage/%s/scheduling_checks/all' % self.program.getUrlBase())
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content.decode('utf-8'))
+        for diag, title in self.runner().all_diagnostics():
+            self.assertIsNotNone(data['results'][diag], diag)
+            #   The results match running the check by itself.
+            single = self.client.get('/manage/%s/scheduling_checks/%s' % (self.program.getUrlBase(), diag))
+            self.assertEqual(json.loads(single.content.decode('utf-8')), json.loads(data['results'][diag]))
+
+    def testQueriesDontDependOnSize(self):
+        #   Warm up caches which are not part of the snapshot
+        self.runner().run_all()
+        with CaptureQueriesContext(connection) as queries:
+            results, timings = self.runner().run_all()
+        num_queries = len(queries)
+        self.assertFalse([diag for diag, result in results.items() if result is None])
+
+        #   Scheduling more classes doesn't make the checks run more queries.
+        added = 0
+        for cls in self.program.classes():
+            section = cls.add_section()
+            times = section.viable_times()
+            if times:
+                section.assign_start_time(times[0])
+                rooms = section.viable_rooms()
+                if rooms:
+                    section.assign_room(rooms[0])
+                    added += 1
+        self.assertTrue(added)
+        self.runner().run_all()
+        with CaptureQueriesContext(connection) as queries:
+            self.runner().run_all()
+        self.assertLessEqual(len(queries), num_queries)
+
+    def testTeachersUnavailable(self):
+        section = self.scheduled[0]
+        teacher = section.parent_class.get_teachers()[0]
+        teacher.clearAvailableTimes(self.program)
+        unavailable = self.runner().teachers_unavailable()
+        self.assertIn(section, [row['Section'] for row in unavailable if row['Teacher'] == teacher])
+        self.assertFalse([row for row in unavailable if row['Teacher'] != teacher])
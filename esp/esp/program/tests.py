@@ -38,10 +38,11 @@
 
 from esp.accounting.models import LineItemType
 from esp.cal.models import EventType, Event
-from esp.program.models import Program, ClassSection, RegistrationProfile, ScheduleMap, ProgramModule, StudentRegistration, RegistrationType, ClassCategories, ClassSubject, BooleanExpression, ScheduleConstraint, ScheduleTestOccupied, ScheduleTestCategory, ScheduleTestSectionList
+from esp.program.models import Program, ClassSection, RegistrationProfile, ScheduleMap, ProgramModule, StudentRegistration, RegistrationType, ClassCategories, ClassSubject, BooleanExpression, BooleanToken, ScheduleConstraint, ScheduleTestOccupied, ScheduleTestCategory, ScheduleTestSectionList
 from esp.qsd.models import QuasiStaticData
 from esp.resources.models import Resource, ResourceType
-from esp.users.models import ESPUser, ContactInfo, StudentInfo, TeacherInfo, Permission
+from esp.users.controllers.usersearch import UserSearchController
+from esp.users.models import ESPUser, ContactInfo, StudentInfo, TeacherInfo, Permission, PersistentQueryFilter
 from esp.web.models import NavBarCategory
 from esp.tagdict.models import Tag
 
@@ -50,9 +51,13 @@
 from django.test.client import Client
 from django import forms
 
+from esp.program.class_status import ClassStatus
+from esp.program.controllers.availability import AvailabilityIndex
 from esp.program.controllers.classreg import get_custom_fields
+from esp.program.controllers.classrooms import ClassroomMatrix
 from esp.program.controllers.lottery import LotteryAssignmentController
 from esp.program.controllers.lunch_constraints import LunchConstraintGenerator
+from esp.program.controllers.userlists import PROGRAM_VERSION_KEY, VERSION_KEY, ProgramUserLists, UserSet, _version
 from esp.program.forms import ProgramCreationForm
 from esp.program.modules.base import ProgramModuleObj
 from esp.program.setup import prepare_program, commit_program
@@ -1091,6 +1096,60 @@ def runTest(self):
         self.assertTrue(sc1.evaluate(sm), 'ScheduleConstraint broken')
         self.assertTrue(sc2.evaluate(sm), 'ScheduleConstraint broken')
 
+class CompiledScheduleConstraintTest(ProgramFrameworkTest):
+    def testCompiledConstraints(self):
+        student = self.students[0]
+        program = self.program
+        (section_list, timeslot_list) = randomized_attrs(program)
+        section1 = section_list[0]
+        section1.assign_start_time(timeslot_list[0])
+        section1.parent_class.category = self.categories[0]
+        section1.parent_class.save()
+        section2 = [sec for sec in section_list if sec.parent_class != section1.parent_class][0]
+        section2.assign_start_time(timeslot_list[1])
+        section2.parent_class.category = self.categories[1]
+        section2.parent_class.save()
+
+        #   "If you have a class in the first timeslot, you have a class in
+        #   the second one which isn't section2, or a class of the first
+        #   category in the first one."
+        condition = BooleanExpression.objects.create(label='condition')
+        condition.add_token(ScheduleTestOccupied(timeblock=timeslot_list[0]), duplicate=False)
+        requirement = BooleanExpression.objects.create(label='requirement')
+        requirement.add_token(ScheduleTestOccupied(timeblock=timeslot_list[1]), duplicate=False)
+        requirement.add_token(ScheduleTestSectionList(timeblock=timeslot_list[1], section_ids='%s' % section2.id), duplicate=False)
+        requirement.add_token('not')
+        requirement.add_token('and')
+        requirement.add_token(ScheduleTestCategory(timeblock=timeslot_list[0], category=self.categories[0]), duplicate=False)
+        requirement.add_token('or')
+        constraint = ScheduleConstraint.objects.create(program=program, condition=condition, requirement=requirement)
+
+        def check(expected):
+            sm = ScheduleMap(student, program)
+            compiled = program.getCompiledScheduleConstraints()
+            self.assertEqual([c.id for c in compiled], [constraint.id])
+            self.assertEqual(compiled[0].requirement_label, 'requirement')
+            self.assertEqual(requirement.compile(), requirement.compile())
+            #   Checking the constraints takes at most the one query to look
+            #   up the categories of the sections in the map.
+            with self.assertNumQueries(1 if sm.map[timeslot_list[0].id] else 0):
+                self.assertEqual(compiled[0].evaluate(sm, recursive=False), expected)
+            self.assertEqual(constraint.evaluate(sm, recursive=False), expected)
+            self.assertEqual(requirement.evaluate(map=sm.map),
+                             BooleanToken.evaluate_compiled(requirement.compile(), sm))
+
+        check(True)
+        section1.preregister_student(student)
+        check(True)
+        section1.parent_class.category = self.categories[1]
+        section1.parent_class.save()
+        check(False)
+        section2.preregister_student(student)
+        check(False)
+        section2.unpreregister_student(student)
+        self.assertEqual(section1.cannotAdd(student, checkFull=False, autocorrect_constraints=False),
+                         "Adding <i>%s</i> to your schedule requires that you requirement.  You can go back and correct this." % section1.title())
+
 class DynamicCapacityTest(ProgramFrameworkTest):
     def runTest(self):
         #   Parameters
@@ -1193,6 +1252,235 @@ def runTest(self):
         section.meeting_times.remove(ts2)
         self.assertSetEquals(section.get_meeting_times(), [])
 
+class AvailabilityIndexTest(ProgramFrameworkTest):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.schedule_randomly()
+        self.timeslots = list(self.program.getTimeSlots())
+        self.sections = [sec for sec in self.program.sections() if sec.get_meeting_times()]
+        self.assertTrue(len(self.sections) >= 2)
+
+        #   One teacher is only available for the first timeslot, and another
+        #   moderates a section.
+        self.teachers[0].clearAvailableTimes(self.program)
+        self.teachers[0].addAvailableTime(self.program, self.timeslots[0])
+        self.moderated = [sec for sec in self.sections if self.teachers[1] not in sec.parent_class.get_teachers()][0]
+        self.moderated.moderators.add(self.teachers[1])
+
+    def expected_times(self, teacher, ignore_classes, ignore_moderation):
+        available = set(Event.objects.filter(useravailability__user=teacher, program=self.program))
+        if not ignore_classes:
+            available -= teacher.getTaughtTimes(self.program)
+        if not ignore_moderation:
+            available -= teacher.getModeratingTimesFromProgram(self.program)
+        return [ts for ts in self.timeslots if ts in available]
+
+    def testAvailableTimes(self):
+        index = AvailabilityIndex(self.program)
+        for teacher in self.teachers:
+            for ignore_classes in (True, False):
+                for ignore_moderation in (True, False):
+                    expected = self.expected_times(teacher, ignore_classes, ignore_moderation)
+                    kwargs = {'ignore_classes': ignore_classes, 'ignore_moderation': ignore_moderation}
+                    self.assertEqual(index.available_times(teacher, **kwargs), expected)
+                    self.assertEqual(teacher.getAvailableTimes(self.program, **kwargs), expected)
+
+        #   Indexes for some users agree with the one for everyone.
+        some = AvailabilityIndex(self.program, self.teachers[:2])
+        for teacher in self.teachers[:2]:
+            self.assertEqual(some.available_mask(teacher), index.available_mask(teacher))
+
+    def testViableTimes(self):
+        index = AvailabilityIndex(self.program)
+        for sec in self.program.sections():
+            self.assertEqual(sec.viable_times(index=index), sec.viable_times())
+            for time in sec.viable_times(True, index=index):
+                for teacher in sec.parent_class.get_teachers():
+                    self.assertIn(time, teacher.getAvailableTimes(self.program, True) + list(sec.get_meeting_times()))
+
+    def testConflicts(self):
+        #   Have a teacher of one section also teach another one at the same time.
+        first, second = self.sections[:2]
+        teacher = first.parent_class.get_teachers()[0]
+        second.parent_class.makeTeacher(teacher)
+        second.meeting_times.set(first.meeting_times.all())
+        time = first.meeting_times.order_by('start')[0]
+
+        self.assertEqual(first.conflicts(teacher), (second, time))
+        self.assertEqual(second.conflicts(teacher), (first, time))
+        self.assertTrue(second.parent_class.conflicts(teacher))
+        self.assertIsNone(first.conflicts(teacher, meeting_times=Event.objects.none()))
+
+        #   Cancelled sections don't conflict.
+        second.status = ClassStatus.CANCELLED
+        second.save()
+        self.assertIsNone(first.conflicts(teacher))
+
+class ClassroomMatrixTest(ProgramFrameworkTest):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.schedule_randomly()
+        room = self.program.getClassrooms()[0]
+        self.projector = ResourceType.get_or_create('Projector')
+        Resource.objects.create(name='Projector', res_type=self.projector, event=room.event, res_group=room.res_group)
+
+    def testMatchesResources(self):
+        matrix = ClassroomMatrix.for_program(self.program)
+        for ts in self.program.getTimeSlots():
+            self.assertEqual(sorted(matrix.free_rooms(ts.id)),
+                             sorted(r.id for r in self.program.getClassrooms(ts) if r.is_available()))
+        for room in self.program.getClassrooms():
+            self.assertEqual(matrix.times(room.name), [e.id for e in room.matching_times(self.program)])
+            self.assertEqual(matrix.available_times(room.name), [e.id for e in room.available_times(self.program)])
+            self.assertEqual(matrix.furnishing_types(room.id),
+                             set(room.associated_resources().values_list('res_type_id', flat=True)))
+        self.assertIn(self.projector.id, matrix.furnishing_types(self.program.getClassrooms()[0].id))
+
+    def testUpdatedWithSchedule(self):
+        section = [sec for sec in self.program.sections() if sec.classrooms().exists()][0]
+        room = section.classrooms()[0]
+        self.assertNotIn(room.id, ClassroomMatrix.for_program(self.program).free_rooms(room.event_id))
+        with self.assertNumQueries(0):
+            ClassroomMatrix.for_program(self.program)
+
+        section.clearRooms()
+        self.assertIn(room.id, ClassroomMatrix.for_program(self.program).free_rooms(room.event_id))
+        self.assertIn(room.name, [r.name for r in section.viable_rooms()])
+
+class ProgramUserListsTest(ProgramFrameworkTest):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.schedule_randomly()
+        self.classreg_students()
+        #   Only some of the students are enrolled.
+        StudentRegistration.objects.filter(user__in=self.students[:2]).delete()
+
+    def list_ids(self, user_type_func, list_name):
+        query = getattr(self.program, user_type_func)(QObjects=True)[list_name]
+        return set(ESPUser.objects.filter(query).values_list('id', flat=True))
+
+    def testUserSetAlgebra(self):
+        universe = set(range(10))
+        a, b = {1, 2, 3}, {3, 4}
+        sets = [(UserSet(a), a), (UserSet(b), b), (~UserSet(a), universe - a), (~UserSet(b), universe - b)]
+        for (x, x_ids) in sets:
+            for (y, y_ids) in sets:
+                self.assertEqual({i for i in universe if i in x & y}, x_ids & y_ids)
+                self.assertEqual({i for i in universe if i in x | y}, x_ids | y_ids)
+        self.assertEqual(UserSet.everyone() & UserSet(a), UserSet(a))
+
+    def testCombinationList(self):
+        data = {'combo_base_list': 'Student:enrolled',
+                'checkbox_and_enrolled': '', 'checkbox_or_class_approved': '',
+                'checkbox_or_student_profile': '', 'checkbox_not_student_profile': ''}
+        filterObj = UserSearchController().filter_from_postdata(self.program, data)
+        enrolled = self.list_ids('students', 'enrolled')
+        approved = self.list_ids('teachers', 'class_approved')
+        everyone = set(ESPUser.objects.values_list('id', flat=True))
+        expected = (enrolled | approved | (everyone - self.list_ids('students', 'student_profile'))) \
+            & set(ESPUser.getAllOfType('Student', False).filter(is_active=True).values_list('id', flat=True))
+        self.assertTrue(enrolled)
+        self.assertEqual(set(filterObj.getList(ESPUser).values_list('id', flat=True)), expected)
+
+    def testCachedUntilChanged(self):
+        enrolled = ProgramUserLists(self.program).get('enrolled')
+        self.assertEqual(enrolled, UserSet(self.list_ids('students', 'enrolled')))
+        lists = ProgramUserLists(self.program)
+        lists.queries('students')
+        with self.assertNumQueries(0):
+            self.assertEqual(lists.get('enrolled'), enrolled)
+
+        student = [s for s in self.students if s.id in enrolled][0]
+        StudentRegistration.objects.filter(user=student).delete()
+        self.assertNotIn(student.id, ProgramUserLists(self.program).get('enrolled'))
+
+    def testVersionPerProgram(self):
+        program_version = _version(PROGRAM_VERSION_KEY % self.program.id)
+        global_version = _version(VERSION_KEY)
+        StudentRegistration.objects.filter(section__parent_class__parent_program=self.program)[0].save()
+        self.assertEqual(_version(PROGRAM_VERSION_KEY % self.program.id), program_version + 1)
+        self.assertEqual(_version(VERSION_KEY), global_version)
+
+    def testProgramFromLoadedObjects(self):
+        from esp.program.modules.signals import _user_list_program_ids
+        registration = StudentRegistration.objects.filter(section__parent_class__parent_program=self.program) \
+            .select_related('section__parent_class')[0]
+        with self.assertNumQueries(0):
+            self.assertEqual(_user_list_program_ids(StudentRegistration, registration), [self.program.id])
+        registration = StudentRegistration.objects.get(id=registration.id)
+        with self.assertNumQueries(1):
+            self.assertEqual(_user_list_program_ids(StudentRegistration, registration), [self.program.id])
+
+    def testProfileWithoutProgram(self):
+        program_version = _version(PROGRAM_VERSION_KEY % self.program.id)
+        global_version = _version(VERSION_KEY)
+        RegistrationProfile.objects.create(user=self.students[0], program=None)
+        self.assertEqual(_version(PROGRAM_VERSION_KEY % self.program.id), program_version)
+        self.assertEqual(_version(VERSION_KEY), global_version)
+
+    def testFilterUsesCurrentLists(self):
+        data = {'combo_base_list': 'Student:enrolled'}
+        filterObj = UserSearchController().filter_from_postdata(self.program, data)
+        enrolled = self.list_ids('students', 'enrolled') \
+            & set(ESPUser.getAllOfType('Student', False).filter(is_active=True).values_list('id', flat=True))
+        self.assertTrue(enrolled)
+        self.assertEqual(set(filterObj.getList(ESPUser).values_list('id', flat=True)), enrolled)
+
+        #   The stored filter holds the lists, not their members at the time.
+        student = ESPUser.objects.get(id=min(enrolled))
+        StudentRegistration.objects.filter(user=student).delete()
+        filterObj = PersistentQueryFilter.objects.get(id=filterObj.id)
+        self.assertEqual(set(filterObj.getList(ESPUser).values_list('id', flat=True)), enrolled - {student.id})
+
+class RegistrationExpiryTest(ProgramFrameworkTest):
+    def setUp(self, *args, **kwargs):
+        super().setUp(*args, **kwargs)
+        self.section = self.program.sections()[0]
+        self.enrolled = RegistrationType.get_map(include=['Enrolled'], category='student')['Enrolled']
+
+    def register(self, student, **kwargs):
+        return StudentRegistration.objects.create(user=student, section=self.section, relationship=self.enrolled, **kwargs)
+
+    def valid_ids(self, when=None):
+        return set(StudentRegistration.valid_objects(when).filter(section=self.section).values_list('id', flat=True))
+
+    def testExpiredFlag(self):
+        now = datetime.now()
+        live = self.register(self.students[0])
+        ended = self.register(self.students[1], end_date=now - timedelta(days=1))
+        ending = self.register(self.students[2], end_date=now + timedelta(days=1))
+        self.assertFalse(live.expired)
+        self.assertTrue(ended.expired)
+        self.assertFalse(ending.expired)
+        self.assertEqual(self.valid_ids(), {live.id, ending.id})
+
+        #   Expiring and unexpiring keeps the flag up to date.
+        live.expire()
+        self.assertTrue(StudentRegistration.objects.get(id=live.id).expired)
+        self.assertEqual(self.valid_ids(), {ending.id})
+        live.unexpire()
+        self.assertFalse(StudentRegistration.objects.get(id=live.id).expired)
+        self.assertEqual(self.valid_ids(), {live.id, ending.id})
+
+        #   So do updates in bulk.
+        StudentRegistration.objects.filter(id=live.id).update(end_date=datetime.now())
+        self.assertTrue(StudentRegistration.objects.get(id=live.id).expired)
+        StudentRegistration.objects.filter(id=live.id).update(end_date=None)
+        self.assertFalse(StudentRegistration.objects.get(id=live.id).expired)
+
+        #   Registrations which were valid at an earlier time still count for it.
+        self.assertIn(ended.id, self.valid_ids(now - timedelta(days=2)))
+
+    def testSweepExpired(self):
+        ending = self.register(self.students[0], end_date=datetime.now() + timedelta(days=1))
+        self.assertEqual(StudentRegistration.sweep_expired(), 0)
+        #   Let the end date pass, without touching the flag.
+        StudentRegistration.objects.filter(id=ending.id).update(end_date=datetime.now() - timedelta(minutes=1), expired=False)
+        self.assertNotIn(ending.id, self.valid_ids())
+        self.assertEqual(StudentRegistration.sweep_expired(), 1)
+        self.assertTrue(StudentRegistration.objects.get(id=ending.id).expired)
+        self.assertNotIn(ending.id, self.valid_ids())
+
 class LSRAssignmentTest(ProgramFrameworkTest):
     def setUp(self):
         random.seed()
@@ -43,11 +43,11 @@
 from django.core.cache import cache
 from django.template.defaultfilters import urlencode
 from esp.middleware import Http403
-from esp.utils.no_autocookie import disable_csrf_cookie_update
+from esp.utils.no_autocookie import disable_csrf_cookie_update, make_cookie_free, render_as_anonymous
 from django.utils.cache import add_never_cache_headers, patch_cache_control, patch_vary_headers
 from django.views.decorators.vary import vary_on_cookie
 from django.views.decorators.cache import cache_control
-from esp.varnish.varnish import purge_page
+from esp.varnish.varnish import add_surrogate_keys, qsd_surrogate_key, queue_ban_keys, queue_purge_page
 from urllib.parse import urlparse
 from bleach import clean
 
@@ -129,8 +129,12 @@ def qsd(request, url):
     # Detect the standard read verb
     if action == 'read':
 
+        #   Public pages are rendered the same for everyone, so that a single
+        #   copy can be cached by Varnish; edit controls are added client-side.
+        cookie_free = url_parts[0] != 'manage'
+
         # Render response
-        response = render_to_response('qsd/qsd.html', request, {
+        context = {
             'title': qsd_rec.title,
             'nav_category': qsd_rec.nav_category,
             'content': qsd_rec.html(),
@@ -138,7 +142,13 @@ def qsd(request, url):
             'qsdrec': qsd_rec,
             'class_qsd' : class_qsd,
             'have_edit': True,  ## Edit-ness is determined client-side these days
-            'edit_url': '/' + base_url + ".edit.html" }, use_request_context=False)
+            'edit_url': '/' + base_url + ".edit.html" }
+        if cookie_free:
+            with render_as_anonymous(request):
+                response = render_to_response('qsd/qsd.html', request, context, use_request_context=False)
+            make_cookie_free(response)
+        else:
+            response = render_to_response('qsd/qsd.html', request, context, use_request_context=False)
 
 #        patch_vary_headers(response, ['Cookie'])
 #        if have_edit:
@@ -146,6 +156,7 @@ def qsd(request, url):
 #            patch_cache_control(response, no_cache=True, no_store=True)
 #        else:
         patch_cache_control(response, max_age=3600, public=True)
+        add_surrogate_keys(response, [qsd_surrogate_key(qsd_rec.url)])
 
         return response
 
@@ -184,7 +195,8 @@ def qsd(request, url):
             qsd_rec.save()
 
             # We should also purge the cache
-            purge_page(qsd_rec.url+".html")
+            queue_purge_page('/' + qsd_rec.url + ".html")
+            queue_ban_keys([qsd_surrogate_key(qsd_rec.url)])
 
 
     # Detect the edit verb
@@ -254,7 +266,8 @@ def ajax_qsd(request):
             qsd.save()
 
             # We should also purge the cache
-            purge_page(qsd.url+".html")
+            queue_purge_page('/' + qsd.url + ".html")
+            queue_ban_keys([qsd_surrogate_key(qsd.url)])
 
         result['status'] = 1
         result['content'] = markdown(qsd.content)
@@ -237,11 +237,11 @@ def satisfies_requests(self, req_class):
 
         result = [True, []]
         request_list = req_class.getResourceRequests()
-        furnishings = self.associated_resources()
+        furnishing_types = set(self.associated_resources().values_list('res_type_id', flat=True))
         id_list = []
 
         for req in request_list:
-            if not furnishings.filter(res_type=req.res_type).exists():
+            if req.res_type_id not in furnishing_types:
                 result[0] = False
                 id_list.append(req.id)
 
@@ -38,7 +38,9 @@
 
 import datetime
 import json
-from django.db import models
+from django.db import connection, models
+from django.db.models import Count, FloatField, Sum
+from django.db.models.functions import Cast
 from django.template import loader
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
@@ -53,6 +55,11 @@
 from esp.program.models import Program
 from esp.tagdict.models import Tag
 
+#   Answers which float() accepts; the others make the numeric aggregates N/A
+NUMERIC_ANSWER_RE = r'^\s*[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?\s*$'
+
+LIST_VALUE_TYPE = "<class 'list'>"
+
 class ListField(object):
     """ Create a list type field descriptor. Allows you to
     pack lists (actually tuples) into a delimited string easily.
@@ -295,24 +302,52 @@ def pretty_val(val):
         if not self.question_type.is_numeric:
             return None
 
-        try:
-            ans = Answer.objects.filter(question=self)
-            ans_count = ans.count()
-            ans_sum = 0.0
-            for a in ans:
-                ans_sum += float(a.answer)
-            if ans_count == 0:
-                new_val = 0
-            else:
-                new_val = ans_sum // ans_count;
-            return pretty_val(new_val)
-        except:
+        ans = Answer.objects.filter(question=self)
+        if ans.exclude(value__regex=NUMERIC_ANSWER_RE).exists():
             return 'N/A'
+        stats = ans.aggregate(ans_sum=Sum(Cast('value', FloatField())), ans_count=Count('id'))
+        if stats['ans_count'] == 0:
+            new_val = 0
+        else:
+            new_val = stats['ans_sum'] // stats['ans_count']
+        return pretty_val(new_val)
     global_average.depend_on_row('survey.Answer', lambda ans: {'self': ans.question})
 
+    def favorite_classes(self, limit=20):
+        """ For a Favorite Class question, return the classes with the most
+            votes among all of its answers; see favorite_class_votes(). """
+        return favorite_class_votes(self.answer_set.all(), limit)
+
     class Meta:
         ordering = ['seq']
 
+def favorite_class_votes(answers, limit=20):
+    """ Return the classes with the most votes among the given queryset of
+        Favorite Class answers, as a list of dicts with the 'title' of the
+        class and its number of 'votes'.
+
+        Answers hold either a class ID or a list of them, so the votes are
+        counted in the database after expanding the lists. """
+    from esp.program.models import ClassSubject
+
+    table = Answer._meta.db_table
+    answers_sql, answers_params = answers.order_by().values('id').query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT class_id, COUNT(*), MIN(answer_id) FROM (
+                SELECT id AS answer_id, jsonb_array_elements_text(value::jsonb) AS class_id
+                    FROM """ + table + """ WHERE id IN (""" + answers_sql + """) AND value <> '' AND value_type = %s
+                UNION ALL
+                SELECT id, value FROM """ + table + """ WHERE id IN (""" + answers_sql + """) AND value <> '' AND value_type <> %s
+            ) AS votes
+            GROUP BY class_id ORDER BY COUNT(*) DESC, MIN(answer_id) LIMIT %s""",
+            list(answers_params) + [LIST_VALUE_TYPE] + list(answers_params) + [LIST_VALUE_TYPE, limit])
+        votes = [(int(class_id), num_votes) for (class_id, num_votes, first_answer) in cursor.fetchall()]
+
+    classes = ClassSubject.objects.select_related('category').in_bulk([class_id for (class_id, num_votes) in votes])
+    return [{'title': '%s: %s' % (classes[class_id].emailcode(), classes[class_id].title), 'votes': num_votes}
+            for (class_id, num_votes) in votes if class_id in classes]
+
 @python_2_unicode_compatible
 class Answer(models.Model):
     """ An answer for a single question for a single survey response. """
@@ -336,7 +371,7 @@ def _answer_getter(self):
             return None
         if hasattr(self, '_answer'):
             return self._answer
-        if self.value_type == "<class 'list'>":
+        if self.value_type == LIST_VALUE_TYPE:
             value = json.loads(self.value)
         else:
             value = self.value
@@ -346,7 +381,7 @@ def _answer_getter(self):
     def _answer_setter(self, value):
         self._answer = value
         self.value_type = str(type(value))
-        if self.value_type == "<class 'list'>":
+        if self.value_type == LIST_VALUE_TYPE:
             self.value = json.dumps(value)
         else:
             self.value = value
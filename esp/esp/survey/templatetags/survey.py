@@ -38,6 +38,7 @@
 from django.http import QueryDict
 from django.template import loader
 from esp.program.models import Program, ClassSubject, ClassSection
+from esp.survey import models as survey_models
 from esp.utils.cache_inclusion_tag import cache_inclusion_tag
 
 import os
@@ -280,13 +281,19 @@ def favorite_classes(answer_list, limit=20):
 
     max_count = min(limit, len(key_list))
 
+    classes = ClassSubject.objects.select_related('category').in_bulk(key_list[:max_count])
     for key in key_list[:max_count]:
-        cl = ClassSubject.objects.filter(id=key)
-        if cl.count() == 1:
-            result_list.append({'title': '%s: %s' % (cl[0].emailcode(), cl[0].title), 'votes': class_dict[key]})
+        if key in classes:
+            result_list.append({'title': '%s: %s' % (classes[key].emailcode(), classes[key].title), 'votes': class_dict[key]})
 
     return result_list
 
+@register.filter
+def favorite_class_votes(answers, limit=20):
+    """ Like favorite_classes, but counts the votes of a queryset of answers
+        in the database. """
+    return survey_models.favorite_class_votes(answers, int(limit))
+
 @register.filter(is_safe=True)
 def dictlookup(key, dict):
     '''Get the correct column for the answer, for dump_survey.'''
@@ -9,14 +9,16 @@
 
 from django.contrib.auth.models import Group
 
-from esp.program.models import Program
+from esp.program.models import ClassCategories, ClassSubject, Program
 from esp.survey.models import (
+    LIST_VALUE_TYPE,
     Answer,
     ListField,
     Question,
     QuestionType,
     Survey,
     SurveyResponse,
+    favorite_class_votes,
 )
 from esp.tests.util import CacheFlushTestCase as TestCase
 
@@ -213,3 +215,56 @@ def test_answer_property_setter_and_getter(self):
         self.answer.save()
         self.answer.refresh_from_db()
         self.assertEqual(self.answer.answer, 'New answer')
+
+
+class QuestionAggregateTest(TestCase):
+    def setUp(self):
+        super().setUp()
+        _setup_roles()
+        self.program = Program.objects.create(grade_min=7, grade_max=12)
+        self.survey = Survey.objects.create(name='Agg Survey', program=self.program, category='learn')
+
+    def make_question(self, type_name, is_numeric=False):
+        qt = QuestionType.objects.create(name=type_name, is_numeric=is_numeric, is_countable=True)
+        return Question.objects.create(survey=self.survey, name=type_name, question_type=qt, seq=1)
+
+    def add_answer(self, question, value):
+        answer = Answer(survey_response=SurveyResponse.objects.create(survey=self.survey), question=question)
+        answer.answer = value
+        answer.save()
+        return answer
+
+    def test_global_average(self):
+        question = self.make_question('Numeric Rating', is_numeric=True)
+        self.assertEqual(question.global_average(), 'N/A')
+        for value in ['4', '5', ' 3 ']:
+            self.add_answer(question, value)
+        self.assertEqual(question.global_average(), '4.0')
+        self.add_answer(question, 'not a number')
+        self.assertEqual(question.global_average(), 'N/A')
+
+    def test_favorite_classes(self):
+        category = ClassCategories.objects.create(symbol='F', category='Favorites')
+        classes = [ClassSubject.objects.create(parent_program=self.program, category=category,
+                                               title='Class %d' % i, grade_min=7, grade_max=12)
+                   for i in range(3)]
+        question = self.make_question('Favorite Class')
+        self.add_answer(question, [str(classes[1].id), str(classes[2].id)])
+        self.add_answer(question, [str(classes[2].id)])
+        self.add_answer(question, str(classes[0].id))
+        self.add_answer(question, str(classes[2].id))
+        with self.assertNumQueries(2):
+            favorites = question.favorite_classes()
+        self.assertEqual(favorites, [
+            {'title': 'F%d: Class 2' % classes[2].id, 'votes': 3},
+            {'title': 'F%d: Class 1' % classes[1].id, 'votes': 1},
+            {'title': 'F%d: Class 0' % classes[0].id, 'votes': 1},
+        ])
+        self.assertEqual(len(question.favorite_classes(limit=1)), 1)
+
+        #   Only the given answers are counted.
+        answers = question.answer_set.filter(value_type=LIST_VALUE_TYPE)
+        self.assertEqual(favorite_class_votes(answers), [
+            {'title': 'F%d: Class 2' % classes[2].id, 'votes': 2},
+            {'title': 'F%d: Class 1' % classes[1].id, 'votes': 1},
+        ])
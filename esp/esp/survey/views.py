@@ -38,23 +38,26 @@
 import datetime
 import openpyxl
 import re
-from io import BytesIO
+import tempfile
+from collections import OrderedDict
+from openpyxl.cell import WriteOnlyCell
 from django.db import models
 from django.db.models import Q
 from esp.users.models import ESPUser, Record, RecordType, admin_required
-from esp.program.models import Program, ClassCategories, StudentRegistration, RegistrationType, ClassSection
-from esp.survey.models import Question, Survey, SurveyResponse, Answer
+from esp.program.models import Program, ClassCategories, StudentRegistration, RegistrationType, ClassSection, ClassSubject
+from esp.survey.models import Question, Survey, SurveyResponse, Answer, NUMERIC_ANSWER_RE
 from esp.utils.web import render_to_response
 from esp.utils.latex import render_to_latex
 from esp.program.modules.base import needs_admin
 from esp.middleware import ESPError
 from esp.tagdict.models import Tag
 from esp.users.forms.generic_search_form import ApprovedTeacherSearchForm
-from django.http import Http404, HttpResponse
+from django.http import FileResponse, Http404
 from wsgiref.util import FileWrapper
 from django.contrib.auth.decorators import login_required
 from django.contrib.contenttypes.models import ContentType
-from django.db.models import Q, Min
+from django.db.models import Count, FloatField, Min, Q, Sum
+from django.db.models.functions import Cast
 
 @login_required
 def survey_view(request, tl, program, instance, template = 'survey/survey.html', context = {}):
@@ -303,11 +306,48 @@ def delist(x):
         return x
 
 
+def section_labels(section_ids):
+    """ Return the class code and title of each of the given sections (a
+        list or a queryset of IDs) and the other sections of their classes,
+        as a dict mapping section IDs to (code, title) pairs. """
+    class_ids = ClassSection.objects.filter(id__in=section_ids).values('parent_class')
+    classes = {cls.id: cls for cls in ClassSubject.objects.filter(id__in=class_ids).select_related('category')}
+    result = {}
+    indices = {}
+    #   Sections are numbered in order of ID, as in ClassSection.index()
+    for (section_id, class_id) in ClassSection.objects.filter(parent_class__in=class_ids).order_by('id').values_list('id', 'parent_class'):
+        indices[class_id] = indices.get(class_id, 0) + 1
+        cls = classes[class_id]
+        result[section_id] = ('%ss%d' % (cls.emailcode(), indices[class_id]), cls.title)
+    return result
+
+def responses_with_answers(responses, answers):
+    """ Yield each of the survey responses with the list of its answers,
+        in order of response ID.  Both querysets are read a chunk at a
+        time, so that this needs little memory however many there are. """
+    answers = answers.order_by('survey_response', 'id').iterator()
+    answer = next(answers, None)
+    for sr in responses.order_by('id').iterator():
+        sr_answers = []
+        while answer is not None and answer.survey_response_id <= sr.id:
+            if answer.survey_response_id == sr.id:
+                sr_answers.append(answer)
+            answer = next(answers, None)
+        yield sr, sr_answers
+
+def timestamp_cell(ws, time_filled):
+    if not time_filled:
+        return None
+    cell = WriteOnlyCell(ws, value=time_filled.replace(tzinfo=None))
+    cell.number_format = 'yyyy-mm-dd hh:mm:ss'
+    return cell
+
 def dump_survey_xlsx(user, prog, surveys, request, tl):
-    from esp.program.models import ClassSubject, ClassSection
     if tl == 'manage' and not 'teacher_id' in request.GET and not 'classsection_id' in request.GET and not 'classsubject_id' in request.GET:
-        wb = openpyxl.Workbook()
-        wb.remove(wb.active)
+        #   Rows are written out as they are produced, rather than keeping
+        #   the whole workbook in memory
+        wb = openpyxl.Workbook(write_only=True)
+        section_ct = ContentType.objects.get_for_model(ClassSection)
         survey_index = 0
         for s in surveys:
             # Certain characters are forbidden in sheet names
@@ -320,79 +360,50 @@ def dump_survey_xlsx(user, prog, surveys, request, tl):
             else:
                 ws = wb.create_sheet(s.name)
 
-            ws.cell(row=1, column=1, value='Response ID')
-            ws.cell(row=1, column=2, value='Timestamp')
             qs = list(s.questions.filter(per_class=False).order_by('seq', 'id'))
-            srs = list(s.surveyresponse_set.all().order_by('id'))
-            i = 3
-            q_dict = {}
-            for q in qs:
-                q_dict[q.id] = i
-                ws.cell(row=1, column=i, value=q.name)
-                i += 1
-            i = 2
-            sr_dict = {}
-            for sr in srs:
-                sr_dict[sr.id] = i
-                ws.cell(row=i, column=1, value=sr.id)
-                if sr.time_filled:
-                    cell = ws.cell(row=i, column=2, value=sr.time_filled.replace(tzinfo=None))
-                    cell.number_format = 'yyyy-mm-dd hh:mm:ss'
-                i += 1
-            for a in Answer.objects.filter(question__in=qs).order_by('id'):
-                if a.survey_response_id in sr_dict and a.question_id in q_dict:
-                    ws.cell(row=sr_dict[a.survey_response_id], column=q_dict[a.question_id], value=delist(a.answer))
+            ws.append(['Response ID', 'Timestamp'] + [q.name for q in qs])
+            q_dict = {q.id: i for (i, q) in enumerate(qs, 2)}
+            answers = Answer.objects.filter(question__in=qs).only('survey_response', 'question', 'value_type', 'value')
+            for (sr, sr_answers) in responses_with_answers(s.surveyresponse_set.all(), answers):
+                row = [sr.id, timestamp_cell(ws, sr.time_filled)] + [None] * len(qs)
+                for a in sr_answers:
+                    row[q_dict[a.question_id]] = delist(a.answer)
+                ws.append(row)
 
             # PER-CLASS QUESTIONS
             if len(s.name) > 19:
                 ws_perclass = wb.create_sheet("%d %s... (%s, per-class)" % (survey_index, s.name[:5], s.category[:5]))
             else:
                 ws_perclass = wb.create_sheet(s.name + " (per-class)")
-            ws_perclass.cell(row=1, column=1, value="Response ID")
-            ws_perclass.cell(row=1, column=2, value="Timestamp")
-            ws_perclass.cell(row=1, column=3, value="Class Code")
-            ws_perclass.cell(row=1, column=4, value="Class Title")
             qs_perclass = list(s.questions.filter(per_class=True).order_by('seq', 'id'))
-            i = 5
-            q_dict_perclass = {}
-            for q in qs_perclass:
-                q_dict_perclass[q.id] = i
-                ws_perclass.cell(row=1, column=i, value=q.name)
-                i += 1
-            i = 2
-            src_dict_perclass = {}
-            for a in Answer.objects.filter(question__in=qs_perclass).order_by('id').select_related('survey_response'):
-                sr = a.survey_response
-                cs = a.target
-                if isinstance(cs, ClassSection):
-                    key = (sr, cs)
-                else:
-                    key = sr
-                if key in src_dict_perclass:
-                    row = src_dict_perclass[key]
-                else:
-                    row = i
-                    src_dict_perclass[key] = i
-                    ws_perclass.cell(row=i, column=1, value=sr.id)
-                    if sr.time_filled:
-                        cell = ws_perclass.cell(row=i, column=2, value=sr.time_filled.replace(tzinfo=None))
-                        cell.number_format = 'yyyy-mm-dd hh:mm:ss'
-                    if cs:
-                        ws_perclass.cell(row=i, column=3, value=cs.emailcode())
-                        ws_perclass.cell(row=i, column=4, value=cs.title())
-                    i += 1
-                if a.question_id in q_dict_perclass:
-                    ws_perclass.cell(row=row, column=q_dict_perclass[a.question_id], value=delist(a.answer))
+            ws_perclass.append(["Response ID", "Timestamp", "Class Code", "Class Title"] + [q.name for q in qs_perclass])
+            q_dict_perclass = {q.id: i for (i, q) in enumerate(qs_perclass, 4)}
+            answers_perclass = Answer.objects.filter(question__in=qs_perclass)
+            labels = section_labels(answers_perclass.filter(content_type=section_ct).values('object_id'))
+            answers_perclass = answers_perclass.only('survey_response', 'content_type', 'object_id', 'question', 'value_type', 'value')
+            for (sr, sr_answers) in responses_with_answers(s.surveyresponse_set.all(), answers_perclass):
+                #   One row for each section the response is about, in the
+                #   order of their first answers
+                rows = OrderedDict()
+                for a in sr_answers:
+                    if a.content_type_id == section_ct.id and a.object_id in labels:
+                        key = a.object_id
+                    else:
+                        key = None
+                    if key not in rows:
+                        rows[key] = [sr.id, timestamp_cell(ws_perclass, sr.time_filled)] + list(labels.get(key, (None, None))) + [None] * len(qs_perclass)
+                    rows[key][q_dict_perclass[a.question_id]] = delist(a.answer)
+                for row in rows.values():
+                    ws_perclass.append(row)
 
         # Ensure at least one sheet exists
         if len(wb.sheetnames) == 0:
             wb.create_sheet("Empty")
 
-        out = BytesIO()
+        out = tempfile.TemporaryFile()
         wb.save(out)
-        wb.close()
-        response = HttpResponse(out.getvalue(), content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-        out.close()
+        out.seek(0)
+        response = FileResponse(out, content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
         response['Content-Disposition'] = 'attachment; filename=dump-%s.xlsx' % (prog.name)
         return response
     else:
@@ -519,13 +530,26 @@ def top_classes(request, tl, program, instance):
 
         section_ct=ContentType.objects.get(app_label="program", model="classsection")
 
+        #   Add up the ratings of each section in the database, then
+        #   combine the sections of each class
+        sections = ClassSection.objects.filter(parent_class__parent_program=prog)
+        section_classes = dict(sections.values_list('id', 'parent_class'))
+        ratings = Answer.objects.filter(content_type=section_ct, question=rating_question, object_id__in=sections.values('id'))
+        #   Skip blank or malformed ratings rather than failing the cast.
+        ratings = ratings.filter(value__regex=NUMERIC_ANSWER_RE)
+        rating_totals = {}
+        for row in ratings.order_by().values('object_id').annotate(num=Count('id'), total=Sum(Cast('value', FloatField()))):
+            totals = rating_totals.setdefault(section_classes[row['object_id']], [0, 0.0])
+            totals[0] += row['num']
+            totals[1] += row['total']
+
         perclass_data = []
-        initclass_data = [ { 'class': cls, 'ratings': [ float(x.answer) for sec in cls.get_sections() for x in Answer.objects.filter(object_id=sec.id, content_type=section_ct, question=rating_question)] } for cls in classes ]
+        initclass_data = [ { 'class': cls, 'ratings': rating_totals.get(cls.id, [0, 0.0]) } for cls in classes ]
         for c in initclass_data:
-            c['numratings'] = len(c['ratings'])
+            c['numratings'] = c['ratings'][0]
             if c['numratings'] < num_cut:
                 continue
-            c['avg'] = sum(c['ratings']) * 1.0 / c['numratings']
+            c['avg'] = c['ratings'][1] / c['numratings']
             if c['avg'] < rating_cut:
                 continue
             teachers = list(c['class'].get_teachers())
@@ -2,8 +2,10 @@
 Tests for esp.middleware.espauthmiddleware
 Source: esp/esp/middleware/espauthmiddleware.py
 
-Tests get_user function and ESPAuthMiddleware cookie management.
+Tests get_user function and ESPAuthMiddleware cookie management, including
+cookie-free responses from esp.utils.no_autocookie.
 """
+import json
 from unittest.mock import MagicMock
 
 from django.contrib.auth.models import Group
@@ -13,6 +15,7 @@
 from esp.middleware.espauthmiddleware import ESPAuthMiddleware, get_user
 from esp.tests.util import CacheFlushTestCase as TestCase
 from esp.users.models import AnonymousESPUser, ESPUser
+from esp.utils.no_autocookie import cookie_free, make_cookie_free
 
 
 def _setup_roles():
@@ -94,3 +97,66 @@ def test_authenticated_user_sets_cookies(self):
         self.assertIn('cur_username', cookie_names)
         self.assertIn('cur_userid', cookie_names)
         self.assertIn('cur_email', cookie_names)
+
+    def test_cookie_free_response(self):
+        """Cookie-free responses set no cookies and don't leave the session marked as accessed."""
+        user = ESPUser.objects.create_user(
+            username='cachedpageuser',
+            password='password',
+            email='cached@test.com',
+        )
+
+        request = self.factory.get('/')
+        request.session = self.client.session
+        request._cached_user = user
+        request.COOKIES = {}
+        request.session.accessed = True
+
+        response = make_cookie_free(HttpResponse())
+        result = self.middleware.process_response(request, response)
+        self.assertEqual(len(result.cookies), 0)
+        self.assertFalse(request.session.accessed)
+
+
+class CookieFreeViewTest(TestCase):
+    def setUp(self):
+        super().setUp()
+        _setup_roles()
+        self.factory = RequestFactory()
+        self.user = ESPUser.objects.create_user(
+            username='cookiefree',
+            password='password',
+            email='cookiefree@test.com',
+            first_name='Cookie',
+        )
+
+    def test_renders_as_anonymous(self):
+        seen = []
+
+        @cookie_free
+        def view(request):
+            seen.append((request.user, request.cookie_free))
+            return HttpResponse()
+
+        request = self.factory.get('/')
+        request.user = self.user
+        response = view(request)
+        self.assertIsInstance(seen[0][0], AnonymousESPUser)
+        #   Templates rendered inside the view load the user's data separately
+        self.assertTrue(seen[0][1])
+        self.assertIs(request.user, self.user)
+        self.assertFalse(request.cookie_free)
+        self.assertTrue(response.no_set_cookies)
+        self.assertTrue(response.csrf_processing_done)
+
+    def test_user_data_json(self):
+        self.client.login(username='cookiefree', password='password')
+        response = self.client.get('/myesp/user_data_json')
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(data['cur_username'], 'cookiefree')
+        self.assertEqual(data['cur_first_name'], 'Cookie')
+        self.assertIn('private', response['Cache-Control'])
+
+        self.client.logout()
+        response = self.client.get('/myesp/user_data_json')
+        self.assertEqual(json.loads(response.content.decode('utf-8')), {})
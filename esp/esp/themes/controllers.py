@@ -40,7 +40,6 @@
 import os
 import os.path
 import shutil
-import random
 import re
 import subprocess
 import tempfile
@@ -282,7 +281,40 @@ def get_variable_defaults(self, theme_name=None):
 
         return defaults
 
+    def less_fingerprint(self, less_data):
+        """ A hash of the LESS sources (with the variables filled in) and of
+            the search path for imports, identifying the compiled CSS. """
+        less_hash = hashlib.sha1(less_data.encode('UTF-8'))
+        less_hash.update(repr(settings.LESS_SEARCH_PATH).encode('UTF-8'))
+        return less_hash.hexdigest()[:16]
+
+    def fingerprinted_filename(self, output_filename, fingerprint):
+        """ Where the CSS compiled with the given fingerprint is kept, next to
+            output_filename: e.g. theme_compiled.0123456789abcdef.css """
+        (root, ext) = os.path.splitext(output_filename)
+        return '%s.%s%s' % (root, fingerprint, ext)
+
+    def prune_compiled_css(self, output_filename, keep):
+        """ Remove all but the `keep` most recently used fingerprinted copies
+            of output_filename. """
+        (root, ext) = os.path.splitext(output_filename)
+        dirname = os.path.dirname(output_filename)
+        pattern = re.compile(r'^%s\.[0-9a-f]{16}%s$' % (re.escape(os.path.basename(root)), re.escape(ext)))
+        copies = [os.path.join(dirname, filename) for filename in os.listdir(dirname) if pattern.match(filename)]
+        copies.sort(key=os.path.getmtime, reverse=True)
+        for filename in copies[keep:]:
+            os.remove(filename)
+
     def compile_css(self, theme_name, variable_data, output_filename):
+        """ Compile the theme's LESS sources, with the given variables, to
+            output_filename.
+
+            The compiled CSS is also kept in a copy whose name includes the
+            fingerprint of the sources and variables, so that compiling the
+            same sources again (when reloading or switching back to a theme)
+            reuses it instead of running lessc.  The fingerprint is stored as
+            the current_theme_version tag, which versions the stylesheet URL.
+            Returns whether the output changed. """
         #   Load LESS files in order of search path
         less_data = ''
         for filename in self.get_less_names(theme_name):
@@ -299,13 +331,37 @@ def compile_css(self, theme_name, variable_data, output_filename):
         for (variable_name, variable_value) in variable_data.items():
             less_data = re.sub(r'@%s:(\s*)(.*?);' % variable_name, r'@%s: %s;' % (variable_name, variable_value), less_data)
 
-        #   Compile to CSS
-        css_data = self.compile_less(less_data)
+        fingerprint = self.less_fingerprint(less_data)
+        if os.path.exists(output_filename) and Tag.getTag('current_theme_version') == fingerprint:
+            logger.debug('CSS output %s is up to date', output_filename)
+            return False
+
+        #   Compile to CSS, unless we already have
+        fingerprinted_filename = self.fingerprinted_filename(output_filename, fingerprint)
+        if os.path.exists(fingerprinted_filename):
+            logger.debug('Using compiled CSS from %s', fingerprinted_filename)
+            with open(fingerprinted_filename) as compiled_file:
+                css_data = compiled_file.read()
+            #   Mark it as recently used, so it isn't pruned
+            os.utime(fingerprinted_filename, None)
+        else:
+            css_data = str(THEME_COMPILED_WARNING) + self.compile_less(less_data).decode('UTF-8')
+            with open(fingerprinted_filename, 'w') as compiled_file:
+                compiled_file.write(css_data)
+            self.prune_compiled_css(output_filename, themes_settings.COMPILED_CSS_KEEP)
 
         with open(output_filename, 'w') as output_file:
-            output_file.write(str(THEME_COMPILED_WARNING) + css_data.decode('UTF-8'))
+            output_file.write(css_data)
         logger.debug('Wrote %.1f KB CSS output to %s', len(css_data) / 1000., output_filename)
-        Tag.setTag("current_theme_version", value = hex(random.getrandbits(16)))
+        Tag.setTag("current_theme_version", value = fingerprint)
+        return True
+
+    def purge_stylesheet(self, versions):
+        """ Purge the stylesheet from the Varnish cache, as linked to with each
+            of the given versions. """
+        url = '/media/styles/%s' % os.path.basename(self.css_filename)
+        for version in versions:
+            varnish.queue_purge_page('%s?v=%s' % (url, version))
 
     def recompile_theme(self, theme_name=None, customization_name=None, keep_files=None):
         """
@@ -494,7 +550,8 @@ def load_theme(self, theme_name, **kwargs):
 
     def customize_theme(self, vars):
         logger.debug('Customizing theme with variables: %s', vars)
-        self.compile_css(self.get_current_theme(), vars, self.css_filename)
+        old_version = Tag.getTag('current_theme_version')
+        changed = self.compile_css(self.get_current_theme(), vars, self.css_filename)
         vars_available = self.find_less_variables(self.get_current_theme(), flat=True)
         vars_diff = {}
         for key in vars:
@@ -504,8 +561,11 @@ def customize_theme(self, vars):
         logger.debug('Customized %d variables for theme %s', len(vars_diff), self.get_current_theme())
         Tag.setTag('current_theme_params', value=json.dumps(vars_diff))
 
-        #   Clear the Varnish cache
-        varnish.purge_all()
+        #   Only the stylesheet changed, so only it needs to be purged from
+        #   the Varnish cache.  Cached pages still link to it with the old
+        #   version; the new one is for pages rendered from now on.
+        if changed:
+            self.purge_stylesheet([old_version, Tag.getTag('current_theme_version')])
 
     ##  Customizations - stored as LESS files with modified variables only; palette is included
 
@@ -43,4 +43,6 @@
 
 THEME_DEBUG = False
 COMPILED_CSS_FILE = "theme_compiled.css"
+# how many fingerprinted copies of the compiled CSS to keep for reuse
+COMPILED_CSS_KEEP = 20
 
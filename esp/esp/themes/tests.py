@@ -6,10 +6,12 @@
 import random
 import re
 import shutil
+from unittest import mock
 
 from django.conf import settings
 
 from esp.users.models import ESPUser
+from esp.tagdict.models import Tag
 from esp.tests.util import CacheFlushTestCase as TestCase
 from esp.themes.controllers import ThemeController
 from esp.themes import settings as themes_settings
@@ -232,3 +234,47 @@ def verify_linkcolor(color_str):
 
         #   We're done.  Log out.
         self.client.logout()
+
+    def testCompileCache(self):
+        """ Check that compiling the same sources again reuses the CSS. """
+
+        tc = ThemeController()
+        css_filename = tc.css_filename
+        theme_name = 'barebones'
+        vars1 = {'linkColor': '#%06X' % random.randint(0, 1 << 24)}
+        vars2 = {'linkColor': '#%06X' % random.randint(0, 1 << 24)}
+        compiled = []
+        try:
+            with mock.patch.object(ThemeController, 'compile_less', autospec=True,
+                                   side_effect=ThemeController.compile_less) as compile_less:
+                self.assertTrue(tc.compile_css(theme_name, dict(vars1), css_filename))
+                version1 = Tag.getTag('current_theme_version')
+                compiled.append(tc.fingerprinted_filename(css_filename, version1))
+                self.assertEqual(compile_less.call_count, 1)
+                with open(css_filename) as f:
+                    css1 = f.read()
+                with open(compiled[0]) as f:
+                    self.assertEqual(f.read(), css1)
+
+                #   Nothing changed, so nothing is done.
+                self.assertFalse(tc.compile_css(theme_name, dict(vars1), css_filename))
+                self.assertEqual(compile_less.call_count, 1)
+
+                #   New variables are compiled, to a new version.
+                self.assertTrue(tc.compile_css(theme_name, dict(vars2), css_filename))
+                version2 = Tag.getTag('current_theme_version')
+                compiled.append(tc.fingerprinted_filename(css_filename, version2))
+                self.assertNotEqual(version1, version2)
+                self.assertEqual(compile_less.call_count, 2)
+
+                #   Going back reuses the first compiled CSS.
+                os.remove(css_filename)
+                self.assertTrue(tc.compile_css(theme_name, dict(vars1), css_filename))
+                self.assertEqual(Tag.getTag('current_theme_version'), version1)
+                self.assertEqual(compile_less.call_count, 2)
+                with open(css_filename) as f:
+                    self.assertEqual(f.read(), css1)
+        finally:
+            for filename in compiled + [css_filename]:
+                if os.path.exists(filename):
+                    os.remove(filename)
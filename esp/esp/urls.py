@@ -160,4 +160,8 @@
 urlpatterns += [
     url(r'^manage/templateoverride/(?P<template_id>[0-9]+)',
         esp.utils.views.diff_templateoverride),
+    url(r'^latex_job/(?P<job_id>[0-9a-f]{32})/status/?$',
+        esp.utils.views.latex_job_status),
+    url(r'^latex_job/(?P<job_id>[0-9a-f]{32})/download/?$',
+        esp.utils.views.latex_job_download),
 ]
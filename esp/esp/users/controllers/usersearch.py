@@ -32,11 +32,12 @@
   Email: web-team@learningu.org
 """
 from collections import defaultdict
-from esp.users.models import ESPUser, ZipCode, PersistentQueryFilter, Record
+from esp.users.models import ESPUser, ZipCode, PersistentQueryFilter
 from esp.users.forms.generic_search_form import StudentSearchForm
 from esp.middleware import ESPError
 from esp.utils.web import render_to_response
 from esp.program.models import Program, RegistrationType, StudentRegistration
+from esp.program.controllers.userlists import ProgramUserLists
 from esp.dbmail.models import MessageRequest
 from esp.utils.query_utils import nest_Q
 from esp.cal.models import EventType
@@ -263,13 +264,7 @@ def query_from_postdata(self, program, data):
             on the main "comm panel" page
         """
 
-        def get_recipient_type(list_name):
-            for user_type in Program.USER_TYPE_LIST_FUNCS:
-                raw_lists = getattr(program, user_type)(True)
-                if list_name in raw_lists:
-                    return user_type
-
-        subquery = None
+        program_lists = ProgramUserLists(program)
 
         if 'base_list' in data and 'recipient_type' in data:
             #   Get the program-specific part of the query (e.g. which list to use)
@@ -281,8 +276,7 @@ def get_recipient_type(list_name):
                     q_program = Q()
                     recipient_type = data['recipient_type']
                 else:
-                    program_lists = getattr(program, data['recipient_type'].lower()+'s')(QObjects=True)
-                    q_program = program_lists[data['base_list']]
+                    q_program = program_lists.query(program_lists.get(data['base_list'], data['recipient_type'].lower()+'s'))
                     """ Some program queries rely on UserBits, and since user types are also stored in
                         UserBits we cannot store both of these in a single Q object.  To compensate, we
                         ignore the user type when performing a program-specific query.  """
@@ -293,79 +287,35 @@ def get_recipient_type(list_name):
 
         ##  Handle "combination list" submissions
         elif 'combo_base_list' in data:
-            #   Get an initial query from the supplied base list
+            #   Get an initial set of users from the supplied base list
             recipient_type, list_name = data['combo_base_list'].split(':')
-            if list_name.startswith('all'):
-                q_program = Q()
-            else:
-                q_program = getattr(program, recipient_type.lower()+'s')(QObjects=True)[list_name]
+            users = program_lists.get(list_name, recipient_type.lower()+'s')
 
             #   Apply Boolean filters
             #   Base list will be intersected with any lists marked 'AND', and then unioned
-            #   with any lists marked 'OR'.
+            #   with any lists marked 'OR'.  Each list is evaluated separately (see
+            #   ProgramUserLists), so that lists on the same relation (e.g. several
+            #   Records) don't have to match the same row.
             checkbox_keys = [x[9:] for x in [x for x in list(data.keys()) if x.startswith('checkbox_')]]
             and_keys = [x[4:] for x in [x for x in checkbox_keys if x.startswith('and_')]]
             or_keys = [x[3:] for x in [x for x in checkbox_keys if x.startswith('or_')]]
             not_keys = [x[4:] for x in [x for x in checkbox_keys if x.startswith('not_')]]
-            #if any keys concern the same field, we will place them into
-            #a subquery and count occurrences
-
-            #for the purpose of experimentation simply fix this to the record__event
-            #as this could very well have different implications for other fields
-
-            subqry_fieldmap = {'record__event':[]}
 
             for and_list_name in and_keys:
-                user_type = get_recipient_type(and_list_name)
-
-                if user_type:
-
-                    qobject = getattr(program, user_type)(QObjects=True)[and_list_name]
-
+                if program_lists.user_type_func(and_list_name):
                     if and_list_name in not_keys:
-                        q_program = q_program & ~qobject
+                        users = users & ~program_lists.get(and_list_name)
                     else:
-                        needs_subquery = False
-                        if len(qobject.children) > 1:
-                            qobject_child = qobject.children[1]
-
-                            if isinstance(qobject_child, (list, tuple)):
-                                field_name, field_value = qobject.children[1]
-                                needs_subquery = field_name in subqry_fieldmap
-
-                                if needs_subquery:
-                                    subqry_fieldmap[field_name].append(field_value)
-                        if not needs_subquery:
-                            q_program = q_program & qobject
-
-            event_fields = subqry_fieldmap['record__event']
-
-            if event_fields:
-                #annotation is needed to initiate group by
-                #except that it causes the query to return two columns
-                #so we call values at the end of the chain, however,
-                #that results in multiple group by fields(causing the query to fail)
-                #so, we assign a group by field, to force grouping by user_id
-                subquery = (
-                              Record
-                              .objects
-                              .filter(program=program, event__name__in=event_fields)
-                              .annotate(numusers=Count('user__id'))
-                              .filter(numusers=len(event_fields))
-                              .values_list('user_id', flat=True)
-                            )
-
-                subquery.query.group_by = []#leave empty to strip out duplicate group by
-                subquery = Q(pk__in=subquery)
+                        users = users & program_lists.get(and_list_name)
 
             for or_list_name in or_keys:
-                user_type = get_recipient_type(or_list_name)
-                if user_type:
-                    qobject = getattr(program, user_type)(QObjects=True)[or_list_name]
+                if program_lists.user_type_func(or_list_name):
                     if or_list_name not in not_keys:
-                        q_program = q_program | qobject
+                        users = users | program_lists.get(or_list_name)
                     else:
-                        q_program = q_program | ~qobject
+                        users = users | ~program_lists.get(or_list_name)
+
+            q_program = program_lists.query(users)
 
             #   Get the user-specific part of the query (e.g. ID, name, school)
             q_extra = self.query_from_criteria(recipient_type, data, program)
@@ -384,17 +334,15 @@ def get_recipient_type(list_name):
                 clauses_unhashable.append(clause)
         qobject.children = list(set(clauses_hashable)) + clauses_unhashable
 
-        if subquery:
-            qobject = qobject & subquery
         return qobject
 
-    def filter_from_postdata(self, program, data):
-        """ Wraps the query_from_postdata function above to return a PersistentQueryFilter. """
+    def filter_from_postdata(self, program, data, query=None):
+        """ Wraps the query_from_postdata function above to return a PersistentQueryFilter.
+            The query may be passed in if the caller already made it. """
 
-        query = self.query_from_postdata(program, data)
+        if query is None:
+            query = self.query_from_postdata(program, data)
 
-        #TODO-determine best location to inject subquery
-        #the string subquery should be assigned to .extra of the resultant filter
         filterObj = PersistentQueryFilter.create_from_Q(ESPUser, query)
 
         if 'base_list' in data and 'recipient_type' in data:
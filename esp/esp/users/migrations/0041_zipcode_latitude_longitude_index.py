@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0040_auto_20260106_2204'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='zipcode',
+            name='latitude',
+            field=models.DecimalField(db_index=True, decimal_places=6, max_digits=10),
+        ),
+        migrations.AlterField(
+            model_name='zipcode',
+            name='longitude',
+            field=models.DecimalField(db_index=True, decimal_places=6, max_digits=10),
+        ),
+    ]
@@ -608,30 +608,13 @@ def getAllOfType(strType, QObject = True):
     def getAvailableTimes(self, program, ignore_classes=False, ignore_moderation=False, ignore_sections=[]):
         """ Return a list of the Event objects representing the times that a particular user
             can teach for a particular program. """
-        from esp.cal.models import Event, EventType
+        from esp.program.controllers.availability import AvailabilityIndex
 
-        #   Detect whether the program has the availability module, and assume
-        #   the user is always available if it isn't there.
-        if program.hasModule('AvailabilityModule'):
-            et = EventType.get_from_desc('Class Time Block')
-            valid_events = Event.objects.filter(useravailability__user=self, program=program, event_type=et).order_by('start')
-        else:
-            valid_events = program.getTimeSlots()
-
-        if not ignore_classes:
-            #   Subtract out the times that they are already teaching.
-            other_sections = self.getTaughtSections(program)
-            other_times = [sec.meeting_times.values_list('id', flat=True) for sec in other_sections if sec not in ignore_sections]
-            for lst in other_times:
-                valid_events = valid_events.exclude(id__in=lst)
-        if not ignore_moderation:
-            #   Subtract out the times that they are moderating
-            moderating_sections = self.getModeratingSectionsFromProgram(program)
-            moderating_times = [sec.meeting_times.values_list('id', flat=True) for sec in moderating_sections]
-            for lst in moderating_times:
-                valid_events = valid_events.exclude(id__in=lst)
-
-        return list(valid_events)
+        #   The index assumes the user is always available if the program
+        #   doesn't have the availability module.
+        index = AvailabilityIndex(program, [self])
+        return index.available_times(self, ignore_classes=ignore_classes, ignore_moderation=ignore_moderation,
+                                     ignore_sections=ignore_sections)
     getAvailableTimes.get_or_create_token(('self', 'program',))
     getAvailableTimes.depend_on_cache(getTaughtSectionsFromProgram,
             lambda self=wildcard, program=wildcard, **kwargs:
@@ -639,6 +622,7 @@ def getAvailableTimes(self, program, ignore_classes=False, ignore_moderation=Fal
     # FIXME: Really should take into account section's teachers...
     # even though that shouldn't change often
     getAvailableTimes.depend_on_m2m('program.ClassSection', 'meeting_times', lambda sec, event: {'program': sec.parent_program})
+    getAvailableTimes.depend_on_m2m('program.ClassSection', 'moderators', lambda sec, moderator: {'self': moderator, 'program': sec.parent_program})
     getAvailableTimes.depend_on_m2m('program.Program', 'program_modules', lambda prog, pm: {'program': prog})
     getAvailableTimes.depend_on_row('users.UserAvailability', lambda ua:
                                         {'program': ua.event.program,
@@ -1811,8 +1795,11 @@ def get_absolute_url(self):
 class ZipCode(models.Model):
     """ Zip Code information """
     zip_code = models.CharField(max_length=5)
-    latitude = models.DecimalField(max_digits=10, decimal_places = 6)
-    longitude = models.DecimalField(max_digits=10, decimal_places = 6)
+    # Indexed for the bounding box prefilter in close_zipcodes()
+    latitude = models.DecimalField(max_digits=10, decimal_places = 6, db_index=True)
+    longitude = models.DecimalField(max_digits=10, decimal_places = 6, db_index=True)
+
+    EARTH_RADIUS = 3963.1676 # in miles; from google...
 
     class Meta:
         app_label = 'users'
@@ -1822,7 +1809,7 @@ def distance(self, other):
         """ Returns the distance from one point to another """
         import math
 
-        earth_radius = 3963.1676 # From google...
+        earth_radius = self.EARTH_RADIUS
         lat1 = math.radians(self.latitude)
         lon1 = math.radians(self.longitude)
         lat2 = math.radians(other.latitude)
@@ -1842,33 +1829,47 @@ def distance(self, other):
 
     def close_zipcodes(self, distance):
         """ Get a list of zip codes less than or equal to
-            distance from this zip code. """
-        from decimal import Decimal
+            distance from this zip code.
+
+            Only the zip codes in a bounding box around this one are loaded
+            (using the indexes on latitude and longitude), and their exact
+            distances are then computed all at once with numpy. """
+        import math
+        import numpy
         try:
-            distance_decimal = Decimal(str(distance))
-            distance_float = float(str(distance))
+            distance = abs(float(str(distance)))
         except:
             raise ESPError('%s should be a valid decimal number!' % distance)
 
-        if distance < 0:
-            distance *= -1
-
-        oldsearches = ZipCodeSearches.objects.filter(zip_code = self,
-                                                     distance = distance_decimal)
-
-        if len(oldsearches) > 0:
-            return oldsearches[0].zipcodes.split(',')
-
-        all_zips = list(ZipCode.objects.exclude(id = self.id))
-        winners  = [ self.zip_code ]
-
-        winners += [ zipc.zip_code for zipc in all_zips
-                     if self.distance(zipc) <= distance_float ]
-
-        newsearch = ZipCodeSearches(zip_code = self,
-                                    distance = distance,
-                                    zipcodes = ','.join(winners))
-        newsearch.save()
+        lat = float(self.latitude)
+        lon = float(self.longitude)
+        # Pad the box a little, so that rounding can't exclude a zip code on
+        # its edge; the exact distances are checked below.
+        delta_lat = math.degrees(distance / self.EARTH_RADIUS) * 1.01 + 1e-6
+        candidates = ZipCode.objects.exclude(id=self.id).filter(
+            latitude__gte=lat - delta_lat, latitude__lte=lat + delta_lat)
+        # Near the poles, or if the box wraps around the antimeridian, don't
+        # bother restricting the longitude.
+        max_lat = min(abs(lat) + delta_lat, 90.0)
+        if max_lat < 89.0:
+            delta_lon = delta_lat / math.cos(math.radians(max_lat))
+            if abs(lon) + delta_lon < 180.0:
+                candidates = candidates.filter(longitude__gte=lon - delta_lon,
+                                               longitude__lte=lon + delta_lon)
+
+        rows = list(candidates.order_by('id').values_list('zip_code', 'latitude', 'longitude'))
+        winners = [ self.zip_code ]
+        if rows:
+            lat1 = math.radians(lat)
+            lon1 = math.radians(lon)
+            lat2 = numpy.radians(numpy.array([row[1] for row in rows], dtype=float))
+            lon2 = numpy.radians(numpy.array([row[2] for row in rows], dtype=float))
+            tmp = numpy.sin((lat2 - lat1) / 2.0)**2 + \
+                  math.cos(lat1) * numpy.cos(lat2) * \
+                  numpy.sin((lon2 - lon1) / 2.0)**2
+            distances = 2 * numpy.arctan2(numpy.sqrt(tmp), numpy.sqrt(1 - tmp)) * \
+                        self.EARTH_RADIUS
+            winners += [ row[0] for (row, close) in zip(rows, distances <= distance) if close ]
         return winners
 
     def __str__(self):
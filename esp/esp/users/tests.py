@@ -9,13 +9,13 @@
 from django.conf import settings
 from django.utils.functional import SimpleLazyObject
 
-from esp.middleware import ESPError
+from esp.middleware import ESPError, ESPError_Log
 from esp.program.models import RegistrationProfile, Program
 from esp.program.tests import ProgramFrameworkTest
 from esp.tagdict.models import Tag
 from esp.tests.util import CacheFlushTestCase as TestCase, user_role_setup
 from esp.users.forms.user_reg import ValidHostEmailField
-from esp.users.models import User, ESPUser, PasswordRecoveryTicket, UserForwarder, StudentInfo, Permission, Record, RecordType
+from esp.users.models import User, ESPUser, PasswordRecoveryTicket, UserForwarder, StudentInfo, Permission, Record, RecordType, ZipCode
 
 class ESPUserTest(TestCase):
     def setUp(self):
@@ -560,6 +560,29 @@ def test_send_request_email(self):
         self.assertEqual(msg.to, [settings.DEFAULT_EMAIL_ADDRESSES['default']])
         self.assertEqual(msg.from_email, settings.SERVER_EMAIL)
 
+class ZipCodeTest(TestCase):
+    def setUp(self):
+        super().setUp()
+        from decimal import Decimal
+        import random
+        rng = random.Random(42)
+        self.zipcodes = [ZipCode.objects.create(zip_code='%05d' % i,
+                                                latitude=Decimal('%.6f' % rng.uniform(40, 44)),
+                                                longitude=Decimal('%.6f' % rng.uniform(-74, -69)))
+                         for i in range(200)]
+
+    def test_close_zipcodes(self):
+        center = self.zipcodes[0]
+        for distance in [0, 5, 20, 50, 500]:
+            expected = {center.zip_code} | {z.zip_code for z in self.zipcodes[1:] if center.distance(z) <= distance}
+            close = center.close_zipcodes(distance)
+            self.assertEqual(close[0], center.zip_code)
+            self.assertEqual(len(close), len(set(close)))
+            self.assertEqual(set(close), expected)
+        self.assertEqual(set(center.close_zipcodes('-20')), set(center.close_zipcodes(20)))
+        with self.assertRaises(ESPError_Log):
+            center.close_zipcodes('far')
+
 class RecordTest(TestCase):
     def setUp(self):
         super().setUp()
@@ -2,11 +2,13 @@
 from django.contrib.auth import login, logout
 from django.contrib.auth.views import LoginView
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponseRedirect, HttpResponse
+from django.http import HttpResponseRedirect, HttpResponse, JsonResponse
 from django.template import RequestContext
 from django.urls import reverse
+from django.views.decorators.cache import cache_control
 from django.views.decorators.csrf import csrf_exempt
 
+from esp.middleware.espauthmiddleware import get_user_data
 from esp.program.models import Program, RegistrationProfile
 from esp.tagdict.models import Tag
 from esp.users.models import ESPUser, admin_required
@@ -171,6 +173,15 @@ def signed_out_message(request):
     return render_to_response('registration/logged_out.html', request, {})
 
 
+@cache_control(private=True, no_cache=True)
+def user_data_json(request):
+    """ The same per-user data as the cur_* cookies, for pages that are
+    served cookie-free from the cache (see esp.utils.no_autocookie). """
+    if not request.user.is_authenticated:
+        return JsonResponse({})
+    return JsonResponse(get_user_data(request, request.user))
+
+
 @login_required
 def disable_account(request):
 
@@ -79,3 +79,58 @@ def is_valid_qobject(when=None):
 
     class Meta:
         abstract = True
+
+
+def _has_expired(end_date):
+    """ Whether a row with this end date has expired for good. """
+    return isinstance(end_date, datetime) and end_date < datetime.now()
+
+class SweptExpirableQuerySet(models.QuerySet):
+    def update(self, **kwargs):
+        #   Keep the expired flag in step with end dates set in bulk.  An
+        #   end date we can't evaluate here (e.g. an F() expression) clears
+        #   the flag, which is always safe; the sweeper sets it again later.
+        if 'end_date' in kwargs and 'expired' not in kwargs:
+            kwargs['expired'] = _has_expired(kwargs['end_date'])
+        return super().update(**kwargs)
+
+class SweptExpirableModel(ExpirableModel):
+    """
+    An ExpirableModel which also keeps a flag marking the rows which have
+    expired for good (whose end date has passed), so that queries for the
+    valid rows can skip the expired history with a partial index on the
+    rows where the flag is not set.
+
+    The flag is set when a row is saved or updated with an end date in the
+    past, and by sweep_expired() for rows whose end date has since passed.
+    It is never set on a row which is still valid, so adding it to a query
+    for the rows valid now doesn't change the results; rows which expired
+    since the last sweep are left out by the date comparisons as usual.
+    """
+    expired = models.BooleanField(default=False, editable=False)
+
+    objects = SweptExpirableQuerySet.as_manager()
+
+    def save(self, *args, **kwargs):
+        self.expired = _has_expired(self.end_date)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'end_date' in update_fields and 'expired' not in update_fields:
+            kwargs['update_fields'] = list(update_fields) + ['expired']
+        super().save(*args, **kwargs)
+
+    @staticmethod
+    def is_valid_qobject(when=None):
+        if when is None:
+            #   Rows which had expired before now can't be valid now.  (For
+            #   other times, the flag says nothing.)
+            return Q(expired=False) & ExpirableModel.is_valid_qobject()
+        return ExpirableModel.is_valid_qobject(when)
+
+    @classmethod
+    def sweep_expired(cls):
+        """ Set the expired flag on the rows whose end date has passed.
+            Returns the number of rows swept. """
+        return cls.objects.filter(expired=False, end_date__lt=datetime.now()).update(expired=True)
+
+    class Meta:
+        abstract = True
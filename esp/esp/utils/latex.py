@@ -36,18 +36,29 @@
 """ This module will render latex code and return a rendered display. """
 
 import hashlib
+import logging
 import os.path
 import os
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from functools import partial
 from random import random
+import re
+import shutil
 import subprocess
+import sys
 import tempfile
+import threading
+import time
+import uuid
 
 from django.conf import settings
+from django.core.cache import cache
 from django.http import HttpResponse
 from django.template import Template, loader
 
-from esp.middleware import ESPError
+from esp.middleware import ESPError, ESPError_Log, ESPError_NoLog
+
+logger = logging.getLogger(__name__)
 
 TEX_TEMP = tempfile.gettempdir()
 TEX_EXT  = '.tex'
@@ -64,6 +75,38 @@
 }
 
 
+# Each compilation runs in its own directory under here, which it removes
+# when it is done.  Directories left behind by a crashed process are removed
+# by cleanup_latex_cache() once they are LATEX_WORK_MAX_AGE seconds old.
+LATEX_WORK_DIR = os.path.join(TEX_TEMP, 'esp_latex_work')
+LATEX_WORK_MAX_AGE = 86400
+
+# Compiled output is kept here, named by a hash of its source, so that
+# identical documents are only compiled once.  cleanup_latex_cache() removes
+# files unused for LATEX_CACHE_MAX_AGE seconds, and then the least recently
+# used ones until the cache is no larger than LATEX_CACHE_MAX_SIZE bytes.
+# On a site with more than one application server, set LATEX_CACHE_DIR and
+# LATEX_JOB_DIR to directories on a filesystem they all share, so that any
+# of them can serve the output of a background job.
+LATEX_CACHE_DIR = getattr(settings, 'LATEX_CACHE_DIR', os.path.join(TEX_TEMP, 'esp_latex_cache'))
+LATEX_CACHE_MAX_AGE = getattr(settings, 'LATEX_CACHE_MAX_AGE', 7 * 86400)
+LATEX_CACHE_MAX_SIZE = getattr(settings, 'LATEX_CACHE_MAX_SIZE', 2 * 1024 ** 3)
+# Output types worth caching; logs and TeX source are cheap to regenerate
+CACHED_FILE_TYPES = ('pdf', 'svg', 'png')
+
+# The sources of background jobs are kept here while they are compiled
+LATEX_JOB_DIR = getattr(settings, 'LATEX_JOB_DIR', os.path.join(TEX_TEMP, 'esp_latex_jobs'))
+# How long (in seconds) the status of a background job is remembered, and
+# after how long without a heartbeat a running job is presumed dead
+LATEX_JOB_TIMEOUT = 86400
+LATEX_JOB_STALE = 600
+LATEX_JOB_HEARTBEAT = 60
+
+# Documents with more than this many pages' worth of items (e.g. students'
+# schedules) are split into shards of this size and compiled in the background
+LATEX_SHARD_SIZE = getattr(settings, 'LATEX_SHARD_SIZE', 200)
+
+
 def render_to_latex(filepath, context_dict=None, file_type='pdf'):
     """Render some tex source to latex.
 
@@ -74,22 +117,9 @@ def render_to_latex(filepath, context_dict=None, file_type='pdf'):
         raise ESPError('Invalid type received for latex generation: %s should '
                        'be one of %s' % (file_type, ', '.join(FILE_MIME_TYPES)))
 
-    context_dict = context_dict or {}
-
-    if isinstance(filepath, Template):
-        t = filepath
-    elif isinstance(filepath, (tuple, list)):
-        t = loader.select_template(filepath)
-    else:
-        t = loader.get_template(filepath)
+    rendered_source = render_latex_source(filepath, context_dict, file_type)
 
-    context_dict['MEDIA_ROOT'] = settings.MEDIA_ROOT
-    context_dict['file_type'] = file_type
-    context_dict['settings'] = settings
-
-    rendered_source = t.render(context_dict)
-
-    contents = gen_latex(rendered_source, file_type)
+    contents = gen_latex_cached(rendered_source, file_type)
     return HttpResponse(contents, content_type=FILE_MIME_TYPES[file_type])
 
 
@@ -136,11 +166,20 @@ def gen_latex(texcode, file_type='pdf', stdout=_devnull_sentinel, stderr=subproc
 
 
 def _gen_latex(texcode, stdout, stderr, file_type='pdf'):
-    file_base = os.path.join(TEX_TEMP, get_rand_file_base())
-
     if file_type == 'tex':
         return texcode
 
+    os.makedirs(LATEX_WORK_DIR, exist_ok=True)
+    work_dir = tempfile.mkdtemp(dir=LATEX_WORK_DIR)
+    try:
+        return _gen_latex_in(work_dir, texcode, stdout, stderr, file_type)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def _gen_latex_in(work_dir, texcode, stdout, stderr, file_type):
+    file_base = os.path.join(work_dir, get_rand_file_base(work_dir))
+
     # write to the LaTeX file
     with open(file_base+TEX_EXT, 'w') as texfile:
         texfile.write(texcode)
@@ -148,7 +187,7 @@ def _gen_latex(texcode, stdout, stderr, file_type='pdf'):
     # All command calls will use the same values for the cwd, stdout, and
     # stderr arguments, so we define a partially-applied callable call() that
     # makes it easier to call subprocess.call() with these values.
-    call = partial(subprocess.call, cwd=TEX_TEMP, stdout=stdout, stderr=stderr)
+    call = partial(subprocess.call, cwd=work_dir, stdout=stdout, stderr=stderr)
 
     retcode = call(['pdflatex'] + LATEX_OPTIONS + ['%s.tex' % file_base])
 
@@ -215,10 +254,447 @@ def _gen_latex(texcode, stdout, stderr, file_type='pdf'):
         return f.read()
 
 
-def get_rand_file_base():
+def get_rand_file_base(dirname=TEX_TEMP):
     rand = hashlib.md5(str(random()).encode("UTF-8")).hexdigest()
 
-    while os.path.exists(os.path.join(TEX_TEMP, rand+TEX_EXT)):
+    while os.path.exists(os.path.join(dirname, rand+TEX_EXT)):
         rand = hashlib.md5(str(random()).encode("UTF-8")).hexdigest()
 
     return rand
+
+
+def render_latex_source(filepath, context_dict=None, file_type='pdf'):
+    """Render the TeX source of a template, without compiling it.
+
+    Takes the same arguments as render_to_latex().
+    """
+    context_dict = context_dict or {}
+
+    if isinstance(filepath, Template):
+        t = filepath
+    elif isinstance(filepath, (tuple, list)):
+        t = loader.select_template(filepath)
+    else:
+        t = loader.get_template(filepath)
+
+    context_dict['MEDIA_ROOT'] = settings.MEDIA_ROOT
+    context_dict['file_type'] = file_type
+    context_dict['settings'] = settings
+
+    return t.render(context_dict)
+
+
+def latex_worker_count():
+    """Number of LaTeX compilations to run at once in this process."""
+    return getattr(settings, 'LATEX_PARALLEL_JOBS', None) or os.cpu_count() or 1
+
+
+##  Render cache
+#
+#   Compilation goes through one bounded pool of worker threads per process
+#   (pdflatex itself runs in a subprocess, so threads are enough to drive
+#   it).  Output is stored in LATEX_CACHE_DIR under a hash of the source and
+#   file type; a request for a document that is already being compiled
+#   waits for the same compilation instead of starting another one.
+
+_KEY_RE = re.compile(r'^[0-9a-f]{32}$')
+_CACHE_FILE_RE = re.compile(r'^[0-9a-f]{32}\.(pdf|svg|png|tex|log)(\.[0-9a-f]{32}\.part)?$')
+
+_pool = None
+_pool_lock = threading.Lock()
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+_last_cleanup = 0
+
+
+def latex_hash(texcode, file_type):
+    """Cache key for the output of compiling texcode to file_type."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(file_type.encode('UTF-8'))
+    h.update(b'\0')
+    h.update(texcode.encode('UTF-8'))
+    return h.hexdigest()
+
+
+def latex_cache_path(key, file_type):
+    if not _KEY_RE.match(key or ''):
+        raise ValueError('Invalid LaTeX cache key: %r' % key)
+    return os.path.join(LATEX_CACHE_DIR, '%s.%s' % (key, file_type))
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=latex_worker_count(),
+                                       thread_name_prefix='latex')
+        return _pool
+
+
+def _read_cached(path):
+    try:
+        with open(path, 'rb') as f:
+            contents = f.read()
+        #   Mark it as recently used, so that cleanup keeps it.
+        os.utime(path, None)
+    except OSError:
+        return None
+    return contents
+
+
+def _write_cached(path, contents):
+    if isinstance(contents, str):
+        contents = contents.encode('UTF-8')
+    os.makedirs(LATEX_CACHE_DIR, exist_ok=True)
+    #   Write under a temporary name so that a half-written file is never
+    #   served.
+    part_path = '%s.%s.part' % (path, uuid.uuid4().hex)
+    with open(part_path, 'wb') as f:
+        f.write(contents)
+    os.replace(part_path, path)
+
+
+def _compile_and_cache(texcode, file_type, path):
+    global _last_cleanup
+    contents = gen_latex(texcode, file_type)
+    _write_cached(path, contents)
+    #   Clean up at most once an hour per process, on a worker thread.
+    if time.time() - _last_cleanup > 3600:
+        _last_cleanup = time.time()
+        cleanup_latex_cache()
+    return contents
+
+
+def compile_latex_async(texcode, file_type='pdf'):
+    """Start compiling texcode in the worker pool; returns a Future.
+
+    If the same source was compiled to the same type before, the Future is
+    already resolved with the cached output.  If an identical compilation is
+    in progress, its Future is returned.
+    """
+    if file_type not in CACHED_FILE_TYPES:
+        return _get_pool().submit(gen_latex, texcode, file_type)
+
+    key = latex_hash(texcode, file_type)
+    path = latex_cache_path(key, file_type)
+    with _in_flight_lock:
+        future = _in_flight.get(key)
+        if future is not None:
+            return future
+        contents = _read_cached(path)
+        if contents is not None:
+            future = Future()
+            future.set_result(contents)
+            return future
+        future = _get_pool().submit(_compile_and_cache, texcode, file_type, path)
+        _in_flight[key] = future
+
+    def forget(future):
+        with _in_flight_lock:
+            _in_flight.pop(key, None)
+    future.add_done_callback(forget)
+    return future
+
+
+def gen_latex_cached(texcode, file_type='pdf'):
+    """Like gen_latex(), but reuses the output of identical earlier requests.
+
+    Compilation happens in the shared worker pool, so at most
+    latex_worker_count() documents are compiled at once; callers beyond that
+    wait their turn.
+    """
+    return compile_latex_async(texcode, file_type).result()
+
+
+def cleanup_latex_cache(max_age=None, max_size=None):
+    """Delete cached output that hasn't been used for max_age seconds, and
+    then the least recently used output until the cache takes up no more
+    than max_size bytes.
+
+    Work and job directories left behind by compilations that never finished
+    are removed too.  Nothing outside LATEX_CACHE_DIR, LATEX_WORK_DIR and
+    LATEX_JOB_DIR is touched.  Returns the number of files and directories deleted.
+    """
+    if max_age is None:
+        max_age = LATEX_CACHE_MAX_AGE
+    if max_size is None:
+        max_size = LATEX_CACHE_MAX_SIZE
+    now = time.time()
+    removed = 0
+
+    def remove(path):
+        try:
+            os.remove(path)
+            return 1
+        except OSError:
+            #   Somebody else got to it first.
+            return 0
+
+    try:
+        names = os.listdir(LATEX_CACHE_DIR)
+    except OSError:
+        names = []
+    kept = []
+    for name in names:
+        if not _CACHE_FILE_RE.match(name):
+            continue
+        path = os.path.join(LATEX_CACHE_DIR, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        if stat.st_mtime < now - max_age:
+            removed += remove(path)
+        elif not name.endswith('.part'):
+            kept.append((stat.st_mtime, stat.st_size, path))
+
+    total_size = sum(size for (mtime, size, path) in kept)
+    for (mtime, size, path) in sorted(kept):
+        if total_size <= max_size:
+            break
+        removed += remove(path)
+        total_size -= size
+
+    for (dirname, dir_max_age) in ((LATEX_WORK_DIR, LATEX_WORK_MAX_AGE), (LATEX_JOB_DIR, LATEX_JOB_TIMEOUT)):
+        try:
+            names = os.listdir(dirname)
+        except OSError:
+            names = []
+        for name in names:
+            path = os.path.join(dirname, name)
+            try:
+                if os.path.getmtime(path) < now - dir_max_age:
+                    shutil.rmtree(path)
+                    removed += 1
+            except OSError:
+                pass
+    return removed
+
+
+def shard_items(items, size, key=None):
+    """Split items into consecutive lists of at most size items each.
+
+    If key is given, runs of consecutive items with the same key are kept in
+    one shard (even if that makes it bigger than size), so that a document
+    which groups its pages, e.g. by room, can be split between groups.
+    """
+    shards = []
+    current = []
+    for group in _consecutive_groups(items, key):
+        if current and len(current) + len(group) > size:
+            shards.append(current)
+            current = []
+        current.extend(group)
+    if current:
+        shards.append(current)
+    return shards
+
+
+def _consecutive_groups(items, key):
+    if key is None:
+        return [[item] for item in items]
+    groups = []
+    for item in items:
+        if groups and key(groups[-1][0]) == key(item):
+            groups[-1].append(item)
+        else:
+            groups.append([item])
+    return groups
+
+
+def gen_latex_parallel(texcodes, file_type='pdf', progress=None):
+    """Compile several independent TeX documents and concatenate the output.
+
+    :param texcodes:
+        The latex sources, in the order their pages should appear.
+    :param file_type:
+        'pdf', 'tex' or 'log'; other formats can't be concatenated.
+    :param progress:
+        Optional callable, called with the number of finished documents each
+        time one finishes.
+    :return:
+        The generated file contents.
+
+    pdflatex is single-threaded, so splitting a long document (e.g. the
+    schedules of a thousand students) into shards lets us use every core.
+    Each shard goes through the render cache, so unchanged shards of a
+    document that was generated before are not recompiled.
+    """
+    if file_type not in ('pdf', 'tex', 'log'):
+        raise ESPError('Cannot generate %s output in parallel; try PDF.' % file_type)
+    texcodes = list(texcodes)
+    if not texcodes:
+        raise ESPError('LaTeX generated no output.  Are you sure you selected '
+                       'any users?')
+
+    futures = {compile_latex_async(texcode, file_type): i
+               for i, texcode in enumerate(texcodes)}
+    results = [None] * len(texcodes)
+    for done, future in enumerate(as_completed(futures), 1):
+        results[futures[future]] = future.result()
+        if progress is not None:
+            progress(done)
+
+    if file_type == 'pdf':
+        return merge_pdfs(results)
+    return '\n'.join(results)
+
+
+def merge_pdfs(pdfs):
+    """Concatenate the pages of several PDF files (given as bytes)."""
+    if len(pdfs) == 1:
+        return pdfs[0]
+
+    os.makedirs(LATEX_WORK_DIR, exist_ok=True)
+    work_dir = tempfile.mkdtemp(dir=LATEX_WORK_DIR)
+    in_files = [os.path.join(work_dir, 'part-%d.pdf' % i) for i in range(len(pdfs))]
+    out_file = os.path.join(work_dir, 'merged.pdf')
+    try:
+        for in_file, contents in zip(in_files, pdfs):
+            with open(in_file, 'wb') as f:
+                f.write(contents)
+        with open(os.devnull, 'w') as devnull_file:
+            retcode = subprocess.call(['pdfunite'] + in_files + [out_file],
+                                      cwd=work_dir, stdout=devnull_file,
+                                      stderr=subprocess.STDOUT)
+        if retcode or not os.path.isfile(out_file):
+            raise ESPError('Could not merge the generated PDF files.')
+        with open(out_file, 'rb') as f:
+            return f.read()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+##  Background jobs
+#
+#   Large documents can take minutes to compile, which is longer than we want
+#   to hold a web request open.  start_latex_job() writes the sources to
+#   LATEX_JOB_DIR and starts a separate `manage.py latex_job` process to
+#   compile them, so that the job survives the web worker being recycled.
+#   The job's progress is kept in the cache, and the result is stored in the
+#   render cache, from where latex_job_status and latex_job_download (in
+#   esp.utils.views) serve it to the users who asked.  A job whose process
+#   stops sending heartbeats is reported as interrupted; asking for the
+#   document again restarts it.  The job ID is a hash of the sources, so
+#   asking for the same document again joins the running job or gets the
+#   finished one.
+
+_job_lock = threading.Lock()
+
+
+def _latex_job_key(job_id):
+    return 'latex_job:%s' % job_id
+
+
+def _latex_job_dir(job_id):
+    if not _KEY_RE.match(job_id or ''):
+        raise ValueError('Invalid LaTeX job ID: %r' % job_id)
+    return os.path.join(LATEX_JOB_DIR, job_id)
+
+
+def _is_stale(job):
+    return time.time() - job.get('updated', 0) >= LATEX_JOB_STALE
+
+
+def get_latex_job(job_id):
+    """Return the status of a background job, or None if it doesn't exist.
+
+    The status is a dict with keys 'status' ('running', 'done' or 'error'),
+    'done' and 'total' (the number of finished and total shards),
+    'user_ids' (who may download it), 'filename', 'file_type', 'updated'
+    and, for failed jobs, 'error'.  A running job which has stopped sending
+    heartbeats is reported as an error.
+    """
+    if not _KEY_RE.match(job_id or ''):
+        return None
+    job = cache.get(_latex_job_key(job_id))
+    if job is not None and job.get('status') == 'running' and _is_stale(job):
+        job = dict(job, status='error',
+                   error='The job was interrupted.  Reload the page to start it again.')
+    return job
+
+
+def _update_latex_job(job_id, **kwargs):
+    with _job_lock:
+        job = cache.get(_latex_job_key(job_id)) or {}
+        job.update(kwargs)
+        job['updated'] = time.time()
+        cache.set(_latex_job_key(job_id), job, LATEX_JOB_TIMEOUT)
+    return job
+
+
+def start_latex_job(texcodes, file_type='pdf', user=None, filename='output'):
+    """Compile the given TeX shards in the background; returns the job ID.
+
+    The shards are compiled and merged as in gen_latex_parallel().
+    """
+    texcodes = list(texcodes)
+    job_id = latex_hash('\n'.join(latex_hash(texcode, file_type) for texcode in texcodes),
+                        'job-' + file_type)
+
+    job = cache.get(_latex_job_key(job_id)) or {}
+    user_ids = set(job.get('user_ids', []))
+    if user is not None:
+        user_ids.add(user.id)
+    running = job.get('status') == 'running' and not _is_stale(job)
+    if running or os.path.isfile(latex_cache_path(job_id, file_type)):
+        #   Somebody already asked for this document.
+        if not running:
+            job.update(status='done', done=len(texcodes))
+        _update_latex_job(job_id, user_ids=sorted(user_ids), filename=filename,
+                          file_type=file_type, total=len(texcodes),
+                          **{k: job[k] for k in ('status', 'done')})
+        return job_id
+
+    job_dir = _latex_job_dir(job_id)
+    shutil.rmtree(job_dir, ignore_errors=True)
+    os.makedirs(job_dir)
+    for (i, texcode) in enumerate(texcodes):
+        with open(os.path.join(job_dir, '%06d.tex' % i), 'w', encoding='UTF-8') as f:
+            f.write(texcode)
+
+    _update_latex_job(job_id, status='running', done=0, total=len(texcodes),
+                      user_ids=sorted(user_ids), filename=filename,
+                      file_type=file_type)
+    _launch_latex_job(job_id)
+    return job_id
+
+
+def _launch_latex_job(job_id):
+    """Run the job in a new process, detached from this one."""
+    manage_py = os.path.join(settings.PROJECT_ROOT, 'manage.py')
+    with open(os.devnull, 'wb') as devnull:
+        subprocess.Popen([sys.executable, manage_py, 'latex_job', job_id],
+                         stdin=devnull, stdout=devnull, stderr=devnull,
+                         close_fds=True, start_new_session=True)
+
+
+def run_latex_job(job_id):
+    """Compile a job started by start_latex_job(), in this process."""
+    job_dir = _latex_job_dir(job_id)
+    file_type = (cache.get(_latex_job_key(job_id)) or {}).get('file_type', 'pdf')
+    stopped = threading.Event()
+
+    def heartbeat():
+        while not stopped.wait(LATEX_JOB_HEARTBEAT):
+            _update_latex_job(job_id)
+    threading.Thread(target=heartbeat, name='latex-job-heartbeat', daemon=True).start()
+
+    try:
+        texcodes = []
+        for name in sorted(os.listdir(job_dir)):
+            with open(os.path.join(job_dir, name), encoding='UTF-8') as f:
+                texcodes.append(f.read())
+        contents = gen_latex_parallel(
+            texcodes, file_type,
+            progress=lambda done: _update_latex_job(job_id, done=done))
+        _write_cached(latex_cache_path(job_id, file_type), contents)
+        _update_latex_job(job_id, status='done')
+    except (ESPError_Log, ESPError_NoLog) as e:
+        _update_latex_job(job_id, status='error', error=str(e))
+    except Exception as e:
+        logger.exception('LaTeX job %s failed', job_id)
+        _update_latex_job(job_id, status='error', error=str(e))
+    finally:
+        stopped.set()
+        shutil.rmtree(job_dir, ignore_errors=True)
@@ -0,0 +1,64 @@
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from django.core.management.base import BaseCommand
+
+from esp.utils import latex
+
+class Command(BaseCommand):
+    """
+    Measures the overhead of compiling LaTeX documents in parallel shards.
+
+    pdflatex is replaced by a stub which sleeps for a fixed startup time plus
+    a fixed time per page, so the numbers only reflect our own sharding,
+    dispatching, caching and merging.  With N workers, the sharded times
+    should approach the unsharded time divided by N; whatever is left over
+    is the sharding overhead.
+    """
+    help = 'Benchmark parallel LaTeX sharding with a stubbed compiler'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pages', type=int, default=2000)
+        parser.add_argument('--shard-sizes', default='50,100,200,500',
+                            help='Comma-separated shard sizes to try')
+        parser.add_argument('--workers', type=int, default=latex.latex_worker_count())
+        parser.add_argument('--startup', type=float, default=0.5,
+                            help='Simulated compiler startup time, in seconds')
+        parser.add_argument('--per-page', type=float, default=0.002,
+                            help='Simulated compile time per page, in seconds')
+
+    def handle(self, *args, **options):
+        startup = options['startup']
+        per_page = options['per_page']
+
+        def fake_gen_latex(texcode, file_type='pdf'):
+            time.sleep(startup + per_page * texcode.count('\n'))
+            return texcode.encode('UTF-8')
+
+        pages = ['page %d\n' % i for i in range(options['pages'])]
+        cache_dir = tempfile.mkdtemp()
+        try:
+            with mock.patch.object(latex, 'LATEX_CACHE_DIR', cache_dir), \
+                 mock.patch.object(latex, 'gen_latex', fake_gen_latex), \
+                 mock.patch.object(latex, 'merge_pdfs', lambda pdfs: b''.join(pdfs)), \
+                 mock.patch.object(latex, '_pool', ThreadPoolExecutor(max_workers=options['workers'])):
+                start = time.time()
+                fake_gen_latex(''.join(pages))
+                serial = time.time() - start
+                self.stdout.write('%d pages, %d workers' % (len(pages), options['workers']))
+                self.stdout.write('unsharded: %.2fs' % serial)
+
+                for size in [int(x) for x in options['shard_sizes'].split(',')]:
+                    start = time.time()
+                    shards = latex.shard_items(pages, size)
+                    latex.gen_latex_parallel([''.join(shard) for shard in shards], 'pdf')
+                    elapsed = time.time() - start
+                    ideal = serial / min(options['workers'], len(shards))
+                    self.stdout.write('shards of %d (%d shards): %.2fs, %.2fs over ideal'
+                                      % (size, len(shards), elapsed, elapsed - ideal))
+                latex._pool.shutdown()
+        finally:
+            shutil.rmtree(cache_dir, True)
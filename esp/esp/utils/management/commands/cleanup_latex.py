@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from esp.utils.latex import LATEX_CACHE_MAX_AGE, LATEX_CACHE_MAX_SIZE, cleanup_latex_cache
+
+class Command(BaseCommand):
+    """
+    Deletes cached LaTeX output that hasn't been used recently, or that
+    makes the cache too large, along with work directories left behind by
+    compilations that never finished.  Meant to be run from cron.
+    """
+    help = 'Delete old cached LaTeX output'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age', type=int, default=LATEX_CACHE_MAX_AGE,
+                            help='Delete files unused for this many seconds (default %(default)s)')
+        parser.add_argument('--max-size', type=int, default=LATEX_CACHE_MAX_SIZE,
+                            help='Then delete the least recently used files until the cache is at most this many bytes (default %(default)s)')
+
+    def handle(self, *args, **options):
+        removed = cleanup_latex_cache(options['max_age'], options['max_size'])
+        if options['verbosity'] > 0:
+            self.stdout.write('Removed %d files' % removed)
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from esp.utils.latex import run_latex_job
+
+class Command(BaseCommand):
+    """
+    Compiles a background LaTeX job started by esp.utils.latex.start_latex_job(),
+    which runs this command in a process of its own.
+    """
+    help = 'Compile a background LaTeX job'
+
+    def add_arguments(self, parser):
+        parser.add_argument('job_id', help='The ID of the job')
+
+    def handle(self, *args, **options):
+        run_latex_job(options['job_id'])
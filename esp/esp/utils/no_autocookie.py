@@ -1,6 +1,9 @@
 #!/usr/bin/env python
+from contextlib import contextmanager
 from functools import wraps
 
+from django.http import HttpRequest
+
 def disable_csrf_cookie_update(fn):
     """
     If a user doesn't have a CSRF cookie, Django's csrf middleware
@@ -19,3 +22,50 @@ def wrapped(request, *args, **kwargs):
     return wrapped
 
 
+
+@contextmanager
+def render_as_anonymous(request):
+    """
+    Temporarily replace request.user with an anonymous user, so that
+    whatever is rendered inside the block can't depend on who is
+    logged in.  Evaluating the real (lazy) user would also mark the
+    session as accessed, which makes the response vary on Cookie.
+    """
+    from esp.users.models import AnonymousESPUser
+    real_user = request.user
+    request.user = AnonymousESPUser()
+    #   Lets templates load the user's data from user_data_json instead
+    #   (see templates/elements/html)
+    request.cookie_free = True
+    try:
+        yield
+    finally:
+        request.user = real_user
+        request.cookie_free = False
+
+def make_cookie_free(response):
+    """
+    Mark a response as identical for every visitor, so that Varnish can
+    serve one copy to everyone: no cookies are set or refreshed on it and
+    it does not vary on Cookie.  Anything user-specific on such a page has
+    to be fetched separately by JavaScript (see e.g. ajax_schedule,
+    catalog_registered_classes_json and esp.users.views.user_data_json), and the Varnish configuration should
+    drop the Cookie header of requests for these pages.
+    """
+    response.csrf_processing_done = True
+    response.no_set_cookies = True
+    response.cookie_free = True
+    return response
+
+def cookie_free(fn):
+    """
+    Render a view as an anonymous user and make its response cookie-free.
+    Works on plain views and on program module methods.
+    """
+    @wraps(fn)
+    def wrapped(*args, **kwargs):
+        request = next(arg for arg in args if isinstance(arg, HttpRequest))
+        with render_as_anonymous(request):
+            response = fn(*args, **kwargs)
+        return make_cookie_free(response)
+    return wrapped
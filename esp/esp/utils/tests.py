@@ -11,12 +11,19 @@
     import memcache
 import logging
 logger = logging.getLogger(__name__)
+import json
 import os
+import shutil
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 from reversion import revisions as reversion
 from reversion.models import Version
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
 from django.db.models.query import Q
 from django.template import loader, Template, Context, TemplateDoesNotExist
@@ -26,6 +33,8 @@
 from esp.users.models import ESPUser
 from esp import utils
 from esp.utils import query_builder
+from esp.utils import latex
+from esp.utils.latex import cleanup_latex_cache, gen_latex_cached, gen_latex_parallel, get_latex_job, latex_cache_path, run_latex_job, shard_items, start_latex_job
 from esp.utils.models import TemplateOverride, Printer, PrintRequest
 
 
@@ -109,6 +118,7 @@ def testDeps(self):
         self.tryExecutable("dvipng")  # Used to convert LaTeX output (.dvi) to .png files
         self.tryExecutable("ps2pdf")  # Used to convert LaTeX output (.dvi) to .pdf files (must go to .ps first because we use some LaTeX packages that depend on Postscript)
         self.tryExecutable("inkscape")  # Used to render LaTeX output (once converted to .pdf) to .svg image files
+        self.tryExecutable("pdfunite")  # Used to merge LaTeX output compiled in parallel shards
 
         self.assert_(not self._exe_not_found)
 
@@ -441,6 +451,205 @@ def test_text_input(self):
                          str(Q(a_db_field="foo bar baz")))
 
 
+class LatexCacheTest(unittest.TestCase):
+    """ The LaTeX render cache, with a stub in place of the compiler. """
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.compiled = []
+        patches = [
+            mock.patch.object(latex, 'LATEX_CACHE_DIR', self.cache_dir),
+            mock.patch.object(latex, 'gen_latex', self.fake_gen_latex),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+        self.addCleanup(shutil.rmtree, self.cache_dir, True)
+
+    def fake_gen_latex(self, texcode, file_type='pdf'):
+        self.compiled.append(texcode)
+        time.sleep(0.1)
+        return ('%s as %s' % (texcode, file_type)).encode('UTF-8')
+
+    def test_cache_hit(self):
+        self.assertEqual(gen_latex_cached('doc', 'pdf'), b'doc as pdf')
+        self.assertEqual(gen_latex_cached('doc', 'pdf'), b'doc as pdf')
+        self.assertEqual(gen_latex_cached('doc', 'png'), b'doc as png')
+        self.assertEqual(self.compiled, ['doc', 'doc'])
+
+    def test_concurrent_requests_share_compilation(self):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(gen_latex_cached('shared', 'pdf')))
+                   for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [b'shared as pdf'] * 5)
+        self.assertEqual(self.compiled, ['shared'])
+
+    def test_cleanup(self):
+        gen_latex_cached('old', 'pdf')
+        gen_latex_cached('new', 'pdf')
+        old_path = latex_cache_path(latex.latex_hash('old', 'pdf'), 'pdf')
+        os.utime(old_path, (time.time() - 3600, time.time() - 3600))
+        cleanup_latex_cache(max_age=60)
+        self.assertFalse(os.path.exists(old_path))
+        self.assertTrue(os.path.exists(latex_cache_path(latex.latex_hash('new', 'pdf'), 'pdf')))
+
+    def test_cleanup_size_bound(self):
+        for (i, name) in enumerate(['oldest', 'older', 'newest']):
+            gen_latex_cached(name, 'pdf')
+            path = latex_cache_path(latex.latex_hash(name, 'pdf'), 'pdf')
+            os.utime(path, (time.time() - 300 + i, time.time() - 300 + i))
+        size = os.path.getsize(latex_cache_path(latex.latex_hash('older', 'pdf'), 'pdf'))
+        cleanup_latex_cache(max_age=3600, max_size=size + len(b'newest as pdf'))
+        self.assertEqual(sorted(os.listdir(self.cache_dir)),
+                         sorted(os.path.basename(latex_cache_path(latex.latex_hash(name, 'pdf'), 'pdf'))
+                                for name in ['older', 'newest']))
+
+    def test_cleanup_only_touches_own_directories(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir, True)
+        stale = os.path.join(work_dir, 'stale')
+        os.mkdir(stale)
+        os.utime(stale, (time.time() - 2 * latex.LATEX_WORK_MAX_AGE,) * 2)
+        #   Named like LaTeX output, but in the shared temporary directory
+        tex_temp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tex_temp, True)
+        other = os.path.join(tex_temp, '0' * 32 + '.pdf')
+        open(other, 'w').close()
+        os.utime(other, (0, 0))
+        with mock.patch.object(latex, 'LATEX_WORK_DIR', work_dir), \
+             mock.patch.object(latex, 'TEX_TEMP', tex_temp):
+            self.assertEqual(cleanup_latex_cache(max_age=0), 1)
+        self.assertEqual(os.listdir(work_dir), [])
+        self.assertTrue(os.path.exists(other))
+
+
+class LatexShardingTest(unittest.TestCase):
+    def test_shard_items(self):
+        self.assertEqual(shard_items(list(range(5)), 2), [[0, 1], [2, 3], [4]])
+        self.assertEqual(shard_items([], 2), [])
+
+    def test_shard_items_keeps_groups(self):
+        rooms = ['a', 'a', 'b', 'c', 'c', 'c', 'd']
+        self.assertEqual(shard_items(rooms, 3, key=lambda room: room),
+                         [['a', 'a', 'b'], ['c', 'c', 'c'], ['d']])
+        #   A group bigger than the shard size stays in one piece
+        self.assertEqual(shard_items(rooms, 2, key=lambda room: room),
+                         [['a', 'a'], ['b'], ['c', 'c', 'c'], ['d']])
+
+    def test_shards_compile_in_parallel(self):
+        #   With a stub compiler taking 0.2s per document, 8 shards on 4
+        #   workers should take about 0.4s rather than 1.6s.
+        def fake_gen_latex(texcode, file_type='pdf'):
+            time.sleep(0.2)
+            return texcode.encode('UTF-8')
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, True)
+        pool = ThreadPoolExecutor(max_workers=4)
+        self.addCleanup(pool.shutdown)
+        with mock.patch.object(latex, 'LATEX_CACHE_DIR', cache_dir), \
+             mock.patch.object(latex, 'gen_latex', fake_gen_latex), \
+             mock.patch.object(latex, 'merge_pdfs', lambda pdfs: b'|'.join(pdfs)), \
+             mock.patch.object(latex, '_pool', pool):
+            start = time.time()
+            result = gen_latex_parallel(['shard %d' % i for i in range(8)], 'pdf')
+            elapsed = time.time() - start
+        self.assertEqual(result, b'|'.join(b'shard %d' % i for i in range(8)))
+        self.assertLess(elapsed, 1.0)
+
+
+class LatexJobTest(DjangoTestCase):
+    """ Background LaTeX jobs.  These use the 'tex' output type, which skips
+        the compiler, so they exercise only the job machinery. """
+
+    def setUp(self):
+        self.user = ESPUser.objects.create_user(username='latexjob', password='password')
+        self.other = ESPUser.objects.create_user(username='otherjob', password='password')
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir, True)
+        #   Jobs run in this process, since a separate one couldn't see the
+        #   test database and cache.
+        self.launched = []
+        for p in [mock.patch.object(latex, 'LATEX_CACHE_DIR', self.cache_dir),
+                  mock.patch.object(latex, 'LATEX_JOB_DIR', os.path.join(self.cache_dir, 'jobs')),
+                  mock.patch.object(latex, '_launch_latex_job', self.launch)]:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def launch(self, job_id):
+        self.launched.append(job_id)
+        run_latex_job(job_id)
+
+    def wait_for_job(self, job_id):
+        for i in range(100):
+            job = get_latex_job(job_id)
+            if job['status'] != 'running':
+                return job
+            time.sleep(0.05)
+        self.fail('LaTeX job did not finish')
+
+    def test_parallel_keeps_order(self):
+        done = []
+        result = gen_latex_parallel(['first', 'second', 'third'], 'tex', progress=done.append)
+        self.assertEqual(result, 'first\nsecond\nthird')
+        self.assertEqual(sorted(done), [1, 2, 3])
+
+    def test_parallel_rejects_images(self):
+        with self.assertRaises(ESPError_Log):
+            gen_latex_parallel(['x'], 'png')
+
+    def test_job_lifecycle(self):
+        job_id = start_latex_job(['one', 'two'], 'tex', user=self.user, filename='things')
+        job = self.wait_for_job(job_id)
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual((job['done'], job['total']), (2, 2))
+
+        self.assertTrue(self.client.login(username='latexjob', password='password'))
+        response = self.client.get('/latex_job/%s/status' % job_id)
+        self.assertEqual(json.loads(response.content.decode('UTF-8'))['status'], 'done')
+        response = self.client.get('/latex_job/%s/download' % job_id)
+        self.assertEqual(b''.join(response.streaming_content), b'one\ntwo')
+        self.assertIn('things.tex', response['Content-Disposition'])
+
+        #   Other users can't see the job
+        self.client.logout()
+        self.assertTrue(self.client.login(username='otherjob', password='password'))
+        self.assertEqual(self.client.get('/latex_job/%s/status' % job_id).status_code, 404)
+        self.assertEqual(self.client.get('/latex_job/%s/download' % job_id).status_code, 404)
+
+    def test_identical_jobs_are_shared(self):
+        job_id = start_latex_job(['same'], 'tex', user=self.user)
+        self.assertEqual(start_latex_job(['same'], 'tex', user=self.other), job_id)
+        self.wait_for_job(job_id)
+        self.assertEqual(get_latex_job(job_id)['user_ids'], sorted([self.user.id, self.other.id]))
+        self.assertNotEqual(start_latex_job(['different'], 'tex', user=self.user), job_id)
+
+    def test_job_runs_out_of_process(self):
+        with mock.patch.object(latex, '_launch_latex_job') as launch:
+            job_id = start_latex_job(['one'], 'tex', user=self.user)
+        launch.assert_called_once_with(job_id)
+        #   The sources are left for the other process to read.
+        self.assertEqual(os.listdir(os.path.join(self.cache_dir, 'jobs', job_id)), ['000000.tex'])
+        self.assertEqual(get_latex_job(job_id)['status'], 'running')
+
+        #   If that process dies, the job is reported as interrupted, and
+        #   asking for the document again starts it over.
+        with mock.patch.object(latex.time, 'time', return_value=time.time() + latex.LATEX_JOB_STALE):
+            self.assertEqual(get_latex_job(job_id)['status'], 'error')
+            self.assertEqual(start_latex_job(['one'], 'tex', user=self.user), job_id)
+        self.assertEqual(self.launched, [job_id])
+        self.assertEqual(self.wait_for_job(job_id)['status'], 'done')
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, 'jobs', job_id)))
+
+    def test_invalid_job_id(self):
+        self.assertIsNone(get_latex_job('../../etc/passwd'))
+        with self.assertRaises(ValueError):
+            latex_cache_path('../../etc/passwd', 'pdf')
+
+
 def suite():
     """Choose tests to expose to the Django tester."""
     s = unittest.TestSuite()
@@ -450,4 +659,3 @@ def suite():
     s.addTest(doctest.DocTestSuite(utils))
     return s
 
-
@@ -35,11 +35,14 @@
 
 from esp.utils.web import render_to_response
 from esp.utils.models import TemplateOverride
+from esp.utils.latex import FILE_MIME_TYPES, get_latex_job, latex_cache_path
 from esp.users.models import admin_required
 from difflib import HtmlDiff
 import os.path
 from django.conf import settings
-from django.http import Http404
+from django.contrib.auth.decorators import login_required
+from django.http import FileResponse, Http404, JsonResponse
+from django.views.decorators.cache import never_cache
 
 @admin_required
 def diff_templateoverride(request, template_id):
@@ -63,3 +66,34 @@ def diff_templateoverride(request, template_id):
             original_lines, override_lines,
             'original', 'override (version {})'.format(template_id))
     return render_to_response('utils/diff_templateoverride.html', request, context)
+
+def _get_own_latex_job(request, job_id):
+    job = get_latex_job(job_id)
+    if job is None or request.user.id not in job.get('user_ids', []):
+        raise Http404
+    return job
+
+@never_cache
+@login_required
+def latex_job_status(request, job_id):
+    """ Progress of a background LaTeX job, polled by utils/latex_job.html. """
+    job = _get_own_latex_job(request, job_id)
+    return JsonResponse({
+        'status': job['status'],
+        'done': job['done'],
+        'total': job['total'],
+        'error': job.get('error', ''),
+    })
+
+@never_cache
+@login_required
+def latex_job_download(request, job_id):
+    job = _get_own_latex_job(request, job_id)
+    if job['status'] != 'done':
+        raise Http404
+    path = latex_cache_path(job_id, job['file_type'])
+    if not os.path.isfile(path):
+        raise Http404
+    response = FileResponse(open(path, 'rb'), content_type=FILE_MIME_TYPES[job['file_type']])
+    response['Content-Disposition'] = 'attachment; filename=%s.%s' % (job['filename'], job['file_type'])
+    return response
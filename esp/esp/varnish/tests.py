@@ -2,13 +2,24 @@
 Tests for esp.varnish.varnish
 Source: esp/esp/varnish/varnish.py
 
-Tests Varnish cache purge utilities: get_varnish_host, purge_page, purge_all.
+Tests Varnish cache purge utilities: get_varnish_host, purge_page, purge_all,
+the asynchronous PurgeQueue, surrogate key helpers and catalog bans.
 """
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest.mock import patch, MagicMock
 
+from django.http import HttpResponse
 from django.test import override_settings
 
-from esp.varnish.varnish import get_varnish_host, purge_all, purge_page
+from esp.program.models import ClassSection
+from esp.program.models.class_ import purge_catalog_for_section
+from esp.program.tests import ProgramFrameworkTest
+from esp.resources.models import ResourceAssignment
+from esp.varnish.varnish import (
+    SURROGATE_KEY_HEADER, PurgeQueue, add_surrogate_keys, catalog_surrogate_key,
+    get_varnish_host, purge_all, purge_page, qsd_surrogate_key,
+)
 from esp.tests.util import CacheFlushTestCase as TestCase
 
 
@@ -76,3 +87,117 @@ def test_sends_ban_request(self, MockHTTPConnection):
         args = mock_conn.request.call_args[0]
         self.assertEqual(args[0], 'BAN')
         self.assertEqual(args[1], '/')
+
+
+class _RecordingHandler(BaseHTTPRequestHandler):
+    """ Local stand-in for Varnish: records requests, keeps connections alive. """
+    protocol_version = 'HTTP/1.1'
+
+    def _record(self):
+        self.server.requests.append((self.command, self.path, self.headers.get(SURROGATE_KEY_HEADER)))
+        self.server.connections.add(self.client_address)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_PURGE = _record
+    do_BAN = _record
+
+    def log_message(self, *args):
+        pass
+
+
+class PurgeQueueTest(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _RecordingHandler)
+        self.server.requests = []
+        self.server.connections = set()
+        self.server.daemon_threads = True
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.queue = PurgeQueue('127.0.0.1:%d' % self.server.server_address[1])
+
+    def tearDown(self):
+        self.queue._close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_coalesces_and_reuses_connection(self):
+        #   Hold the sender so that everything below is still pending
+        with self.queue._cond:
+            for i in range(5):
+                self.queue.purge('/learn/index.html', 'example.com')
+            self.queue.ban_keys(['catalog-1', 'catalog-1', 'qsd-abc'], 'example.com')
+            self.queue.purge('/teach/index.html', 'example.com')
+        self.assertTrue(self.queue.flush(timeout=10))
+        self.assertEqual(self.server.requests, [
+            ('PURGE', '/learn/index.html', None),
+            ('BAN', '/', 'catalog-1'),
+            ('BAN', '/', 'qsd-abc'),
+            ('PURGE', '/teach/index.html', None),
+        ])
+        self.assertEqual(self.queue.connections_opened, 1)
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_reconnects_after_server_closes(self):
+        self.queue.purge('/a.html', 'example.com')
+        self.assertTrue(self.queue.flush(timeout=10))
+        self.queue._conn.sock.close()
+        self.queue.purge('/b.html', 'example.com')
+        self.assertTrue(self.queue.flush(timeout=10))
+        self.assertEqual([r[1] for r in self.server.requests], ['/a.html', '/b.html'])
+
+
+class SurrogateKeyTest(TestCase):
+    def test_add_surrogate_keys(self):
+        response = HttpResponse('')
+        add_surrogate_keys(response, ['program-1'])
+        add_surrogate_keys(response, ['catalog-1', 'program-1'])
+        self.assertEqual(response[SURROGATE_KEY_HEADER], 'program-1 catalog-1')
+
+    def test_qsd_key_is_header_safe(self):
+        key = qsd_surrogate_key('learn/Splash/2024/some page')
+        self.assertRegex(key, r'^qsd-[0-9a-f]+$')
+
+
+class CatalogBanTest(ProgramFrameworkTest):
+    @patch('esp.program.models.class_.queue_ban_keys')
+    def test_bans_only_catalog_changes(self, mock_ban):
+        section = ClassSection.objects.filter(parent_class__parent_program=self.program).select_related('parent_class')[0]
+
+        #   Recomputing enrollment doesn't change the catalog
+        section.enrolled_students = 3
+        with self.assertNumQueries(0):
+            purge_catalog_for_section(ClassSection, section, created=False, update_fields=['enrolled_students'])
+            purge_catalog_for_section(ClassSection, section, created=False)
+        self.assertFalse(mock_ban.called)
+
+        section.max_class_capacity = (section.max_class_capacity or 0) + 1
+        with self.assertNumQueries(0):
+            purge_catalog_for_section(ClassSection, section, created=False)
+        mock_ban.assert_called_once_with([catalog_surrogate_key(self.program.id)])
+
+    @patch('esp.program.models.class_.queue_ban_keys')
+    def test_bans_on_meeting_times(self, mock_ban):
+        section = ClassSection.objects.filter(parent_class__parent_program=self.program)[0]
+        section.meeting_times.add(self.timeslots[0])
+        mock_ban.assert_called_with([catalog_surrogate_key(self.program.id)])
+        mock_ban.reset_mock()
+        self.timeslots[0].meeting_times.remove(section)
+        mock_ban.assert_called_with([catalog_surrogate_key(self.program.id)])
+
+    @patch('esp.program.models.class_.queue_ban_keys')
+    def test_bans_on_teachers(self, mock_ban):
+        section = ClassSection.objects.filter(parent_class__parent_program=self.program)[0]
+        section.parent_class.teachers.add(self.teachers[-1])
+        mock_ban.assert_called_with([catalog_surrogate_key(self.program.id)])
+
+    @patch('esp.program.models.class_.queue_ban_keys')
+    def test_bans_on_room_assignments(self, mock_ban):
+        section = ClassSection.objects.filter(parent_class__parent_program=self.program)[0]
+        assignment = ResourceAssignment.objects.create(resource=self.rooms[0], target=section)
+        mock_ban.assert_called_with([catalog_surrogate_key(self.program.id)])
+        mock_ban.reset_mock()
+        assignment.delete()
+        mock_ban.assert_called_with([catalog_surrogate_key(self.program.id)])
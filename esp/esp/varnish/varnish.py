@@ -1,7 +1,32 @@
+r""" Helpers for controlling the Varnish cache in front of the site.
+
+    Besides the one-off purge_page() and purge_all() requests, this module
+    provides a background PurgeQueue which coalesces duplicate requests and
+    sends them over a single persistent connection, and "surrogate keys":
+    space-separated tags emitted in a response header so that every cached
+    page carrying a tag can be banned at once.  Tag bans need a rule like the
+    following in the Varnish configuration:
+
+        sub vcl_recv {
+            if (req.method == "BAN" && req.http.Surrogate-Key) {
+                ban("obj.http.Surrogate-Key ~ (^|\s)" + req.http.Surrogate-Key + "($|\s)");
+                return (synth(200, "Banned"));
+            }
+        }
+"""
+import hashlib
 import http.client
+import logging
+import threading
+from collections import OrderedDict
 
 from django.conf import settings
 from django.contrib.sites.models import Site
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+SURROGATE_KEY_HEADER = 'Surrogate-Key'
 
 def get_varnish_host():
     """ Obtain the host to send Varnish control requests to.
@@ -36,3 +61,149 @@ def purge_all(host=None):
     conn.request("BAN", "/", "", {'Host': cur_domain, 'Accept-Encoding': 'gzip'})
     ret = conn.getresponse()
     return (ret.status, ret.reason)
+
+##  Surrogate keys
+
+def program_surrogate_key(program_id):
+    """ Tag for every page belonging to a program. """
+    return 'program-%d' % program_id
+
+def catalog_surrogate_key(program_id):
+    """ Tag for the catalog pages (HTML, JSON and PDF) of a program. """
+    return 'catalog-%d' % program_id
+
+def qsd_surrogate_key(url):
+    """ Tag for a QSD page.  QSD URLs may contain characters with a meaning
+        in headers or in the ban regex, so use a digest of the URL. """
+    return 'qsd-' + hashlib.md5(url.encode('utf-8')).hexdigest()[:16]
+
+def add_surrogate_keys(response, keys):
+    """ Add the given tags to the surrogate key header of a response,
+        keeping any tags that are already there. """
+    existing = response.get(SURROGATE_KEY_HEADER, '').split()
+    for key in keys:
+        if key not in existing:
+            existing.append(key)
+    if existing:
+        response[SURROGATE_KEY_HEADER] = ' '.join(existing)
+    return response
+
+##  Asynchronous purge queue
+
+class PurgeQueue(object):
+    """ Sends PURGE and BAN requests to Varnish from a background thread.
+
+        Requests are queued in order and identical requests that are still
+        waiting are coalesced, so saving the same page ten times in a row
+        costs one purge.  One HTTP/1.1 connection is kept open and reused,
+        and is reopened if Varnish drops it.  Failures are logged and
+        otherwise ignored; a stale cache entry is not worth failing over.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.connections_opened = 0
+        self._pending = OrderedDict()
+        self._busy = False
+        self._cond = threading.Condition()
+        self._conn = None
+        self._thread = None
+
+    def purge(self, url, domain):
+        """ Queue a PURGE of a single URL on the given site domain. """
+        self._put(('PURGE', domain, url, None))
+
+    def ban_keys(self, keys, domain):
+        """ Queue a BAN of every cached page tagged with one of the keys. """
+        for key in keys:
+            self._put(('BAN', domain, '/', key))
+
+    def _put(self, item):
+        with self._cond:
+            self._pending[item] = None
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='varnish-purge')
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """ Block until everything queued so far has been sent.
+            Returns False if the timeout expired first. """
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending and not self._busy, timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending)
+                batch = list(self._pending)
+                self._pending.clear()
+                self._busy = True
+            try:
+                for item in batch:
+                    self._send(*item)
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def _send(self, method, domain, url, key):
+        headers = {'Host': domain, 'Accept-Encoding': 'gzip'}
+        if key is not None:
+            headers[SURROGATE_KEY_HEADER] = key
+        #   Retry once: the persistent connection may have been closed by
+        #   Varnish since the last request.
+        for attempt in range(2):
+            try:
+                if self._conn is None:
+                    self._conn = http.client.HTTPConnection(self.host, timeout=10)
+                    self.connections_opened += 1
+                self._conn.request(method, url, '', headers)
+                ret = self._conn.getresponse()
+                ret.read()
+                if ret.will_close:
+                    self._close()
+                return (ret.status, ret.reason)
+            except (http.client.HTTPException, OSError):
+                self._close()
+        logger.warning('Varnish %s of %s (key %s) failed', method, url, key)
+        return None
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+_purge_queue = None
+_purge_queue_lock = threading.Lock()
+
+def get_purge_queue():
+    """ Return the process-wide purge queue, or None if Varnish is not set up. """
+    global _purge_queue
+    host = get_varnish_host()
+    if host is None:
+        return None
+    with _purge_queue_lock:
+        if _purge_queue is None or _purge_queue.host != host:
+            _purge_queue = PurgeQueue(host)
+        return _purge_queue
+
+def queue_purge_page(url):
+    """ Asynchronous version of purge_page().  The purge is sent once the
+        current transaction commits, so that Varnish can't refetch the page
+        before the change is visible. """
+    queue = get_purge_queue()
+    if queue is None:
+        return
+    domain = Site.objects.get_current().domain
+    transaction.on_commit(lambda: queue.purge(url, domain))
+
+def queue_ban_keys(keys):
+    """ Asynchronously ban every cached page tagged with any of the keys. """
+    queue = get_purge_queue()
+    if queue is None:
+        return
+    keys = list(keys)
+    domain = Site.objects.get_current().domain
+    transaction.on_commit(lambda: queue.ban_keys(keys, domain))
@@ -52,6 +52,7 @@
 from esp.web.forms.contact_form import ContactForm
 from esp.tagdict.models import Tag
 from esp.utils.no_autocookie import disable_csrf_cookie_update
+from esp.varnish.varnish import add_surrogate_keys, program_surrogate_key
 
 from django.views.decorators.cache import cache_control
 from django.conf import settings
@@ -91,7 +92,7 @@ def program(request, tl, one, two, module, extra = None):
     newResponse = ProgramModuleObj.findModule(request, tl, one, two, module, extra, prog)
 
     if newResponse:
-        return newResponse
+        return add_surrogate_keys(newResponse, [program_surrogate_key(prog.id)])
 
     raise Http404
 
@@ -7,11 +7,17 @@ function ApiClient() {
      *                  ajax_data which is the data that was fetched.
      * @param: errorReporter: If server reports an error, this function will be called.
      *                        Takes one param msg with an error message.
+     * @param wait: (optional) If there are no new changes, ask the server to
+     *              wait up to this many seconds for one before responding.
      */
-    this.get_change_log = function(last_fetched_index, callback, errorReporter){
+    this.get_change_log = function(last_fetched_index, callback, errorReporter, wait){
+        var params = { 'last_fetched_index': last_fetched_index };
+        if (wait) {
+            params['wait'] = wait;
+        }
         $j.getJSON(
             'ajax_change_log',
-            { 'last_fetched_index': last_fetched_index })
+            params)
             .done(function(ajax_data, status) {
                 callback(ajax_data);
             })
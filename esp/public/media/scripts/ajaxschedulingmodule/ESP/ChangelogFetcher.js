@@ -17,8 +17,18 @@ function ChangelogFetcher(matrix, api_client){
         }
     });
 
+    // How long (in seconds) to ask the server to hold a request open while
+    // waiting for a change.  As soon as a response arrives, the next request
+    // is sent, so changes from other schedulers show up right away.
+    this.long_poll_wait = 20;
+
+    // Whether a request for the changelog is outstanding
+    this.fetching = false;
+
     /**
-     * Poll for changes every interval milliseconds.
+     * Poll for changes every interval milliseconds.  If the server supports
+     * waiting for changes, requests are chained instead, and the interval
+     * only matters after a failed request.
      *
      * @param interval: The time in milliseconds between polling the server
      */
@@ -32,12 +42,26 @@ function ChangelogFetcher(matrix, api_client){
      * Fetch the changelog from the server
      */
     this.getChanges = function(){
+        if (this.fetching) {
+            return;
+        }
+        this.fetching = true;
         this.api_client.get_change_log(
             this.last_applied_index,
-            this.applyChangeLog.bind(this),
+            function(data) {
+                this.fetching = false;
+                this.applyChangeLog(data);
+                var other = data.other && data.other[0];
+                if (other && other.wait && !other.command) {
+                    // The server waited for changes; ask again right away.
+                    this.getChanges();
+                }
+            }.bind(this),
             function(msg) {
+                this.fetching = false;
                 console.log(msg);
-            }
+            }.bind(this),
+            this.long_poll_wait
         );
     };
 
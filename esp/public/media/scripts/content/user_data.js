@@ -11,37 +11,63 @@ if (typeof(window["$j"]) == "undefined") {
 
 var esp_user = {};
 var esp_user_keys = new Array('cur_username','cur_userid','cur_email','cur_first_name','cur_last_name','cur_other_user','cur_retTitle', 'cur_admin','cur_yog','cur_grade','cur_roles','cur_qsd_bits');
+var esp_user_login = null;
 
-for (var i=0; i < esp_user_keys.length; i++) {
-    var tmp = $j.cookie(esp_user_keys[i]);
-    if (tmp) {
-	esp_user[esp_user_keys[i]] = tmp;
+/* Fill in esp_user from a function returning the raw value of each key.
+ * Values from the cookies are escaped for potential unicode.
+ * : see esp/middleware/espauthmiddleware.py
+ */
+function set_esp_user(get_value, escaped) {
+    var decode = escaped ? unescape : function (value) { return value; };
+    esp_user = {};
+    for (var i=0; i < esp_user_keys.length; i++) {
+        var tmp = get_value(esp_user_keys[i]);
+        if (tmp) {
+            esp_user[esp_user_keys[i]] = String(tmp);
+        }
+    }
+    esp_user['cur_userid'] = parseInt(esp_user['cur_userid']);
+    esp_user['cur_email'] = decode(esp_user['cur_email']);
+    esp_user['cur_first_name'] = decode(esp_user['cur_first_name']);
+    esp_user['cur_last_name'] = decode(esp_user['cur_last_name']);
+    if (esp_user['cur_retTitle']) {
+        esp_user['cur_retTitle'] = decode(esp_user['cur_retTitle']);
+    }
+    esp_user['cur_yog'] = parseInt(esp_user['cur_yog']);
+    esp_user['cur_grade'] = parseInt(esp_user['cur_grade']);
+    if (esp_user['cur_roles']) {
+        esp_user['cur_roles'] = decode(esp_user['cur_roles']).split(',');
+    } else {
+        esp_user['cur_roles'] = [];
     }
-    /* These cookies are escape for potential unicode.
-     * : see esp/middleware/esperrormiddleware.py
-     */
-}
-esp_user['cur_userid'] = parseInt(esp_user['cur_userid']);
-esp_user['cur_email'] = unescape(esp_user['cur_email']);
-esp_user['cur_first_name'] = unescape(esp_user['cur_first_name']);
-esp_user['cur_last_name'] = unescape(esp_user['cur_last_name']);
-esp_user['cur_yog'] = parseInt(esp_user['cur_yog']);
-esp_user['cur_grade'] = parseInt(esp_user['cur_grade']);
-if (esp_user['cur_roles']) {
-    esp_user['cur_roles'] = unescape(esp_user['cur_roles']).split(',');
-} else {
-    esp_user['cur_roles'] = [];
-}
-
-var esp_user_login = null;
 
-if (esp_user['cur_username']) {
-    esp_user_login = '<table border="0" cellpadding="0" cellspacing="0" summary=" "><tr><td width="100%"><div class="divformcol1">&nbsp;</div></td><td style="text-align:left"><div class="divformcol1" style="text-align:left">';
+    esp_user_login = null;
+    if (esp_user['cur_username']) {
+        esp_user_login = '<table border="0" cellpadding="0" cellspacing="0" summary=" "><tr><td width="100%"><div class="divformcol1">&nbsp;</div></td><td style="text-align:left"><div class="divformcol1" style="text-align:left">';
 
-    if (esp_user['cur_other_user'] == '1') {
-	esp_user_login += '<a href="/myesp/switchback/">Go back to ' + esp_user['cur_retTitle'] + '</a>';
-    } else {
-	esp_user_login += 'Welcome, ' + esp_user['cur_first_name'] + '!';
+        if (esp_user['cur_other_user'] == '1') {
+            esp_user_login += '<a href="/myesp/switchback/">Go back to ' + esp_user['cur_retTitle'] + '</a>';
+        } else {
+            esp_user_login += 'Welcome, ' + esp_user['cur_first_name'] + '!';
+        }
+        esp_user_login += '</div></td><td colspan="2"><div class="divformcol2" style="text-align:right"><a href="/myesp/signout/">Sign Out</a></div></tr></table>';
     }
-    esp_user_login += '</div></td><td colspan="2"><div class="divformcol2" style="text-align:right"><a href="/myesp/signout/">Sign Out</a></div></tr></table>';
 }
+
+/* Pages served cookie-free from the cache (see esp/utils/no_autocookie.py)
+ * don't refresh the cookies, which may then be stale or missing, so they
+ * fetch the same data from the server and update the page with it.  Scripts
+ * which read esp_user when the page loads can listen for the
+ * "esp_user_refreshed" event to pick up the new values.
+ */
+function refresh_esp_user() {
+    $j.getJSON('/myesp/user_data_json', function (data) {
+        set_esp_user(function (key) { return data[key]; }, false);
+        if (typeof(window["update_user_classes"]) != "undefined") {
+            update_user_classes();
+        }
+        $j(document).trigger("esp_user_refreshed");
+    });
+}
+
+set_esp_user(function (key) { return $j.cookie(key); }, true);
@@ -1403,6 +1403,58 @@ function fetch_all(avoid_catalog)
     });
 }
 
+/*  Section status feed
+    Between full refreshes, poll for the sections whose counts or full
+    status changed since the last version we saw, and redraw if any did.  */
+
+var section_status_version = null;
+
+function handle_section_status(new_data, text_status, jqxhr)
+{
+    var first_poll = (section_status_version === null);
+    section_status_version = new_data.version;
+    if (first_poll || !data.sections)
+        return;
+
+    var changed = false;
+    for (var sec_id in new_data.sections)
+    {
+        var status = new_data.sections[sec_id];
+        var section = data.sections[sec_id];
+        if (!status || !section)
+            continue;
+        section.capacity = status.capacity;
+        section.num_students_attending = status.attending;
+        //  As in populate_counts(), trust the larger number of students.
+        if (status.enrolled > section.num_students_enrolled)
+            section.num_students_enrolled = status.enrolled;
+        section.full = status.full;
+        section.registration_status = status.registration_status;
+        changed = true;
+    }
+
+    if (changed && check_status())
+    {
+        if (state.display_mode == "status")
+            set_current_student(null);
+        else if (state.display_mode == "classchange")
+            set_current_student(state.student_id);
+    }
+}
+
+function poll_section_status()
+{
+    var params = {};
+    if (section_status_version !== null)
+        params.since = section_status_version;
+    $j.ajax({
+        url: program_base_url + "section_status_feed",
+        data: params,
+        dataType: 'json',
+        success: handle_section_status
+    });
+}
+
 function refresh_counts() {
     add_message("Pinging server for updated information, please stand by...", "message_header");
     fetch_all(true);
@@ -1480,4 +1532,8 @@ $j(document).ready(function () {
     
     //  Update enrollment counts and list of students once per minute.
     setInterval(refresh_counts, 300000);
+
+    //  Pick up changes to section counts and full statuses in between.
+    poll_section_status();
+    setInterval(poll_section_status, 15000);
 });
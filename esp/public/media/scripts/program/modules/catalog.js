@@ -100,17 +100,27 @@ function updateEmptyCategories() {
     });
 }
 
-var student_grade = esp_user.cur_grade;
-if (student_grade != "" && student_grade != null) {
-    student_grade = parseInt(student_grade);
-    const gradeFilterElem = document.getElementById("grade_filter")
-    if (gradeFilterElem.querySelector(`option[value="${student_grade}"]`)) {
-        gradeFilterElem.value = student_grade
+function selectStudentGrade() {
+    var student_grade = esp_user.cur_grade;
+    if (student_grade != "" && student_grade != null) {
+        student_grade = parseInt(student_grade);
+        const gradeFilterElem = document.getElementById("grade_filter")
+        if (gradeFilterElem.querySelector(`option[value="${student_grade}"]`)) {
+            gradeFilterElem.value = student_grade
+        }
     }
 }
 
+selectStudentGrade()
 applyCurrentFilters()
 
+// The catalog is served cookie-free, so the user's grade may only be known
+// once user_data.js has fetched it.
+$j(document).on("esp_user_refreshed", function () {
+    selectStudentGrade()
+    applyCurrentFilters()
+})
+
 // Set up duration options by finding all unique durations from the classes in the catalog
 const durationFilterElem = document.getElementById("duration_filter");
 let uniqueLengths = [
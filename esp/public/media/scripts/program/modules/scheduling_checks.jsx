@@ -4,7 +4,7 @@ var myInterval;
 $j(function(){
     function refreshAll() {
         if (auto_running) {
-            $j("button.refresh-button").click();
+            $j(document).trigger("refresh-scheduling-checks");
             // Allow for updating fresh interval while the refresh is already running
             myInterval = setTimeout(refreshAll, $j("[name=refresh_interval]").val() * 1000);
         }
@@ -32,6 +32,22 @@ $j(function(){
     });
 });
 
+/**
+ * Load the results of all of the scheduling checks in one request, so that the
+ * server only has to load the schedule once.  Checks which ask for the results
+ * at the same time share the request.
+ */
+var allChecksRequest = null;
+function loadAllChecks(unreviewed) {
+  if (!allChecksRequest) {
+    allChecksRequest = $j.getJSON("scheduling_checks/all" + (unreviewed ? "?unreviewed" : ""));
+    allChecksRequest.always(function () {
+      allChecksRequest = null;
+    });
+  }
+  return allChecksRequest;
+}
+
 /**
  * List of scheduling checks.
  *
@@ -127,13 +143,29 @@ var SchedulingCheck = React.createClass({
       return now.toLocaleTimeString();
   },
 
-  loadData: function () {
+  /**
+   * Load the results of this check.  If all is true, they come from the
+   * request for all of the checks; otherwise, just this check is run.
+   */
+  loadData: function (all) {
     // remove any existing data, so we see a loading thing again
     this.setState({data: undefined});
     this.setState({has_items: false});
     this.setState({timestamp: "loading"});
 
-    $j.get("scheduling_checks/" + this.props.slug)
+    var request;
+    if (all === true) {
+      var name = this.props.slug.split("?")[0];
+      var unreviewed = this.props.slug.indexOf("?unreviewed") != -1;
+      request = loadAllChecks(unreviewed).then(function (data) {
+        var result = data.results[name];
+        // a check which failed on the server has no result
+        return result ? result : $j.Deferred().reject();
+      });
+    } else {
+      request = $j.get("scheduling_checks/" + this.props.slug);
+    }
+    request
     .done(function (data) {
       var data_parse = JSON.parse(data);
       this.setState({
@@ -151,9 +183,18 @@ var SchedulingCheck = React.createClass({
     }.bind(this));
   },
 
+  loadAllData: function () {
+    this.loadData(true);
+  },
+
 /*loads all of the scheduling checks */
   componentDidMount() {
-    this.loadData();
+    this.loadAllData();
+    $j(document).on("refresh-scheduling-checks", this.loadAllData);
+  },
+
+  componentWillUnmount() {
+    $j(document).off("refresh-scheduling-checks", this.loadAllData);
   },
 
   render: function () {